@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Compare the binary encoding of L{twittytwister.binary} with JSON.
+
+Statuses as generated by the fake Twitter server, with a user and
+entities, are encoded and decoded to and from their data as dictionaries,
+with simplejson, with the binary format as encoded in Python, and, if
+installed, with the binary format as encoded with msgpack. Reported are
+the average size of an encoded status, and the encode and decode rates.
+
+With CPython 2.7.18, simplejson 4.2.0 and msgpack 0.6.2, for 20000
+statuses::
+
+    json:            562.0 bytes, encode   70806/s, decode   31850/s
+    binary:          261.7 bytes, encode   31375/s, decode   18761/s
+    binary+msgpack:  447.5 bytes, encode  241887/s, decode   50813/s
+
+Usage: C{PYTHONPATH=. python bench/binary_format.py [statuses]} from the
+top of the source tree, defaulting to 20000 statuses.
+"""
+
+import sys
+import time
+
+import simplejson as json
+
+from twittytwister import binary, fakeserver
+
+def codec(function):
+    """
+    Return a function that calls C{function} without using msgpack.
+    """
+    def call(value):
+        packed, binary.msgpack = binary.msgpack, None
+        try:
+            return function(value)
+        finally:
+            binary.msgpack = packed
+    return call
+
+
+
+def rate(function, items):
+    start = time.time()
+    results = [function(item) for item in items]
+    return len(items) / (time.time() - start), results
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    statuses = [json.loads(json.dumps(fakeserver.makeStatus(i, 1445412480)))
+                for i in xrange(count)]
+
+    print '%d statuses' % (count,)
+    formats = [('json', json.dumps, json.loads),
+               ('binary', codec(binary.encodeDict), codec(binary.decodeDict))]
+    if binary.msgpack is not None:
+        formats.append(('binary+msgpack', binary.encodeDict,
+                        binary.decodeDict))
+    for name, encode, decode in formats:
+        encodeRate, encoded = rate(encode, statuses)
+        decodeRate, decoded = rate(decode, encoded)
+        assert decoded == statuses
+        size = sum(len(data) for data in encoded) / float(count)
+        print '%-15s %6.1f bytes, encode %7.0f/s, decode %7.0f/s' % (
+            name + ':', size, encodeRate, decodeRate)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Compare counting hashtags through platform objects and through flat arrays.
+
+A batch of statuses with a few hashtags, mentions and URLs each is counted
+once by creating L{twittytwister.platform.Status} objects and walking their
+entities, and once with L{twittytwister.entities.extract}. Reported is the
+time per status for finding the top 10 hashtags, and with flat arrays also
+for finding the top 10 hashtags, mentions and URLs, which share the counts.
+
+Usage: C{PYTHONPATH=. python bench/entity_counts.py [statuses]} from the
+top of the source tree, defaulting to 100000 statuses.
+"""
+
+import collections
+import random
+import sys
+import time
+
+from twittytwister import entities, platform
+
+def makeStatuses(count):
+    rng = random.Random(0)
+    statuses = []
+    for i in xrange(count):
+        tags = [u'tag%d' % int(rng.paretovariate(1)) for j in xrange(3)]
+        statuses.append({
+            'id': i,
+            'text': u'Hello',
+            'entities': {
+                'hashtags': [{'text': tag, 'indices': [0, len(tag) + 1]}
+                             for tag in tags],
+                'user_mentions': [{'screen_name': u'user%d' % (i % 1000),
+                                   'id': i % 1000, 'indices': [10, 20]}],
+                'urls': [{'url': 'http://t.co/x',
+                          'expanded_url': 'http://example.org/%d' % i,
+                          'indices': [30, 43]}],
+                },
+            })
+    return statuses
+
+
+
+def viaObjects(statuses):
+    counts = collections.Counter()
+    for data in statuses:
+        status = platform.Status.fromDict(data)
+        for hashtag in status.entities.hashtags:
+            counts[hashtag.text.lower()] += 1
+    return counts.most_common(10)
+
+
+
+def viaArrays(statuses):
+    return entities.extract(statuses).top(10)
+
+
+
+def viaArraysAllKinds(statuses):
+    result = entities.extract(statuses)
+    return [result.top(10, kind) for kind in (entities.HASHTAG,
+                                               entities.MENTION,
+                                               entities.URL)]
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    statuses = makeStatuses(count)
+
+    for name, function in (('platform objects', viaObjects),
+                           ('flat arrays', viaArrays),
+                           ('flat arrays, top of 3 kinds', viaArraysAllKinds)):
+        start = time.time()
+        function(statuses)
+        elapsed = time.time() - start
+        print '%-29s %.2f us per status' % (name + ':', elapsed / count * 1e6)
+
+
+
+if __name__ == '__main__':
+    main()
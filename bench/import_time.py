@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Measure the time it takes to import a module in a fresh interpreter.
+
+Each run times a new Python process, C{python -c 'import <module>'}, from
+the outside, so that nothing is cached in C{sys.modules} and everything
+the import costs, including loading the Twisted modules it pulls in, is
+included. The median time of C{python -c pass} is subtracted as the
+baseline of starting the interpreter. Also lists the modules that are
+only imported where they are used, see L{OPTIONAL}, that were pulled in
+by the import anyway.
+
+Usage: C{PYTHONPATH=. python bench/import_time.py [module [runs]]} from the
+top of the source tree, defaulting to C{twittytwister.twitter} and 20 runs.
+"""
+
+import subprocess
+import sys
+import time
+
+# Modules that twittytwister.twitter imports only where they are used.
+OPTIONAL = ('treq', 'twittytwister.backfill', 'twittytwister.bulk',
+            'twittytwister.hub', 'twittytwister.media',
+            'twittytwister.multipart', 'twittytwister.threaded')
+
+REPORT = """
+import logging, sys
+import %s
+print ' '.join(name for name in %r if name in sys.modules)
+print len(logging.getLogger().handlers)
+"""
+
+def measure(statement):
+    """
+    Return the wall clock time of running a statement in a new process.
+    """
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', statement])
+    return time.time() - start
+
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+
+def main():
+    module = sys.argv[1] if len(sys.argv) > 1 else 'twittytwister.twitter'
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    baseline = median([measure('pass') for i in xrange(runs)])
+    elapsed = median([measure('import %s' % module) for i in xrange(runs)])
+    output = subprocess.check_output([sys.executable, '-c',
+                                      REPORT % (module, OPTIONAL)])
+    modules, handlers = output.splitlines()
+
+    print 'python -c pass: %.1f ms' % (baseline * 1000)
+    print 'python -c "import %s": %.1f ms' % (module, elapsed * 1000)
+    print 'import %s: %.1f ms (median of %d runs)' % (
+            module, (elapsed - baseline) * 1000, runs)
+    print 'optional modules imported: %s' % (modules or 'none')
+    print 'root logger handlers: %s' % handlers
+
+
+
+if __name__ == '__main__':
+    main()
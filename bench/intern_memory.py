@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Measure the memory used by strings of buffered statuses, without and with
+an L{twittytwister.platform.InternPool} or a
+L{twittytwister.platform.UserCache}.
+
+A stream of JSON encoded statuses by a limited number of users is
+replayed, decoded and kept in a buffer, as a long-lived consumer would.
+Reported is the size of all distinct string objects reachable from the
+buffered statuses, and the time per status for decoding.
+
+Usage: C{PYTHONPATH=. python bench/intern_memory.py [statuses [users]]}
+from the top of the source tree, defaulting to 50000 statuses by 2000
+users.
+"""
+
+import random
+import sys
+import time
+
+import simplejson as json
+
+from twittytwister import platform
+
+SOURCES = ['web', '<a href="http://twitter.com/download/iphone" '
+           'rel="nofollow">Twitter for iPhone</a>',
+           '<a href="http://twitter.com/download/android" '
+           'rel="nofollow">Twitter for Android</a>']
+
+def makeStream(count, userCount):
+    rng = random.Random(0)
+    users = []
+    for i in xrange(userCount):
+        users.append({
+            'id': i,
+            'name': 'User %d' % i,
+            'screen_name': 'user%d' % i,
+            'location': rng.choice(['Amsterdam', 'Berlin', 'New York', '']),
+            'description': 'Description of user %d, who tweets a lot.' % i,
+            'profile_image_url': 'http://a0.twimg.com/profile_images/'
+                                 '%d/avatar_normal.png' % i,
+            'profile_background_color': 'C0DEED',
+            'profile_text_color': '333333',
+            'profile_link_color': '0084B4',
+            'created_at': 'Mon Aug 31 13:36:20 +0000 2009',
+            'time_zone': rng.choice(['Amsterdam', 'Pacific Time (US & Canada)']),
+            'lang': rng.choice(['en', 'nl', 'de']),
+            })
+
+    lines = []
+    for i in xrange(count):
+        user = users[int(rng.paretovariate(0.8)) % userCount]
+        lines.append(json.dumps({
+            'id': i,
+            'text': 'Status %d' % i,
+            'source': rng.choice(SOURCES),
+            'lang': user['lang'],
+            'created_at': 'Wed Oct 21 07:28:00 +0000 2015',
+            'user': user,
+            }))
+    return lines
+
+
+
+def stringBytes(objects):
+    seen = set()
+    total = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, basestring) and id(obj) not in seen:
+            seen.add(id(obj))
+            total += sys.getsizeof(obj)
+    return total
+
+
+
+def run(lines, pool, cache):
+    platform.TwitterObject.internPool = pool
+    platform.User.userCache = cache
+    try:
+        start = time.time()
+        buffered = [platform.Status.fromDict(json.loads(line))
+                    for line in lines]
+        elapsed = time.time() - start
+    finally:
+        platform.TwitterObject.internPool = None
+        platform.User.userCache = None
+    return stringBytes(status.raw for status in buffered), elapsed
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    userCount = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    lines = makeStream(count, userCount)
+
+    print '%d statuses by up to %d users' % (count, userCount)
+    for name, pool, cache in (
+            ('neither', None, None),
+            ('intern pool', platform.InternPool(20000), None),
+            ('user cache', None, platform.UserCache(userCount))):
+        size, elapsed = run(lines, pool, cache)
+        print '%-12s %6.1f MB of strings, %.2f us per status' % (
+            name + ':', size / 1e6, elapsed / count * 1e6)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Load test the stream and REST clients against a local fake Twitter server.
+
+A L{twittytwister.fakeserver.FakeTwitterServer} is started in the same
+process. A number of streams are opened to it, each receiving statuses at
+the target rate for a number of seconds, after which the achieved status
+rate, the received bytes and the latency percentiles per stage are
+reported. Then a number of timeline requests is made with a
+L{twittytwister.bulk.BulkExecutor} and their rate is reported.
+
+Client and server share the reactor, so the figures include the cost of
+generating and serving the load. They are meant for comparing changes, not
+as absolute numbers.
+
+Usage: C{PYTHONPATH=. python bench/load.py [rate [seconds [streams
+[requests]]]]} from the top of the source tree, defaulting to 2000 statuses
+per second, 10 seconds, 1 stream and 200 requests.
+"""
+
+import logging
+import sys
+
+from twisted.internet import defer, task
+
+from twittytwister import bulk, fakeserver, latency, metrics
+
+def formatPercentiles(values):
+    return ', '.join('p%d %.2f ms' % (percentile, value * 1000)
+                     for percentile, value in sorted(values.iteritems()))
+
+
+
+@defer.inlineCallbacks
+def streams(reactor, server, rate, seconds, count):
+    server.stream.rate = rate
+    feed = server.feed()
+    feed.metrics = metrics.MemoryMetrics()
+    tracker = latency.LatencyTracker(size=10000)
+    statuses = []
+
+    def onStatus(status):
+        statuses.append(None)
+
+    protocols = []
+    for i in xrange(count):
+        protocol = yield feed.filter(onStatus, {'track': 'twisted'})
+        protocol.latency = tracker
+        protocol.deferred.addErrback(lambda failure: None)
+        protocols.append(protocol)
+
+    start = reactor.seconds()
+    yield task.deferLater(reactor, seconds, lambda: None)
+    elapsed = reactor.seconds() - start
+    for protocol in protocols:
+        protocol.transport.stopProducing()
+
+    counters = feed.metrics.counters
+    print 'streams: %d x %d statuses/s for %.1f s' % (count, rate, elapsed)
+    print '  received %d statuses, %.0f/s, %d bytes' % (
+            len(statuses), len(statuses) / elapsed,
+            counters.get('stream.bytes', 0))
+    for stage, values in sorted(tracker.percentiles().iteritems()):
+        print '  %s: %s' % (stage, formatPercentiles(values))
+    print '  bottleneck: %s' % tracker.bottleneck()
+
+
+
+@defer.inlineCallbacks
+def requests(reactor, server, count):
+    server.rest.rateLimit = count + 1
+    api = server.api()
+    statuses = []
+    executor = bulk.BulkExecutor(api, concurrency=4, reactor=reactor)
+
+    start = reactor.seconds()
+    yield executor.run((api.home_timeline, (statuses.append,
+                                            {'count': '20'}))
+                       for i in xrange(count))
+    elapsed = reactor.seconds() - start
+
+    print 'requests: %d timelines in %.2f s, %.0f/s' % (
+            executor.succeeded, elapsed, executor.succeeded / elapsed)
+    print '  %d failed, %d statuses parsed' % (executor.failed,
+                                                len(statuses))
+
+
+
+@defer.inlineCallbacks
+def main(reactor, rate=2000, seconds=10, count=1, requestCount=200):
+    server = fakeserver.FakeTwitterServer()
+    server.start()
+    try:
+        yield streams(reactor, server, int(rate), float(seconds), int(count))
+        yield requests(reactor, server, int(requestCount))
+    finally:
+        yield server.stop()
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Compare the cost of per-stream timeout timers with a shared watchdog.
+
+A number of streams receive keep-alive chunks in turn, once with a timer
+per stream that is reset on each chunk and once with a shared
+L{twittytwister.streaming.Watchdog}. Reported is the time per chunk,
+including the reactor's processing of timed calls between rounds of chunks.
+
+Usage: C{PYTHONPATH=. python bench/stream_timeouts.py [streams [rounds]]}
+from the top of the source tree, defaulting to 500 streams and 200 rounds.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.test import proto_helpers
+
+from twittytwister import streaming
+
+def run(streamCount, rounds, watchdog):
+    protocols = []
+    for i in xrange(streamCount):
+        protocol = streaming.TwitterStream(lambda entry: None,
+                                           watchdog=watchdog)
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocols.append(protocol)
+
+    start = time.time()
+    for i in xrange(rounds):
+        for protocol in protocols:
+            protocol.dataReceived('\r\n')
+        reactor.runUntilCurrent()
+    elapsed = time.time() - start
+
+    for protocol in protocols:
+        protocol.setTimeout(None)
+    return elapsed / (streamCount * rounds)
+
+
+
+def main():
+    streamCount = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    timers = run(streamCount, rounds, None)
+    shared = run(streamCount, rounds, streaming.Watchdog())
+    print '%d streams, %d chunks each' % (streamCount, rounds)
+    print 'timer per stream: %.2f us per chunk' % (timers * 1e6)
+    print 'shared watchdog:  %.2f us per chunk' % (shared * 1e6)
+
+
+
+if __name__ == '__main__':
+    main()
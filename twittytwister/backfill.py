@@ -0,0 +1,234 @@
+# -*- test-case-name: twittytwister.test.test_backfill -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Backfill of statuses missed while a stream was reconnecting.
+
+Statuses sent while a L{twittytwister.twitter.TwitterMonitor} is
+reconnecting are not delivered by the new connection. With a checkpoint
+(see L{twittytwister.checkpoint}), the monitor remembers the ID of the last
+status it delivered. With a backfill strategy from this module, it fetches
+the statuses since then after reconnecting, and merges them with the live
+statuses, dropping duplicates::
+
+    monitor = TwitterMonitor(feed.filter, delegate, args,
+                             checkpoint=JSONFileCheckpoint('stream.json'),
+                             backfill=TimelineBackfill(api.home_timeline))
+
+L{CountBackfill} uses the C{count} parameter of the Streaming API, which
+replays recent statuses at the start of a connection, if the access level
+allows it. L{TimelineBackfill} pages through a REST timeline instead, and
+converts the statuses to L{twittytwister.platform.Status}, like the ones
+of the stream.
+
+Backfill strategies have two methods: C{args}, returning extra arguments
+for the stream request, and C{fetch}, fetching the missed statuses.
+"""
+
+from collections import deque
+
+from twisted.internet import defer
+
+from twittytwister import platform, txml
+
+# Properties of REST XML statuses and users that are numbers or booleans.
+_integerProps = frozenset(['id', 'in_reply_to_status_id',
+                           'in_reply_to_user_id', 'user_id',
+                           'followers_count', 'friends_count',
+                           'favourites_count', 'statuses_count',
+                           'utc_offset'])
+_booleanProps = frozenset(['truncated', 'favorited', 'protected',
+                           'following', 'notifications',
+                           'profile_background_tile', 'verified',
+                           'geo_enabled'])
+
+def entryID(entry):
+    """
+    Return the ID of an entry as an integer, or C{None} if it has none.
+    """
+    try:
+        return int(entry.id)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+
+def _xmlToDict(handler):
+    """
+    Convert an object parsed by L{twittytwister.txml} to a dictionary in the
+    form of the JSON APIs.
+    """
+    data = {}
+    for name in handler.SIMPLE_PROPS:
+        value = getattr(handler, handler.cleanup(name), None)
+        if value is None:
+            continue
+        if name in _integerProps:
+            try:
+                value = int(value)
+            except ValueError:
+                value = None
+        elif name in _booleanProps:
+            value = (value == 'true')
+        data[name] = value
+
+    for prop in handler.COMPLEX_PROPS:
+        value = getattr(handler, prop.MY_TAG, None)
+        if value is not None:
+            data[prop.MY_TAG] = _xmlToDict(value)
+    return data
+
+
+
+def toStatus(entry):
+    """
+    Convert a status parsed from a REST XML response to a
+    L{twittytwister.platform.Status}.
+
+    Other entries are returned as is.
+    """
+    if isinstance(entry, txml.Status):
+        return platform.Status.fromDict(_xmlToDict(entry))
+    return entry
+
+
+
+class RecentIDs(object):
+    """
+    Bounded set of recently seen IDs, for dropping duplicates.
+
+    When full, the oldest IDs are forgotten first.
+
+    @ivar size: Maximum number of IDs remembered.
+    @type size: C{int}
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._ids = set()
+        self._order = deque()
+
+
+    def __len__(self):
+        return len(self._ids)
+
+
+    def __contains__(self, itemID):
+        return itemID in self._ids
+
+
+    def add(self, itemID):
+        """
+        Add an ID.
+
+        @return: Whether the ID was new.
+        @rtype: C{bool}
+        """
+        if itemID in self._ids:
+            return False
+
+        self._ids.add(itemID)
+        self._order.append(itemID)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+        return True
+
+
+
+class CountBackfill(object):
+    """
+    Backfill using the C{count} parameter of the Streaming API.
+
+    On reconnect, up to C{count} recent statuses are replayed by the stream
+    itself, before the live statuses. This requires elevated access.
+
+    @ivar count: Number of statuses to replay.
+    @type count: C{int}
+    """
+
+    def __init__(self, count=1000):
+        self.count = count
+
+
+    def args(self, lastID):
+        """
+        Return extra arguments for the stream request.
+
+        @param lastID: ID of the last delivered status.
+        @type lastID: C{int}
+
+        @rtype: C{dict}
+        """
+        return {'count': str(self.count)}
+
+
+    def fetch(self, lastID, deliver):
+        """
+        Fetch the statuses since C{lastID}, once connected.
+
+        @param deliver: Called with each status, oldest first.
+
+        @return: Deferred that fires when all statuses have been delivered.
+        """
+        return defer.succeed(None)
+
+
+
+class TimelineBackfill(object):
+    """
+    Backfill from a REST timeline.
+
+    Pages of the timeline newer than the checkpoint are fetched, newest
+    first, using C{max_id} to page back. The statuses are delivered oldest
+    first, once all pages have been fetched, converted with L{toStatus}.
+
+    @ivar method: REST API method to fetch the timeline with. This is called
+        with a delegate and the request parameters as C{params}, e.g.
+        L{twittytwister.twitter.Twitter.home_timeline}. Bind other arguments
+        up front, e.g. with C{functools.partial(api.list_timeline, user=user,
+        list_name=name)}.
+
+    @ivar count: Number of statuses per page.
+    @type count: C{int}
+
+    @ivar maxPages: Maximum number of pages to fetch.
+    @type maxPages: C{int}
+    """
+
+    def __init__(self, method, count=200, maxPages=16):
+        self.method = method
+        self.count = count
+        self.maxPages = maxPages
+
+
+    def args(self, lastID):
+        return {}
+
+
+    @defer.inlineCallbacks
+    def fetch(self, lastID, deliver):
+        collected = []
+        maxID = None
+        for page in xrange(self.maxPages):
+            params = {'since_id': str(lastID), 'count': str(self.count)}
+            if maxID is not None:
+                params['max_id'] = str(maxID)
+            items = []
+            yield self.method(items.append, params=params)
+
+            ids = []
+            for item in items:
+                itemID = entryID(item)
+                if itemID is not None and itemID > lastID:
+                    collected.append((itemID, item))
+                    ids.append(itemID)
+
+            if len(items) < self.count or not ids:
+                break
+            maxID = min(ids) - 1
+
+        collected.sort()
+        for itemID, item in collected:
+            deliver(toStatus(item))
@@ -0,0 +1,214 @@
+# -*- test-case-name: twittytwister.test.test_backoff -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Back-off strategies for reconnecting streams.
+
+A strategy computes the delay before the next reconnect attempt, from the
+back-off settings of an error state of
+L{twittytwister.twitter.TwitterMonitor} (a dictionary with C{'initial'},
+C{'max'} and C{'factor'}), the number of the attempt in that error state,
+the previous delay and the failure that caused the reconnect. Strategies are
+configured with the C{'strategy'} key of an entry in
+L{TwitterMonitor.backOffs<twittytwister.twitter.TwitterMonitor.backOffs>},
+and default to L{Exponential}.
+
+When many monitors lose their connection at the same time, deterministic
+delays make them reconnect in lockstep, which gets them rate limited. The
+jittered strategies spread reconnects out over time, see
+U{http://www.awsarchitectureblog.com/2015/03/backoff.html}. A
+L{ReconnectBudget} shared by all monitors in a process additionally bounds
+the rate of reconnects::
+
+    TwitterMonitor.reconnectBudget = ReconnectBudget(rate=2, burst=10)
+"""
+
+import math
+import random
+import time
+
+from twisted.web import http
+
+class Exponential(object):
+    """
+    Exponential back-off without jitter.
+
+    The first delay is C{initial}, multiplied by C{factor} on each following
+    attempt, up to C{max}.
+    """
+
+    def nextDelay(self, backOff, attempt, previous, reason):
+        """
+        Return the delay before the next reconnect attempt.
+
+        @param backOff: Back-off settings of the error state.
+        @type backOff: C{dict}
+
+        @param attempt: Number of the attempt in this error state, starting
+            at 0.
+        @type attempt: C{int}
+
+        @param previous: The previous delay in this error state, C{None} for
+            the first attempt.
+        @type previous: C{float}
+
+        @param reason: The failure that caused the reconnect, or C{None} for
+            clean disconnects.
+        @type reason: L{twisted.python.failure.Failure}
+
+        @return: The delay, in seconds.
+        @rtype: C{float}
+        """
+        if previous is None:
+            return backOff['initial']
+        return min(backOff['max'], previous * backOff['factor'])
+
+
+
+class FullJitter(object):
+    """
+    Exponential back-off with full jitter.
+
+    The delay is random, between 0 and the exponential delay of the attempt.
+    This spreads reconnects out the most, but reconnects may be immediate.
+    """
+
+    def __init__(self, random=random.random):
+        self.random = random
+
+
+    def nextDelay(self, backOff, attempt, previous, reason):
+        initial = backOff['initial']
+        factor = backOff['factor']
+        ceiling = backOff['max']
+        if factor <= 1 or initial <= 0:
+            ceiling = min(ceiling, initial * factor ** attempt)
+        elif (initial < ceiling and
+              attempt < math.log(ceiling / float(initial), factor)):
+            # Only compute the power below the cap, it overflows for the
+            # attempts of long outages.
+            ceiling = initial * factor ** attempt
+        return self.random() * ceiling
+
+
+
+class DecorrelatedJitter(object):
+    """
+    Decorrelated jitter.
+
+    The delay is random, between C{initial} and three times the previous
+    delay, up to C{max}. Delays grow with the attempts as with exponential
+    back-off, but never drop below C{initial}.
+    """
+
+    def __init__(self, random=random.random):
+        self.random = random
+
+
+    def nextDelay(self, backOff, attempt, previous, reason):
+        initial = backOff['initial']
+        if previous is None:
+            return initial
+        upper = max(previous * 3, initial)
+        return min(backOff['max'],
+                   initial + self.random() * (upper - initial))
+
+
+
+def parseRetryAfter(value, now=None):
+    """
+    Parse the value of a C{Retry-After} header.
+
+    @param value: Number of seconds or an HTTP date.
+    @type value: C{str}
+
+    @param now: The current time, to compute the delay until a date.
+        Defaults to the current time.
+
+    @return: The delay in seconds, or C{None} if the value is invalid.
+    @rtype: C{float}
+    """
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        when = http.stringToDatetime(value)
+    except (ValueError, IndexError, KeyError):
+        return None
+    if now is None:
+        now = time.time()
+    return max(when - now, 0)
+
+
+
+class RetryAfter(object):
+    """
+    Back-off that honours the C{Retry-After} of rate limit responses.
+
+    If the exception of the failure has a C{retryAfter} attribute that is
+    not C{None}, like L{twittytwister.twitter.RateLimitError}, that is the
+    delay. Otherwise the delay is computed by the fallback strategy.
+    """
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or DecorrelatedJitter()
+
+
+    def nextDelay(self, backOff, attempt, previous, reason):
+        retryAfter = None
+        if reason is not None:
+            retryAfter = getattr(reason.value, 'retryAfter', None)
+        if retryAfter is not None:
+            return max(retryAfter, 0)
+        return self.fallback.nextDelay(backOff, attempt, previous, reason)
+
+
+
+class ReconnectBudget(object):
+    """
+    Bound on the rate of reconnects, shared by several monitors.
+
+    Reconnects are scheduled no earlier than their back-off delay, but also
+    no earlier than the budget allows: on average C{rate} reconnects per
+    second, with up to C{burst} reconnects at once. This is the generic cell
+    rate algorithm, so that no timers are needed.
+
+    @ivar rate: Average number of reconnects per second.
+    @type rate: C{float}
+
+    @ivar burst: Maximum number of reconnects at the same time.
+    @type burst: C{int}
+    """
+
+    def __init__(self, rate=1, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self._theoreticalArrival = None
+
+
+    def reserve(self, now, delay):
+        """
+        Reserve a reconnect.
+
+        @param now: The current time, in seconds.
+        @type now: C{float}
+
+        @param delay: The back-off delay, in seconds.
+        @type delay: C{float}
+
+        @return: The delay until the reserved reconnect, at least C{delay}.
+        @rtype: C{float}
+        """
+        interval = 1.0 / self.rate
+        tolerance = (self.burst - 1) * interval
+        wanted = now + delay
+        arrival = self._theoreticalArrival
+        if arrival is None or arrival < wanted:
+            arrival = wanted
+        when = max(wanted, arrival - tolerance)
+        self._theoreticalArrival = arrival + interval
+        return when - now
@@ -0,0 +1,440 @@
+# -*- test-case-name: twittytwister.test.test_binary -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Compact binary encoding of platform objects.
+
+Statuses passed between processes or persisted as JSON repeat every key of
+every object, and numbers are written out in decimal. This module encodes
+the data of a platform object (see
+L{twittytwister.platform.TwitterObject.toDict}) in a binary format
+instead:
+
+ - Values are prefixed by a type byte. Integers and lengths are encoded as
+   variable length integers, floats as 8 bytes.
+ - Keys that are properties of the platform object class that the
+   enclosing dictionary represents are encoded as a field tag, the index of
+   the property in the sorted properties of that class. Other keys are
+   written out once per message, and refer back to that after.
+ - Strings keep their type, C{str} or C{unicode}, as decoded from JSON.
+
+As the field tags depend on the properties of the platform object classes,
+each message starts with a format version and a fingerprint of the
+properties. Decoding a message encoded with other properties raises
+L{SchemaError}.
+
+The encoder above is written in Python, and is slower than C{simplejson}.
+If C{msgpack} is installed, messages are encoded with that instead, with
+the keys written out, as format version L{PACKED_VERSION}. Those messages
+are larger, but encoded and decoded several times faster. Data that
+C{msgpack} cannot encode, like integers of more than 64 bits, is still
+encoded with the encoder above. Both formats are decoded, but decoding
+messages of format version L{PACKED_VERSION} without C{msgpack} raises
+L{SchemaError}.
+
+Messages can be framed like the Streaming API, with a line with the length
+in decimal before each message. L{FrameWriter} writes frames,
+L{BinaryStream} is a protocol that decodes them, and L{readFrames} reads
+frames from a file::
+
+    writer = FrameWriter(f.write)
+    monitor = TwitterMonitor(feed.filter, writer.write, args)
+"""
+
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from twittytwister import platform
+from twittytwister.streaming import LengthDelimitedStream
+
+VERSION = 1
+PACKED_VERSION = 2
+
+NONE, FALSE, TRUE, INT, NEGATIVE, FLOAT, STR, UNICODE, LIST, DICT = range(10)
+
+_DOUBLE = struct.Struct('>d')
+_HEADER = struct.Struct('>BI')
+
+class SchemaError(ValueError):
+    """
+    The message was encoded with another version or other properties.
+    """
+
+
+
+class _Schema(object):
+    """
+    Field tags of a platform object class.
+
+    Classes have fewer than 128 properties, so that tags fit in one byte.
+
+    @ivar names: Property names by tag, starting at tag 1.
+    @ivar tags: Tags by property name.
+    @ivar children: Class of the value of complex and list properties, by
+        property name.
+    """
+
+    def __init__(self, cls):
+        self.names = [None]
+        self.tags = {}
+        self.children = {}
+        for name, kind in cls._fields():
+            self.tags[name] = len(self.names)
+            self.names.append(name)
+            if kind == platform.COMPLEX:
+                self.children[name] = cls.COMPLEX_PROPS[name]
+            elif kind == platform.LIST:
+                self.children[name] = cls.LIST_PROPS[name]
+        self.size = len(self.names) - 1
+        if self.size >= 0x80:
+            raise ValueError("Too many properties in %s" % (cls.__name__,))
+
+
+
+_schemas = {}
+
+def _schema(cls):
+    if cls is None:
+        return None
+    try:
+        return _schemas[cls]
+    except KeyError:
+        schema = _schemas[cls] = _Schema(cls)
+        return schema
+
+
+
+_fingerprints = {}
+
+def fingerprint(cls):
+    """
+    Return the fingerprint of the properties of a class and its children.
+
+    @rtype: C{int}
+    """
+    try:
+        return _fingerprints[cls]
+    except KeyError:
+        pass
+
+    seen = set()
+    pending = [cls]
+    parts = []
+    while pending:
+        current = pending.pop(0)
+        if current in seen:
+            continue
+        seen.add(current)
+        schema = _schema(current)
+        parts.append('%s:%s' % (current.__name__, ','.join(schema.names[1:])))
+        pending.extend(schema.children[name]
+                       for name in schema.names[1:]
+                       if name in schema.children)
+    result = _fingerprints[cls] = zlib.crc32(';'.join(parts)) & 0xffffffff
+    return result
+
+
+
+def _writeVarint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+
+def _encodeValue(out, value, cls, keys):
+    kind = type(value)
+    if value is None:
+        out.append(NONE)
+    elif kind is bool:
+        out.append(TRUE if value else FALSE)
+    elif kind is int or kind is long:
+        if value >= 0:
+            out.append(INT)
+            if value < 0x80:
+                out.append(value)
+            else:
+                _writeVarint(out, value)
+        else:
+            out.append(NEGATIVE)
+            _writeVarint(out, -value - 1)
+    elif kind is str or kind is unicode:
+        if kind is unicode:
+            value = value.encode('utf-8')
+            out.append(UNICODE)
+        else:
+            out.append(STR)
+        length = len(value)
+        if length < 0x80:
+            out.append(length)
+        else:
+            _writeVarint(out, length)
+        out.extend(value)
+    elif kind is dict:
+        out.append(DICT)
+        _writeVarint(out, len(value))
+        schema = _schema(cls)
+        if schema is None:
+            tags = children = {}
+            size = 0
+        else:
+            tags, children, size = schema.tags, schema.children, schema.size
+        for key, item in value.iteritems():
+            tag = tags.get(key)
+            if tag is None:
+                index = keys.get(key)
+                if index is None:
+                    keys[key] = len(keys)
+                    out.append(0)
+                    _encodeValue(out, key, None, keys)
+                else:
+                    _writeVarint(out, size + 1 + index)
+            else:
+                out.append(tag)
+            _encodeValue(out, item, children.get(key), keys)
+    elif kind is list or kind is tuple:
+        out.append(LIST)
+        _writeVarint(out, len(value))
+        for item in value:
+            _encodeValue(out, item, cls, keys)
+    elif kind is float:
+        out.append(FLOAT)
+        out.extend(_DOUBLE.pack(value))
+    else:
+        raise TypeError("Cannot encode %r" % (value,))
+
+
+
+def encodeDict(data, cls=platform.Status):
+    """
+    Encode the data of a platform object.
+
+    @param data: The data, as decoded from JSON.
+    @type data: C{dict}
+
+    @param cls: The platform object class the data represents.
+
+    @rtype: C{str}
+    """
+    if msgpack is not None:
+        try:
+            packed = msgpack.packb(data, use_bin_type=True)
+        except OverflowError:
+            pass
+        else:
+            return _HEADER.pack(PACKED_VERSION, fingerprint(cls)) + packed
+
+    out = bytearray(_HEADER.pack(VERSION, fingerprint(cls)))
+    _encodeValue(out, data, cls, {})
+    return str(out)
+
+
+
+def encode(obj):
+    """
+    Encode a platform object.
+
+    @type obj: L{twittytwister.platform.TwitterObject}
+    @rtype: C{str}
+    """
+    return encodeDict(obj.toDict(), obj.__class__)
+
+
+
+def _decodeValue(data, buffer, position, cls, keys):
+    """
+    Decode the value at C{position}.
+
+    @return: The value and the position after it.
+    """
+    kind = buffer[position]
+    position += 1
+    if kind == STR or kind == UNICODE:
+        length = buffer[position]
+        position += 1
+        if length & 0x80:
+            length, position = _readVarint(buffer, position - 1)
+        end = position + length
+        if kind == UNICODE:
+            return data[position:end].decode('utf-8'), end
+        return data[position:end], end
+    elif kind == INT:
+        value = buffer[position]
+        if value & 0x80:
+            return _readVarint(buffer, position)
+        return value, position + 1
+    elif kind == DICT:
+        count, position = _readVarint(buffer, position)
+        schema = _schemas.get(cls) or _schema(cls)
+        if schema is None:
+            names, children, size = (None,), {}, 0
+        else:
+            names, children, size = (schema.names, schema.children,
+                                     schema.size)
+        result = {}
+        for i in xrange(count):
+            tag = buffer[position]
+            position += 1
+            if tag & 0x80:
+                tag, position = _readVarint(buffer, position - 1)
+            if tag == 0:
+                key, position = _decodeValue(data, buffer, position, None,
+                                             keys)
+                keys.append(key)
+            elif tag <= size:
+                key = names[tag]
+            else:
+                key = keys[tag - size - 1]
+            result[key], position = _decodeValue(data, buffer, position,
+                                                 children.get(key), keys)
+        return result, position
+    elif kind == LIST:
+        count, position = _readVarint(buffer, position)
+        result = []
+        for i in xrange(count):
+            value, position = _decodeValue(data, buffer, position, cls, keys)
+            result.append(value)
+        return result, position
+    elif kind == NONE:
+        return None, position
+    elif kind == FALSE:
+        return False, position
+    elif kind == TRUE:
+        return True, position
+    elif kind == NEGATIVE:
+        value, position = _readVarint(buffer, position)
+        return -value - 1, position
+    elif kind == FLOAT:
+        return _DOUBLE.unpack_from(data, position)[0], position + 8
+    else:
+        raise ValueError("Unknown type %d at %d" % (kind, position - 1))
+
+
+
+def _readVarint(buffer, position):
+    byte = buffer[position]
+    position += 1
+    value = byte & 0x7f
+    shift = 7
+    while byte & 0x80:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+    return value, position
+
+
+
+def decodeDict(data, cls=platform.Status):
+    """
+    Decode the data of a platform object.
+
+    @param data: The encoded message.
+    @type data: C{str}
+
+    @param cls: The platform object class the data represents.
+
+    @raises SchemaError: If the message was encoded with another format
+        version or other properties.
+
+    @rtype: C{dict}
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("Message too short")
+    version, messageFingerprint = _HEADER.unpack_from(data)
+    if version == PACKED_VERSION:
+        if msgpack is None:
+            raise SchemaError("Decoding format version %d requires msgpack" %
+                              (version,))
+    elif version != VERSION:
+        raise SchemaError("Unsupported format version %d" % (version,))
+    if messageFingerprint != fingerprint(cls):
+        raise SchemaError("Message was encoded with other %s properties" %
+                          (cls.__name__,))
+
+    if version == PACKED_VERSION:
+        return msgpack.unpackb(data[_HEADER.size:], raw=False)
+
+    value, position = _decodeValue(data, bytearray(data), _HEADER.size, cls,
+                                   [])
+    return value
+
+
+
+def decode(data, cls=platform.Status):
+    """
+    Decode a platform object.
+
+    @rtype: L{twittytwister.platform.TwitterObject}
+    """
+    return cls.fromDict(decodeDict(data, cls))
+
+
+
+class FrameWriter(object):
+    """
+    Writer of encoded platform objects as length delimited frames.
+
+    @ivar writeData: Called with the data of each frame, e.g. the C{write}
+        method of a file or transport.
+    """
+
+    def __init__(self, writeData):
+        self.writeData = writeData
+
+
+    def write(self, obj):
+        """
+        Encode and write a platform object.
+        """
+        data = encode(obj)
+        self.writeData('%d\r\n%s' % (len(data), data))
+
+
+
+def readFrames(f, cls=platform.Status):
+    """
+    Read platform objects from the frames in a file.
+
+    @return: Iterator over the decoded objects.
+    """
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        line = line.strip()
+        if not line:
+            continue
+        length = int(line)
+        data = f.read(length)
+        if len(data) < length:
+            raise ValueError("Truncated frame")
+        yield decode(data, cls)
+
+
+
+class BinaryStream(LengthDelimitedStream):
+    """
+    Protocol that decodes framed binary platform objects.
+
+    @ivar callback: Called with each decoded object.
+
+    @ivar cls: The platform object class of the objects.
+    """
+
+    def __init__(self, callback, cls=platform.Status):
+        LengthDelimitedStream.__init__(self)
+        self.callback = callback
+        self.cls = cls
+
+
+    def datagramReceived(self, data):
+        self.callback(decode(data, self.cls))
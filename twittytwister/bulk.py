@@ -0,0 +1,338 @@
+# -*- test-case-name: twittytwister.test.test_bulk -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Bulk execution of REST API operations with bounded concurrency.
+"""
+
+import random
+import urlparse
+
+from twisted.internet import defer
+from twisted.internet import error as ierror
+from twisted.python import log
+from twisted.web import error
+
+class Operation(object):
+    """
+    A single operation of a bulk job.
+
+    @ivar method: The API method to call, e.g.
+        L{twittytwister.twitter.Twitter.follow_user}.
+
+    @ivar args: Positional arguments to C{method}.
+    @type args: C{tuple}
+
+    @ivar kwargs: Keyword arguments to C{method}.
+    @type kwargs: C{dict}
+
+    @ivar attempts: Number of attempts made so far.
+    @type attempts: C{int}
+    """
+
+    def __init__(self, method, args=(), kwargs=None):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.attempts = 0
+
+
+    def __call__(self):
+        return self.method(*self.args, **self.kwargs)
+
+
+    def __repr__(self):
+        return "Operation(%r, %r, %r)" % (self.method, self.args, self.kwargs)
+
+
+
+class BulkExecutor(object):
+    """
+    Run many REST API operations with bounded concurrency.
+
+    Operations are taken from an iterable lazily, so that very large jobs
+    don't need to be materialized up front. At most C{concurrency}
+    operations run concurrently against any one host. Before each
+    operation, the rate limit state of the API, as tracked by
+    L{twittytwister.twitter.Twitter.gotHeaders}, is checked. Each running
+    operation reserves one of the calls left in the current window of its
+    host, so that concurrent operations don't exceed it. If no calls are
+    left, operations wait until the window is reset.
+
+    Operations that fail with a transient error (see L{isTransient}) are
+    retried up to L{maxRetries} times, with an exponential back-off delay
+    with full jitter. For rate limit errors with a C{Retry-After} delay, like
+    L{twittytwister.twitter.RateLimitError}, that delay is used instead.
+
+    @ivar api: The API object used for rate limit information.
+    @type api: L{twittytwister.twitter.Twitter}
+
+    @ivar resultDelegate: Called with the operation and its result for each
+        succeeded operation.
+
+    @ivar failureDelegate: Called with the operation and the failure for each
+        operation that failed permanently. If not set, failures are logged.
+
+    @ivar progressDelegate: Called with this executor after each finished
+        operation.
+
+    @ivar concurrency: Maximum number of concurrent operations per host.
+    @type concurrency: C{int}
+
+    @ivar workers: Number of operations taken from the iterable at a time.
+        Defaults to C{concurrency}. Raise it for jobs spanning several hosts.
+    @type workers: C{int}
+
+    @ivar succeeded: Number of succeeded operations.
+    @ivar failed: Number of permanently failed operations.
+    @ivar retried: Number of retries.
+    @ivar running: Number of operations currently in progress.
+    """
+
+    maxRetries = 3
+    retryDelay = 1
+    maxRetryDelay = 60
+
+    transientErrors = (ierror.ConnectError,
+                       ierror.TimeoutError,
+                       ierror.ConnectionLost,
+                       ierror.DNSLookupError,
+                       )
+    transientStatus = frozenset(['420', '429', '500', '502', '503', '504'])
+
+    def __init__(self, api=None, concurrency=4, resultDelegate=None,
+                 failureDelegate=None, progressDelegate=None, workers=None,
+                 reactor=None, random=random.random):
+        self.api = api
+        self.concurrency = concurrency
+        self.workers = workers
+        self.resultDelegate = resultDelegate
+        self.failureDelegate = failureDelegate
+        self.progressDelegate = progressDelegate
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.random = random
+
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.running = 0
+        self.startTime = None
+
+        self._semaphores = {}
+        self._reserved = {}
+
+
+    def run(self, operations):
+        """
+        Run operations.
+
+        @param operations: Iterable of operations. Each operation is an
+            L{Operation}, a tuple of C{(method, args, kwargs)} or a callable
+            without arguments returning a deferred.
+
+        @return: Deferred that fires with this executor when all operations
+            have finished.
+        """
+        self.startTime = self.reactor.seconds()
+        iterator = iter(operations)
+        finished = defer.Deferred()
+        self._workers = 0
+
+        def stopWorker():
+            self._workers -= 1
+            if not self._workers:
+                finished.callback(self)
+
+        def work(_=None):
+            # Loop instead of recursing for operations that finish right
+            # away, to not exhaust the stack on large jobs.
+            while True:
+                try:
+                    operation = iterator.next()
+                except StopIteration:
+                    stopWorker()
+                    return
+                except:
+                    log.err(None, "Getting next operation failed")
+                    stopWorker()
+                    return
+
+                # A deferred waiting on a chained deferred is also called,
+                # so record if it actually has a result.
+                d = self._execute(self._makeOperation(operation))
+                done = []
+                d.addBoth(done.append)
+                if not done:
+                    d.addCallback(work)
+                    return
+
+        self._workers = self.workers or self.concurrency
+        for i in xrange(self._workers):
+            work()
+
+        return finished
+
+
+    def progress(self):
+        """
+        Return progress metrics.
+
+        @return: Dictionary with the number of succeeded, failed, retried
+            and running operations, the elapsed time in seconds and the rate
+            of finished operations per second.
+        @rtype: C{dict}
+        """
+        if self.startTime is None:
+            elapsed = 0
+        else:
+            elapsed = self.reactor.seconds() - self.startTime
+        done = self.succeeded + self.failed
+        if elapsed > 0:
+            rate = done / elapsed
+        else:
+            rate = 0.
+        return {'succeeded': self.succeeded,
+                'failed': self.failed,
+                'retried': self.retried,
+                'running': self.running,
+                'elapsed': elapsed,
+                'rate': rate}
+
+
+    def isTransient(self, failure):
+        """
+        Check if a failure is transient, so that a retry might succeed.
+
+        Network errors and HTTP errors for rate limiting or server side
+        errors are considered transient.
+        """
+        if failure.check(*self.transientErrors):
+            return True
+        elif failure.check(error.Error):
+            return failure.value.status in self.transientStatus
+        else:
+            return False
+
+
+    def _makeOperation(self, operation):
+        if isinstance(operation, Operation):
+            return operation
+        elif isinstance(operation, tuple):
+            return Operation(*operation)
+        else:
+            return Operation(operation)
+
+
+    def _hostFor(self, operation):
+        """
+        Return the host an operation talks to, or C{None} if unknown.
+        """
+        api = getattr(operation.method, 'im_self', None)
+        baseURL = getattr(api, 'base_url', None)
+        if baseURL:
+            return urlparse.urlparse(baseURL)[1]
+        else:
+            return None
+
+
+    def _semaphoreFor(self, host):
+        """
+        Return the semaphore of a host.
+        """
+        if host not in self._semaphores:
+            self._semaphores[host] = defer.DeferredSemaphore(self.concurrency)
+        return self._semaphores[host]
+
+
+    def _rateLimitDelay(self, host):
+        """
+        Return the delay until the rate limit window is reset, if all calls
+        left in it are reserved by running operations on the host.
+        """
+        remaining = getattr(self.api, 'rate_limit_remaining', None)
+        reset = getattr(self.api, 'rate_limit_reset', None)
+        if remaining is None or reset is None:
+            return 0
+        delay = reset - self.reactor.seconds()
+        if delay <= 0 or remaining > self._reserved.get(host, 0):
+            return 0
+        return delay
+
+
+    def _sleep(self, delay):
+        d = defer.Deferred()
+        self.reactor.callLater(delay, d.callback, None)
+        return d
+
+
+    def _execute(self, operation):
+        """
+        Execute an operation, retrying on transient errors.
+        """
+        host = self._hostFor(operation)
+        semaphore = self._semaphoreFor(host)
+
+        def attempt(_=None):
+            delay = self._rateLimitDelay(host)
+            if delay:
+                return self._sleep(delay).addCallback(attempt)
+
+            operation.attempts += 1
+            self.running += 1
+            self._reserved[host] = self._reserved.get(host, 0) + 1
+            d = defer.maybeDeferred(operation)
+            d.addBoth(done)
+            return d
+
+        def done(result):
+            # By now, the rate limit state reflects the call.
+            self.running -= 1
+            self._reserved[host] -= 1
+            return result
+
+        def retry(failure):
+            if (operation.attempts > self.maxRetries or
+                not self.isTransient(failure)):
+                return failure
+
+            self.retried += 1
+            delay = getattr(failure.value, 'retryAfter', None)
+            if delay is None:
+                backOff = min(self.maxRetryDelay,
+                              self.retryDelay * 2 ** (operation.attempts - 1))
+                delay = self.random() * backOff
+            d = self._sleep(delay)
+            d.addCallback(attempt)
+            d.addErrback(retry)
+            return d
+
+        def succeeded(result):
+            self.succeeded += 1
+            if self.resultDelegate is not None:
+                self.resultDelegate(operation, result)
+
+        def failed(reason):
+            self.failed += 1
+            if self.failureDelegate is not None:
+                self.failureDelegate(operation, reason)
+            else:
+                log.err(reason, "Operation %r failed" % (operation,))
+
+        def progress(_):
+            if self.progressDelegate is not None:
+                self.progressDelegate(self)
+
+        def run():
+            d = attempt()
+            d.addErrback(retry)
+            d.addCallbacks(succeeded, failed)
+            d.addErrback(log.err)
+            d.addCallback(progress)
+            d.addErrback(log.err)
+            return d
+
+        return semaphore.run(run)
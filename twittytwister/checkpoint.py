@@ -0,0 +1,77 @@
+# -*- test-case-name: twittytwister.test.test_checkpoint -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Persistent checkpoints for resumable Twitter consumers.
+"""
+
+import os
+
+import simplejson as json
+
+from twisted.python import log
+
+class JSONFileCheckpoint(object):
+    """
+    Checkpoint stored as a JSON encoded dictionary in a local file.
+
+    Saving writes to a temporary file first, which is then renamed over the
+    previous checkpoint. This makes sure a crash while saving never leaves a
+    truncated checkpoint behind.
+
+    @ivar path: Path of the checkpoint file.
+    @type path: C{str}
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def load(self):
+        """
+        Load the checkpoint.
+
+        A missing or unreadable checkpoint results in an empty state, the
+        latter is logged.
+
+        @rtype: C{dict}
+        """
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return {}
+
+        try:
+            try:
+                state = json.load(f)
+            except ValueError:
+                log.err(None, "Invalid checkpoint in %r" % (self.path,))
+                return {}
+        finally:
+            f.close()
+
+        if not isinstance(state, dict):
+            log.msg("Ignoring unexpected checkpoint in %r" % (self.path,))
+            return {}
+
+        return state
+
+
+    def save(self, state):
+        """
+        Save the checkpoint.
+
+        @param state: JSON serializable state.
+        @type state: C{dict}
+        """
+        tmpPath = self.path + '.tmp'
+        f = open(tmpPath, 'wb')
+        try:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmpPath, self.path)
@@ -0,0 +1,250 @@
+# -*- test-case-name: twittytwister.test.test_collect -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Deferred returning collection API on top of the delegate based REST methods.
+
+The methods of L{twittytwister.twitter.Twitter} push parsed items into a
+delegate one at a time. The functions and classes in this module collect
+those items instead, either into a list that is passed to the callback of
+a deferred, or into an iterator that fetches further pages on demand::
+
+    @defer.inlineCallbacks
+    def printFollowers(api):
+        followers = collect.CursorIterator(api.followers_ids, 'ralphm')
+        while True:
+            userID = yield followers.get()
+            if userID is None:
+                break
+            print userID
+"""
+
+from collections import deque
+
+from twisted.internet import defer
+
+def collect(method, *args, **kwargs):
+    """
+    Call a delegate based REST method and collect all items in a list.
+
+    @param method: REST API method that takes a delegate as its first
+        argument and returns a deferred, e.g.
+        L{twittytwister.twitter.Twitter.home_timeline}.
+
+    @param args: Extra positional arguments to C{method}.
+
+    @param kwargs: Keyword arguments to C{method}. Don't pass
+        C{extra_args}, as that changes the signature of the delegate.
+
+    @return: Deferred that fires with the list of items, in the order they
+        were received.
+    """
+    items = []
+    d = method(items.append, *args, **kwargs)
+    d.addCallback(lambda _: items)
+    return d
+
+
+
+@defer.inlineCallbacks
+def collectPages(method, *args, **kwargs):
+    """
+    Call a cursor paged REST method and collect the items of all pages.
+
+    @param method: Paged REST API method, e.g.
+        L{twittytwister.twitter.Twitter.followers_ids}.
+
+    @return: Deferred that fires with the list of items on all pages.
+    """
+    items = []
+    iterator = CursorIterator(method, *args, **kwargs)
+    while True:
+        item = yield iterator.get()
+        if item is None:
+            break
+        items.append(item)
+    defer.returnValue(items)
+
+
+
+class PageIterator(object):
+    """
+    Iterator over the items of a paged REST resource.
+
+    Pages are fetched as items are consumed through L{get}. Up to
+    C{prefetch} pages worth of items are fetched ahead and buffered.
+
+    @ivar prefetch: Maximum number of pages buffered ahead of consumption.
+    @type prefetch: C{int}
+
+    @ivar pages: Number of pages fetched so far.
+    @type pages: C{int}
+    """
+
+    def __init__(self, method, *args, **kwargs):
+        self.method = method
+        self.args = args
+        self.prefetch = kwargs.pop('prefetch', 1)
+        self.params = dict(kwargs.pop('params', None) or {})
+        self.kwargs = kwargs
+        self.pages = 0
+
+        self._pages = deque()
+        self._waiting = []
+        self._fetching = False
+        self._done = False
+        self._failure = None
+
+
+    def get(self):
+        """
+        Get the next item.
+
+        @return: Deferred that fires with the next item, or C{None} when all
+            items have been consumed. If fetching a page failed, the deferred
+            errbacks with that failure.
+        """
+        if self._pages:
+            item = self._popItem()
+            self._maybeFetch()
+            return defer.succeed(item)
+        elif self._failure is not None:
+            return defer.fail(self._failure)
+        elif self._done:
+            return defer.succeed(None)
+        else:
+            d = defer.Deferred()
+            self._waiting.append(d)
+            self._maybeFetch()
+            return d
+
+
+    def _popItem(self):
+        page = self._pages[0]
+        item = page.popleft()
+        if not page:
+            self._pages.popleft()
+        return item
+
+
+    def _maybeFetch(self):
+        if self._fetching or self._done or self._failure is not None:
+            return
+        if len(self._pages) >= self.prefetch and not self._waiting:
+            return
+
+        items = []
+
+        def cb(more):
+            self._fetching = False
+            self.pages += 1
+            if items:
+                self._pages.append(deque(items))
+            if not more:
+                self._done = True
+            self._flush()
+
+        def eb(failure):
+            self._fetching = False
+            self._failure = failure
+            self._flush()
+
+        self._fetching = True
+        d = self._fetchPage(items.append)
+        d.addCallbacks(cb, eb)
+
+
+    def _flush(self):
+        """
+        Hand out buffered items to waiting consumers, then fetch more.
+        """
+        while self._waiting and self._pages:
+            self._waiting.pop(0).callback(self._popItem())
+
+        if self._waiting and self._failure is not None:
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.errback(self._failure)
+        elif self._waiting and self._done:
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.callback(None)
+        else:
+            self._maybeFetch()
+
+
+    def _fetchPage(self, delegate):
+        """
+        Fetch the next page, passing its items to C{delegate}.
+
+        @return: Deferred that fires with C{True} if there are more pages.
+        """
+        raise NotImplementedError()
+
+
+
+class CursorIterator(PageIterator):
+    """
+    Iterator over a resource paged with cursors.
+
+    This works with the REST methods that take a C{page_delegate}, like
+    L{twittytwister.twitter.Twitter.list_followers}.
+    """
+
+    cursor = '-1'
+
+    def _fetchPage(self, delegate):
+        cursors = []
+
+        def pageDelegate(nextCursor, previousCursor):
+            cursors.append(nextCursor)
+
+        def cb(_):
+            if cursors and cursors[-1] not in (None, '', '0'):
+                self.cursor = cursors[-1]
+                return True
+            else:
+                return False
+
+        params = dict(self.params)
+        params['cursor'] = self.cursor
+        d = self.method(delegate, *self.args, params=params,
+                        page_delegate=pageDelegate, **self.kwargs)
+        d.addCallback(cb)
+        return d
+
+
+
+class TimelineIterator(PageIterator):
+    """
+    Iterator over a timeline, paging backwards in time using C{max_id}.
+
+    This works with the timeline REST methods, like
+    L{twittytwister.twitter.Twitter.user_timeline}. Iteration stops at the
+    first empty page.
+    """
+
+    maxID = None
+
+    def _fetchPage(self, delegate):
+        ids = []
+
+        def onItem(item):
+            ids.append(int(item.id))
+            delegate(item)
+
+        def cb(_):
+            if ids:
+                self.maxID = min(ids) - 1
+                return True
+            else:
+                return False
+
+        params = dict(self.params)
+        if self.maxID is not None:
+            params['max_id'] = str(self.maxID)
+        d = self.method(onItem, *self.args, params=params, **self.kwargs)
+        d.addCallback(cb)
+        return d
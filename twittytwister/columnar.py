@@ -0,0 +1,491 @@
+# -*- test-case-name: twittytwister.test.test_columnar -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Columnar batches of statuses.
+
+L{ColumnarSink} is a delegate for L{twittytwister.twitter.TwitterMonitor}
+or L{twittytwister.streaming.TwitterStream} that copies selected fields of
+each status into typed arrays, instead of keeping the status objects
+around. Full batches are passed to a writer, when C{batchSize} statuses
+have been collected or C{flushInterval} seconds after the first status of
+a batch::
+
+    sink = ColumnarSink(NPYWriter('/var/lib/statuses'), batchSize=100000)
+    monitor = TwitterMonitor(feed.filter, sink, args)
+
+Numbers take 4 or 8 bytes per row in an C{array.array}. Text is stored as
+UTF-8 encoded bytes with offsets, like Arrow string arrays, taking 4 bytes
+per row on top of the encoded text. Numeric columns assume a 64 bit
+platform for 8 byte integers.
+
+L{NPYWriter} writes each column to a NumPy C{.npy} file and needs no
+extra dependencies. L{ParquetWriter} requires pyarrow.
+"""
+
+import os
+import struct
+import sys
+from array import array
+
+from twisted.python import log
+
+from twittytwister import latency
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+def _userID(status):
+    user = getattr(status, 'user', None)
+    if user is not None:
+        return getattr(user, 'id', None)
+    return getattr(status, 'user_id', None)
+
+
+
+def _entityCount(kind):
+    def extract(status):
+        entities = getattr(status, 'entities', None)
+        return len(getattr(entities, kind, None) or ())
+    return extract
+
+
+
+class Column(object):
+    """
+    Numeric column.
+
+    @ivar name: Name of the column.
+    @type name: C{str}
+
+    @ivar typecode: Type code of the L{array.array} holding the values.
+    @type typecode: C{str}
+
+    @ivar extract: Called with a status to get the value of this column.
+
+    @ivar missing: Value stored when C{extract} returns C{None}.
+
+    @cvar rowAligned: Whether the column has one value per row, as needed
+        for Arrow record batches.
+    @type rowAligned: C{bool}
+    """
+
+    rowAligned = True
+
+    def __init__(self, name, typecode, extract, missing=0):
+        self.name = name
+        self.typecode = typecode
+        self.extract = extract
+        self.missing = missing
+
+
+    def allocate(self, size):
+        """
+        Return storage for C{size} values.
+        """
+        return array(self.typecode, [self.missing]) * size
+
+
+    def store(self, storage, row, status):
+        value = self.extract(status)
+        if value is None:
+            value = self.missing
+        storage[row] = value
+
+
+    def values(self, storage, rows):
+        """
+        Return the arrays holding the first C{rows} values, by suffix.
+        """
+        return {'': storage[:rows]}
+
+
+
+class TextColumn(Column):
+    """
+    Text column, stored as UTF-8 encoded bytes with offsets.
+
+    The text of row C{i} is C{data[offsets[i]:offsets[i + 1]]}. A missing
+    value is stored as the empty string.
+    """
+
+    def __init__(self, name, extract):
+        Column.__init__(self, name, 'B', extract)
+
+
+    def allocate(self, size):
+        return (array('i', [0]) * (size + 1), array('B'))
+
+
+    def store(self, storage, row, status):
+        offsets, data = storage
+        value = self.extract(status)
+        if value:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            data.fromstring(value)
+        offsets[row + 1] = len(data)
+
+
+    def values(self, storage, rows):
+        offsets, data = storage
+        return {'.offsets': offsets[:rows + 1], '.data': data}
+
+
+
+STATUS_COLUMNS = (
+    Column('id', 'l', lambda status: getattr(status, 'id', None)),
+    Column('created_at', 'd',
+           lambda status: latency.messageTime(status.raw or {}),
+           missing=float('nan')),
+    Column('user_id', 'l', _userID, missing=-1),
+    TextColumn('text', lambda status: getattr(status, 'text', None)),
+    Column('hashtags', 'i', _entityCount('hashtags')),
+    Column('urls', 'i', _entityCount('urls')),
+    Column('user_mentions', 'i', _entityCount('user_mentions')),
+    Column('media', 'i', _entityCount('media')),
+    )
+
+
+
+class Batch(object):
+    """
+    Batch of rows in preallocated columns.
+
+    @ivar columns: The columns.
+    @type columns: C{tuple} of L{Column}
+
+    @ivar size: Maximum number of rows.
+    @type size: C{int}
+
+    @ivar rows: Number of rows appended.
+    @type rows: C{int}
+    """
+
+    def __init__(self, columns=STATUS_COLUMNS, size=10000):
+        self.columns = columns
+        self.size = size
+        self.rows = 0
+        self._storage = [column.allocate(size) for column in columns]
+
+
+    def __len__(self):
+        return self.rows
+
+
+    def append(self, status):
+        """
+        Append a row with the values of a status.
+
+        @raises IndexError: When the batch is full.
+        """
+        row = self.rows
+        if row >= self.size:
+            raise IndexError("Batch is full")
+        for column, storage in zip(self.columns, self._storage):
+            column.store(storage, row, status)
+        self.rows = row + 1
+
+
+    def arrays(self):
+        """
+        Return the arrays holding the values of all rows.
+
+        @return: Dictionary of array name to L{array.array}. Numeric columns
+            have a single array named after the column, text columns an
+            array with suffix C{'.offsets'} and one with suffix C{'.data'}.
+        @rtype: C{dict}
+        """
+        result = {}
+        for column, storage in zip(self.columns, self._storage):
+            for suffix, values in column.values(storage,
+                                                self.rows).iteritems():
+                result[column.name + suffix] = values
+        return result
+
+
+    def storage(self, name):
+        """
+        Return the storage of a column, as allocated by the column.
+
+        @raises KeyError: If there is no column with this name.
+        """
+        for column, storage in zip(self.columns, self._storage):
+            if column.name == name:
+                return storage
+        raise KeyError(name)
+
+
+    def text(self, name, row):
+        """
+        Return the text of a text column in a row.
+
+        @rtype: C{unicode}
+        """
+        offsets, data = self.storage(name)
+        return data[offsets[row]:offsets[row + 1]].tostring().decode('utf-8')
+
+
+    def nbytes(self):
+        """
+        Return the number of bytes used by the values of all rows.
+        """
+        return sum(len(values) * values.itemsize
+                   for values in self.arrays().itervalues())
+
+
+
+class ColumnarSink(object):
+    """
+    Delegate that collects statuses into columnar batches.
+
+    Failures of the writer are logged, and the batch is kept to be written
+    again at the next status or after C{flushInterval}. Statuses received
+    while a full batch could not be written are dropped.
+
+    @ivar writer: Object with a C{write} method that is called with each
+        full L{Batch}, and a C{close} method. See L{NPYWriter}.
+
+    @ivar columns: The columns to collect.
+    @type columns: C{tuple} of L{Column}
+
+    @ivar batchSize: Number of rows after which a batch is written.
+    @type batchSize: C{int}
+
+    @ivar flushInterval: Maximum number of seconds between the first row of
+        a batch and writing it, or C{None} to only write full batches.
+    @type flushInterval: C{float}
+
+    @ivar batch: The current batch.
+    @type batch: L{Batch}
+
+    @ivar dropped: Number of dropped statuses.
+    @type dropped: C{int}
+    """
+
+    def __init__(self, writer, columns=STATUS_COLUMNS, batchSize=10000,
+                 flushInterval=60, reactor=None):
+        self.writer = writer
+        self.columns = columns
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.batch = Batch(columns, batchSize)
+        self.dropped = 0
+        self._flushCall = None
+
+
+    def __call__(self, status):
+        """
+        Append a status to the current batch.
+        """
+        if len(self.batch) >= self.batchSize:
+            # Writing this batch failed before, try again.
+            self._tryFlush()
+            if len(self.batch) >= self.batchSize:
+                self.dropped += 1
+                return
+
+        self.batch.append(status)
+        if len(self.batch) >= self.batchSize:
+            self._tryFlush()
+        elif self._flushCall is None and self.flushInterval is not None:
+            self._scheduleFlush()
+
+
+    def _scheduleFlush(self):
+        self._flushCall = self.reactor.callLater(self.flushInterval,
+                                                 self._timedFlush)
+
+
+    def _timedFlush(self):
+        self._flushCall = None
+        self._tryFlush()
+
+
+    def _tryFlush(self):
+        try:
+            self.flush()
+        except:
+            log.err(None, "Error writing batch")
+            if self._flushCall is None and self.flushInterval is not None:
+                self._scheduleFlush()
+
+
+    def flush(self):
+        """
+        Write the current batch, if it has any rows, and start a new one.
+
+        If writing fails, the current batch is kept.
+        """
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flushCall = None
+        if not len(self.batch):
+            return
+        self.writer.write(self.batch)
+        self.batch = Batch(self.columns, self.batchSize)
+
+
+    def close(self):
+        """
+        Write the current batch and close the writer.
+        """
+        self.flush()
+        self.writer.close()
+
+
+
+_KINDS = {'b': 'i', 'h': 'i', 'i': 'i', 'l': 'i',
+          'B': 'u', 'H': 'u', 'I': 'u', 'L': 'u',
+          'f': 'f', 'd': 'f'}
+
+def _descr(values):
+    if values.itemsize == 1:
+        order = '|'
+    elif sys.byteorder == 'little':
+        order = '<'
+    else:
+        order = '>'
+    return '%s%s%d' % (order, _KINDS[values.typecode], values.itemsize)
+
+
+
+def writeNPY(f, values):
+    """
+    Write an array to a file in NumPy's C{.npy} format, version 1.0.
+
+    @param values: One-dimensional array of numbers.
+    @type values: L{array.array}
+    """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+        _descr(values), len(values))
+    # The header is padded so that the data is aligned on 16 bytes.
+    total = 10 + len(header) + 1
+    header += ' ' * (-total % 16) + '\n'
+    f.write('\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header)
+    values.tofile(f)
+
+
+
+class NPYWriter(object):
+    """
+    Writer of batches as C{.npy} files, one per array.
+
+    Files are named C{<prefix>-<sequence>.<array>.npy}, e.g.
+    C{statuses-000001.id.npy} and C{statuses-000001.text.offsets.npy}, and
+    can be loaded with C{numpy.load}. The sequence number continues after
+    the highest one already in the directory.
+
+    @ivar directory: Directory to write files to.
+    @type directory: C{str}
+
+    @ivar prefix: Prefix of the file names.
+    @type prefix: C{str}
+    """
+
+    def __init__(self, directory, prefix='statuses'):
+        self.directory = directory
+        self.prefix = prefix
+        self.sequence = 0
+        for name in os.listdir(directory):
+            if name.startswith(prefix + '-'):
+                try:
+                    sequence = int(name[len(prefix) + 1:].split('.')[0])
+                except ValueError:
+                    continue
+                self.sequence = max(self.sequence, sequence)
+
+
+    def write(self, batch):
+        """
+        Write a batch.
+
+        @return: The paths of the written files.
+        @rtype: C{list}
+        """
+        self.sequence += 1
+        paths = []
+        for name, values in sorted(batch.arrays().iteritems()):
+            path = os.path.join(self.directory, '%s-%06d.%s.npy' % (
+                self.prefix, self.sequence, name))
+            f = open(path + '.tmp', 'wb')
+            try:
+                writeNPY(f, values)
+            finally:
+                f.close()
+            os.rename(path + '.tmp', path)
+            paths.append(path)
+        return paths
+
+
+    def close(self):
+        pass
+
+
+
+def toRecordBatch(batch):
+    """
+    Convert a batch to an Arrow record batch. This requires pyarrow.
+
+    Columns that don't have one value per row are left out.
+
+    @rtype: C{pyarrow.RecordBatch}
+    """
+    if pyarrow is None:
+        raise ImportError("pyarrow is required for Arrow record batches")
+
+    arrays = batch.arrays()
+    columns = [column for column in batch.columns if column.rowAligned]
+    fields = []
+    for column in columns:
+        if isinstance(column, TextColumn):
+            offsets = arrays[column.name + '.offsets']
+            data = arrays[column.name + '.data']
+            fields.append(pyarrow.StringArray.from_buffers(
+                batch.rows, pyarrow.py_buffer(offsets.tostring()),
+                pyarrow.py_buffer(data.tostring())))
+        else:
+            fields.append(pyarrow.array(arrays[column.name].tolist()))
+    return pyarrow.RecordBatch.from_arrays(
+        fields, [column.name for column in columns])
+
+
+
+class ParquetWriter(object):
+    """
+    Writer of batches to a Parquet file. This requires pyarrow.
+
+    Each batch is written as a row group.
+
+    @ivar path: Path of the Parquet file.
+    @type path: C{str}
+    """
+
+    def __init__(self, path):
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for Parquet output")
+        self.path = path
+        self._writer = None
+
+
+    def write(self, batch):
+        recordBatch = toRecordBatch(batch)
+        if self._writer is None:
+            self._writer = pyarrow.parquet.ParquetWriter(self.path,
+                                                         recordBatch.schema)
+        self._writer.write_table(
+            pyarrow.Table.from_batches([recordBatch]))
+
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
@@ -0,0 +1,301 @@
+# -*- test-case-name: twittytwister.test.test_compression -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Incremental decompression of compressed HTTP responses.
+
+Twitter serves both the streaming and the REST APIs with C{gzip} content
+encoding when requested. This typically reduces the transferred bytes of the
+JSON and XML payloads by a factor of 4 to 10, at the cost of some CPU time
+for decompression. Decompression is done chunk by chunk as data arrives, so
+that the decoded bytes are fed to the stream protocols and parsers without
+buffering the whole response.
+"""
+
+import time
+import zlib
+
+from twisted.internet import protocol
+from twisted.python import components, failure
+from twisted.web import client
+from twisted.web.iweb import IResponse, UNKNOWN_LENGTH
+
+class CompressionStats(object):
+    """
+    Statistics on decompressed responses.
+
+    @ivar compressedBytes: Number of received compressed bytes.
+    @type compressedBytes: C{int}
+
+    @ivar decompressedBytes: Number of bytes after decompression.
+    @type decompressedBytes: C{int}
+
+    @ivar decompressTime: Total time spent decompressing, in seconds.
+    @type decompressTime: C{float}
+    """
+
+    timer = staticmethod(time.time)
+
+    def __init__(self):
+        self.compressedBytes = 0
+        self.decompressedBytes = 0
+        self.decompressTime = 0.
+
+
+    def ratio(self):
+        """
+        Return the compression ratio, decompressed bytes per received byte.
+
+        @rtype: C{float}
+        """
+        if not self.compressedBytes:
+            return None
+        return float(self.decompressedBytes) / self.compressedBytes
+
+
+    def costPerMegabyte(self):
+        """
+        Return the time spent decompressing per megabyte of output.
+
+        @rtype: C{float}
+        """
+        if not self.decompressedBytes:
+            return None
+        return self.decompressTime * 1024 * 1024 / self.decompressedBytes
+
+
+
+class Decompressor(object):
+    """
+    Incremental C{gzip} or C{deflate} decompressor that keeps statistics.
+
+    @ivar stats: Where to record statistics, optional.
+    @type stats: L{CompressionStats}
+    """
+
+    def __init__(self, encoding='gzip', stats=None):
+        if encoding in ('gzip', 'x-gzip'):
+            wbits = 16 + zlib.MAX_WBITS
+        else:
+            wbits = zlib.MAX_WBITS
+        self._decompressObj = zlib.decompressobj(wbits)
+        self.stats = stats
+
+
+    def decompress(self, data):
+        """
+        Decompress a chunk of data.
+
+        @raises zlib.error: If the data is not properly compressed.
+        """
+        if self.stats is None:
+            return self._decompressObj.decompress(data)
+
+        start = self.stats.timer()
+        result = self._decompressObj.decompress(data)
+        self.stats.decompressTime += self.stats.timer() - start
+        self.stats.compressedBytes += len(data)
+        self.stats.decompressedBytes += len(result)
+        return result
+
+
+    def flush(self):
+        """
+        Return remaining decompressed data at the end of the input.
+        """
+        result = self._decompressObj.flush()
+        if self.stats is not None:
+            self.stats.decompressedBytes += len(result)
+        return result
+
+
+
+class DecompressingWriter(object):
+    """
+    File-like object that decompresses data written to it.
+
+    This wraps the file-like objects that are passed to
+    L{twisted.web.client.HTTPDownloader}, like L{twittytwister.txml.Parser}.
+    """
+
+    def __init__(self, original, decompressor):
+        self.original = original
+        self.decompressor = decompressor
+
+
+    def write(self, data):
+        try:
+            data = self.decompressor.decompress(data)
+        except zlib.error, e:
+            raise IOError(str(e))
+        if data:
+            self.original.write(data)
+
+
+    def close(self):
+        try:
+            data = self.decompressor.flush()
+        except zlib.error, e:
+            raise IOError(str(e))
+        if data:
+            self.original.write(data)
+        self.original.close()
+
+
+
+class DecompressingDownloader(client.HTTPDownloader):
+    """
+    HTTP downloader that requests compression and decompresses the body.
+
+    @ivar compressionStats: Where to record statistics, optional.
+    @type compressionStats: L{CompressionStats}
+    """
+
+    compressionStats = None
+    encodings = ('gzip', 'x-gzip', 'deflate')
+
+    def __init__(self, *args, **kwargs):
+        client.HTTPDownloader.__init__(self, *args, **kwargs)
+        self.headers.setdefault('accept-encoding', 'gzip')
+
+
+    def pageStart(self, partialContent):
+        headers = self.response_headers or {}
+        encoding = headers.get('content-encoding', [None])[0]
+        if encoding is not None:
+            encoding = encoding.lower()
+        if self.file is not None and encoding in self.encodings:
+            decompressor = Decompressor(encoding, self.compressionStats)
+            self.file = DecompressingWriter(self.file, decompressor)
+        client.HTTPDownloader.pageStart(self, partialContent)
+
+
+
+def decompressBody(body, headers, stats=None):
+    """
+    Decompress a complete response body according to its content encoding.
+
+    This is used for responses that are received in full, like those of
+    L{twisted.web.client.HTTPClientFactory}.
+
+    @param headers: The response headers, as collected by
+        L{twisted.web.client.HTTPClientFactory}.
+    @type headers: C{dict}
+    """
+    encoding = (headers or {}).get('content-encoding', [None])[0]
+    if encoding is None or encoding.lower() not in ('gzip', 'x-gzip',
+                                                    'deflate'):
+        return body
+
+    decompressor = Decompressor(encoding.lower(), stats)
+    return decompressor.decompress(body) + decompressor.flush()
+
+
+
+class _DecompressingProtocol(protocol.Protocol):
+    """
+    Protocol wrapper that decompresses a response body incrementally.
+
+    The transport is passed on to the wrapped protocol unchanged, so that
+    it can still pause or stop the underlying connection.
+    """
+
+    def __init__(self, original, decompressor):
+        self.original = original
+        self.decompressor = decompressor
+        self._failed = False
+
+
+    def makeConnection(self, transport):
+        protocol.Protocol.makeConnection(self, transport)
+        self.original.makeConnection(transport)
+
+
+    def dataReceived(self, data):
+        if self._failed:
+            return
+
+        try:
+            data = self.decompressor.decompress(data)
+        except zlib.error:
+            self._failed = True
+            self.original.connectionLost(failure.Failure(
+                client.ResponseFailed([failure.Failure()])))
+            self.transport.stopProducing()
+            return
+
+        if data:
+            self.original.dataReceived(data)
+
+
+    def connectionLost(self, reason):
+        if self._failed:
+            return
+
+        try:
+            data = self.decompressor.flush()
+        except zlib.error:
+            reason = failure.Failure(client.ResponseFailed([reason,
+                                                            failure.Failure()]))
+        else:
+            if data:
+                self.original.dataReceived(data)
+        self.original.connectionLost(reason)
+
+
+
+class DecompressingResponse(components.proxyForInterface(IResponse)):
+    """
+    Response wrapper that decompresses the body as it is delivered.
+    """
+
+    def __init__(self, original, decompressor):
+        self.original = original
+        self.decompressor = decompressor
+        self.length = UNKNOWN_LENGTH
+
+
+    def deliverBody(self, protocol):
+        self.original.deliverBody(_DecompressingProtocol(protocol,
+                                                         self.decompressor))
+
+
+
+class DecoderFactory(object):
+    """
+    Content decoder for L{twisted.web.client.ContentDecoderAgent}.
+
+    Unlike L{twisted.web.client.GzipDecoder}, this records statistics on
+    the decompressed responses.
+
+    @ivar encoding: The content encoding to decode.
+    @type encoding: C{str}
+
+    @ivar stats: Where to record statistics, optional.
+    @type stats: L{CompressionStats}
+    """
+
+    def __init__(self, encoding='gzip', stats=None):
+        self.encoding = encoding
+        self.stats = stats
+
+
+    def __call__(self, response):
+        return DecompressingResponse(response,
+                                     Decompressor(self.encoding, self.stats))
+
+
+
+def decodingAgent(agent, stats=None):
+    """
+    Wrap an agent to request and decode compressed responses.
+
+    @param stats: Where to record statistics, optional.
+    @type stats: L{CompressionStats}
+
+    @rtype: L{twisted.web.client.ContentDecoderAgent}
+    """
+    return client.ContentDecoderAgent(agent,
+                                      [('gzip', DecoderFactory('gzip', stats))])
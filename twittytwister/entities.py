@@ -0,0 +1,294 @@
+# -*- test-case-name: twittytwister.test.test_entities -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Flat arrays of the entities of batches of statuses.
+
+L{twittytwister.platform.Entities} creates an object for every entity and
+its indices. For analytics over many statuses, L{extract} instead appends
+the entities of raw status dictionaries to parallel arrays: the index of
+the status, the entity type, the start and end indices and a code for the
+value. Values are dictionary encoded, each distinct value of a type is kept
+once::
+
+    entities = extract(status.raw for status in statuses)
+    for tag, count in entities.top(10, HASHTAG):
+        print tag, count
+
+To collect the entities along with the other fields of statuses in a
+L{twittytwister.columnar.ColumnarSink}, add an L{EntityColumn} to its
+columns. The written batches can then be passed to L{extract}.
+
+Counts per value are computed once after adding statuses, with
+C{numpy.bincount} if NumPy is installed.
+"""
+
+import heapq
+from array import array
+
+from twittytwister import columnar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HASHTAG, MENTION, URL, MEDIA = range(4)
+
+KINDS = ('hashtags', 'user_mentions', 'urls', 'media')
+
+_VALUE_KEYS = ('text', 'screen_name', 'expanded_url', 'media_url_https')
+
+class EntityArrays(object):
+    """
+    Parallel arrays of entities.
+
+    For entity C{i}, C{status[i]} is the index of its status in the order
+    the statuses were added, C{kind[i]} its type (one of L{HASHTAG},
+    L{MENTION}, L{URL} or L{MEDIA}), C{start[i]} and C{end[i]} its indices
+    in the text, C{-1} if unknown, and C{value[i]} the code of its value.
+
+    The value of hashtags is their text, of mentions the screen name, of
+    URLs the expanded URL and of media the HTTPS media URL. With
+    C{lowercase}, hashtags and screen names are folded to lower case, as
+    Twitter matches them case insensitively.
+
+    @ivar values: Distinct values, by code.
+    @type values: C{list}
+
+    @ivar valueKinds: The entity type of each distinct value, by code.
+    @type valueKinds: L{array.array}
+
+    @ivar statuses: Number of statuses added.
+    @type statuses: C{int}
+    """
+
+    def __init__(self, lowercase=True):
+        self.lowercase = lowercase
+        self.status = array('i')
+        self.kind = array('B')
+        self.start = array('i')
+        self.end = array('i')
+        self.value = array('i')
+        self.values = []
+        self.valueKinds = array('B')
+        self.statuses = 0
+        self._codes = {}
+        self._counts = None
+
+
+    def __len__(self):
+        return len(self.value)
+
+
+    def extend(self, statuses):
+        """
+        Add the entities of statuses.
+
+        @param statuses: Decoded JSON statuses, or objects with the decoded
+            status as C{raw}, like L{twittytwister.platform.Status}, or a
+            L{twittytwister.columnar.Batch} with an L{EntityColumn}.
+        @type statuses: iterable
+        """
+        self._counts = None
+        if isinstance(statuses, columnar.Batch):
+            self._extendBatch(statuses)
+            return
+
+        status, kindArray = self.status, self.kind
+        start, end, value = self.start, self.end, self.value
+        codes = self._codes
+        lowercase = self.lowercase
+        index = self.statuses
+
+        for data in statuses:
+            if not isinstance(data, dict):
+                data = data.raw or {}
+            entities = data.get('entities')
+            if entities:
+                for kind, name in enumerate(KINDS):
+                    items = entities.get(name)
+                    if not items:
+                        continue
+                    valueKey = _VALUE_KEYS[kind]
+                    fold = lowercase and kind <= MENTION
+                    for item in items:
+                        text = item.get(valueKey)
+                        if text is None:
+                            continue
+                        if fold:
+                            text = text.lower()
+                        key = (kind, text)
+                        code = codes.get(key)
+                        if code is None:
+                            code = codes[key] = len(self.values)
+                            self.values.append(text)
+                            self.valueKinds.append(kind)
+                        try:
+                            first, last = item['indices']
+                        except (KeyError, TypeError, ValueError):
+                            first = last = -1
+                        status.append(index)
+                        kindArray.append(kind)
+                        start.append(first)
+                        end.append(last)
+                        value.append(code)
+            index += 1
+
+        self.statuses = index
+
+
+    def _code(self, kind, text):
+        """
+        Return the code of a value, adding it if new.
+        """
+        key = (kind, text)
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self.values)
+            self.values.append(text)
+            self.valueKinds.append(kind)
+        return code
+
+
+    def _extendBatch(self, batch):
+        """
+        Add the entities collected by the entity columns of a batch.
+
+        @raises ValueError: If the batch has no L{EntityColumn}.
+        """
+        sources = [batch.storage(column.name) for column in batch.columns
+                   if isinstance(column, EntityColumn)]
+        if not sources:
+            raise ValueError("Batch has no entity column")
+
+        for other in sources:
+            remap = []
+            for code, text in enumerate(other.values):
+                kind = other.valueKinds[code]
+                if self.lowercase and kind <= MENTION:
+                    text = text.lower()
+                remap.append(self._code(kind, text))
+
+            offset = self.statuses
+            self.status.extend(array('i', [index + offset
+                                           for index in other.status]))
+            self.kind.extend(other.kind)
+            self.start.extend(other.start)
+            self.end.extend(other.end)
+            self.value.extend(array('i', [remap[code]
+                                          for code in other.value]))
+        self.statuses += len(batch)
+
+
+    def _countsByCode(self):
+        if self._counts is None:
+            if numpy is not None and len(self.value):
+                codes = numpy.frombuffer(self.value,
+                                         dtype=numpy.dtype(self.value.typecode))
+                self._counts = numpy.bincount(
+                    codes, minlength=len(self.values)).tolist()
+            else:
+                counts = [0] * len(self.values)
+                for code in self.value:
+                    counts[code] += 1
+                self._counts = counts
+        return self._counts
+
+
+    def counts(self):
+        """
+        Count the entities per value code.
+
+        The counts are kept until statuses are added.
+
+        @return: The number of entities of each value, by code.
+        @rtype: C{list}
+        """
+        return list(self._countsByCode())
+
+
+    def top(self, k, kind=HASHTAG):
+        """
+        Return the most frequent values of an entity type.
+
+        @param k: Number of values to return.
+        @type k: C{int}
+
+        @param kind: The entity type.
+
+        @return: Up to C{k} tuples of value and count, most frequent first.
+        @rtype: C{list}
+        """
+        counts = self._countsByCode()
+        valueKinds = self.valueKinds
+        codes = [code for code in xrange(len(counts))
+                 if valueKinds[code] == kind]
+        best = heapq.nlargest(k, codes, key=counts.__getitem__)
+        return [(self.values[code], counts[code]) for code in best]
+
+
+
+def extract(statuses, lowercase=True):
+    """
+    Extract the entities of statuses into flat arrays.
+
+    @param statuses: Decoded JSON statuses, or objects with the decoded
+        status as C{raw}.
+    @type statuses: iterable
+
+    @rtype: L{EntityArrays}
+    """
+    entities = EntityArrays(lowercase)
+    entities.extend(statuses)
+    return entities
+
+
+
+class EntityColumn(columnar.Column):
+    """
+    Column collecting the entities of the statuses of a
+    L{twittytwister.columnar.Batch} into an L{EntityArrays}.
+
+    The status index of each entity is the row of its status. The arrays
+    are named after the attributes of L{EntityArrays}, e.g.
+    C{entities.status} and C{entities.value}, and the distinct values are
+    stored as UTF-8 encoded text with offsets, in C{entities.values.offsets}
+    and C{entities.values.data}, with their types in
+    C{entities.values.kind}. As there is not one value per row, this column
+    is left out of Arrow record batches.
+    """
+
+    rowAligned = False
+
+    def __init__(self, name='entities', lowercase=True):
+        columnar.Column.__init__(self, name, 'i', None)
+        self.lowercase = lowercase
+
+
+    def allocate(self, size):
+        return EntityArrays(self.lowercase)
+
+
+    def store(self, storage, row, status):
+        storage.extend((status,))
+
+
+    def values(self, storage, rows):
+        offsets = array('i', [0])
+        data = array('B')
+        for value in storage.values:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            data.fromstring(value)
+            offsets.append(len(data))
+        return {'.status': storage.status,
+                '.kind': storage.kind,
+                '.start': storage.start,
+                '.end': storage.end,
+                '.value': storage.value,
+                '.values.offsets': offsets,
+                '.values.data': data,
+                '.values.kind': storage.valueKinds}
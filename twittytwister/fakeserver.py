@@ -0,0 +1,583 @@
+# -*- test-case-name: twittytwister.test.test_fakeserver -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Fake Twitter API server, for integration tests and load benchmarks.
+
+This serves the Streaming API and parts of the REST API over plain HTTP
+with C{twisted.web}, so that the real HTTP, OAuth and parsing code paths of
+L{twittytwister.twitter} can be exercised end to end, without network
+access::
+
+    server = FakeTwitterServer(rate=500)
+    server.start()
+    feed = server.feed()
+    feed.filter(onStatus, {'track': 'twisted'})
+
+Streams send length-delimited JSON statuses at a target rate, with
+keep-alives when idle, optional stall warnings and optional disconnects
+after a number of statuses. REST endpoints return XML or JSON documents,
+with rate limit headers and cursor based paging.
+
+Requests must carry an OAuth C{Authorization} header, but signatures are
+not verified.
+"""
+
+import time
+from xml.sax.saxutils import escape
+
+import simplejson as json
+from oauth import oauth
+
+from twisted.internet import task
+from twisted.python import log
+from twisted.web import resource, server
+
+from twittytwister import twitter
+
+def formatDate(seconds):
+    """
+    Format a time in seconds since the epoch like Twitter's C{created_at}.
+    """
+    return time.strftime('%a %b %d %H:%M:%S +0000 %Y', time.gmtime(seconds))
+
+
+
+def makeUser(userID):
+    """
+    Return a user for an ID.
+    """
+    return {'id': userID,
+            'id_str': str(userID),
+            'screen_name': 'user%d' % userID,
+            'name': 'User %d' % userID,
+            'followers_count': userID % 1000,
+            'friends_count': userID % 100,
+            'statuses_count': userID % 10000,
+            'created_at': 'Wed Aug 27 13:08:45 +0000 2008'}
+
+
+
+def makeStatus(statusID, now, userCount=1000):
+    """
+    Return a status for an ID.
+
+    Statuses have a hashtag and a mention, taken from small sets so that
+    aggregations see repeated values.
+    """
+    userID = statusID % userCount + 1
+    tag = 'tag%d' % (statusID % 17)
+    mention = (statusID * 7) % userCount + 1
+    text = u'Status %d #%s @user%d' % (statusID, tag, mention)
+    tagStart = text.index('#')
+    mentionStart = text.index('@')
+    return {'id': statusID,
+            'id_str': str(statusID),
+            'text': text,
+            'created_at': formatDate(now),
+            'timestamp_ms': str(int(now * 1000)),
+            'source': 'web',
+            'truncated': False,
+            'user': makeUser(userID),
+            'entities': {
+                'hashtags': [{'text': tag,
+                              'indices': [tagStart, tagStart + len(tag) + 1]}],
+                'user_mentions': [{'id': mention,
+                                   'id_str': str(mention),
+                                   'screen_name': 'user%d' % mention,
+                                   'indices': [mentionStart,
+                                               len(text)]}],
+                'urls': []}}
+
+
+
+def _checkAuthorization(request):
+    """
+    Check that the request carries OAuth credentials, respond if not.
+    """
+    authorization = request.getHeader('authorization') or ''
+    if authorization.startswith('OAuth '):
+        return True
+    request.setResponseCode(401)
+    request.setHeader('content-type', 'application/json')
+    request.write(json.dumps({'errors': [{'code': 32,
+                                          'message': 'Could not authenticate '
+                                                     'you.'}]}))
+    request.finish()
+    return False
+
+
+
+class _StreamWriter(object):
+    """
+    Writes statuses to a single stream request at the target rate.
+    """
+
+    def __init__(self, stream, request):
+        self.stream = stream
+        self.request = request
+        self.reactor = stream.reactor
+        self.started = self.lastWrite = self.lastWarning = \
+                self.reactor.seconds()
+        self.sent = 0
+        self.call = task.LoopingCall(self.tick)
+        self.call.clock = self.reactor
+
+
+    def start(self):
+        self.request.notifyFinish().addBoth(self.stop)
+        self.call.start(self.stream.tickInterval, now=True)
+
+
+    def stop(self, _=None):
+        if self.call.running:
+            self.call.stop()
+        if self in self.stream.writers:
+            self.stream.writers.remove(self)
+
+
+    def tick(self):
+        stream = self.stream
+        now = self.reactor.seconds()
+        due = int((now - self.started) * stream.rate) - self.sent
+        if stream.disconnectAfter is not None:
+            due = min(due, stream.disconnectAfter - self.sent)
+
+        chunks = []
+        for i in xrange(due):
+            stream.lastID += 1
+            status = stream.statusFactory(stream.lastID, now)
+            chunks.append(stream.frame(status))
+        self.sent += due
+        stream.sent += due
+
+        if (stream.stallWarningInterval is not None and
+            now - self.lastWarning >= stream.stallWarningInterval):
+            self.lastWarning = now
+            chunks.append(stream.frame({'warning': {
+                'code': 'FALLING_BEHIND',
+                'message': 'Your connection is falling behind.',
+                'percent_full': 60}}))
+
+        if chunks:
+            self.lastWrite = now
+            self.request.write(''.join(chunks))
+        elif now - self.lastWrite >= stream.keepAliveInterval:
+            self.lastWrite = now
+            self.request.write('\r\n')
+
+        if (stream.disconnectAfter is not None and
+            self.sent >= stream.disconnectAfter):
+            self.stop()
+            self.request.finish()
+
+
+
+class StreamResource(resource.Resource):
+    """
+    Streaming API endpoint.
+
+    All paths below this resource serve the same stream. The requests are
+    recorded in L{requests}, as tuples of the path, the arguments and the
+    request headers.
+
+    @ivar rate: Target number of statuses per second, per connection.
+    @type rate: C{float}
+
+    @ivar keepAliveInterval: Seconds of inactivity after which a keep-alive
+        is sent.
+    @type keepAliveInterval: C{float}
+
+    @ivar disconnectAfter: Number of statuses after which the connection is
+        closed, or C{None} to never disconnect.
+    @type disconnectAfter: C{int}
+
+    @ivar stallWarningInterval: Seconds between stall warnings, or C{None}
+        to send none.
+    @type stallWarningInterval: C{float}
+
+    @ivar statusFactory: Called with a status ID and the current time to
+        create the statuses to send.
+
+    @ivar sent: Total number of statuses sent.
+    @type sent: C{int}
+    """
+
+    isLeaf = True
+    tickInterval = 0.01
+
+    def __init__(self, rate=100, keepAliveInterval=30, disconnectAfter=None,
+                 stallWarningInterval=None, statusFactory=makeStatus,
+                 reactor=None):
+        resource.Resource.__init__(self)
+        self.rate = rate
+        self.keepAliveInterval = keepAliveInterval
+        self.disconnectAfter = disconnectAfter
+        self.stallWarningInterval = stallWarningInterval
+        self.statusFactory = statusFactory
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        self.requests = []
+        self.writers = []
+        self.lastID = 0
+        self.sent = 0
+
+
+    def frame(self, obj):
+        """
+        Encode an object as a length-delimited datagram.
+        """
+        data = json.dumps(obj) + '\r\n'
+        return '%d\r\n%s' % (len(data), data)
+
+
+    def render_GET(self, request):
+        self.requests.append(('/'.join(request.postpath), request.args,
+                              request.requestHeaders))
+        if not _checkAuthorization(request):
+            return server.NOT_DONE_YET
+
+        request.setHeader('content-type', 'application/json')
+        writer = _StreamWriter(self, request)
+        self.writers.append(writer)
+        writer.start()
+        return server.NOT_DONE_YET
+
+    render_POST = render_GET
+
+
+    def disconnectAll(self):
+        """
+        Close all open streams.
+        """
+        for writer in list(self.writers):
+            writer.stop()
+            writer.request.finish()
+
+
+
+# Properties of the JSON API that the XML API doesn't have.
+_JSON_ONLY = frozenset(['id_str', 'timestamp_ms'])
+
+def _xmlElements(obj):
+    """
+    Render the simple values of a dictionary as XML elements.
+    """
+    parts = []
+    for key, value in sorted(obj.iteritems()):
+        if isinstance(value, (dict, list)) or key in _JSON_ONLY:
+            continue
+        if isinstance(value, bool):
+            value = value and 'true' or 'false'
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        parts.append(u'<%s>%s</%s>' % (key, escape(value), key))
+    return u''.join(parts)
+
+
+
+def statusXML(status):
+    return u'<status>%s<user>%s</user></status>' % (
+            _xmlElements(status), _xmlElements(status['user']))
+
+
+
+def userXML(user):
+    return u'<user>%s</user>' % _xmlElements(user)
+
+
+
+class RESTResource(resource.Resource):
+    """
+    REST API endpoints.
+
+    This serves timelines, ID and user lists with cursors, single users and
+    status updates. All requests count against a single rate limit window,
+    reported in the C{X-RateLimit-*} headers. When the limit is exhausted,
+    requests get a 429 response, with the seconds until the window is reset
+    as C{Retry-After}.
+
+    @ivar statusCount: Number of statuses available in timelines.
+    @type statusCount: C{int}
+
+    @ivar idCount: Number of IDs in friend and follower lists.
+    @type idCount: C{int}
+
+    @ivar pageSize: Number of IDs or users per page, when paging.
+    @type pageSize: C{int}
+
+    @ivar rateLimit: Number of requests per rate limit window.
+    @type rateLimit: C{int}
+
+    @ivar rateLimitWindow: Length of the rate limit window, in seconds.
+    @type rateLimitWindow: C{int}
+    """
+
+    isLeaf = True
+
+    def __init__(self, statusCount=1000, idCount=1000, pageSize=100,
+                 rateLimit=15, rateLimitWindow=900, reactor=None):
+        resource.Resource.__init__(self)
+        self.statusCount = statusCount
+        self.idCount = idCount
+        self.pageSize = pageSize
+        self.rateLimit = rateLimit
+        self.rateLimitWindow = rateLimitWindow
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        self.requests = []
+        self.updates = []
+        self._windowReset = None
+        self._remaining = rateLimit
+
+
+    def _rateLimited(self, request):
+        """
+        Account for a request, set rate limit headers.
+
+        @return: Whether the request is over the limit.
+        """
+        now = self.reactor.seconds()
+        if self._windowReset is None or now >= self._windowReset:
+            self._windowReset = int(now) + self.rateLimitWindow
+            self._remaining = self.rateLimit
+
+        self._remaining -= 1
+        request.setHeader('x-ratelimit-limit', str(self.rateLimit))
+        request.setHeader('x-ratelimit-remaining',
+                          str(max(self._remaining, 0)))
+        request.setHeader('x-ratelimit-reset', str(self._windowReset))
+        return self._remaining < 0
+
+
+    def render(self, request):
+        path = '/'.join(request.postpath)
+        self.requests.append((request.method, path, request.args,
+                              request.requestHeaders))
+        if not _checkAuthorization(request):
+            return server.NOT_DONE_YET
+
+        if self._rateLimited(request):
+            request.setResponseCode(429)
+            request.setHeader('retry-after', str(int(
+                self._windowReset - self.reactor.seconds())))
+            request.setHeader('content-type', 'application/json')
+            return json.dumps({'errors': [{'code': 88,
+                                           'message': 'Rate limit exceeded'}]})
+
+        if path.endswith('.json'):
+            request.setHeader('content-type', 'application/json')
+        else:
+            request.setHeader('content-type', 'application/xml')
+
+        body = self.route(request, path)
+        if body is None:
+            request.setResponseCode(404)
+            return ''
+        elif isinstance(body, unicode):
+            body = body.encode('utf-8')
+        return body
+
+
+    def route(self, request, path):
+        """
+        Return the response body for a path, or C{None} if not found.
+        """
+        args = request.args
+        parts = path.split('/')
+
+        if request.method == 'POST':
+            if path == 'statuses/update.xml':
+                return self.update(args['status'][0].decode('utf-8'))
+            elif parts[:2] in (['friendships', 'create'],
+                               ['friendships', 'destroy']):
+                return u'<?xml version="1.0"?>' + userXML(makeUser(1))
+            return None
+
+        if parts[0] == 'statuses' and (path.endswith('_timeline.xml') or
+                                       path == 'statuses/mentions.xml'):
+            return self.timeline(args)
+        elif parts[0] in ('friends', 'followers') and parts[1] == 'ids':
+            return self.ids(args)
+        elif parts[0] == 'statuses' and parts[1] in ('friends', 'followers'):
+            return self.users(args)
+        elif path in ('users/show.json', 'account/verify_credentials.json'):
+            userID = int(args.get('user_id', ['1'])[0])
+            return json.dumps(makeUser(userID))
+        elif path == 'account/verify_credentials.xml':
+            return u'<?xml version="1.0"?><users>%s</users>' % (
+                    userXML(makeUser(1)))
+        return None
+
+
+    def timeline(self, args):
+        """
+        Render statuses, newest first, with C{count}, C{since_id} and
+        C{max_id}.
+        """
+        count = int(args.get('count', ['20'])[0])
+        sinceID = int(args.get('since_id', ['0'])[0])
+        maxID = int(args.get('max_id', [str(self.statusCount)])[0])
+        now = self.reactor.seconds()
+
+        statuses = []
+        statusID = min(maxID, self.statusCount)
+        while statusID > sinceID and len(statuses) < count:
+            statuses.append(statusXML(makeStatus(statusID, now)))
+            statusID -= 1
+        return (u'<?xml version="1.0" encoding="UTF-8"?>'
+                u'<statuses type="array">%s</statuses>' % u''.join(statuses))
+
+
+    def _page(self, args):
+        """
+        Return the IDs of a page and the next and previous cursors.
+
+        Cursors are the offset of the page plus one, so that C{-1} is the
+        first page and C{0} marks the end.
+        """
+        cursor = int(args.get('cursor', ['-1'])[0])
+        offset = max(cursor - 1, 0)
+        end = min(offset + self.pageSize, self.idCount)
+        ids = range(offset + 1, end + 1)
+        if end < self.idCount:
+            nextCursor = end + 1
+        else:
+            nextCursor = 0
+        previousCursor = offset and -(offset - self.pageSize + 1) or 0
+        return ids, nextCursor, previousCursor
+
+
+    def ids(self, args):
+        if 'cursor' not in args:
+            ids = xrange(1, self.idCount + 1)
+            return u'<?xml version="1.0"?><ids>%s</ids>' % u''.join(
+                    u'<id>%d</id>' % userID for userID in ids)
+
+        ids, nextCursor, previousCursor = self._page(args)
+        return (u'<?xml version="1.0"?><id_list><ids>%s</ids>'
+                u'<next_cursor>%d</next_cursor>'
+                u'<previous_cursor>%d</previous_cursor></id_list>' % (
+                    u''.join(u'<id>%d</id>' % userID for userID in ids),
+                    nextCursor, previousCursor))
+
+
+    def users(self, args):
+        if 'cursor' not in args:
+            ids = xrange(1, min(self.pageSize, self.idCount) + 1)
+            return u'<?xml version="1.0"?><users>%s</users>' % u''.join(
+                    userXML(makeUser(userID)) for userID in ids)
+
+        ids, nextCursor, previousCursor = self._page(args)
+        return (u'<?xml version="1.0"?><users_list><users>%s</users>'
+                u'<next_cursor>%d</next_cursor>'
+                u'<previous_cursor>%d</previous_cursor></users_list>' % (
+                    u''.join(userXML(makeUser(userID)) for userID in ids),
+                    nextCursor, previousCursor))
+
+
+    def update(self, text):
+        self.updates.append(text)
+        status = makeStatus(self.statusCount + len(self.updates),
+                            self.reactor.seconds())
+        status['text'] = text
+        return u'<?xml version="1.0"?>' + statusXML(status)
+
+
+
+class FakeTwitterServer(object):
+    """
+    Fake Twitter server with a stream and REST endpoints.
+
+    The stream is served below C{/stream/1.1} and the REST API, with gzip
+    compression, below C{/api/1.1}.
+
+    @ivar stream: The stream endpoint.
+    @type stream: L{StreamResource}
+
+    @ivar rest: The REST endpoints.
+    @type rest: L{RESTResource}
+    """
+
+    def __init__(self, stream=None, rest=None, reactor=None, **kwargs):
+        """
+        @param kwargs: Keyword arguments for L{StreamResource}, if no
+            C{stream} is passed.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.stream = stream or StreamResource(reactor=reactor, **kwargs)
+        self.rest = rest or RESTResource(reactor=reactor)
+        self.port = None
+
+        root = resource.Resource()
+        streamRoot = resource.Resource()
+        streamRoot.putChild('1.1', self.stream)
+        root.putChild('stream', streamRoot)
+        apiRoot = resource.Resource()
+        apiRoot.putChild('1.1', resource.EncodingResourceWrapper(
+            self.rest, [server.GzipEncoderFactory()]))
+        root.putChild('api', apiRoot)
+        self.site = server.Site(root)
+        self.site.noisy = False
+
+
+    def start(self, port=0, interface='127.0.0.1'):
+        """
+        Start listening.
+
+        @return: The listening port.
+        @rtype: L{twisted.internet.interfaces.IListeningPort}
+        """
+        self.port = self.reactor.listenTCP(port, self.site,
+                                           interface=interface)
+        address = self.port.getHost()
+        root = 'http://%s:%d' % (address.host, address.port)
+        self.baseURL = root + '/api/1.1'
+        self.streamURL = root + '/stream/1.1'
+        log.msg("Fake Twitter server listening on %s" % root)
+        return self.port
+
+
+    def stop(self):
+        """
+        Close all streams and stop listening.
+        """
+        self.stream.disconnectAll()
+        return self.port.stopListening()
+
+
+    def _credentials(self):
+        return {'consumer': oauth.OAuthConsumer('key', 'secret'),
+                'token': oauth.OAuthToken('token', 'secret')}
+
+
+    def api(self, **kwargs):
+        """
+        Return a REST API client for this server.
+
+        @rtype: L{twittytwister.twitter.Twitter}
+        """
+        kwargs.update(self._credentials())
+        return twitter.Twitter(base_url=self.baseURL, **kwargs)
+
+
+    def feed(self, **kwargs):
+        """
+        Return a stream client for this server.
+
+        @rtype: L{twittytwister.twitter.TwitterFeed}
+        """
+        kwargs.update(self._credentials())
+        return twitter.TwitterFeed(base_url=self.baseURL,
+                                   stream_url=self.streamURL,
+                                   userstream_url=self.streamURL,
+                                   sitestream_url=self.streamURL,
+                                   **kwargs)
@@ -0,0 +1,149 @@
+# -*- test-case-name: twittytwister.test.test_flow -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Flow control between Twitter streams and their consumers.
+
+L{twittytwister.twitter.TwitterMonitor} is a push producer: when a
+consumer calls C{pauseProducing}, the stream is paused until
+C{resumeProducing} is called. Twisted transports do this on their own when
+their write buffer fills up. L{Backpressure} does the same for consumers
+that handle entries asynchronously, like message queue clients::
+
+    backpressure = Backpressure(publish, highWater=500, lowWater=100)
+    monitor = TwitterMonitor(feed.filter, backpressure.write, args)
+    backpressure.registerProducer(monitor, True)
+"""
+
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
+from twisted.python import log
+
+from twittytwister import metrics
+
+@implementer(IConsumer)
+class Backpressure(object):
+    """
+    Consumer that pauses its producer while too many entries are pending.
+
+    Each entry written is passed to C{handler}, which may return a
+    deferred. When C{highWater} entries are pending, the producer is
+    paused. It is resumed only when the number of pending entries has
+    dropped to C{lowWater}, so that a consumer working near its capacity
+    does not pause and resume the stream for every entry.
+
+    Failures of the handler are logged and counted as C{flow.errors}.
+    Besides that, this reports the number of pending entries
+    (C{flow.pending}), pauses (C{flow.pauses}) and the time spent paused
+    (C{flow.paused_time}).
+
+    @ivar handler: Called with each entry.
+
+    @ivar highWater: Number of pending entries to pause at.
+    @type highWater: C{int}
+
+    @ivar lowWater: Number of pending entries to resume at.
+    @type lowWater: C{int}
+
+    @ivar pending: Number of entries being handled.
+    @type pending: C{int}
+
+    @ivar paused: Whether the producer is currently paused.
+    @type paused: C{bool}
+
+    @ivar producer: The registered producer.
+    @type producer: L{twisted.internet.interfaces.IPushProducer}
+    """
+
+    metrics = metrics.NullMetrics()
+    producer = None
+    paused = False
+    _pausedSince = None
+
+    def __init__(self, handler, highWater=100, lowWater=None, metrics=None,
+                 reactor=None):
+        self.handler = handler
+        self.highWater = highWater
+        if lowWater is None:
+            lowWater = highWater // 2
+        self.lowWater = lowWater
+        if metrics is not None:
+            self.metrics = metrics
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.pending = 0
+
+
+    def registerProducer(self, producer, streaming):
+        """
+        Register a push producer.
+
+        @raises RuntimeError: When a producer is already registered.
+        @raises ValueError: For pull producers, which are not supported.
+        """
+        if self.producer is not None:
+            raise RuntimeError("Producer %r already registered" %
+                               (self.producer,))
+        if not streaming:
+            raise ValueError("Only push producers are supported")
+
+        self.producer = producer
+        if self.pending >= self.highWater:
+            self._pause()
+
+
+    def unregisterProducer(self):
+        """
+        Unregister the producer.
+        """
+        if self.paused:
+            self._resume()
+        self.producer = None
+
+
+    def write(self, entry):
+        """
+        Handle an entry.
+
+        This can be used as the delegate of a stream.
+        """
+        self.pending += 1
+        self.metrics.gauge('flow.pending', self.pending)
+        d = defer.maybeDeferred(self.handler, entry)
+        d.addErrback(self._failed)
+        d.addCallback(self._handled)
+
+        if (not self.paused and self.producer is not None and
+            self.pending >= self.highWater):
+            self._pause()
+
+
+    def _failed(self, failure):
+        self.metrics.increment('flow.errors')
+        log.err(failure, "Error handling entry")
+
+
+    def _handled(self, result):
+        self.pending -= 1
+        self.metrics.gauge('flow.pending', self.pending)
+        if self.paused and self.pending <= self.lowWater:
+            self._resume()
+
+
+    def _pause(self):
+        self.paused = True
+        self._pausedSince = self.reactor.seconds()
+        self.metrics.increment('flow.pauses')
+        self.producer.pauseProducing()
+
+
+    def _resume(self):
+        self.paused = False
+        self.metrics.timing('flow.paused_time',
+                            self.reactor.seconds() - self._pausedSince)
+        self.producer.resumeProducing()
@@ -0,0 +1,247 @@
+# -*- test-case-name: twittytwister.test.test_hub -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Fan-out of one stream to many in-process subscribers.
+
+A L{SubscriptionHub} is the delegate of a stream, and passes each entry on
+to its subscribers. Entries are decoded once and shared by all
+subscribers, so subscribers must not modify them. Each subscriber has its
+own bounded queue, an optional predicate, and handles one entry at a time,
+at its own pace. A slow or failing subscriber does not hold up the others::
+
+    monitor = TwitterMonitor(feed.filter, None, args)
+    monitor.subscribe(archive, name='archive', size=10000)
+    monitor.subscribe(alert, name='alert',
+                      predicate=lambda status: 'twisted' in status.text)
+
+Per subscriber, the number of queued entries (C{hub.<name>.queued}), and
+the number of delivered (C{hub.<name>.delivered}), dropped
+(C{hub.<name>.dropped}) and failed (C{hub.<name>.errors}) entries are
+reported, as is the time entries spent in the queue (C{hub.<name>.lag}).
+"""
+
+from collections import deque
+
+from twisted.internet import defer, threads
+from twisted.python import failure, log
+
+from twittytwister import metrics
+
+class Subscription(object):
+    """
+    A subscriber of a L{SubscriptionHub}.
+
+    When the queue is full, the oldest queued entry is dropped, so that
+    the subscriber falls behind by at most C{size} entries.
+
+    @ivar name: Name of the subscription, used for metrics.
+    @type name: C{str}
+
+    @ivar handler: Called with each entry. If it returns a deferred, the
+        next entry is passed when it has fired.
+
+    @ivar predicate: If set, called with each entry to decide whether to
+        pass it to C{handler}.
+
+    @ivar size: Maximum number of queued entries.
+    @type size: C{int}
+
+    @ivar threadpool: If set, the thread pool to call C{handler} in.
+    @type threadpool: L{twisted.python.threadpool.ThreadPool}
+
+    @ivar delivered: Number of entries passed to the handler.
+    @type delivered: C{int}
+
+    @ivar dropped: Number of entries dropped because the queue was full.
+    @type dropped: C{int}
+
+    @ivar errors: Number of entries for which the handler or predicate
+        failed.
+    @type errors: C{int}
+    """
+
+    def __init__(self, hub, name, handler, predicate=None, size=1000,
+                 threadpool=None):
+        self.hub = hub
+        self.name = name
+        self.handler = handler
+        self.predicate = predicate
+        self.size = size
+        self.threadpool = threadpool
+        self.queue = deque()
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.active = True
+        self._busy = False
+        self._prefix = 'hub.%s.' % (name,)
+
+
+    def __len__(self):
+        return len(self.queue)
+
+
+    def put(self, entry):
+        """
+        Queue an entry, if it matches the predicate.
+        """
+        if self.predicate is not None:
+            try:
+                if not self.predicate(entry):
+                    return
+            except:
+                self._failed(failure.Failure())
+                return
+
+        queue = self.queue
+        if len(queue) >= self.size:
+            queue.popleft()
+            self.dropped += 1
+            self.hub.metrics.increment(self._prefix + 'dropped')
+        queue.append((self.hub.reactor.seconds(), entry))
+        self.hub.metrics.gauge(self._prefix + 'queued', len(queue))
+        if not self._busy:
+            self._process()
+
+
+    def _process(self):
+        """
+        Pass queued entries to the handler, until one returns a deferred.
+        """
+        queue = self.queue
+        metrics = self.hub.metrics
+        self._busy = True
+        while queue and self.active:
+            queued, entry = queue.popleft()
+            metrics.gauge(self._prefix + 'queued', len(queue))
+            metrics.timing(self._prefix + 'lag',
+                           self.hub.reactor.seconds() - queued)
+            self.delivered += 1
+            metrics.increment(self._prefix + 'delivered')
+
+            if self.threadpool is not None:
+                d = threads.deferToThreadPool(self.hub.reactor,
+                                              self.threadpool,
+                                              self.handler, entry)
+            else:
+                d = defer.maybeDeferred(self.handler, entry)
+            d.addErrback(self._failed)
+
+            # A deferred that has been called can still wait on another
+            # deferred it chains to, so check whether it has a result.
+            done = []
+            d.addBoth(done.append)
+            if not done:
+                d.addCallback(self._done)
+                return
+        self._busy = False
+
+
+    def _done(self, result):
+        self._process()
+
+
+    def _failed(self, reason):
+        self.errors += 1
+        self.hub.metrics.increment(self._prefix + 'errors')
+        log.err(reason, "Subscriber %s failed" % (self.name,))
+
+
+    def cancel(self):
+        """
+        Stop receiving entries, discarding the queued ones.
+        """
+        self.hub.unsubscribe(self)
+
+
+
+class SubscriptionHub(object):
+    """
+    Delegate that passes each entry on to a set of subscriptions.
+
+    @ivar subscriptions: The current subscriptions.
+    @type subscriptions: C{list} of L{Subscription}
+
+    @ivar metrics: Metrics sink, see L{twittytwister.metrics}.
+    """
+
+    metrics = metrics.NullMetrics()
+
+    def __init__(self, metrics=None, reactor=None):
+        if metrics is not None:
+            self.metrics = metrics
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.subscriptions = []
+        self._count = 0
+
+
+    def __call__(self, entry):
+        """
+        Pass an entry to all subscriptions.
+        """
+        for subscription in self.subscriptions:
+            subscription.put(entry)
+
+
+    def subscribe(self, handler, predicate=None, size=1000, name=None,
+                  threadpool=None):
+        """
+        Add a subscription.
+
+        @param handler: Called with each entry. If it returns a deferred,
+            the next entry is passed when it has fired.
+
+        @param predicate: If set, called with each entry to decide whether
+            to pass it to C{handler}.
+
+        @param size: Maximum number of queued entries.
+        @type size: C{int}
+
+        @param name: Name of the subscription, used for metrics. Defaults
+            to C{subscriber<n>}.
+        @type name: C{str}
+
+        @param threadpool: If set, the thread pool to call C{handler} in.
+            Entries are still passed one at a time.
+
+        @rtype: L{Subscription}
+        """
+        self._count += 1
+        if name is None:
+            name = 'subscriber%d' % (self._count,)
+        subscription = Subscription(self, name, handler, predicate, size,
+                                    threadpool)
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+
+    def unsubscribe(self, subscription):
+        """
+        Remove a subscription, discarding its queued entries.
+        """
+        subscription.active = False
+        subscription.queue.clear()
+        self.subscriptions = [other for other in self.subscriptions
+                              if other is not subscription]
+
+
+    def stats(self):
+        """
+        Return the state of each subscription.
+
+        @return: Dictionary of subscription name to a dictionary with the
+            number of C{'queued'}, C{'delivered'}, C{'dropped'} and
+            C{'errors'} entries.
+        @rtype: C{dict}
+        """
+        return dict((subscription.name,
+                     {'queued': len(subscription),
+                      'delivered': subscription.delivered,
+                      'dropped': subscription.dropped,
+                      'errors': subscription.errors})
+                    for subscription in self.subscriptions)
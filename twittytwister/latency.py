@@ -0,0 +1,248 @@
+# -*- test-case-name: twittytwister.test.test_latency -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+End-to-end latency of stream messages.
+
+For each status received over a stream, L{twittytwister.streaming.TwitterStream}
+can take timestamps when its bytes arrive, when the datagram is complete,
+when it has been decoded and when the delegate was called and returned.
+Together with the time the status was created at Twitter, this splits the
+total lag into stages:
+
+ - C{'network'}: from creation to arrival of the first bytes. This includes
+   Twitter's own processing and clock skew between the hosts.
+ - C{'framing'}: from arrival to a complete datagram.
+ - C{'decoding'}: JSON decoding and creation of the status object.
+ - C{'consumer'}: time spent in the delegate.
+ - C{'total'}: from creation until the delegate returned.
+
+L{LatencyTracker} keeps a rolling window of samples per stage, from which
+percentiles can be computed.
+"""
+
+import calendar
+import time
+from collections import deque
+
+from twittytwister import metrics as _metrics
+
+MONTHS = dict((name, number) for number, name in
+              enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                         'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1))
+
+STAGES = ('network', 'framing', 'decoding', 'consumer', 'total')
+
+class CreatedAtParser(object):
+    """
+    Parser for the C{created_at} dates of Twitter, with caching.
+
+    Dates look like C{'Wed Aug 27 13:08:45 +0000 2008'}. As messages in a
+    stream are created within a short time of each other, the start of the
+    day is cached by the date and timezone part of the string, so that
+    parsing a date mostly comes down to slicing out the time of day.
+
+    @ivar maxSize: Maximum number of cached days, after which the cache is
+        cleared.
+    @type maxSize: C{int}
+    """
+
+    maxSize = 64
+
+    def __init__(self):
+        self._days = {}
+
+
+    def _dayStart(self, value):
+        month = MONTHS[value[4:7]]
+        day = int(value[8:10])
+        offset = value[20:25]
+        year = int(value[26:30])
+
+        seconds = calendar.timegm((year, month, day, 0, 0, 0))
+        offsetSeconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        if offset[0] == '-':
+            offsetSeconds = -offsetSeconds
+        return seconds - offsetSeconds
+
+
+    def parse(self, value):
+        """
+        Parse a date into seconds since the epoch.
+
+        @param value: The date, in Twitter's format.
+        @type value: C{unicode} or C{str}
+
+        @return: Seconds since the epoch, or C{None} if the date could not be
+            parsed.
+        @rtype: C{int}
+        """
+        key = value[4:10] + value[19:]
+        try:
+            dayStart = self._days[key]
+        except KeyError:
+            try:
+                dayStart = self._dayStart(value)
+            except (KeyError, ValueError, IndexError):
+                return None
+            if len(self._days) >= self.maxSize:
+                self._days.clear()
+            self._days[key] = dayStart
+
+        try:
+            return dayStart + (int(value[11:13]) * 3600 +
+                               int(value[14:16]) * 60 +
+                               int(value[17:19]))
+        except ValueError:
+            return None
+
+
+
+_parser = CreatedAtParser()
+
+def messageTime(obj):
+    """
+    Return the creation time of a decoded stream message.
+
+    The millisecond precision C{timestamp_ms} is used if present, otherwise
+    C{created_at} is parsed.
+
+    @param obj: The decoded JSON object.
+    @type obj: C{dict}
+
+    @return: Seconds since the epoch or C{None} if unknown.
+    @rtype: C{float}
+    """
+    timestamp = obj.get('timestamp_ms')
+    if timestamp is not None:
+        try:
+            return int(timestamp) / 1000.
+        except (TypeError, ValueError):
+            pass
+
+    createdAt = obj.get('created_at')
+    if createdAt is not None:
+        try:
+            return _parser.parse(createdAt)
+        except TypeError:
+            return None
+    else:
+        return None
+
+
+
+class RollingWindow(object):
+    """
+    The most recent samples of a value, for computing percentiles.
+
+    @ivar size: Maximum number of samples kept.
+    @type size: C{int}
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.samples = deque(maxlen=size)
+
+
+    def add(self, value):
+        self.samples.append(value)
+
+
+    def __len__(self):
+        return len(self.samples)
+
+
+    def percentiles(self, percentiles=(50, 90, 99)):
+        """
+        Return percentiles of the samples, using the nearest rank method.
+
+        @param percentiles: The percentiles to compute, between 0 and 100.
+
+        @return: Dictionary of percentile to value, empty without samples.
+        @rtype: C{dict}
+        """
+        if not self.samples:
+            return {}
+
+        ordered = sorted(self.samples)
+        result = {}
+        for percentile in percentiles:
+            rank = int(round(percentile / 100. * len(ordered))) - 1
+            result[percentile] = ordered[min(max(rank, 0), len(ordered) - 1)]
+        return result
+
+
+
+class LatencyTracker(object):
+    """
+    Tracker of the per stage latency of stream messages.
+
+    @ivar windows: Rolling window of samples per stage.
+    @type windows: C{dict}
+
+    @ivar metrics: Metrics sink that receives a timing per stage, as
+        C{'latency.<stage>'}. See L{twittytwister.metrics}.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, size=1000, metrics=None):
+        self.windows = dict((stage, RollingWindow(size)) for stage in STAGES)
+        if metrics is None:
+            metrics = _metrics.NullMetrics()
+        self.metrics = metrics
+        self.count = 0
+
+
+    def record(self, created, arrived, framed, decoded, delegated, done):
+        """
+        Record the timestamps of a single message.
+
+        @param created: Creation time at Twitter, or C{None} if unknown. In
+            that case, the C{'network'} and C{'total'} stages are not
+            recorded.
+        """
+        self.count += 1
+        samples = [('framing', framed - arrived),
+                   ('decoding', decoded - framed),
+                   ('consumer', done - delegated)]
+        if created is not None:
+            samples.append(('network', arrived - created))
+            samples.append(('total', done - created))
+
+        for stage, value in samples:
+            self.windows[stage].add(value)
+            self.metrics.timing('latency.' + stage, value)
+
+
+    def percentiles(self, percentiles=(50, 90, 99)):
+        """
+        Return the percentiles of all stages.
+
+        @return: Dictionary of stage to a dictionary of percentile to value.
+        @rtype: C{dict}
+        """
+        return dict((stage, window.percentiles(percentiles))
+                    for stage, window in self.windows.iteritems())
+
+
+    def bottleneck(self, percentile=90):
+        """
+        Return the stage that contributes most to the lag.
+
+        @return: Name of the stage with the largest value at C{percentile},
+            not counting C{'total'}, or C{None} without samples.
+        @rtype: C{str}
+        """
+        worst = None
+        worstValue = None
+        for stage in STAGES[:-1]:
+            value = self.windows[stage].percentiles((percentile,)).get(
+                    percentile)
+            if value is not None and (worstValue is None or
+                                      value > worstValue):
+                worst = stage
+                worstValue = value
+        return worst
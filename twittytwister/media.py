@@ -0,0 +1,241 @@
+# -*- test-case-name: twittytwister.test.test_media -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Chunked media uploads.
+
+Media are uploaded in three steps: C{INIT} announces the size and type of
+the media and returns a media ID, C{APPEND} uploads the segments of the
+file and C{FINALIZE} completes the upload. For media that need processing,
+like videos, C{STATUS} is polled until processing has finished. The
+resulting media ID can be passed to
+L{twittytwister.twitter.Twitter.update} as the C{media_ids} parameter.
+
+Segments are uploaded in parallel, with bounded concurrency, by a
+L{twittytwister.bulk.BulkExecutor}, so that failed segments are retried on
+their own. Each segment is streamed from the file by a
+L{twittytwister.multipart.MultipartProducer}.
+"""
+
+import os
+
+import simplejson as json
+
+from twisted.internet import defer
+
+from twittytwister import bulk, multipart
+
+class MediaUploadError(Exception):
+    """
+    The upload or processing of media failed.
+    """
+
+
+
+class FileSegment(object):
+    """
+    Read-only file-like view on a segment of a file.
+
+    The position of the underlying file is set on each read, so that
+    several segments of the same file can be read concurrently.
+
+    @ivar offset: Offset of the segment in the file.
+    @type offset: C{int}
+
+    @ivar length: Length of the segment.
+    @type length: C{int}
+    """
+
+    def __init__(self, fObj, offset, length):
+        self.file = fObj
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+
+    def tell(self):
+        return self.position
+
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = min(max(offset, 0), self.length)
+
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        self.file.seek(self.offset + self.position)
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+
+
+class ChunkedUpload(object):
+    """
+    Chunked upload of a single media file.
+
+    @ivar api: The API to upload with.
+    @type api: L{twittytwister.twitter.Twitter}
+
+    @ivar mediaType: The MIME type of the media, e.g. C{'video/mp4'}.
+    @type mediaType: C{str}
+
+    @ivar mediaCategory: The media category, e.g. C{'tweet_video'}, optional.
+    @type mediaCategory: C{str}
+
+    @ivar mediaID: The media ID, once the upload has been initialized.
+    @type mediaID: C{str}
+    """
+
+    segmentSize = 1024 * 1024
+    concurrency = 3
+    maxRetries = 3
+    retryDelay = 1
+    maxStatusChecks = 60
+
+    def __init__(self, api, fObj, mediaType, mediaCategory=None,
+                 segmentSize=None, concurrency=None, reactor=None):
+        """
+        @param fObj: The media, as a file-like object that supports C{seek}
+            and C{tell}, read from its current position.
+        """
+        self.api = api
+        self.file = fObj
+        self.mediaType = mediaType
+        self.mediaCategory = mediaCategory
+        if segmentSize is not None:
+            self.segmentSize = segmentSize
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        self.start = fObj.tell()
+        self.totalBytes = multipart._fileLength(fObj)
+        self.mediaID = None
+
+
+    def _post(self, fields, files=()):
+        producer = multipart.MultipartProducer(fields, files)
+        d = self.api._requestBody('POST', self.api.upload_url, producer,
+                                  {'Content-Type': producer.contentType})
+        d.addCallback(self._decode)
+        return d
+
+
+    def _decode(self, body):
+        if body:
+            return json.loads(body)
+        else:
+            return None
+
+
+    def _sleep(self, delay):
+        d = defer.Deferred()
+        self.reactor.callLater(delay, d.callback, None)
+        return d
+
+
+    def segments(self):
+        """
+        Return the segments of the file.
+
+        @rtype: C{list} of L{FileSegment}
+        """
+        return [FileSegment(self.file, self.start + offset,
+                            min(self.segmentSize, self.totalBytes - offset))
+                for offset in xrange(0, self.totalBytes, self.segmentSize)]
+
+
+    def init(self):
+        fields = [('command', 'INIT'),
+                  ('total_bytes', str(self.totalBytes)),
+                  ('media_type', self.mediaType)]
+        if self.mediaCategory is not None:
+            fields.append(('media_category', self.mediaCategory))
+
+        def cb(result):
+            self.mediaID = result['media_id_string']
+            return self.mediaID
+
+        d = self._post(fields)
+        d.addCallback(cb)
+        return d
+
+
+    def append(self, index, segment):
+        # Read from the start of the segment, also when retrying.
+        segment.seek(0)
+        fields = [('command', 'APPEND'),
+                  ('media_id', self.mediaID),
+                  ('segment_index', str(index))]
+        return self._post(fields, [('media', None, segment)])
+
+
+    def finalize(self):
+        return self._post([('command', 'FINALIZE'),
+                           ('media_id', self.mediaID)])
+
+
+    def status(self):
+        d = self.api._requestBody('GET', self.api.upload_url, None,
+                                  params={'command': 'STATUS',
+                                          'media_id': self.mediaID})
+        d.addCallback(self._decode)
+        return d
+
+
+    @defer.inlineCallbacks
+    def run(self):
+        """
+        Upload the media.
+
+        @return: Deferred that fires with the media ID when the media has
+            been uploaded and processed. It errbacks with
+            L{MediaUploadError} if processing failed, or with the failure of
+            the first segment that could not be uploaded.
+        """
+        yield self.init()
+
+        failures = []
+
+        def failed(operation, failure):
+            failures.append(failure)
+
+        executor = bulk.BulkExecutor(concurrency=self.concurrency,
+                                     failureDelegate=failed,
+                                     reactor=self.reactor)
+        executor.maxRetries = self.maxRetries
+        executor.retryDelay = self.retryDelay
+        yield executor.run([(self.append, (index, segment))
+                            for index, segment
+                            in enumerate(self.segments())])
+        if failures:
+            failures[0].raiseException()
+
+        result = yield self.finalize()
+        checks = 0
+        info = (result or {}).get('processing_info')
+        while info and info.get('state') in ('pending', 'in_progress'):
+            checks += 1
+            if checks > self.maxStatusChecks:
+                raise MediaUploadError("Processing of %s did not finish" %
+                                       self.mediaID)
+            yield self._sleep(info.get('check_after_secs', 1))
+            result = yield self.status()
+            info = (result or {}).get('processing_info')
+
+        if info and info.get('state') == 'failed':
+            raise MediaUploadError(info.get('error', {}).get('message',
+                                                             'failed'))
+
+        defer.returnValue(self.mediaID)
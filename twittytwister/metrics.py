@@ -0,0 +1,288 @@
+# -*- test-case-name: twittytwister.test.test_metrics -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Metrics for streams and monitors.
+
+Metrics are reported to a sink with three methods: C{increment} for
+counters, C{gauge} for values that go up and down and C{timing} for
+observations of durations (in seconds) that end up in histograms. The
+default sink, L{NullMetrics}, discards everything, so that
+instrumentation costs no more than a method call unless a real sink is
+configured.
+
+Available sinks are L{MemoryMetrics}, which keeps everything in memory for
+snapshots and can be exposed through a L{PrometheusResource},
+L{StatsDMetrics}, which emits to a StatsD daemon over UDP, and
+L{MultiMetrics} to combine several sinks.
+"""
+
+import bisect
+import re
+import socket
+
+from twisted.web import resource
+
+class NullMetrics(object):
+    """
+    Metrics sink that discards all metrics.
+    """
+
+    def increment(self, name, value=1):
+        """
+        Increment a counter.
+
+        @param name: Name of the counter, components separated by dots.
+        @type name: C{str}
+
+        @param value: Amount to increment with.
+        @type value: C{int}
+        """
+
+
+    def gauge(self, name, value):
+        """
+        Set a gauge to a value.
+        """
+
+
+    def timing(self, name, value):
+        """
+        Record an observation of a duration, in seconds.
+        """
+
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets.
+
+    @ivar buckets: Upper bounds of the buckets, in ascending order. An
+        implicit bucket for larger values is added.
+    @type buckets: C{tuple}
+
+    @ivar counts: Number of observations per bucket, not cumulative.
+    @type counts: C{list}
+    """
+
+    defaultBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                      0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=None):
+        if buckets is None:
+            buckets = self.defaultBuckets
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+    def cumulative(self):
+        """
+        Return the cumulative counts, as pairs of upper bound and count.
+
+        The last pair has an upper bound of infinity.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+
+class MemoryMetrics(object):
+    """
+    Metrics sink that keeps all metrics in memory.
+
+    @ivar counters: Counter values by name.
+    @type counters: C{dict}
+
+    @ivar gauges: Gauge values by name.
+    @type gauges: C{dict}
+
+    @ivar histograms: Histograms by name.
+    @type histograms: C{dict}
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+
+    def timing(self, name, value):
+        try:
+            histogram = self.histograms[name]
+        except KeyError:
+            histogram = self.histograms[name] = Histogram(self.buckets)
+        histogram.observe(value)
+
+
+    def snapshot(self):
+        """
+        Return a copy of the current metrics.
+
+        @return: Dictionary with the keys C{'counters'}, C{'gauges'} and
+            C{'histograms'}. The latter holds a dictionary with the count,
+            sum and cumulative bucket counts of each histogram.
+        @rtype: C{dict}
+        """
+        histograms = {}
+        for name, histogram in self.histograms.iteritems():
+            histograms[name] = {'count': histogram.count,
+                                'sum': histogram.sum,
+                                'buckets': histogram.cumulative()}
+        return {'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': histograms}
+
+
+
+class StatsDMetrics(object):
+    """
+    Metrics sink that emits to a StatsD daemon over UDP.
+
+    Packets are sent right away on a non-blocking socket. Send errors are
+    ignored, as metrics are best effort.
+
+    @ivar prefix: Prefix for all metric names, e.g. C{'twitter.'}.
+    @type prefix: C{str}
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix=''):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+
+    def _send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+
+    def increment(self, name, value=1):
+        self._send('%s%s:%d|c' % (self.prefix, name, value))
+
+
+    def gauge(self, name, value):
+        self._send('%s%s:%s|g' % (self.prefix, name, value))
+
+
+    def timing(self, name, value):
+        self._send('%s%s:%0.3f|ms' % (self.prefix, name, value * 1000))
+
+
+    def close(self):
+        self.socket.close()
+
+
+
+class MultiMetrics(object):
+    """
+    Metrics sink that passes all metrics on to several other sinks.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+
+    def increment(self, name, value=1):
+        for sink in self.sinks:
+            sink.increment(name, value)
+
+
+    def gauge(self, name, value):
+        for sink in self.sinks:
+            sink.gauge(name, value)
+
+
+    def timing(self, name, value):
+        for sink in self.sinks:
+            sink.timing(name, value)
+
+
+
+_invalidPrometheusChars = re.compile('[^a-zA-Z0-9_:]')
+
+def _prometheusName(name):
+    return _invalidPrometheusChars.sub('_', name)
+
+
+
+def _prometheusValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    else:
+        return repr(value)
+
+
+
+class PrometheusResource(resource.Resource):
+    """
+    Web resource rendering metrics in the Prometheus text exposition format.
+
+    @ivar metrics: The metrics to expose.
+    @type metrics: L{MemoryMetrics}
+    """
+
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.exposition()
+
+
+    def exposition(self):
+        """
+        Return the current metrics in the text exposition format.
+
+        Metric names have their dots replaced by underscores.
+        """
+        lines = []
+        for name, value in sorted(self.metrics.counters.iteritems()):
+            name = _prometheusName(name)
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %s' % (name, _prometheusValue(value)))
+
+        for name, value in sorted(self.metrics.gauges.iteritems()):
+            name = _prometheusName(name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, _prometheusValue(value)))
+
+        for name, histogram in sorted(self.metrics.histograms.iteritems()):
+            name = _prometheusName(name)
+            lines.append('# TYPE %s histogram' % name)
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket{le="%s"} %d' %
+                             (name, _prometheusValue(bound), count))
+            lines.append('%s_sum %s' % (name, _prometheusValue(histogram.sum)))
+            lines.append('%s_count %d' % (name, histogram.count))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,181 @@
+# -*- test-case-name: twittytwister.test.test_multipart -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Streaming C{multipart/form-data} request bodies.
+
+L{MultipartProducer} writes form fields and file contents to the request as
+the connection is ready to receive them, reading files in chunks instead of
+building the whole body in memory. The length of the body is computed up
+front, so that requests carry a C{Content-Length} header.
+
+Each chunk is read into a new string, which is handed to the transport as
+is. The transport keeps written data until it is sent and pauses the
+producer while its buffer is full, so the memory used by an upload is
+bounded by that buffer and one chunk.
+"""
+
+import os
+import uuid
+
+from zope.interface import implementer
+
+from twisted.internet import defer, task
+from twisted.web.iweb import IBodyProducer
+
+def _contentType(filename):
+    import mimetypes
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+
+def _fileLength(fObj):
+    """
+    Return the number of bytes from the current position to the end.
+    """
+    position = fObj.tell()
+    fObj.seek(0, os.SEEK_END)
+    end = fObj.tell()
+    fObj.seek(position, os.SEEK_SET)
+    return end - position
+
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+
+@implementer(IBodyProducer)
+class MultipartProducer(object):
+    """
+    Body producer for C{multipart/form-data} requests.
+
+    File contents can be given as a string or as a file-like object that
+    supports C{seek} and C{tell}. File objects are read from their position
+    at the time the producer was created, up to their end at that time, and
+    are not closed. Producing can be started again, e.g. to retry a failed
+    request.
+
+    @ivar length: Length of the body, in bytes.
+    @type length: C{int}
+
+    @ivar boundary: The boundary between parts.
+    @type boundary: C{str}
+
+    @ivar contentType: The value of the C{Content-Type} header for the
+        request.
+    @type contentType: C{str}
+
+    @ivar chunkSize: Number of bytes to read from files at a time.
+    @type chunkSize: C{int}
+    """
+
+    chunkSize = 2 ** 16
+
+    def __init__(self, fields=(), files=(), boundary=None, chunkSize=None,
+                 cooperator=task):
+        """
+        @param fields: Sequence of C{(name, value)} for regular form fields.
+
+        @param files: Sequence of C{(name, filename, data)} for files, where
+            C{data} is a string or a file-like object. If C{filename} is
+            C{None}, there is no filename and the content type is
+            C{application/octet-stream}.
+        """
+        if boundary is None:
+            boundary = uuid.uuid4().hex
+        self.boundary = boundary
+        self.contentType = 'multipart/form-data; boundary=%s' % boundary
+        if chunkSize is not None:
+            self.chunkSize = chunkSize
+        self._cooperate = cooperator.cooperate
+        self._task = None
+
+        self._segments = []
+        for name, value in fields:
+            self._addString('--%s\r\n'
+                            'Content-Disposition: form-data; name="%s"\r\n'
+                            '\r\n' % (boundary, _encode(name)))
+            self._addString(_encode(value))
+            self._addString('\r\n')
+
+        for name, filename, data in files:
+            if filename is None:
+                disposition = 'form-data; name="%s"' % _encode(name)
+                contentType = 'application/octet-stream'
+            else:
+                disposition = 'form-data; name="%s"; filename="%s"' % (
+                        _encode(name), _encode(filename))
+                contentType = _contentType(filename)
+            self._addString('--%s\r\n'
+                            'Content-Disposition: %s\r\n'
+                            'Content-Type: %s\r\n'
+                            '\r\n' % (boundary, disposition, contentType))
+            if isinstance(data, basestring):
+                self._addString(_encode(data))
+            else:
+                self._segments.append((data, data.tell(), _fileLength(data)))
+            self._addString('\r\n')
+
+        self._addString('--%s--\r\n' % boundary)
+        self.length = sum(length for _, _, length in self._segments)
+
+
+    def _addString(self, data):
+        self._segments.append((data, None, len(data)))
+
+
+    def startProducing(self, consumer):
+        """
+        Start writing the body to C{consumer}.
+
+        @return: Deferred that fires when the body has been written.
+        """
+        self._task = self._cooperate(self._writeloop(consumer))
+        d = self._task.whenDone()
+
+        def eb(reason):
+            if reason.check(defer.CancelledError):
+                self.stopProducing()
+            elif not reason.check(task.TaskStopped):
+                return reason
+            # The deferred of startProducing doesn't fire after a stop.
+            return defer.Deferred()
+
+        d.addCallbacks(lambda _: None, eb)
+        return d
+
+
+    def _writeloop(self, consumer):
+        for data, start, length in self._segments:
+            if start is None:
+                consumer.write(data)
+                yield None
+                continue
+
+            data.seek(start, os.SEEK_SET)
+            remaining = length
+            while remaining:
+                chunk = data.read(min(remaining, self.chunkSize))
+                if not chunk:
+                    raise IOError("File ended %d bytes early" % remaining)
+                consumer.write(chunk)
+                remaining -= len(chunk)
+                yield None
+
+
+    def pauseProducing(self):
+        self._task.pause()
+
+
+    def resumeProducing(self):
+        self._task.resume()
+
+
+    def stopProducing(self):
+        self._task.stop()
@@ -9,16 +9,81 @@ Twitter Platform objects.
 @see: U{https://dev.twitter.com/docs/platform-objects}.
 """
 
+from collections import OrderedDict
+
+import simplejson as json
+
 from twisted.python import log
 
+SIMPLE, COMPLEX, LIST = 'simple', 'complex', 'list'
+
+_REMOVED = object()
+
+class InternPool(object):
+    """
+    Bounded pool of shared strings.
+
+    In a stream, the same screen names, sources and the like are received
+    over and over again, each time decoded into a new string. Interning
+    them through this pool replaces equal strings by a single shared
+    instance. When the pool is full, the least recently used string is
+    evicted.
+
+    @ivar maxSize: Maximum number of strings in the pool.
+    @type maxSize: C{int}
+
+    @ivar hits: Number of strings that were replaced by a pooled one.
+    @type hits: C{int}
+    """
+
+    def __init__(self, maxSize=10000):
+        self.maxSize = maxSize
+        self.hits = 0
+        self._strings = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._strings)
+
+
+    def intern(self, value):
+        """
+        Return the pooled string equal to C{value}, adding it if needed.
+        """
+        strings = self._strings
+        try:
+            pooled = strings.pop(value)
+        except KeyError:
+            pooled = value
+            if len(strings) >= self.maxSize:
+                strings.popitem(last=False)
+        else:
+            self.hits += 1
+        strings[value] = pooled
+        return pooled
+
+
+
 class TwitterObject(object):
     """
     A Twitter Platform object.
+
+    @cvar internPool: If set, the pool used to intern the string values of
+        the properties in L{INTERN_PROPS}, both in the attributes and in
+        L{raw}. Set this on L{TwitterObject} to share a pool between all
+        classes, or on a subclass.
+    @type internPool: L{InternPool}
+
+    @cvar INTERN_PROPS: Simple properties that are interned if there is an
+        L{internPool}.
+    @type INTERN_PROPS: C{set}
     """
     raw = None
     SIMPLE_PROPS = None
     COMPLEX_PROPS = None
     LIST_PROPS = None
+    INTERN_PROPS = None
+    internPool = None
 
     @classmethod
     def fromDict(cls, data):
@@ -26,56 +91,181 @@ class TwitterObject(object):
         Fill this objects attributes from a dict for known properties.
         """
         obj = cls()
-        obj.raw = data
+        obj._setProperties(data)
+        return obj
+
+
+    def _setProperties(self, data):
+        cls = self.__class__
+        self.raw = data
+        pool = cls.internPool
+        if pool is not None and cls.INTERN_PROPS:
+            for name in cls.INTERN_PROPS:
+                value = data.get(name)
+                if isinstance(value, basestring):
+                    data[name] = pool.intern(value)
+
         for name, value in data.iteritems():
             if cls.SIMPLE_PROPS and name in cls.SIMPLE_PROPS:
-                setattr(obj, name, value)
+                setattr(self, name, value)
             elif cls.COMPLEX_PROPS and name in cls.COMPLEX_PROPS:
-                value = cls.COMPLEX_PROPS[name].fromDict(value)
-                setattr(obj, name, value)
+                obj = cls.COMPLEX_PROPS[name].fromDict(value)
+                setattr(self, name, obj)
             elif cls.LIST_PROPS and name in cls.LIST_PROPS:
                 value = [cls.LIST_PROPS[name].fromDict(item)
                          for item in value]
-                setattr(obj, name, value)
+                setattr(self, name, value)
 
-        return obj
+
+    @classmethod
+    def _fields(cls):
+        """
+        Return the names and kinds of all properties, sorted by name.
+
+        This is computed once per class, on first use, as some properties
+        are only added after the class has been defined.
+        """
+        try:
+            return cls.__dict__['_FIELDS']
+        except KeyError:
+            fields = []
+            for kind, props in ((SIMPLE, cls.SIMPLE_PROPS),
+                                (COMPLEX, cls.COMPLEX_PROPS),
+                                (LIST, cls.LIST_PROPS)):
+                for name in props or ():
+                    fields.append((name, kind))
+            fields.sort()
+            cls._FIELDS = fields
+            return fields
 
 
     def __repr__(self):
-        bodyParts = []
-        for name in dir(self):
-            if self.SIMPLE_PROPS and name in self.SIMPLE_PROPS:
-                if hasattr(self, name):
-                    bodyParts.append("%s=%s" % (name,
-                                                repr(getattr(self, name))))
+        parts = []
+        self._reprParts(parts, '')
+        return ''.join(parts)
 
-            elif self.COMPLEX_PROPS and name in self.COMPLEX_PROPS:
-                if hasattr(self, name):
-                    bodyParts.append("%s=%s" % (name,
-                                                repr(getattr(self, name))))
-            elif self.LIST_PROPS and name in self.LIST_PROPS:
-                if hasattr(self, name):
-                    items = getattr(self, name)
 
-                    itemBodyParts = []
-                    for item in items:
-                        itemBodyParts.append(repr(item))
+    def _reprParts(self, parts, indent):
+        """
+        Append the parts of the representation of this object.
+
+        @param indent: Indentation of the lines following the first.
+        """
+        inner = indent + '    '
+        separator = ',\n' + inner
+        attributes = self.__dict__
+        parts.append(self.__class__.__name__ + '(\n' + inner)
+        first = True
+        for name, kind in self._fields():
+            if name not in attributes:
+                continue
+            if first:
+                first = False
+            else:
+                parts.append(separator)
+            parts.append(name + '=')
+            value = attributes[name]
+            if kind is LIST:
+                if value:
+                    itemIndent = inner + '    '
+                    parts.append('[\n' + itemIndent)
+                    for i, item in enumerate(value):
+                        if i:
+                            parts.append(',\n' + itemIndent)
+                        _reprParts(item, parts, itemIndent)
+                    parts.append('\n' + inner + ']')
+                else:
+                    parts.append('[]')
+            else:
+                _reprParts(value, parts, inner)
+        parts.append('\n' + indent + ')')
+
+
+    def toDict(self):
+        """
+        Return the data of this object as a dictionary.
 
-                    itemBody = ',\n'.join(itemBodyParts)
-                    lines = itemBody.splitlines()
-                    itemBody = '\n    '.join(lines)
+        If no properties were changed since the object was created from
+        L{raw}, that is returned as is. Otherwise a copy of L{raw} with the
+        changed properties is returned. In both cases, the result must not
+        be modified.
 
-                    if itemBody:
-                        itemBody = '\n    %s\n' % (itemBody,)
+        Properties set to a user shared through L{UserCache} keep the data
+        in L{raw}, as that user may have been updated since.
 
-                    bodyParts.append("%s=[%s]" % (name, itemBody))
+        @rtype: C{dict}
+        """
+        raw = self.raw
+        if raw is None:
+            raw = {}
+        attributes = self.__dict__
+        changes = None
+        for name, kind in self._fields():
+            if name not in attributes:
+                if name in raw:
+                    changes = changes or {}
+                    changes[name] = _REMOVED
+                continue
+
+            value = attributes[name]
+            original = raw.get(name, _REMOVED)
+            if kind is SIMPLE:
+                if value is original:
+                    continue
+            elif kind is COMPLEX:
+                if (getattr(value, '_shared', False) and
+                    isinstance(original, dict) and
+                    original.get('id') == getattr(value, 'id', None)):
+                    continue
+                value = _toDict(value)
+                if value is original:
+                    continue
+            else:
+                value = [_toDict(item) for item in value]
+                if (isinstance(original, list) and
+                    len(value) == len(original) and
+                    all(a is b for a, b in zip(value, original))):
+                    continue
+            changes = changes or {}
+            changes[name] = value
+
+        if changes is None:
+            if self.raw is None:
+                return {}
+            return raw
+
+        data = dict(raw)
+        for name, value in changes.iteritems():
+            if value is _REMOVED:
+                del data[name]
+            else:
+                data[name] = value
+        return data
+
+
+    def toJSON(self):
+        """
+        Return the data of this object, JSON encoded.
 
-        body = ',\n'.join(bodyParts)
-        lines = body.splitlines()
-        body = '\n    '.join(lines)
+        @rtype: C{str}
+        """
+        return json.dumps(self.toDict())
 
-        result = "%s(\n    %s\n)" % (self.__class__.__name__, body)
-        return result
+
+
+def _reprParts(value, parts, indent):
+    if isinstance(value, TwitterObject) and \
+       type(value).__repr__ is TwitterObject.__repr__:
+        value._reprParts(parts, indent)
+    else:
+        parts.append(repr(value).replace('\n', '\n' + indent))
+
+
+
+def _toDict(value):
+    if isinstance(value, TwitterObject):
+        return value.toDict()
+    return value
 
 
 
@@ -101,6 +291,19 @@ class Indices(TwitterObject):
                                          self.start, self.end)
 
 
+    def toDict(self):
+        """
+        Return the indices as a list of start and end.
+
+        @rtype: C{list}
+        """
+        raw = self.raw
+        if (isinstance(raw, list) and len(raw) == 2 and
+            raw[0] is self.start and raw[1] is self.end):
+            return raw
+        return [self.start, self.end]
+
+
 
 class Size(TwitterObject):
     """
@@ -142,12 +345,14 @@ class URL(TwitterObject):
 
 class UserMention(TwitterObject):
     SIMPLE_PROPS = set(['id', 'screen_name', 'name'])
+    INTERN_PROPS = set(['screen_name', 'name'])
     COMPLEX_PROPS = {'indices': Indices}
 
 
 
 class HashTag(TwitterObject):
     SIMPLE_PROPS = set(['text'])
+    INTERN_PROPS = set(['text'])
     COMPLEX_PROPS = {'indices': Indices}
 
 
@@ -167,8 +372,9 @@ class Status(TwitterObject):
     """
     SIMPLE_PROPS = set(['created_at', 'id', 'text', 'source', 'truncated',
         'in_reply_to_status_id', 'in_reply_to_screen_name',
-        'in_reply_to_user_id', 'favorited', 'user_id', 'geo'])
+        'in_reply_to_user_id', 'favorited', 'user_id', 'geo', 'lang'])
     COMPLEX_PROPS = {'entities': Entities}
+    INTERN_PROPS = set(['source', 'lang', 'in_reply_to_screen_name'])
 
 # circular reference:
 Status.COMPLEX_PROPS['retweeted_status'] = Status
@@ -178,6 +384,10 @@ Status.COMPLEX_PROPS['retweeted_status'] = Status
 class User(TwitterObject):
     """
     Twitter User.
+
+    @cvar userCache: If set, the cache that makes L{fromDict} return the
+        same instance for all occurrences of a user.
+    @type userCache: L{UserCache}
     """
     SIMPLE_PROPS = set(['id', 'name', 'screen_name', 'location', 'description',
         'profile_image_url', 'url', 'protected', 'followers_count',
@@ -186,12 +396,117 @@ class User(TwitterObject):
         'friends_count', 'created_at', 'favourites_count', 'utc_offset',
         'time_zone', 'following', 'notifications', 'statuses_count',
         'profile_background_image_url', 'profile_background_tile', 'verified',
-        'geo_enabled'])
+        'geo_enabled', 'lang'])
     COMPLEX_PROPS = {'status': Status}
+    _shared = False
+    INTERN_PROPS = set(['name', 'screen_name', 'location', 'description',
+        'profile_image_url', 'url', 'profile_background_color',
+        'profile_text_color', 'profile_link_color',
+        'profile_sidebar_fill_color', 'profile_sidebar_border_color',
+        'created_at', 'time_zone', 'profile_background_image_url', 'lang'])
+    userCache = None
+
+    @classmethod
+    def fromDict(cls, data):
+        cache = cls.userCache
+        if cache is None:
+            return super(User, cls).fromDict(data)
+        return cache.fromDict(cls, data)
 
 # circular reference:
 Status.COMPLEX_PROPS['user'] = User
 
 
 
+class UserCache(object):
+    """
+    Identity map of users by ID.
+
+    Statuses in a stream each embed the full user that posted it. With this
+    cache set as L{User.userCache}, decoding the user of a status returns
+    the cached instance for that user ID. All statuses by a user then share
+    a single L{User}. If the embedded user is newer, judged by its
+    C{statuses_count}, the cached instance is updated in place. The cache
+    always holds the latest known state of a user, see L{get}. A user with
+    a different C{created_at} is another account, and replaces the cached
+    one.
+
+    The C{raw} data of a status keeps the user as received. When the cache
+    is full, the least recently seen user is evicted.
+
+    @ivar maxSize: Maximum number of cached users.
+    @type maxSize: C{int}
+
+    @ivar hits: Number of lookups that returned a cached user unchanged.
+    @type hits: C{int}
+
+    @ivar updates: Number of cached users that were updated.
+    @type updates: C{int}
+
+    @ivar misses: Number of users that were not cached, or replaced.
+    @type misses: C{int}
+    """
+
+    def __init__(self, maxSize=10000):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.updates = 0
+        self.misses = 0
+        self._users = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._users)
+
+
+    def __contains__(self, userID):
+        return userID in self._users
+
+
+    def get(self, userID):
+        """
+        Return the latest known state of a user, or C{None}.
+
+        @rtype: L{User}
+        """
+        return self._users.get(userID)
+
+
+    def fromDict(self, cls, data):
+        """
+        Return the user for decoded data, using the cached user if any.
+        """
+        userID = data.get('id')
+        if userID is None:
+            return super(User, cls).fromDict(data)
+
+        users = self._users
+        user = users.pop(userID, None)
+        if (user is None or
+            user.raw.get('created_at') != data.get('created_at')):
+            self.misses += 1
+            user = super(User, cls).fromDict(data)
+            user._shared = True
+            if len(users) >= self.maxSize:
+                users.popitem(last=False)
+        elif (data.get('statuses_count', -1) >
+              user.raw.get('statuses_count', -1)):
+            self.updates += 1
+            # Build the new state first and apply it in one step, so that
+            # the user is never seen without its properties.
+            fresh = super(User, cls).fromDict(data)
+            fresh._shared = True
+            attributes = fresh.__dict__
+            stale = [name for name in user.__dict__
+                     if name not in attributes]
+            user.__dict__.update(attributes)
+            for name in stale:
+                delattr(user, name)
+        else:
+            self.hits += 1
+        users[userID] = user
+        return user
+
+
+
 
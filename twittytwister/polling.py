@@ -0,0 +1,344 @@
+# -*- test-case-name: twittytwister.test.test_polling -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Incremental polling of REST timelines.
+"""
+
+from twisted.application import service
+from twisted.internet import defer
+from twisted.python import log
+
+class Timeline(object):
+    """
+    A timeline that is polled by L{TimelinePoller}.
+
+    @ivar name: Name of the timeline, also used as key in the checkpoint.
+    @type name: C{str}
+
+    @ivar method: The REST API method used to fetch the timeline, e.g.
+        L{twittytwister.twitter.Twitter.home_timeline}.
+
+    @ivar args: Extra positional arguments to C{method}, after the delegate.
+    @type args: C{tuple}
+
+    @ivar params: Extra request parameters.
+    @type params: C{dict}
+
+    @ivar sinceID: Highest item ID seen so far, or C{None}.
+    @type sinceID: C{int}
+
+    @ivar interval: Current poll interval, in seconds.
+    @type interval: C{float}
+    """
+
+    sinceID = None
+    interval = None
+    delayedCall = None
+    polling = False
+
+    def __init__(self, name, method, args=(), params=None):
+        self.name = name
+        self.method = method
+        self.args = args
+        self.params = params or {}
+
+
+
+class TimelinePoller(service.Service):
+    """
+    Service polling a set of REST timelines for new items.
+
+    For every timeline the highest item ID is tracked, which is passed
+    as C{since_id} on subsequent requests, so that only new items are
+    fetched and parsed. When more than L{count} new items came in since
+    the last poll, older pages are fetched with C{max_id}, up to
+    L{maxPages} pages. New items are passed to the delegate in
+    chronological order, together with the name of their timeline.
+
+    The poll interval adapts to the activity of each timeline: it is halved
+    when new items came in, and grows by L{backOffFactor} otherwise, between
+    L{minInterval} and L{maxInterval}. On top of that, polls are spread out
+    so that the remaining rate limit of the API, as tracked by
+    L{twittytwister.twitter.Twitter.gotHeaders}, is not exhausted before it
+    is reset.
+
+    @cvar noisy: Whether or not to log informational messages about polls.
+    @type noisy: C{bool}
+
+    @ivar api: The API object used for rate limit information.
+    @type api: L{twittytwister.twitter.Twitter}
+
+    @ivar delegate: Called with each new item and the name of its timeline.
+
+    @ivar checkpoint: Optional checkpoint to persist the highest seen IDs
+        across restarts. See L{twittytwister.checkpoint.JSONFileCheckpoint}.
+
+    @ivar timelines: The polled timelines, by name.
+    @type timelines: C{dict}
+    """
+    noisy = False
+
+    minInterval = 60
+    maxInterval = 900
+    backOffFactor = 1.5
+    count = 200
+    maxPages = 16
+
+    def __init__(self, api, delegate, checkpoint=None, reactor=None):
+        self.api = api
+        self.delegate = delegate
+        self.checkpoint = checkpoint
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.timelines = {}
+        self._state = {}
+
+
+    def addTimeline(self, name, method, args=(), params=None):
+        """
+        Add a timeline to poll.
+
+        @param name: Name of the timeline.
+        @type name: C{str}
+
+        @param method: REST API method to fetch the timeline with. This is
+            called with a delegate, C{args}, and the keyword arguments
+            C{params} and C{extra_args}, e.g.
+            L{twittytwister.twitter.Twitter.mentions}.
+
+        @param args: Extra positional arguments to C{method}.
+        @type args: C{tuple}
+
+        @param params: Extra request parameters.
+        @type params: C{dict}
+
+        @rtype: L{Timeline}
+        """
+        timeline = Timeline(name, method, args, params)
+        sinceID = self._state.get(name)
+        if sinceID is not None:
+            timeline.sinceID = int(sinceID)
+        self.timelines[name] = timeline
+
+        if self.running:
+            self._schedule(timeline, 0)
+
+        return timeline
+
+
+    def removeTimeline(self, name):
+        """
+        Stop polling a timeline.
+        """
+        timeline = self.timelines.pop(name)
+        if timeline.delayedCall and timeline.delayedCall.active():
+            timeline.delayedCall.cancel()
+        timeline.delayedCall = None
+
+
+    def startService(self):
+        """
+        Start the service.
+
+        This loads the checkpoint, if any, and starts polling all timelines.
+        """
+        service.Service.startService(self)
+
+        if self.checkpoint is not None:
+            self._state = self.checkpoint.load()
+
+        for timeline in self.timelines.itervalues():
+            sinceID = self._state.get(timeline.name)
+            if sinceID is not None and timeline.sinceID is None:
+                timeline.sinceID = int(sinceID)
+            self._schedule(timeline, 0)
+
+
+    def stopService(self):
+        """
+        Stop the service.
+
+        Pending polls are cancelled. Polls in progress will still deliver
+        their items, but no further polls are scheduled.
+        """
+        service.Service.stopService(self)
+
+        for timeline in self.timelines.itervalues():
+            if timeline.delayedCall and timeline.delayedCall.active():
+                timeline.delayedCall.cancel()
+            timeline.delayedCall = None
+
+
+    def _schedule(self, timeline, delay):
+        if timeline.delayedCall and timeline.delayedCall.active():
+            timeline.delayedCall.cancel()
+        timeline.delayedCall = self.reactor.callLater(delay, self.poll,
+                                                      timeline.name)
+
+
+    def poll(self, name):
+        """
+        Poll a timeline for new items right away.
+
+        A scheduled poll of the timeline is cancelled, the next one is
+        scheduled when this poll is done.
+
+        @param name: Name of the timeline.
+        @type name: C{str}
+
+        @return: Deferred that fires with the number of new items.
+        """
+        timeline = self.timelines[name]
+        if timeline.delayedCall and timeline.delayedCall.active():
+            timeline.delayedCall.cancel()
+        timeline.delayedCall = None
+
+        if timeline.polling:
+            return defer.succeed(0)
+
+        params = dict(timeline.params)
+        params['count'] = str(self.count)
+        if timeline.sinceID is not None:
+            params['since_id'] = str(timeline.sinceID)
+
+        items = []
+
+        def onItem(item, name):
+            items.append(item)
+
+        def itemID(item):
+            try:
+                return int(item.id)
+            except (AttributeError, TypeError, ValueError):
+                return None
+
+        def fetch(pageParams):
+            try:
+                return timeline.method(onItem, *timeline.args,
+                                       params=pageParams,
+                                       extra_args=timeline.name)
+            except:
+                return defer.fail()
+
+        def gotPage(_, pages, received):
+            """
+            Fetch older items, until reaching the since_id.
+
+            When the first page is full, more items might have come in
+            than fit on a page. Older pages are fetched with C{max_id}
+            until a page is empty.
+            """
+            page = items[received:]
+            if timeline.sinceID is None or not page:
+                return
+            if pages == 1 and len(page) < self.count:
+                return
+            ids = [id for id in (itemID(item) for item in page)
+                   if id is not None]
+            if not ids or min(ids) <= timeline.sinceID:
+                return
+            if pages >= self.maxPages:
+                log.msg("Stopped paging timeline %r after %d pages, items "
+                        "may have been missed" % (timeline.name, pages))
+                return
+
+            pageParams = dict(params)
+            pageParams['max_id'] = str(min(ids) - 1)
+            d = fetch(pageParams)
+            d.addCallback(gotPage, pages + 1, len(items))
+            return d
+
+        def cb(_):
+            newItems = []
+            for item in items:
+                id = itemID(item)
+                if id is None:
+                    continue
+                if timeline.sinceID is None or id > timeline.sinceID:
+                    newItems.append((id, item))
+
+            newItems.sort()
+            for id, item in newItems:
+                try:
+                    self.delegate(item, timeline.name)
+                except:
+                    log.err()
+
+            if newItems:
+                timeline.sinceID = newItems[-1][0]
+                self._saveCheckpoint()
+
+            self._adaptInterval(timeline, len(newItems))
+            return len(newItems)
+
+        def eb(failure):
+            log.err(failure, "Polling timeline %r failed" % (timeline.name,))
+            self._adaptInterval(timeline, 0)
+            return 0
+
+        def reschedule(result):
+            timeline.polling = False
+            if (self.running and
+                self.timelines.get(timeline.name) is timeline):
+                if self.noisy:
+                    log.msg("Polling %r again in %0.2f seconds" %
+                            (timeline.name, timeline.interval))
+                self._schedule(timeline, timeline.interval)
+            return result
+
+        timeline.polling = True
+        d = fetch(params)
+        d.addCallback(gotPage, 1, 0)
+        d.addCallbacks(cb, eb)
+        d.addBoth(reschedule)
+        return d
+
+
+    def _adaptInterval(self, timeline, newCount):
+        """
+        Adapt the poll interval to activity and the remaining rate limit.
+        """
+        if timeline.interval is None:
+            interval = self.minInterval
+        elif newCount:
+            interval = timeline.interval / 2
+        else:
+            interval = timeline.interval * self.backOffFactor
+
+        interval = max(self.minInterval, min(self.maxInterval, interval))
+        timeline.interval = max(interval, self._rateLimitInterval())
+
+
+    def _rateLimitInterval(self):
+        """
+        Minimum interval to not exhaust the remaining rate limit.
+
+        Spread the remaining requests of all timelines evenly until the
+        rate limit window is reset.
+        """
+        remaining = getattr(self.api, 'rate_limit_remaining', None)
+        reset = getattr(self.api, 'rate_limit_reset', None)
+        if remaining is None or reset is None:
+            return 0
+
+        window = reset - self.reactor.seconds()
+        if window <= 0:
+            return 0
+
+        return window * len(self.timelines) / max(remaining, 1)
+
+
+    def _saveCheckpoint(self):
+        for timeline in self.timelines.itervalues():
+            if timeline.sinceID is not None:
+                self._state[timeline.name] = timeline.sinceID
+
+        if self.checkpoint is not None:
+            try:
+                self.checkpoint.save(self._state)
+            except:
+                log.err(None, "Saving checkpoint failed")
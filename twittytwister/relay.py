@@ -0,0 +1,426 @@
+# -*- test-case-name: twittytwister.test.test_relay -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Relay of one Twitter stream to many local clients.
+
+Twitter limits the number of streaming connections per account. A
+L{RelayService} holds a single upstream connection, through
+L{twittytwister.twitter.TwitterMonitor}, and serves the length-delimited
+datagrams as received to any number of clients, over plain TCP and HTTP::
+
+    feed = TwitterFeed(consumer=consumer, token=token)
+    relay = RelayService(feed, {'track': 'twisted'},
+                         tcpPort=8007, httpPort=8008)
+    relay.setServiceParent(application)
+
+Clients use L{twittytwister.streaming.TwitterStream} unchanged. Over HTTP,
+that is a L{twittytwister.twitter.TwitterFeed} with the relay as
+C{stream_url}; any path is served. The C{track} and C{follow} request
+arguments select statuses matching any of the comma separated terms or
+user IDs, other entries are only sent to clients without them.
+
+Datagrams are not decoded, unless a client has a predicate, and are framed
+once for all clients. Each client is a push producer for its connection.
+When a client cannot keep up, datagrams are queued, and a client with more
+than C{maxQueued} queued datagrams is disconnected.
+
+This reports the number of clients (C{relay.clients}), relayed datagrams
+(C{relay.datagrams}), datagrams skipped by predicates (C{relay.filtered})
+and disconnected slow clients (C{relay.evictions}).
+"""
+
+from collections import deque
+
+import simplejson as json
+from zope.interface import implementer
+
+from twisted.application import service
+from twisted.internet import defer, protocol, task
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from twisted.web import resource, server
+
+from twittytwister import metrics, platform, streaming, twitter
+
+def makePredicate(args):
+    """
+    Make a predicate from streaming API request arguments.
+
+    @param args: Request arguments, mapping names to lists of values, as
+        in C{twisted.web.http.Request.args}.
+    @type args: C{dict}
+
+    @return: Predicate matching statuses that contain any of the C{track}
+        terms, case insensitively, or are from any of the C{follow} users,
+        or C{None} if neither was given.
+    """
+    terms = set()
+    for value in args.get('track', ()):
+        terms.update(term.strip().lower() for term in value.split(','))
+    terms.discard('')
+    follow = set()
+    for value in args.get('follow', ()):
+        follow.update(int(userID) for userID in value.split(',')
+                      if userID.strip())
+
+    if not terms and not follow:
+        return None
+
+    def predicate(status):
+        if follow:
+            user = status.user
+            if user is not None and user.id in follow:
+                return True
+        if terms:
+            text = (status.text or u'').lower()
+            for term in terms:
+                if term in text:
+                    return True
+        return False
+
+    return predicate
+
+
+
+@implementer(IPushProducer)
+class RelayClient(object):
+    """
+    A client of a L{Relay}.
+
+    This is registered as the producer of the client's connection, so that
+    datagrams are queued while the connection's write buffer is full.
+
+    @ivar consumer: The connection, or HTTP request, to write to.
+
+    @ivar predicate: If set, called with each decoded status to decide
+        whether to send it. Other entries are not sent.
+
+    @ivar disconnect: Called to drop the connection of a slow client.
+
+    @ivar queue: Datagrams waiting to be written, while paused.
+    @type queue: L{deque}
+    """
+
+    paused = False
+
+    def __init__(self, relay, consumer, predicate=None, disconnect=None):
+        self.relay = relay
+        self.consumer = consumer
+        self.predicate = predicate
+        if disconnect is None:
+            disconnect = consumer.loseConnection
+        self.disconnect = disconnect
+        self.queue = deque()
+
+
+    def send(self, frame):
+        """
+        Write a framed datagram, or queue it while paused.
+        """
+        if not self.paused:
+            self.consumer.write(frame)
+            return
+
+        self.queue.append(frame)
+        if len(self.queue) > self.relay.maxQueued:
+            self.relay.metrics.increment('relay.evictions')
+            log.msg(format="Disconnecting slow relay client %(client)r",
+                    client=self.consumer)
+            self.relay.removeClient(self)
+            self.queue.clear()
+            self.disconnect()
+
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+        queue = self.queue
+        while queue and not self.paused:
+            self.consumer.write(queue.popleft())
+
+
+    def stopProducing(self):
+        self.relay.removeClient(self)
+        self.queue.clear()
+
+
+
+class Relay(object):
+    """
+    Delegate that writes raw datagrams to a set of clients.
+
+    Use this as the delegate of a stream with
+    L{twittytwister.streaming.RawTwitterStream} as protocol. While there
+    are clients, an empty line is written to the ones that are not paused
+    every C{keepAliveInterval} seconds, like Twitter does, so that their
+    streams do not time out.
+
+    @ivar clients: The current clients.
+    @type clients: C{list} of L{RelayClient}
+
+    @ivar maxQueued: Maximum number of queued datagrams per client, before
+        it is disconnected.
+    @type maxQueued: C{int}
+
+    @ivar keepAliveInterval: Seconds between keep-alives.
+    @type keepAliveInterval: C{float}
+
+    @ivar metrics: Metrics sink, see L{twittytwister.metrics}.
+    """
+
+    metrics = metrics.NullMetrics()
+
+    def __init__(self, maxQueued=1000, keepAliveInterval=30, metrics=None,
+                 reactor=None):
+        self.maxQueued = maxQueued
+        self.keepAliveInterval = keepAliveInterval
+        if metrics is not None:
+            self.metrics = metrics
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.clients = []
+        self._keepAliveCall = None
+
+
+    def __call__(self, data):
+        """
+        Send a datagram to all clients it matches.
+
+        @param data: The JSON encoded entry.
+        @type data: C{str}
+        """
+        self.metrics.increment('relay.datagrams')
+        frame = '%d\r\n%s' % (len(data), data)
+        status = None
+        for client in self.clients:
+            if client.predicate is not None:
+                if status is None:
+                    status = self._decode(data)
+                if status is False:
+                    continue
+                try:
+                    matched = client.predicate(status)
+                except:
+                    log.err(None, "Error in relay client predicate")
+                    matched = False
+                if not matched:
+                    self.metrics.increment('relay.filtered')
+                    continue
+            client.send(frame)
+
+
+    def _decode(self, data):
+        """
+        Decode a datagram for predicates.
+
+        @return: The status, or C{False} if the datagram is not a status.
+        """
+        try:
+            obj = json.loads(data)
+        except ValueError:
+            return False
+        if not isinstance(obj, dict) or u'text' not in obj:
+            return False
+        return platform.Status.fromDict(obj)
+
+
+    def addClient(self, client):
+        """
+        Start sending datagrams to a client.
+        """
+        self.clients = self.clients + [client]
+        self.metrics.gauge('relay.clients', len(self.clients))
+        if self._keepAliveCall is None and self.keepAliveInterval:
+            self._keepAliveCall = task.LoopingCall(self.keepAlive)
+            self._keepAliveCall.clock = self.reactor
+            self._keepAliveCall.start(self.keepAliveInterval, now=False)
+
+
+    def removeClient(self, client):
+        """
+        Stop sending datagrams to a client.
+        """
+        if client not in self.clients:
+            return
+        self.clients = [other for other in self.clients
+                        if other is not client]
+        self.metrics.gauge('relay.clients', len(self.clients))
+        if not self.clients and self._keepAliveCall is not None:
+            self._keepAliveCall.stop()
+            self._keepAliveCall = None
+
+
+    def keepAlive(self):
+        """
+        Send a keep-alive to the clients that are not paused.
+        """
+        for client in self.clients:
+            if not client.paused:
+                client.consumer.write('\r\n')
+
+
+
+class RelayProtocol(protocol.Protocol):
+    """
+    TCP connection of a relay client.
+
+    Data sent by the client is ignored.
+    """
+
+    client = None
+
+    def connectionMade(self):
+        self.client = RelayClient(self.factory.relay, self.transport,
+                                  self.factory.predicate,
+                                  self.transport.abortConnection)
+        self.transport.registerProducer(self.client, True)
+        self.factory.relay.addClient(self.client)
+
+
+    def connectionLost(self, reason):
+        if self.client is not None:
+            self.factory.relay.removeClient(self.client)
+
+
+
+class RelayFactory(protocol.ServerFactory):
+    """
+    Factory of TCP relay client connections.
+
+    @ivar relay: The relay to add clients to.
+    @type relay: L{Relay}
+
+    @ivar predicate: Predicate for all clients, if any.
+    """
+
+    protocol = RelayProtocol
+
+    def __init__(self, relay, predicate=None):
+        self.relay = relay
+        self.predicate = predicate
+
+
+
+class RelayResource(resource.Resource):
+    """
+    HTTP resource that streams the relayed datagrams.
+
+    The C{track} and C{follow} request arguments select statuses, see
+    L{makePredicate}.
+    """
+
+    isLeaf = True
+
+    def __init__(self, relay):
+        resource.Resource.__init__(self)
+        self.relay = relay
+
+
+    def render_GET(self, request):
+        try:
+            predicate = makePredicate(request.args)
+        except ValueError:
+            request.setResponseCode(400)
+            return "Invalid follow argument\n"
+
+        request.setHeader('Content-Type', 'application/json')
+        # Send the headers now, clients wait for them before streaming.
+        request.write('')
+        client = RelayClient(self.relay, request, predicate,
+                             request.transport.abortConnection)
+        request.registerProducer(client, True)
+        self.relay.addClient(client)
+
+        def done(result):
+            self.relay.removeClient(client)
+
+        request.notifyFinish().addBoth(done)
+        return server.NOT_DONE_YET
+
+
+    render_POST = render_GET
+
+
+
+class RelayService(service.MultiService):
+    """
+    Service relaying a Twitter stream to local TCP and HTTP clients.
+
+    The protocol of C{feed} is set to
+    L{twittytwister.streaming.RawTwitterStream}. The ports are listened on
+    while the service is running.
+
+    @ivar relay: The relay.
+    @type relay: L{Relay}
+
+    @ivar monitor: The monitor of the upstream connection.
+    @type monitor: L{twittytwister.twitter.TwitterMonitor}
+
+    @ivar ports: The listening ports, while running.
+    @type ports: C{list}
+    """
+
+    def __init__(self, feed, args=None, tcpPort=None, httpPort=None,
+                 interface='127.0.0.1', method='filter', maxQueued=1000,
+                 metrics=None, reactor=None):
+        """
+        @param feed: The feed to open the upstream connection with.
+        @type feed: L{twittytwister.twitter.TwitterFeed}
+
+        @param args: Request arguments of the upstream connection.
+        @type args: C{dict}
+
+        @param tcpPort: Port to serve TCP clients on, if any.
+        @type tcpPort: C{int}
+
+        @param httpPort: Port to serve HTTP clients on, if any.
+        @type httpPort: C{int}
+
+        @param interface: Interface to listen on.
+        @type interface: C{str}
+
+        @param method: Name of the stream method of C{feed}.
+        @type method: C{str}
+        """
+        service.MultiService.__init__(self)
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        feed.protocol = streaming.RawTwitterStream
+        self.relay = Relay(maxQueued, metrics=metrics, reactor=reactor)
+        self.monitor = twitter.TwitterMonitor(getattr(feed, method),
+                                              self.relay, args,
+                                              reactor=reactor,
+                                              metrics=metrics)
+        self.monitor.setServiceParent(self)
+
+        self.factories = []
+        if tcpPort is not None:
+            self.factories.append((tcpPort, RelayFactory(self.relay)))
+        if httpPort is not None:
+            site = server.Site(RelayResource(self.relay))
+            self.factories.append((httpPort, site))
+        self.interface = interface
+        self.ports = []
+
+
+    def startService(self):
+        for port, factory in self.factories:
+            self.ports.append(self.reactor.listenTCP(
+                port, factory, interface=self.interface))
+        service.MultiService.startService(self)
+
+
+    def stopService(self):
+        ports, self.ports = self.ports, []
+        d = defer.gatherResults([defer.maybeDeferred(port.stopListening)
+                                 for port in ports])
+        d.addCallback(lambda _: service.MultiService.stopService(self))
+        return d
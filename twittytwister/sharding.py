@@ -0,0 +1,494 @@
+# -*- test-case-name: twittytwister.test.test_sharding -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Dispatch of a stream to worker processes, sharded by key.
+
+To spread the handling of a stream over several cores, a
+L{ShardedDispatcher} sends each entry to one of a number of worker
+processes, chosen by a stable key: the ID of the user, a hashtag, or the
+result of another key function. All entries with the same key go to the
+same worker, in order, so that per-key state can be kept in the worker.
+
+The dispatcher is the delegate of a L{twittytwister.twitter.TwitterMonitor}
+with L{twittytwister.streaming.RawTwitterStream} as protocol. Datagrams are
+decoded to find their key, but forwarded as received, length-delimited,
+over the standard input of the workers. Workers decode the statuses with
+L{twittytwister.platform} and pass them to a handler, named by its fully
+qualified name::
+
+    feed.protocol = RawTwitterStream
+    dispatcher = ShardedDispatcher(key=userKey)
+    spawnWorkers(dispatcher, 'myproject.workers.handleStatus', 4)
+    monitor = TwitterMonitor(feed.filter, dispatcher, args)
+    dispatcher.registerProducer(monitor, True)
+
+The monitor is paused while the pipe to any of the workers is full, so a
+slow worker holds up the stream, instead of losing entries. When a worker
+has exited, its shard is ended: the other shards keep getting their
+entries, and the entries of the ended shard are dropped. Entries
+received without any shards are dropped, too.
+
+Workers log failures of the handler and go on with the next status.
+
+This reports the datagrams (C{shard.<n>.datagrams}) and bytes
+(C{shard.<n>.bytes}) sent to each shard, entries that could not be
+decoded (C{shard.decode_errors}), dropped entries (C{shard.dropped}), the
+number of ended shards (C{shard.ended}), and the imbalance between shards
+(C{shard.imbalance}): the number of datagrams of the busiest shard
+divided by the average.
+"""
+
+import os
+import sys
+import zlib
+
+import simplejson as json
+from zope.interface import implementer
+
+from twisted.internet import defer, protocol
+from twisted.internet.interfaces import IConsumer, IPushProducer
+from twisted.python import log, reflect
+
+from twittytwister import metrics, platform
+
+# The directory this package is in, for workers to import it from. This is
+# determined on import, as __file__ may be relative to the current
+# directory.
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def userKey(data):
+    """
+    Return the ID of the user of a decoded entry, or C{None}.
+    """
+    user = data.get('user')
+    if user:
+        return user.get('id')
+    return None
+
+
+
+def hashtagKey(data):
+    """
+    Return the first hashtag of a decoded entry, in lower case, or C{None}.
+    """
+    entities = data.get('entities')
+    if entities:
+        hashtags = entities.get('hashtags')
+        if hashtags:
+            return hashtags[0].get('text', u'').lower()
+    return None
+
+
+
+def shardFor(key, shards):
+    """
+    Return the shard of a key.
+
+    This is stable across processes and platforms. Entries without a key
+    go to the first shard.
+
+    @param shards: The number of shards.
+    @type shards: C{int}
+
+    @rtype: C{int}
+    """
+    if key is None:
+        return 0
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    else:
+        key = str(key)
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+
+@implementer(IPushProducer)
+class Shard(object):
+    """
+    A shard of a L{ShardedDispatcher}.
+
+    This is registered as the producer of the pipe to the worker, so that
+    the dispatcher knows when the pipe is full.
+
+    @ivar index: Index of the shard.
+    @type index: C{int}
+
+    @ivar transport: The pipe to the worker.
+
+    @ivar datagrams: Number of datagrams sent.
+    @type datagrams: C{int}
+
+    @ivar bytes: Number of bytes sent.
+    @type bytes: C{int}
+
+    @ivar paused: Whether the pipe is full.
+    @type paused: C{bool}
+
+    @ivar ended: Whether the worker has exited.
+    @type ended: C{bool}
+    """
+
+    paused = False
+    ended = False
+
+    def __init__(self, dispatcher, index, transport):
+        self.dispatcher = dispatcher
+        self.index = index
+        self.transport = transport
+        self.datagrams = 0
+        self.bytes = 0
+        self.datagramsMetric = 'shard.%d.datagrams' % (index,)
+        self.bytesMetric = 'shard.%d.bytes' % (index,)
+
+
+    def pauseProducing(self):
+        if not self.paused and not self.ended:
+            self.paused = True
+            self.dispatcher._shardPaused()
+
+
+    def resumeProducing(self):
+        if self.paused:
+            self.paused = False
+            self.dispatcher._shardResumed()
+
+
+    def stopProducing(self):
+        self.resumeProducing()
+
+
+
+@implementer(IConsumer)
+class ShardedDispatcher(object):
+    """
+    Delegate that sends datagrams to shards by key.
+
+    @ivar key: Called with each decoded entry, a C{dict}, to get its key.
+        Defaults to L{userKey}.
+
+    @ivar shards: The shards.
+    @type shards: C{list} of L{Shard}
+
+    @ivar producer: The registered producer, paused while any of the
+        shards is.
+
+    @ivar reportInterval: Number of datagrams between updates of the
+        imbalance gauge.
+    @type reportInterval: C{int}
+
+    @ivar metrics: Metrics sink, see L{twittytwister.metrics}.
+    """
+
+    metrics = metrics.NullMetrics()
+    producer = None
+    reportInterval = 1000
+
+    def __init__(self, key=userKey, metrics=None):
+        self.key = key
+        if metrics is not None:
+            self.metrics = metrics
+        self.shards = []
+        self._paused = 0
+        self._sinceReport = 0
+
+
+    def addShard(self, transport):
+        """
+        Add a shard.
+
+        Keys are mapped to shards by their number, so shards are to be
+        added before entries are dispatched.
+
+        @param transport: The pipe to the worker, e.g. the transport of a
+            L{WorkerProcessProtocol}.
+
+        @rtype: L{Shard}
+        """
+        shard = Shard(self, len(self.shards), transport)
+        self.shards.append(shard)
+        transport.registerProducer(shard, True)
+        return shard
+
+
+    def shardEnded(self, shard):
+        """
+        Mark a shard as ended, because its worker has exited.
+
+        Entries for the shard are dropped from then on, and it no longer
+        holds up the producer. L{spawnWorkers} calls this when a worker has
+        exited.
+
+        @type shard: L{Shard}
+        """
+        if shard.ended:
+            return
+        shard.resumeProducing()
+        shard.ended = True
+        self.metrics.gauge('shard.ended',
+                           len([other for other in self.shards
+                                if other.ended]))
+        log.msg(format="Shard %(index)d ended, dropping its entries",
+                index=shard.index)
+
+
+    def registerProducer(self, producer, streaming):
+        """
+        Register a push producer.
+
+        @raises RuntimeError: When a producer is already registered.
+        @raises ValueError: For pull producers, which are not supported.
+        """
+        if self.producer is not None:
+            raise RuntimeError("Producer %r already registered" %
+                               (self.producer,))
+        if not streaming:
+            raise ValueError("Only push producers are supported")
+        self.producer = producer
+        if self._paused:
+            producer.pauseProducing()
+
+
+    def unregisterProducer(self):
+        """
+        Unregister the producer.
+        """
+        if self._paused:
+            self.producer.resumeProducing()
+        self.producer = None
+
+
+    def _shardPaused(self):
+        self._paused += 1
+        if self._paused == 1 and self.producer is not None:
+            self.producer.pauseProducing()
+
+
+    def _shardResumed(self):
+        self._paused -= 1
+        if not self._paused and self.producer is not None:
+            self.producer.resumeProducing()
+
+
+    def __call__(self, entry):
+        """
+        Send an entry to its shard.
+
+        @param entry: The JSON encoded entry, as passed by
+            L{twittytwister.streaming.RawTwitterStream}, or a platform
+            object, which is encoded again.
+        """
+        if isinstance(entry, str):
+            data = entry
+            try:
+                decoded = json.loads(data)
+            except ValueError:
+                self.metrics.increment('shard.decode_errors')
+                log.msg(format="Invalid JSON in stream: %(data)r", data=data)
+                return
+        else:
+            decoded = entry.raw
+            data = json.dumps(decoded)
+
+        if not self.shards:
+            self.metrics.increment('shard.dropped')
+            return
+
+        key = None
+        if isinstance(decoded, dict):
+            try:
+                key = self.key(decoded)
+            except:
+                log.err(None, "Error getting shard key")
+
+        shard = self.shards[shardFor(key, len(self.shards))]
+        if shard.ended:
+            self.metrics.increment('shard.dropped')
+            return
+        shard.transport.write('%d\r\n%s' % (len(data), data))
+        shard.datagrams += 1
+        shard.bytes += len(data)
+        self.metrics.increment(shard.datagramsMetric)
+        self.metrics.increment(shard.bytesMetric, len(data))
+
+        self._sinceReport += 1
+        if self._sinceReport >= self.reportInterval:
+            self._sinceReport = 0
+            self.metrics.gauge('shard.imbalance', self.imbalance())
+
+
+    def imbalance(self):
+        """
+        Return the datagrams of the busiest shard divided by the average.
+
+        @return: C{1.0} when balanced, up to the number of shards when all
+            datagrams went to one shard.
+        @rtype: C{float}
+        """
+        counts = [shard.datagrams for shard in self.shards]
+        total = sum(counts)
+        if not total:
+            return 1.0
+        return max(counts) * len(counts) / float(total)
+
+
+    def stats(self):
+        """
+        Return the datagrams and bytes sent to each shard.
+
+        @return: List of dictionaries with C{'datagrams'} and C{'bytes'},
+            by shard index.
+        @rtype: C{list}
+        """
+        return [{'datagrams': shard.datagrams, 'bytes': shard.bytes}
+                for shard in self.shards]
+
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """
+    Protocol of a worker process.
+
+    Output of the worker is logged.
+
+    @ivar index: Index of the shard of the worker.
+    @type index: C{int}
+
+    @ivar ended: Deferred that fires when the worker has exited.
+    @type ended: L{defer.Deferred}
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.ended = defer.Deferred()
+
+
+    def outReceived(self, data):
+        log.msg(format="Worker %(index)d: %(data)s", index=self.index,
+                data=data.rstrip())
+
+
+    errReceived = outReceived
+
+
+    def processEnded(self, reason):
+        log.msg(format="Worker %(index)d ended: %(reason)s",
+                index=self.index, reason=reason.getErrorMessage())
+        self.ended.callback(reason.value)
+
+
+    def stop(self):
+        """
+        Close the standard input of the worker, so that it exits when done.
+
+        @return: Deferred that fires when the worker has exited.
+        """
+        self.transport.closeStdin()
+        return self.ended
+
+
+
+def spawnWorkers(dispatcher, handler, count, env=None, reactor=None):
+    """
+    Spawn worker processes and add them as shards of a dispatcher.
+
+    Workers run this module with the Python interpreter of this process,
+    see L{main}, and get the module search path of this process, with the
+    directory of this package first.
+
+    @param handler: Fully qualified name of the callable that the workers
+        pass the statuses to.
+    @type handler: C{str}
+
+    @param count: Number of workers.
+    @type count: C{int}
+
+    @param env: Additional environment variables for the workers.
+    @type env: C{dict}
+
+    @return: The protocols of the workers.
+    @rtype: C{list} of L{WorkerProcessProtocol}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [_root] + [os.path.abspath(path) for path in sys.path])
+    if env:
+        environment.update(env)
+
+    workers = []
+    for i in xrange(count):
+        worker = WorkerProcessProtocol(len(dispatcher.shards))
+        args = [sys.executable, '-m', 'twittytwister.sharding', handler,
+                str(worker.index)]
+        transport = reactor.spawnProcess(worker, sys.executable, args,
+                                         env=environment)
+        shard = dispatcher.addShard(transport)
+        worker.ended.addCallback(lambda _, shard=shard:
+                                 dispatcher.shardEnded(shard))
+        workers.append(worker)
+    return workers
+
+
+
+def runWorker(handler, f):
+    """
+    Pass the statuses in length-delimited datagrams read from a file to a
+    handler, until the end of the file.
+
+    Datagrams that are not statuses are skipped. Failures of the handler
+    are logged.
+
+    @return: The number of statuses handled without failure.
+    @rtype: C{int}
+    """
+    count = 0
+    while True:
+        line = f.readline()
+        if not line:
+            return count
+        line = line.strip()
+        if not line:
+            continue
+        data = f.read(int(line))
+        try:
+            obj = json.loads(data)
+        except ValueError:
+            log.msg(format="Invalid JSON in stream: %(data)r", data=data)
+            continue
+        if not isinstance(obj, dict) or u'text' not in obj:
+            continue
+        try:
+            handler(platform.Status.fromDict(obj))
+        except:
+            log.err(None, "Error in worker handler")
+        else:
+            count += 1
+
+
+
+def main(argv):
+    """
+    Run a worker, with the name of the handler and the index of the shard
+    as arguments.
+
+    The index of the shard is available to the handler as the
+    C{TWITTYTWISTER_SHARD} environment variable.
+    """
+    if len(argv) != 3:
+        sys.stderr.write("Usage: %s <handler> <shard>\n" % (argv[0],))
+        return 2
+    os.environ['TWITTYTWISTER_SHARD'] = argv[2]
+    log.startLogging(sys.stderr, setStdout=False)
+    handler = reflect.namedAny(argv[1])
+    runWorker(handler, sys.stdin)
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
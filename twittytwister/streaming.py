@@ -9,16 +9,19 @@ Twitter Streaming API.
 @see: U{http://dev.twitter.com/pages/streaming_api}.
 """
 
+import time
+from collections import deque
+
 import simplejson as json
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.protocols.basic import LineReceiver
 from twisted.protocols.policies import TimeoutMixin
 from twisted.python import log
 from twisted.web.client import ResponseDone
 from twisted.web.http import PotentialDataLoss
 
-from twittytwister import platform
+from twittytwister import latency, metrics, platform
 
 class LengthDelimitedStream(LineReceiver):
     """
@@ -26,14 +29,30 @@ class LengthDelimitedStream(LineReceiver):
 
     Datagrams are prefixed by a line with a decimal length in ASCII. Lines are
     delimited by C{\r\n} and maybe empty, for keep-alive purposes.
+
+    @ivar metrics: Metrics sink for received bytes, datagrams and
+        keep-alives. See L{twittytwister.metrics}.
     """
 
+    metrics = metrics.NullMetrics()
+
     def __init__(self):
         self._rawBuffer = None
         self._rawBufferLength = None
         self._expectedLength = None
 
 
+    def dataReceived(self, data):
+        """
+        Called when data is received.
+
+        This overrides the default implementation from LineReceiver to
+        count the received bytes.
+        """
+        self.metrics.increment('stream.bytes', len(data))
+        LineReceiver.dataReceived(self, data)
+
+
     def lineReceived(self, line):
         """
         Called when a line is received.
@@ -47,6 +66,7 @@ class LengthDelimitedStream(LineReceiver):
             self._rawBufferLength = 0
             self.setRawMode()
         else:
+            self.metrics.increment('stream.keepalives')
             self.keepAliveReceived()
 
 
@@ -71,8 +91,14 @@ class LengthDelimitedStream(LineReceiver):
             self._rawBufferLength = None
             self._expectedLength = None
 
+            self.metrics.increment('stream.datagrams')
             self.datagramReceived(expectedData)
-            self.setLineMode(extraData)
+
+            # Pass on the remainder without going through our own
+            # dataReceived, so that it is not counted twice.
+            self.setLineMode()
+            if extraData:
+                LineReceiver.dataReceived(self, extraData)
 
 
     def datagramReceived(self, data):
@@ -91,6 +117,88 @@ class LengthDelimitedStream(LineReceiver):
 
 
 
+class Watchdog(object):
+    """
+    Shared, coarse-grained timeout handling for many connections.
+
+    L{TimeoutMixin} resets a L{DelayedCall<twisted.internet.base.DelayedCall>}
+    for each chunk of data received, which is costly with many busy
+    connections. Instead, watched connections only flag activity and a
+    single periodic sweep over all of them detects those that have been idle
+    for longer than their timeout.
+
+    Watched connections have a C{timeOut} attribute with the timeout period
+    in seconds, an C{active} attribute that they set to C{True} when data is
+    received, and a C{timeoutConnection} method, called when they time out.
+    As activity is only noticed at sweeps, connections time out between
+    C{timeOut} and C{timeOut} plus twice the interval after they became
+    idle.
+
+    The sweep runs only while there are watched connections. Failures of
+    C{timeoutConnection} are logged and do not stop the sweep.
+
+    @ivar interval: Seconds between sweeps.
+    @type interval: C{float}
+    """
+
+    def __init__(self, interval=1, reactor=None):
+        self.interval = interval
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self._lastActive = {}
+        self._call = None
+
+
+    def __len__(self):
+        return len(self._lastActive)
+
+
+    def add(self, connection):
+        """
+        Start watching a connection.
+        """
+        connection.active = False
+        self._lastActive[connection] = self.reactor.seconds()
+        if self._call is None or not self._call.running:
+            self._call = task.LoopingCall(self.sweep)
+            self._call.clock = self.reactor
+            self._call.start(self.interval, now=False)
+
+
+    def remove(self, connection):
+        """
+        Stop watching a connection.
+        """
+        self._lastActive.pop(connection, None)
+        if not self._lastActive and self._call is not None:
+            self._call.stop()
+            self._call = None
+
+
+    def sweep(self):
+        """
+        Time out the connections that have been idle for too long.
+        """
+        now = self.reactor.seconds()
+        lastActive = self._lastActive
+        idle = []
+        for connection, last in lastActive.iteritems():
+            if connection.active:
+                connection.active = False
+                lastActive[connection] = now
+            elif now - last >= connection.timeOut:
+                idle.append(connection)
+
+        for connection in idle:
+            self.remove(connection)
+            try:
+                connection.timeoutConnection()
+            except:
+                log.err(None, "Error timing out %r" % (connection,))
+
+
+
 class TwitterStream(LengthDelimitedStream, TimeoutMixin):
     """
     Twitter Stream.
@@ -101,14 +209,99 @@ class TwitterStream(LengthDelimitedStream, TimeoutMixin):
     L{TimeoutMixin} is used to disconnect the stream in case Twitter stops
     sending data, including the keep-alives that usually result in traffic
     at least every 30 seconds. If not passed using C{timeoutPeriod}, the
-    timeout period is set to 60 seconds.
+    timeout period is set to 60 seconds. With many concurrent streams, set
+    L{watchdog} to have timeouts handled by a shared L{Watchdog} instead.
+    While paused, see L{pauseProducing}, the timeout is suspended.
+
+    Besides the metrics of L{LengthDelimitedStream}, this reports decode
+    failures, unsupported objects, delivered statuses and the time spent in
+    the callback.
+
+    @ivar latency: If set, the latency tracker that receives timestamps of
+        each status: when its first bytes arrived, when the datagram was
+        complete, when it was decoded and when the callback was called and
+        returned, together with its creation time.
+    @type latency: L{twittytwister.latency.LatencyTracker}
+
+    @ivar watchdog: If set, the watchdog that handles the timeout, instead
+        of a timer per stream. Set this on the class to share a watchdog
+        between all streams.
+    @type watchdog: L{Watchdog}
     """
 
-    def __init__(self, callback, timeoutPeriod=60):
+    latency = None
+    watchdog = None
+    active = False
+    _pausedTimeout = None
+    _chunkTime = None
+    _arrived = None
+
+    def __init__(self, callback, timeoutPeriod=60, metrics=None, latency=None,
+                 watchdog=None):
         LengthDelimitedStream.__init__(self)
+        if watchdog is not None:
+            self.watchdog = watchdog
         self.setTimeout(timeoutPeriod)
         self.callback = callback
         self.deferred = defer.Deferred()
+        if metrics is not None:
+            self.metrics = metrics
+        if latency is not None:
+            self.latency = latency
+
+
+    def setTimeout(self, period):
+        """
+        Change the timeout period.
+
+        With a L{watchdog}, this starts or stops watching this stream.
+        """
+        if self.watchdog is None:
+            return TimeoutMixin.setTimeout(self, period)
+
+        previous = self.timeOut
+        self.timeOut = period
+        if period is None:
+            self.watchdog.remove(self)
+        else:
+            self.watchdog.add(self)
+        return previous
+
+
+    def resetTimeout(self):
+        """
+        Reset the timeout, because data was received.
+
+        With a L{watchdog}, this only flags activity.
+        """
+        if self.watchdog is None:
+            TimeoutMixin.resetTimeout(self)
+        else:
+            self.active = True
+
+
+    def pauseProducing(self):
+        """
+        Pause the transport and the processing of buffered data.
+
+        No data is read while paused, so the timeout is suspended until
+        L{resumeProducing} is called.
+        """
+        if self.paused:
+            return
+        self._pausedTimeout = self.setTimeout(None)
+        LengthDelimitedStream.pauseProducing(self)
+
+
+    def resumeProducing(self):
+        """
+        Resume the transport and restart the timeout.
+        """
+        if not self.paused:
+            return
+        if not self.deferred.called:
+            self.setTimeout(self._pausedTimeout)
+        LengthDelimitedStream.resumeProducing(self)
 
 
     def dataReceived(self, data):
@@ -119,26 +312,73 @@ class TwitterStream(LengthDelimitedStream, TimeoutMixin):
         reset the connection timeout.
         """
         self.resetTimeout()
+        if self.latency is not None:
+            self._chunkTime = self.latency.clock()
         LengthDelimitedStream.dataReceived(self, data)
 
 
+    def lineReceived(self, line):
+        """
+        Called when a line is received.
+
+        This remembers when the chunk with the length prefix of the next
+        datagram arrived.
+        """
+        self._arrived = self._chunkTime
+        LengthDelimitedStream.lineReceived(self, line)
+
+
     def datagramReceived(self, data):
         """
         Decode the JSON-encoded datagram and call the callback.
         """
+        tracker = self.latency
+        if tracker is not None:
+            framed = tracker.clock()
+
         try:
             obj = json.loads(data)
         except ValueError, e:
+            self.metrics.increment('stream.decode_errors')
             log.err(e, 'Invalid JSON in stream: %r' % data)
             return
 
         if u'text' in obj:
+            if tracker is not None:
+                created = latency.messageTime(obj)
             obj = platform.Status.fromDict(obj)
         else:
-            log.msg('Unsupported object %r' % obj)
+            self.metrics.increment('stream.unsupported')
+            log.msg(format='Unsupported object %(obj)r', obj=obj)
+            return
+
+        self.metrics.increment('stream.statuses')
+        if tracker is not None:
+            decoded = tracker.clock()
+
+        self._deliver(obj)
+
+        if tracker is not None:
+            arrived = self._arrived
+            if arrived is None:
+                arrived = framed
+            tracker.record(created, arrived, framed, decoded, decoded,
+                           tracker.clock())
+
+
+    def _deliver(self, entry):
+        """
+        Call the callback, timing it unless metrics are discarded.
+        """
+        if isinstance(self.metrics, metrics.NullMetrics):
+            self.callback(entry)
             return
 
-        self.callback(obj)
+        start = time.time()
+        try:
+            self.callback(entry)
+        finally:
+            self.metrics.timing('stream.delegate_latency', time.time() - start)
 
 
     def connectionLost(self, reason):
@@ -167,3 +407,152 @@ class TwitterStream(LengthDelimitedStream, TimeoutMixin):
         closed when called.
         """
         self.transport.stopProducing()
+
+
+
+class RawTwitterStream(TwitterStream):
+    """
+    Twitter Stream that passes on datagrams without decoding them.
+
+    The callback is called with the JSON encoded datagram of each entry,
+    including entries other than statuses. This is for relaying a stream,
+    see L{twittytwister.relay}, and other consumers that only pass entries
+    on. As entries are not decoded, no latency is tracked.
+    """
+
+    def datagramReceived(self, data):
+        """
+        Call the callback with the datagram.
+        """
+        self._deliver(data)
+
+
+
+class StreamQueue(object):
+    """
+    Bounded queue of entries received from a Twitter stream.
+
+    This provides a pull interface to a stream: instead of having a
+    delegate called for each entry, consumers ask for entries using L{get}.
+    Pass L{put} as the delegate to the stream API method and, once the
+    response has been received, pass the protocol to L{setProtocol}.
+
+    When the number of queued entries reaches C{size}, the protocol is
+    paused, and it is resumed when the queue has been drained to
+    C{lowWater} entries. This pushes back on Twitter through TCP flow
+    control, instead of buffering without bounds.
+
+    @ivar size: Maximum number of queued entries before pausing.
+    @type size: C{int}
+
+    @ivar lowWater: Number of queued entries to resume at.
+    @type lowWater: C{int}
+
+    @ivar protocol: The stream protocol, once connected.
+    @type protocol: L{TwitterStream}
+
+    @ivar paused: Whether the stream is currently paused.
+    @type paused: C{bool}
+    """
+
+    protocol = None
+    paused = False
+    _cancelled = False
+
+    def __init__(self, size=1000, lowWater=None):
+        self.size = size
+        if lowWater is None:
+            lowWater = size // 2
+        self.lowWater = lowWater
+        self.pending = deque()
+        self.waiting = []
+        self._done = False
+        self._failure = None
+
+
+    def setProtocol(self, protocol):
+        """
+        Set the protocol that is delivering entries.
+
+        The protocol is paused right away if the queue is already full.
+
+        @return: This queue, so this can be used as a callback.
+        """
+        self.protocol = protocol
+        if self._cancelled:
+            protocol.transport.stopProducing()
+        elif self.paused or len(self.pending) >= self.size:
+            self.paused = True
+            protocol.pauseProducing()
+        protocol.deferred.addCallbacks(self._closed, self._failed)
+        return self
+
+
+    def put(self, entry):
+        """
+        Add an entry to the queue.
+        """
+        if self.waiting:
+            self.waiting.pop(0).callback(entry)
+            return
+
+        self.pending.append(entry)
+        if (len(self.pending) >= self.size and not self.paused and
+            self.protocol is not None):
+            self.paused = True
+            self.protocol.pauseProducing()
+
+
+    def get(self):
+        """
+        Get the next entry.
+
+        @return: Deferred that fires with the next entry, or C{None} when
+            the stream was closed cleanly. If the stream was closed with an
+            error, it errbacks with that failure.
+        """
+        if self.pending:
+            entry = self.pending.popleft()
+            if self.paused and len(self.pending) <= self.lowWater:
+                self.paused = False
+                if self.protocol is not None:
+                    self.protocol.resumeProducing()
+            return defer.succeed(entry)
+        elif self._failure is not None:
+            return defer.fail(self._failure)
+        elif self._done:
+            return defer.succeed(None)
+        else:
+            d = defer.Deferred(lambda d: self.waiting.remove(d))
+            self.waiting.append(d)
+            return d
+
+
+    def cancel(self):
+        """
+        Stop receiving entries and close the stream.
+
+        Entries already queued can still be retrieved, after which L{get}
+        returns C{None}, also if closing the connection results in an error.
+        """
+        self._cancelled = True
+        if self.protocol is not None and not self._done:
+            self.protocol.transport.stopProducing()
+
+
+    def _closed(self, result):
+        self._done = True
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
+
+
+    def _failed(self, failure):
+        if self._cancelled:
+            return self._closed(None)
+
+        self._done = True
+        self._failure = failure
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(failure)
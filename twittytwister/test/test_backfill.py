@@ -0,0 +1,189 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.backfill}.
+"""
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from twittytwister import backfill, fakeserver, platform, txml
+
+def makeStatus(statusID):
+    return platform.Status.fromDict({'id': statusID, 'text': u'Hello'})
+
+
+
+class RecentIDsTest(unittest.TestCase):
+    """
+    Tests for L{backfill.RecentIDs}.
+    """
+
+    def test_add(self):
+        recent = backfill.RecentIDs()
+        self.assertTrue(recent.add(1))
+        self.assertFalse(recent.add(1))
+        self.assertIn(1, recent)
+
+
+    def test_bounded(self):
+        """
+        The oldest IDs are forgotten first.
+        """
+        recent = backfill.RecentIDs(size=2)
+        for itemID in (1, 2, 3):
+            recent.add(itemID)
+        self.assertEqual(2, len(recent))
+        self.assertNotIn(1, recent)
+        self.assertTrue(recent.add(1))
+        self.assertNotIn(2, recent)
+
+
+
+class CountBackfillTest(unittest.TestCase):
+    """
+    Tests for L{backfill.CountBackfill}.
+    """
+
+    def test_args(self):
+        strategy = backfill.CountBackfill(500)
+        self.assertEqual({'count': '500'}, strategy.args(10))
+
+
+    def test_fetch(self):
+        """
+        Nothing is fetched, the stream replays the statuses itself.
+        """
+        delivered = []
+        d = backfill.CountBackfill().fetch(10, delivered.append)
+        d.addCallback(lambda _: self.assertEqual([], delivered))
+        return d
+
+
+
+class TimelineBackfillTest(unittest.TestCase):
+    """
+    Tests for L{backfill.TimelineBackfill}.
+    """
+
+    def setUp(self):
+        self.statusIDs = range(1, 26)
+        self.calls = []
+
+
+    def timeline(self, delegate, params):
+        """
+        Fake timeline method, newest first.
+        """
+        self.calls.append(params)
+        count = int(params['count'])
+        sinceID = int(params['since_id'])
+        maxID = int(params.get('max_id', self.statusIDs[-1]))
+        matching = [statusID for statusID in reversed(self.statusIDs)
+                    if sinceID < statusID <= maxID]
+        for statusID in matching[:count]:
+            delegate(makeStatus(statusID))
+        return defer.succeed(None)
+
+
+    def test_fetch(self):
+        """
+        Pages are fetched back to the last ID, delivered oldest first.
+        """
+        delivered = []
+        strategy = backfill.TimelineBackfill(self.timeline, count=5)
+        d = strategy.fetch(12, delivered.append)
+
+        def cb(_):
+            self.assertEqual(range(13, 26),
+                             [status.id for status in delivered])
+            self.assertEqual([None, '20', '15'],
+                             [params.get('max_id') for params in self.calls])
+            self.assertEqual(['12'] * 3,
+                             [params['since_id'] for params in self.calls])
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_fetchMaxPages(self):
+        """
+        At most C{maxPages} pages are fetched.
+        """
+        delivered = []
+        strategy = backfill.TimelineBackfill(self.timeline, count=5,
+                                             maxPages=2)
+        d = strategy.fetch(0, delivered.append)
+
+        def cb(_):
+            self.assertEqual(2, len(self.calls))
+            self.assertEqual(range(16, 26),
+                             [status.id for status in delivered])
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_fetchRESTTimeline(self):
+        """
+        Statuses of a REST timeline are delivered as platform statuses.
+        """
+        server = fakeserver.FakeTwitterServer()
+        server.rest.statusCount = 25
+        server.start()
+        self.addCleanup(server.stop)
+
+        delivered = []
+        strategy = backfill.TimelineBackfill(server.api().user_timeline,
+                                             count=5)
+        d = strategy.fetch(12, delivered.append)
+
+        def cb(_):
+            self.assertEqual(range(13, 26),
+                             [status.id for status in delivered])
+            status = delivered[0]
+            self.assertIsInstance(status, platform.Status)
+            self.assertEqual(u'user14', status.user.screen_name)
+            self.assertEqual(14, status.raw['user']['id'])
+            self.assertIdentical(False, status.truncated)
+            self.assertIsInstance(status.raw['created_at'], basestring)
+            self.assertEqual(['statuses/user_timeline.xml'] * 3,
+                             [request[1] for request in server.rest.requests])
+
+        d.addCallback(cb)
+        return d
+
+
+
+class ToStatusTest(unittest.TestCase):
+    """
+    Tests for L{backfill.toStatus}.
+    """
+
+    def test_xml(self):
+        """
+        Values of numbers and booleans are converted.
+        """
+        statuses = []
+        parser = txml.Statuses(statuses.append)
+        parser.dataReceived(
+            '<?xml version="1.0"?><statuses type="array"><status>'
+            '<id>3</id><text>Hello</text><favorited>true</favorited>'
+            '<in_reply_to_status_id></in_reply_to_status_id>'
+            '<user><id>5</id><screen_name>user5</screen_name></user>'
+            '</status></statuses>')
+        status = backfill.toStatus(statuses[0])
+        self.assertIsInstance(status, platform.Status)
+        self.assertEqual(3, status.id)
+        self.assertEqual(u'Hello', status.text)
+        self.assertIdentical(True, status.favorited)
+        self.assertIdentical(None, status.in_reply_to_status_id)
+        self.assertEqual(5, status.user.id)
+        self.assertEqual({'id': 5, 'screen_name': u'user5'},
+                         status.raw['user'])
+
+
+    def test_platform(self):
+        status = makeStatus(1)
+        self.assertIdentical(status, backfill.toStatus(status))
@@ -0,0 +1,143 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.backoff}.
+"""
+
+from twisted.python import failure
+from twisted.trial import unittest
+
+from twittytwister import backoff, twitter
+
+BACKOFF = {'initial': 10, 'max': 100, 'factor': 2}
+
+class StrategyTest(unittest.TestCase):
+    """
+    Tests for the back-off strategies.
+    """
+
+    def delays(self, strategy, attempts=6, reason=None):
+        delays = []
+        previous = None
+        for attempt in xrange(attempts):
+            previous = strategy.nextDelay(BACKOFF, attempt, previous, reason)
+            delays.append(previous)
+        return delays
+
+
+    def test_exponential(self):
+        self.assertEqual([10, 20, 40, 80, 100, 100],
+                         self.delays(backoff.Exponential()))
+
+
+    def test_fullJitter(self):
+        """
+        Delays are a random part of the exponential delay.
+        """
+        self.assertEqual([5, 10, 20, 40, 50, 50],
+                         self.delays(backoff.FullJitter(lambda: 0.5)))
+        self.assertEqual([0] * 6, self.delays(backoff.FullJitter(lambda: 0)))
+
+
+    def test_fullJitterManyAttempts(self):
+        """
+        The delay stays at the cap, also when the exponential delay would
+        overflow.
+        """
+        strategy = backoff.FullJitter(lambda: 1.0)
+        backOff = {'initial': 0.25, 'max': 60, 'factor': 2.0}
+        self.assertEqual(60, strategy.nextDelay(backOff, 5000, 60, None))
+        self.assertEqual(32, strategy.nextDelay(backOff, 7, 16, None))
+
+
+    def test_decorrelatedJitter(self):
+        """
+        Delays are between the initial delay and three times the previous.
+        """
+        self.assertEqual([10, 10, 10],
+                         self.delays(backoff.DecorrelatedJitter(lambda: 0), 3))
+        self.assertEqual([10, 30, 90, 100],
+                         self.delays(backoff.DecorrelatedJitter(lambda: 1), 4))
+        self.assertEqual([10, 20, 35],
+                         self.delays(backoff.DecorrelatedJitter(lambda: 0.5),
+                                     3))
+
+
+    def test_retryAfter(self):
+        """
+        The Retry-After of rate limit errors is used as the delay.
+        """
+        reason = failure.Failure(twitter.RateLimitError(
+            420, 'Enhance Your Calm', retryAfter=90))
+        strategy = backoff.RetryAfter(backoff.Exponential())
+        self.assertEqual([90, 90], self.delays(strategy, 2, reason))
+
+
+    def test_retryAfterFallback(self):
+        """
+        Without Retry-After, the fallback strategy is used.
+        """
+        strategy = backoff.RetryAfter(backoff.Exponential())
+        reason = failure.Failure(twitter.RateLimitError(
+            420, 'Enhance Your Calm'))
+        self.assertEqual([10, 20], self.delays(strategy, 2, reason))
+        self.assertEqual([10, 20], self.delays(strategy, 2))
+
+
+
+class ReconnectBudgetTest(unittest.TestCase):
+    """
+    Tests for L{backoff.ReconnectBudget}.
+    """
+
+    def test_burst(self):
+        """
+        Up to C{burst} reconnects are immediate, the rest is spread out.
+        """
+        budget = backoff.ReconnectBudget(rate=2, burst=3)
+        self.assertEqual([0, 0, 0, 0.5, 1, 1.5],
+                         [budget.reserve(0, 0) for i in xrange(6)])
+
+
+    def test_delay(self):
+        """
+        Reconnects are never earlier than their back-off delay.
+        """
+        budget = backoff.ReconnectBudget(rate=1, burst=1)
+        self.assertEqual(5, budget.reserve(0, 5))
+        self.assertEqual(6, budget.reserve(0, 5))
+        self.assertEqual(10, budget.reserve(0, 10))
+
+
+    def test_refill(self):
+        """
+        The budget is refilled over time.
+        """
+        budget = backoff.ReconnectBudget(rate=1, burst=2)
+        self.assertEqual([0, 0, 1], [budget.reserve(0, 0) for i in xrange(3)])
+        self.assertEqual([0, 0, 1], [budget.reserve(10, 0) for i in xrange(3)])
+
+
+
+class ParseRetryAfterTest(unittest.TestCase):
+    """
+    Tests for L{backoff.parseRetryAfter}.
+    """
+
+    def test_seconds(self):
+        self.assertEqual(120, backoff.parseRetryAfter('120'))
+
+
+    def test_date(self):
+        self.assertEqual(60, backoff.parseRetryAfter(
+            'Wed, 21 Oct 2015 07:29:00 GMT', now=1445412480))
+
+
+    def test_datePast(self):
+        self.assertEqual(0, backoff.parseRetryAfter(
+            'Wed, 21 Oct 2015 07:29:00 GMT', now=1445412600))
+
+
+    def test_invalid(self):
+        self.assertIdentical(None, backoff.parseRetryAfter('soon'))
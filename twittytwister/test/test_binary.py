@@ -0,0 +1,215 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.binary}.
+"""
+
+from StringIO import StringIO
+
+import simplejson as json
+
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from twittytwister import binary, fakeserver, platform
+
+class EncodingTest(unittest.TestCase):
+    """
+    Tests for encoding and decoding.
+    """
+
+    def setUp(self):
+        self.patch(binary, 'msgpack', None)
+        self.data = json.loads(json.dumps(fakeserver.makeStatus(12345,
+                                                                1445412480)))
+        self.data['place'] = {'name': u'Amsterdam \u2603', 'bounding_box': [
+            [4.7, 52.2], [-4.9, -52.4]]}
+        self.data['geo'] = None
+        self.data['favorite_count'] = -1
+        self.data['big'] = 2 ** 70
+
+
+    def test_roundTrip(self):
+        """
+        Decoding the encoded data gives the same data, with the same types.
+        """
+        result = binary.decodeDict(binary.encodeDict(self.data))
+        self.assertEqual(self.data, result)
+        self.assertIsInstance(result['id_str'], str)
+        self.assertIsInstance(result['place']['name'], unicode)
+        self.assertIsInstance(result['truncated'], bool)
+
+
+    def test_smallerThanJSON(self):
+        self.assertTrue(len(binary.encodeDict(self.data)) <
+                        len(json.dumps(self.data)) * 0.7)
+
+
+    def test_fieldTags(self):
+        """
+        Properties are encoded as tags, other keys once per message.
+        """
+        encoded = binary.encodeDict(self.data)
+        self.assertNotIn('screen_name', encoded)
+        self.assertEqual(1, encoded.count('id_str'))
+
+
+    def test_encodeObject(self):
+        status = platform.Status.fromDict(self.data)
+        result = binary.decode(binary.encode(status))
+        self.assertIsInstance(result, platform.Status)
+        self.assertEqual(self.data, result.raw)
+        self.assertEqual(u'user346', result.user.screen_name)
+
+
+    def test_encodeOtherClass(self):
+        user = platform.User.fromDict({'id': 1, 'screen_name': 'ralphm'})
+        encoded = binary.encode(user)
+        self.assertEqual('ralphm', binary.decode(encoded, platform.User)
+                                         .screen_name)
+        self.assertRaises(binary.SchemaError, binary.decode, encoded)
+
+
+    def test_encodeUnsupported(self):
+        self.assertRaises(TypeError, binary.encodeDict, {'a': object()})
+
+
+    def test_decodeVersion(self):
+        encoded = binary.encodeDict(self.data)
+        self.assertRaises(binary.SchemaError, binary.decodeDict,
+                          '\xff' + encoded[1:])
+
+
+    def test_decodePackedWithoutMsgpack(self):
+        """
+        Messages encoded with C{msgpack} cannot be decoded without it.
+        """
+        encoded = binary.encodeDict(self.data)
+        self.assertRaises(binary.SchemaError, binary.decodeDict,
+                          chr(binary.PACKED_VERSION) + encoded[1:])
+
+
+    def test_decodeFingerprint(self):
+        """
+        Messages encoded with other properties are rejected.
+        """
+        encoded = binary.encodeDict(self.data)
+        fields = platform.Status._fields() + [('retweet_count',
+                                               platform.SIMPLE)]
+        self.patch(platform.Status, '_FIELDS', sorted(fields))
+        self.patch(binary, '_schemas', {})
+        self.patch(binary, '_fingerprints', {})
+        self.assertRaises(binary.SchemaError, binary.decodeDict, encoded)
+
+
+    def test_decodeShort(self):
+        self.assertRaises(ValueError, binary.decodeDict, '\x01')
+
+
+
+class PackedTest(unittest.TestCase):
+    """
+    Tests for encoding and decoding with C{msgpack}.
+    """
+
+    if binary.msgpack is None:
+        skip = "msgpack is not installed"
+
+    def setUp(self):
+        self.data = json.loads(json.dumps(fakeserver.makeStatus(12345,
+                                                                1445412480)))
+        self.data['place'] = {'name': u'Amsterdam \u2603', 'bounding_box': [
+            [4.7, 52.2], [-4.9, -52.4]]}
+        self.data['favorite_count'] = -1
+
+
+    def test_roundTrip(self):
+        """
+        Decoding the encoded data gives the same data, with the same types.
+        """
+        encoded = binary.encodeDict(self.data)
+        self.assertEqual(binary.PACKED_VERSION, ord(encoded[0]))
+        result = binary.decodeDict(encoded)
+        self.assertEqual(self.data, result)
+        self.assertIsInstance(result['id_str'], str)
+        self.assertIsInstance(result['place']['name'], unicode)
+        self.assertIsInstance(result['truncated'], bool)
+
+
+    def test_bigIntegers(self):
+        """
+        Data with integers that C{msgpack} cannot encode is encoded with
+        field tags.
+        """
+        self.data['big'] = 2 ** 70
+        encoded = binary.encodeDict(self.data)
+        self.assertEqual(binary.VERSION, ord(encoded[0]))
+        self.assertEqual(self.data, binary.decodeDict(encoded))
+
+
+    def test_fingerprint(self):
+        user = platform.User.fromDict({'id': 1, 'screen_name': 'ralphm'})
+        encoded = binary.encode(user)
+        self.assertEqual('ralphm', binary.decode(encoded, platform.User)
+                                         .screen_name)
+        self.assertRaises(binary.SchemaError, binary.decode, encoded)
+
+
+    def test_decodeTagged(self):
+        """
+        Messages encoded without C{msgpack} are decoded, too.
+        """
+        msgpack = binary.msgpack
+        self.patch(binary, 'msgpack', None)
+        encoded = binary.encodeDict(self.data)
+        binary.msgpack = msgpack
+        self.assertEqual(self.data, binary.decodeDict(encoded))
+
+
+
+class FramingTest(unittest.TestCase):
+    """
+    Tests for framing of encoded objects.
+    """
+
+    def setUp(self):
+        self.statuses = [platform.Status.fromDict(
+                            fakeserver.makeStatus(i, 1445412480))
+                         for i in xrange(3)]
+
+
+    def test_readFrames(self):
+        f = StringIO()
+        writer = binary.FrameWriter(f.write)
+        for status in self.statuses:
+            writer.write(status)
+        f.write('\r\n')
+        f.seek(0)
+        result = list(binary.readFrames(f))
+        self.assertEqual([0, 1, 2], [status.id for status in result])
+
+
+    def test_readFramesTruncated(self):
+        f = StringIO()
+        binary.FrameWriter(f.write).write(self.statuses[0])
+        f = StringIO(f.getvalue()[:-1])
+        self.assertRaises(ValueError, list, binary.readFrames(f))
+
+
+    def test_binaryStream(self):
+        """
+        The protocol decodes frames, also when split over chunks.
+        """
+        received = []
+        transport = proto_helpers.StringTransport()
+        writer = binary.FrameWriter(transport.write)
+        for status in self.statuses:
+            writer.write(status)
+
+        protocol = binary.BinaryStream(received.append)
+        protocol.makeConnection(proto_helpers.StringTransport())
+        data = transport.value()
+        for i in xrange(0, len(data), 7):
+            protocol.dataReceived(data[i:i + 7])
+        self.assertEqual([0, 1, 2], [status.id for status in received])
@@ -0,0 +1,255 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.bulk}.
+"""
+
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectError
+from twisted.trial import unittest
+from twisted.web import error as http_error
+
+from twittytwister import bulk, twitter
+
+class FakeTwitterAPI(object):
+    """
+    Fake Twitter API with a method that returns deferreds fired at will.
+    """
+
+    base_url = 'https://api.twitter.com/1.1'
+    rate_limit_remaining = None
+    rate_limit_reset = None
+
+    def __init__(self):
+        self.calls = []
+
+
+    def block(self, user):
+        d = defer.Deferred()
+        self.calls.append((user, d))
+        return d
+
+
+
+class BulkExecutorTest(unittest.TestCase):
+    """
+    Tests for L{bulk.BulkExecutor}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.api = FakeTwitterAPI()
+        self.results = []
+        self.failures = []
+        self.executor = bulk.BulkExecutor(self.api, concurrency=2,
+                                          resultDelegate=self.onResult,
+                                          failureDelegate=self.onFailure,
+                                          reactor=self.clock,
+                                          random=lambda: 1.0)
+
+
+    def tearDown(self):
+        self.assertEquals(0, len(self.clock.getDelayedCalls()))
+
+
+    def onResult(self, operation, result):
+        self.results.append((operation.args, result))
+
+
+    def onFailure(self, operation, failure):
+        self.failures.append((operation.args, failure))
+
+
+    def test_concurrency(self):
+        """
+        No more than C{concurrency} operations run at the same time.
+        """
+        operations = [(self.api.block, (user,)) for user in 'abcd']
+        d = self.executor.run(operations)
+        self.assertEqual(['a', 'b'], [user for user, _ in self.api.calls])
+        self.assertEqual(2, self.executor.running)
+        self.assertNoResult(d)
+
+        self.api.calls[0][1].callback('A')
+        self.assertEqual(['a', 'b', 'c'], [user for user, _ in self.api.calls])
+
+        for user, call in self.api.calls[1:]:
+            call.callback(user.upper())
+        self.api.calls[-1][1].callback('D')
+
+        self.assertEqual(4, len(self.results))
+        self.assertEqual(4, self.executor.succeeded)
+        self.assertEqual(0, self.executor.running)
+        d.addCallback(self.assertIdentical, self.executor)
+        return d
+
+
+    def test_chainedDeferred(self):
+        """
+        An operation whose deferred has fired, but waits on another deferred,
+        is still running.
+        """
+        self.executor.concurrency = 1
+        inner = defer.Deferred()
+        outer = defer.succeed(None)
+        outer.addCallback(lambda _: inner)
+        operations = [lambda: outer, (self.api.block, ('a',))]
+        d = self.executor.run(operations)
+        self.assertEqual([], self.api.calls)
+        self.assertEqual(1, self.executor.running)
+        self.assertNoResult(d)
+
+        inner.callback('A')
+        self.assertEqual(['a'], [user for user, _ in self.api.calls])
+        self.api.calls[-1][1].callback('B')
+        self.assertEqual(2, self.executor.succeeded)
+        return d
+
+
+    def test_callables(self):
+        """
+        Operations can be callables returning a deferred.
+        """
+        d = self.executor.run([lambda: defer.succeed(1),
+                               lambda: defer.succeed(2)])
+        self.assertEqual([((), 1), ((), 2)], self.results)
+        return d
+
+
+    def test_many(self):
+        """
+        Large jobs of operations that finish immediately work.
+        """
+        operations = (lambda: defer.succeed(None) for i in xrange(5000))
+        d = self.executor.run(operations)
+        self.assertEqual(5000, self.executor.succeeded)
+        return d
+
+
+    def test_retryTransient(self):
+        """
+        Transient errors are retried after a jittered delay.
+        """
+        d = self.executor.run([(self.api.block, ('a',))])
+        self.api.calls[-1][1].errback(ConnectError())
+        self.assertEqual(1, len(self.api.calls))
+        self.assertEqual(1, self.executor.retried)
+
+        self.assertNoResult(d)
+
+        self.clock.advance(self.executor.retryDelay)
+        self.assertEqual(2, len(self.api.calls))
+        self.api.calls[-1][1].errback(http_error.Error('503'))
+
+        self.clock.advance(self.executor.retryDelay * 2)
+        self.assertEqual(3, len(self.api.calls))
+        self.api.calls[-1][1].callback('A')
+
+        self.assertEqual([(('a',), 'A')], self.results)
+        return d
+
+
+    def test_retryExhausted(self):
+        """
+        After the maximum number of retries, the operation fails.
+        """
+        self.executor.maxRetries = 1
+        d = self.executor.run([(self.api.block, ('a',))])
+        self.api.calls[-1][1].errback(ConnectError())
+        self.clock.advance(self.executor.retryDelay)
+        self.api.calls[-1][1].errback(ConnectError())
+
+        self.assertEqual(1, len(self.failures))
+        self.assertEqual(1, self.executor.failed)
+        self.failures[-1][1].trap(ConnectError)
+        return d
+
+
+    def test_noRetryPermanent(self):
+        """
+        Permanent errors are not retried.
+        """
+        d = self.executor.run([(self.api.block, ('a',))])
+        self.api.calls[-1][1].errback(http_error.Error('404'))
+        self.assertEqual(1, len(self.api.calls))
+        self.assertEqual(1, len(self.failures))
+        return d
+
+
+    def test_failureLogged(self):
+        """
+        Without failure delegate, failures are logged.
+        """
+        self.executor.failureDelegate = None
+        d = self.executor.run([lambda: defer.fail(ValueError())])
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        return d
+
+
+    def test_rateLimited(self):
+        """
+        When the rate limit is exhausted, wait for the window to reset.
+        """
+        self.api.rate_limit_remaining = 0
+        self.api.rate_limit_reset = 100
+        d = self.executor.run([(self.api.block, ('a',))])
+        self.assertEqual(0, len(self.api.calls))
+
+        self.api.rate_limit_remaining = 15
+        self.clock.advance(100)
+        self.assertEqual(1, len(self.api.calls))
+        self.api.calls[-1][1].callback(None)
+        return d
+
+
+    def test_rateLimitReserved(self):
+        """
+        Concurrent operations don't use more calls than left in the window.
+        """
+        self.api.rate_limit_remaining = 1
+        self.api.rate_limit_reset = 100
+        d = self.executor.run([(self.api.block, (user,)) for user in 'ab'])
+        self.assertEqual(['a'], [user for user, _ in self.api.calls])
+
+        self.api.rate_limit_remaining = 0
+        self.api.calls[-1][1].callback(None)
+        self.assertEqual(1, len(self.api.calls))
+
+        self.api.rate_limit_remaining = 15
+        self.clock.advance(100)
+        self.assertEqual(['a', 'b'], [user for user, _ in self.api.calls])
+        self.api.calls[-1][1].callback(None)
+        return d
+
+
+    def test_retryAfter(self):
+        """
+        Rate limit errors are retried after their C{Retry-After} delay.
+        """
+        d = self.executor.run([(self.api.block, ('a',))])
+        self.api.calls[-1][1].errback(
+            twitter.RateLimitError('429', retryAfter=30))
+        self.clock.advance(29)
+        self.assertEqual(1, len(self.api.calls))
+        self.clock.advance(1)
+        self.assertEqual(2, len(self.api.calls))
+        self.api.calls[-1][1].callback('A')
+        self.assertEqual([(('a',), 'A')], self.results)
+        return d
+
+
+    def test_progress(self):
+        """
+        Progress metrics are passed to the progress delegate.
+        """
+        progress = []
+        self.executor.progressDelegate = lambda executor: progress.append(
+                executor.progress())
+        d = self.executor.run([(self.api.block, ('a',))])
+        self.clock.advance(2)
+        self.api.calls[-1][1].callback(None)
+        self.assertEqual([{'succeeded': 1, 'failed': 0, 'retried': 0,
+                           'running': 0, 'elapsed': 2, 'rate': 0.5}],
+                         progress)
+        return d
@@ -0,0 +1,60 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.checkpoint}.
+"""
+
+import os
+
+from twisted.trial import unittest
+
+from twittytwister import checkpoint
+
+class JSONFileCheckpointTest(unittest.TestCase):
+    """
+    Tests for L{checkpoint.JSONFileCheckpoint}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.checkpoint = checkpoint.JSONFileCheckpoint(self.path)
+
+
+    def test_loadMissing(self):
+        """
+        A missing checkpoint file results in an empty state.
+        """
+        self.assertEqual({}, self.checkpoint.load())
+
+
+    def test_saveLoad(self):
+        """
+        A saved state can be loaded again.
+        """
+        self.checkpoint.save({'home': 11748322888908800})
+        self.assertEqual({'home': 11748322888908800}, self.checkpoint.load())
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+
+    def test_loadInvalid(self):
+        """
+        An invalid checkpoint is logged and results in an empty state.
+        """
+        f = open(self.path, 'wb')
+        f.write('{"home": ')
+        f.close()
+
+        self.assertEqual({}, self.checkpoint.load())
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+
+    def test_loadNotDict(self):
+        """
+        A checkpoint that does not hold a dictionary is ignored.
+        """
+        f = open(self.path, 'wb')
+        f.write('[1, 2]')
+        f.close()
+
+        self.assertEqual({}, self.checkpoint.load())
@@ -0,0 +1,197 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.collect}.
+"""
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from twittytwister import collect
+
+class FakeItem(object):
+    def __init__(self, id):
+        self.id = unicode(id)
+
+
+
+class FakePagedAPI(object):
+    """
+    Fake API with paged methods, serving pages of consecutive numbers.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+
+    def followers_ids(self, delegate, user, params={}, extra_args=None,
+                      page_delegate=None):
+        self.calls.append((user, params))
+        cursor = int(params['cursor'])
+        if cursor == -1:
+            cursor = 0
+        for item in self.pages[cursor]:
+            delegate(item)
+        if cursor + 1 < len(self.pages):
+            nextCursor = str(cursor + 1)
+        else:
+            nextCursor = '0'
+        page_delegate(nextCursor, str(cursor - 1))
+        return defer.succeed(None)
+
+
+    def user_timeline(self, delegate, user=None, params={}, extra_args=None):
+        self.calls.append((user, params))
+        maxID = int(params.get('max_id', 1000))
+        for item in self.pages:
+            if int(item.id) <= maxID:
+                delegate(item)
+        return defer.succeed(None)
+
+
+
+class CollectTest(unittest.TestCase):
+    """
+    Tests for L{collect.collect} and L{collect.collectPages}.
+    """
+
+    def test_collect(self):
+        """
+        All items passed to the delegate end up in the result list.
+        """
+        def method(delegate, params={}):
+            delegate(1)
+            delegate(2)
+            return defer.succeed(None)
+
+        d = collect.collect(method, params={})
+        d.addCallback(self.assertEqual, [1, 2])
+        return d
+
+
+    def test_collectFailure(self):
+        """
+        Failures of the method are passed on.
+        """
+        def method(delegate):
+            return defer.fail(ValueError())
+
+        d = collect.collect(method)
+        self.assertFailure(d, ValueError)
+        return d
+
+
+    def test_collectPages(self):
+        """
+        Items of all pages are collected, following the cursors.
+        """
+        api = FakePagedAPI([['1', '2'], ['3'], ['4', '5']])
+        d = collect.collectPages(api.followers_ids, 'ralphm')
+        d.addCallback(self.assertEqual, ['1', '2', '3', '4', '5'])
+        return d
+
+
+    def test_collectPagesMany(self):
+        """
+        Collecting many items does not exhaust the stack.
+        """
+        api = FakePagedAPI([[str(i) for i in xrange(5000)]])
+        d = collect.collectPages(api.followers_ids, 'ralphm')
+        d.addCallback(lambda items: self.assertEqual(5000, len(items)))
+        return d
+
+
+
+class CursorIteratorTest(unittest.TestCase):
+    """
+    Tests for L{collect.CursorIterator}.
+    """
+
+    def test_iterate(self):
+        """
+        Items are returned one by one, None signals the end.
+        """
+        api = FakePagedAPI([['1', '2'], ['3']])
+        iterator = collect.CursorIterator(api.followers_ids, 'ralphm')
+        results = []
+        for i in xrange(4):
+            iterator.get().addCallback(results.append)
+        self.assertEqual(['1', '2', '3', None], results)
+        self.assertEqual([('ralphm', {'cursor': '-1'}),
+                          ('ralphm', {'cursor': '1'})], api.calls)
+
+
+    def test_prefetchBounded(self):
+        """
+        No more than C{prefetch} pages are fetched ahead.
+        """
+        api = FakePagedAPI([['1'], ['2'], ['3'], ['4']])
+        iterator = collect.CursorIterator(api.followers_ids, 'ralphm',
+                                          prefetch=2)
+        iterator.get()
+        self.assertEqual(3, iterator.pages)
+
+
+    def test_failure(self):
+        """
+        A failing page fetch is passed to waiting and later consumers.
+        """
+        def method(delegate, params={}, page_delegate=None):
+            return defer.fail(ValueError())
+
+        iterator = collect.CursorIterator(method)
+        d1 = iterator.get()
+        d2 = iterator.get()
+        self.assertFailure(d1, ValueError)
+        self.assertFailure(d2, ValueError)
+        return defer.gatherResults([d1, d2])
+
+
+    def test_waiting(self):
+        """
+        Consumers waiting for a page in progress get its items.
+        """
+        pending = []
+
+        def method(delegate, params={}, page_delegate=None):
+            d = defer.Deferred()
+            pending.append((delegate, page_delegate, d))
+            return d
+
+        iterator = collect.CursorIterator(method)
+        results = []
+        iterator.get().addCallback(results.append)
+        iterator.get().addCallback(results.append)
+        self.assertEqual([], results)
+
+        delegate, pageDelegate, d = pending[-1]
+        delegate('a')
+        pageDelegate('0', '0')
+        d.callback(None)
+        self.assertEqual(['a', None], results)
+
+
+
+class TimelineIteratorTest(unittest.TestCase):
+    """
+    Tests for L{collect.TimelineIterator}.
+    """
+
+    def test_maxID(self):
+        """
+        Subsequent pages are requested with max_id below the lowest ID.
+        """
+        api = FakePagedAPI([FakeItem(30), FakeItem(20)])
+        iterator = collect.TimelineIterator(api.user_timeline, 'ralphm',
+                                            params={'count': '2'})
+        results = []
+        for i in xrange(3):
+            iterator.get().addCallback(results.append)
+
+        self.assertEqual([u'30', u'20', None], [item and item.id
+                                                for item in results])
+        self.assertEqual([('ralphm', {'count': '2'}),
+                          ('ralphm', {'count': '2', 'max_id': '19'})],
+                         api.calls)
@@ -0,0 +1,282 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.columnar}.
+"""
+
+import ast
+import math
+import os
+import struct
+from array import array
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from twittytwister import columnar, platform
+
+STATUS = {
+    'id': 2 ** 62,
+    'text': u'Hello, w\xf6rld #twisted',
+    'created_at': 'Wed Oct 21 07:28:00 +0000 2015',
+    'user': {'id': 1234},
+    'entities': {'hashtags': [{'text': 'twisted', 'indices': [14, 22]}],
+                 'urls': [],
+                 'user_mentions': [{'id': 1, 'screen_name': 'a',
+                                    'indices': [0, 2]},
+                                   {'id': 2, 'screen_name': 'b',
+                                    'indices': [3, 5]}]},
+    }
+
+def makeStatus(**kwargs):
+    data = dict(STATUS)
+    data.update(kwargs)
+    return platform.Status.fromDict(data)
+
+
+
+def readNPY(path):
+    """
+    Read a C{.npy} file written by L{columnar.writeNPY}.
+    """
+    f = open(path, 'rb')
+    try:
+        content = f.read()
+    finally:
+        f.close()
+    assert content[:8] == '\x93NUMPY\x01\x00'
+    headerLength, = struct.unpack('<H', content[8:10])
+    header = ast.literal_eval(content[10:10 + headerLength])
+    assert (10 + headerLength) % 16 == 0
+    return header, content[10 + headerLength:]
+
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.batches = []
+        self.closed = False
+
+
+    def write(self, batch):
+        self.batches.append(batch)
+
+
+    def close(self):
+        self.closed = True
+
+
+
+class BatchTest(unittest.TestCase):
+    """
+    Tests for L{columnar.Batch}.
+    """
+
+    def test_append(self):
+        batch = columnar.Batch(size=4)
+        batch.append(makeStatus())
+        batch.append(makeStatus(id=2, text=u'', user={'id': 5},
+                                entities={}))
+        arrays = batch.arrays()
+
+        self.assertEqual(2, len(batch))
+        self.assertEqual(array('l', [2 ** 62, 2]), arrays['id'])
+        self.assertEqual(array('d', [1445412480, 1445412480]),
+                         arrays['created_at'])
+        self.assertEqual(array('l', [1234, 5]), arrays['user_id'])
+        self.assertEqual(array('i', [1, 0]), arrays['hashtags'])
+        self.assertEqual(array('i', [2, 0]), arrays['user_mentions'])
+        self.assertEqual(array('i', [0, 0]), arrays['urls'])
+        self.assertEqual(STATUS['text'], batch.text('text', 0))
+        self.assertEqual(u'', batch.text('text', 1))
+
+
+    def test_missing(self):
+        """
+        Missing values are stored as the column's missing value.
+        """
+        batch = columnar.Batch(size=1)
+        batch.append(platform.Status.fromDict({'text': u'Hi'}))
+        arrays = batch.arrays()
+        self.assertEqual(0, arrays['id'][0])
+        self.assertTrue(math.isnan(arrays['created_at'][0]))
+        self.assertEqual(-1, arrays['user_id'][0])
+        self.assertEqual(0, arrays['media'][0])
+
+
+    def test_userIDAttribute(self):
+        batch = columnar.Batch(size=1)
+        batch.append(platform.Status.fromDict({'text': u'Hi', 'user_id': 9}))
+        self.assertEqual(9, batch.arrays()['user_id'][0])
+
+
+    def test_full(self):
+        batch = columnar.Batch(size=1)
+        batch.append(makeStatus())
+        self.assertRaises(IndexError, batch.append, makeStatus())
+
+
+    def test_nbytes(self):
+        """
+        Numbers take their item size, text its encoded length plus offsets.
+        """
+        columns = (columnar.Column('id', 'l', lambda status: status.id),
+                   columnar.TextColumn('text', lambda status: status.text))
+        batch = columnar.Batch(columns, size=10)
+        batch.append(makeStatus(text=u'abc'))
+        self.assertEqual(8 + 3 + 2 * 4, batch.nbytes())
+
+
+
+class ColumnarSinkTest(unittest.TestCase):
+    """
+    Tests for L{columnar.ColumnarSink}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.writer = FakeWriter()
+        self.sink = columnar.ColumnarSink(self.writer, batchSize=2,
+                                          flushInterval=10,
+                                          reactor=self.clock)
+
+
+    def test_flushFull(self):
+        """
+        Full batches are written.
+        """
+        self.sink(makeStatus(id=1))
+        self.assertEqual([], self.writer.batches)
+        self.sink(makeStatus(id=2))
+        self.assertEqual(1, len(self.writer.batches))
+        self.assertEqual(array('l', [1, 2]),
+                         self.writer.batches[0].arrays()['id'])
+        self.assertEqual(0, len(self.sink.batch))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_flushInterval(self):
+        """
+        Batches are written at most C{flushInterval} after their first row.
+        """
+        self.sink(makeStatus(id=1))
+        self.clock.advance(9)
+        self.assertEqual([], self.writer.batches)
+        self.clock.advance(1)
+        self.assertEqual(1, len(self.writer.batches))
+        self.assertEqual(1, len(self.writer.batches[0]))
+
+
+    def test_flushIntervalError(self):
+        """
+        Errors writing timed batches are logged.
+        """
+        def write(batch):
+            raise IOError()
+
+        self.writer.write = write
+        self.sink(makeStatus(id=1))
+        self.clock.advance(10)
+        self.assertEqual(1, len(self.flushLoggedErrors(IOError)))
+        self.assertEqual(1, len(self.sink.batch))
+        del self.writer.write
+        self.clock.advance(10)
+        self.assertEqual(1, len(self.writer.batches))
+
+
+    def test_flushFullError(self):
+        """
+        Full batches that fail to be written are kept and written at the
+        next status, statuses that do not fit are dropped.
+        """
+        def write(batch):
+            raise IOError()
+
+        self.writer.write = write
+        self.sink(makeStatus(id=1))
+        self.sink(makeStatus(id=2))
+        self.assertEqual(1, len(self.flushLoggedErrors(IOError)))
+        self.assertEqual(2, len(self.sink.batch))
+
+        self.sink(makeStatus(id=3))
+        self.assertEqual(1, len(self.flushLoggedErrors(IOError)))
+        self.assertEqual(1, self.sink.dropped)
+
+        del self.writer.write
+        self.sink(makeStatus(id=4))
+        self.assertEqual([array('l', [1, 2])],
+                         [batch.arrays()['id']
+                          for batch in self.writer.batches])
+        self.assertEqual(1, len(self.sink.batch))
+        self.sink.flush()
+
+
+    def test_close(self):
+        self.sink(makeStatus(id=1))
+        self.sink.close()
+        self.assertEqual(1, len(self.writer.batches))
+        self.assertTrue(self.writer.closed)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_flushEmpty(self):
+        self.sink.flush()
+        self.assertEqual([], self.writer.batches)
+
+
+
+class NPYWriterTest(unittest.TestCase):
+    """
+    Tests for L{columnar.NPYWriter}.
+    """
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.batch = columnar.Batch(size=2)
+        self.batch.append(makeStatus(id=1))
+        self.batch.append(makeStatus(id=2, text=u'\xe9'))
+
+
+    def test_write(self):
+        writer = columnar.NPYWriter(self.directory)
+        paths = writer.write(self.batch)
+        self.assertEqual(1 + 5 + 2 * 1 + 1, len(paths))
+
+        idPath = [path for path in paths if path.endswith('-000001.id.npy')]
+        header, data = readNPY(idPath[0])
+        self.assertEqual((2,), header['shape'])
+        self.assertFalse(header['fortran_order'])
+        self.assertEqual('i8', header['descr'][1:])
+        self.assertEqual(array('l', [1, 2]), array('l', data))
+
+        header, data = readNPY(idPath[0].replace('.id.', '.text.data.'))
+        self.assertEqual('|u1', header['descr'])
+        self.assertEqual(STATUS['text'].encode('utf-8') + '\xc3\xa9', data)
+
+        header, data = readNPY(idPath[0].replace('.id.', '.text.offsets.'))
+        self.assertEqual((3,), header['shape'])
+
+
+    def test_sequence(self):
+        """
+        Sequence numbers continue after the files already written.
+        """
+        columnar.NPYWriter(self.directory).write(self.batch)
+        writer = columnar.NPYWriter(self.directory)
+        paths = writer.write(self.batch)
+        self.assertIn('statuses-000002.id.npy', ' '.join(paths))
+
+
+
+class ParquetWriterTest(unittest.TestCase):
+    """
+    Tests for L{columnar.ParquetWriter}.
+    """
+
+    def test_noPyArrow(self):
+        if columnar.pyarrow is not None:
+            raise unittest.SkipTest("pyarrow is installed")
+        self.assertRaises(ImportError, columnar.ParquetWriter, 'out.parquet')
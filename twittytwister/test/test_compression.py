@@ -0,0 +1,250 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.compression}.
+"""
+
+import gzip
+import StringIO
+import zlib
+
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from twisted.web import client
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from twittytwister import compression, streaming
+
+def gzipData(data):
+    f = StringIO.StringIO()
+    g = gzip.GzipFile(fileobj=f, mode='wb')
+    g.write(data)
+    g.close()
+    return f.getvalue()
+
+
+
+class FakeFile(object):
+
+    def __init__(self):
+        self.data = []
+        self.closed = False
+
+
+    def write(self, data):
+        self.data.append(data)
+
+
+    def close(self):
+        self.closed = True
+
+
+
+class FakeResponse(object):
+    """
+    Fake response that delivers its body to a protocol on request.
+    """
+
+    code = 200
+    length = 10
+
+    def __init__(self):
+        self.transport = proto_helpers.StringTransport()
+
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self.transport)
+
+
+
+class DecompressorTest(unittest.TestCase):
+    """
+    Tests for L{compression.Decompressor}.
+    """
+
+    def test_gzipChunks(self):
+        """
+        Gzip data is decompressed incrementally, statistics are recorded.
+        """
+        data = 'test ' * 1000
+        compressed = gzipData(data)
+        stats = compression.CompressionStats()
+        decompressor = compression.Decompressor('gzip', stats)
+
+        result = []
+        for i in xrange(0, len(compressed), 7):
+            result.append(decompressor.decompress(compressed[i:i+7]))
+        result.append(decompressor.flush())
+
+        self.assertEqual(data, ''.join(result))
+        self.assertEqual(len(compressed), stats.compressedBytes)
+        self.assertEqual(len(data), stats.decompressedBytes)
+        self.assertTrue(stats.ratio() > 10)
+        self.assertNotIdentical(None, stats.costPerMegabyte())
+
+
+    def test_deflate(self):
+        """
+        Deflate data is decompressed.
+        """
+        decompressor = compression.Decompressor('deflate')
+        result = decompressor.decompress(zlib.compress('test'))
+        self.assertEqual('test', result + decompressor.flush())
+
+
+    def test_noStats(self):
+        """
+        Without data, there are no ratio and cost.
+        """
+        stats = compression.CompressionStats()
+        self.assertIdentical(None, stats.ratio())
+        self.assertIdentical(None, stats.costPerMegabyte())
+
+
+
+class DecompressingWriterTest(unittest.TestCase):
+    """
+    Tests for L{compression.DecompressingWriter}.
+    """
+
+    def test_write(self):
+        """
+        Written data is decompressed and passed on, close is passed on.
+        """
+        original = FakeFile()
+        writer = compression.DecompressingWriter(
+                original, compression.Decompressor('gzip'))
+        writer.write(gzipData('<statuses/>'))
+        writer.close()
+        self.assertEqual('<statuses/>', ''.join(original.data))
+        self.assertTrue(original.closed)
+
+
+    def test_writeInvalid(self):
+        """
+        Invalid data results in an IOError, as expected by HTTPDownloader.
+        """
+        writer = compression.DecompressingWriter(
+                FakeFile(), compression.Decompressor('gzip'))
+        self.assertRaises(IOError, writer.write, 'not compressed')
+
+
+
+class DecompressingDownloaderTest(unittest.TestCase):
+    """
+    Tests for L{compression.DecompressingDownloader}.
+    """
+
+    def test_acceptEncoding(self):
+        """
+        Compressed responses are requested.
+        """
+        downloader = compression.DecompressingDownloader('http://example.org/',
+                                                         FakeFile())
+        self.assertEqual('gzip', downloader.headers['accept-encoding'])
+
+
+    def test_pageStartCompressed(self):
+        """
+        Compressed responses are decompressed before writing to the file.
+        """
+        original = FakeFile()
+        downloader = compression.DecompressingDownloader('http://example.org/',
+                                                         original)
+        downloader.gotHeaders({'content-encoding': ['gzip']})
+        downloader.pageStart(False)
+        downloader.pagePart(gzipData('<statuses/>'))
+        downloader.pageEnd()
+        self.assertEqual('<statuses/>', ''.join(original.data))
+        self.assertTrue(original.closed)
+
+
+    def test_pageStartUncompressed(self):
+        """
+        Uncompressed responses are written as is.
+        """
+        original = FakeFile()
+        downloader = compression.DecompressingDownloader('http://example.org/',
+                                                         original)
+        downloader.gotHeaders({})
+        downloader.pageStart(False)
+        self.assertIdentical(original, downloader.file)
+
+
+
+class DecompressBodyTest(unittest.TestCase):
+    """
+    Tests for L{compression.decompressBody}.
+    """
+
+    def test_compressed(self):
+        body = compression.decompressBody(gzipData('test'),
+                                          {'content-encoding': ['gzip']})
+        self.assertEqual('test', body)
+
+
+    def test_uncompressed(self):
+        self.assertEqual('test', compression.decompressBody('test', {}))
+        self.assertEqual('test', compression.decompressBody('test', None))
+
+
+
+class DecoderFactoryTest(unittest.TestCase):
+    """
+    Tests for L{compression.DecoderFactory}.
+    """
+
+    def setUp(self):
+        self.objects = []
+        self.stats = compression.CompressionStats()
+        self.response = FakeResponse()
+        decoder = compression.DecoderFactory('gzip', self.stats)
+        self.decoded = decoder(self.response)
+        self.protocol = streaming.TwitterStream(self.objects.append,
+                                                timeoutPeriod=None)
+        self.decoded.deliverBody(self.protocol)
+
+
+    def test_stream(self):
+        """
+        A compressed stream is decoded chunk by chunk.
+        """
+        data = gzipData('23\r\n{"text": "Test status"}\r\n')
+        for i in xrange(len(data)):
+            self.response.protocol.dataReceived(data[i])
+        self.response.protocol.connectionLost(
+                failure.Failure(client.ResponseDone()))
+        self.assertEqual(1, len(self.objects))
+        self.assertEqual(len(data), self.stats.compressedBytes)
+        return self.protocol.deferred
+
+
+    def test_length(self):
+        """
+        The length of the decoded response is unknown.
+        """
+        self.assertEqual(UNKNOWN_LENGTH, self.decoded.length)
+        self.assertEqual(200, self.decoded.code)
+
+
+    def test_transport(self):
+        """
+        The stream protocol can stop the underlying transport.
+        """
+        self.protocol.timeoutConnection()
+        self.assertEqual('stopped', self.response.transport.producerState)
+
+
+    def test_invalid(self):
+        """
+        Invalid data closes the stream with an error.
+        """
+        self.response.protocol.dataReceived('not compressed')
+        self.assertEqual('stopped', self.response.transport.producerState)
+        self.response.protocol.connectionLost(
+                failure.Failure(client.ResponseDone()))
+        self.assertFailure(self.protocol.deferred, client.ResponseFailed)
+        return self.protocol.deferred
@@ -0,0 +1,211 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.entities}.
+"""
+
+from array import array
+
+from twisted.trial import unittest
+
+from twittytwister import columnar, entities, platform
+
+def makeStatus(hashtags=(), mentions=(), urls=(), media=()):
+    return {
+        'text': u'Hello',
+        'entities': {
+            'hashtags': [{'text': text, 'indices': [i, i + len(text)]}
+                         for i, text in enumerate(hashtags)],
+            'user_mentions': [{'screen_name': name, 'id': 1,
+                               'indices': [0, len(name) + 1]}
+                              for name in mentions],
+            'urls': [{'url': 'http://t.co/x', 'expanded_url': url,
+                      'indices': [0, 13]} for url in urls],
+            'media': [{'media_url_https': url, 'indices': [0, 13]}
+                      for url in media],
+            },
+        }
+
+
+
+class ExtractTest(unittest.TestCase):
+    """
+    Tests for L{entities.extract}.
+    """
+
+    def test_arrays(self):
+        """
+        Entities of all statuses end up in parallel arrays.
+        """
+        result = entities.extract([
+            makeStatus(hashtags=['twisted'], mentions=['ralphm']),
+            {'text': u'No entities'},
+            makeStatus(urls=['http://example.org/'],
+                       media=['https://pbs.twimg.com/a.jpg']),
+            ])
+        self.assertEqual(4, len(result))
+        self.assertEqual(3, result.statuses)
+        self.assertEqual(array('i', [0, 0, 2, 2]), result.status)
+        self.assertEqual(array('B', [entities.HASHTAG, entities.MENTION,
+                                     entities.URL, entities.MEDIA]),
+                         result.kind)
+        self.assertEqual(array('i', [0, 0, 0, 0]), result.start)
+        self.assertEqual(array('i', [7, 7, 13, 13]), result.end)
+        self.assertEqual([u'twisted', u'ralphm', 'http://example.org/',
+                          'https://pbs.twimg.com/a.jpg'],
+                         [result.values[code] for code in result.value])
+
+
+    def test_dictionaryEncoded(self):
+        """
+        Each distinct value per entity type is stored once.
+        """
+        result = entities.extract([makeStatus(hashtags=['Twisted', 'a']),
+                                   makeStatus(hashtags=['twisted'],
+                                              mentions=['twisted'])])
+        self.assertEqual(array('i', [0, 1, 0, 2]), result.value)
+        self.assertEqual([u'twisted', u'a', u'twisted'], result.values)
+        self.assertEqual(array('B', [entities.HASHTAG, entities.HASHTAG,
+                                     entities.MENTION]),
+                         result.valueKinds)
+
+
+    def test_caseSensitive(self):
+        result = entities.extract([makeStatus(hashtags=['Twisted',
+                                                        'twisted'])],
+                                  lowercase=False)
+        self.assertEqual([u'Twisted', u'twisted'], result.values)
+
+
+    def test_statusObjects(self):
+        """
+        Status objects are extracted from their raw data.
+        """
+        status = platform.Status.fromDict(makeStatus(hashtags=['twisted']))
+        result = entities.extract([status])
+        self.assertEqual([u'twisted'], result.values)
+
+
+    def test_invalidIndices(self):
+        result = entities.extract([{'entities': {'hashtags': [
+            {'text': 'twisted'}, {'text': 'python', 'indices': None}]}}])
+        self.assertEqual(array('i', [-1, -1]), result.start)
+        self.assertEqual(array('i', [-1, -1]), result.end)
+
+
+    def test_extend(self):
+        """
+        Status indices continue over batches.
+        """
+        result = entities.EntityArrays()
+        result.extend([makeStatus(hashtags=['a'])])
+        result.extend([makeStatus(hashtags=['a'])])
+        self.assertEqual(array('i', [0, 1]), result.status)
+        self.assertEqual([u'a'], result.values)
+
+
+
+class AggregationTest(unittest.TestCase):
+    """
+    Tests for counting entities in L{entities.EntityArrays}.
+    """
+
+    def setUp(self):
+        self.result = entities.extract([
+            makeStatus(hashtags=['a', 'b'], mentions=['a']),
+            makeStatus(hashtags=['b', 'c']),
+            makeStatus(hashtags=['b'], mentions=['a', 'c']),
+            ])
+
+
+    def test_counts(self):
+        counts = self.result.counts()
+        self.assertEqual({u'a': 1, u'b': 3, u'c': 1},
+                         dict((self.result.values[code], counts[code])
+                              for code in xrange(len(counts))
+                              if self.result.valueKinds[code] ==
+                                 entities.HASHTAG))
+
+
+    def test_top(self):
+        self.assertEqual([(u'b', 3)], self.result.top(1))
+        self.assertEqual([(u'a', 2), (u'c', 1)],
+                         self.result.top(5, entities.MENTION))
+        self.assertEqual([], self.result.top(5, entities.URL))
+
+
+    def test_countsAfterExtend(self):
+        """
+        Counts are kept until statuses are added.
+        """
+        self.assertEqual([(u'b', 3)], self.result.top(1))
+        self.result.extend([makeStatus(hashtags=['c', 'c', 'c'])])
+        self.assertEqual([(u'c', 4)], self.result.top(1))
+
+
+    def test_countsWithoutNumPy(self):
+        self.patch(entities, 'numpy', None)
+        self.assertEqual([(u'b', 3)], self.result.top(1))
+
+
+
+class EntityColumnTest(unittest.TestCase):
+    """
+    Tests for L{entities.EntityColumn}.
+    """
+
+    def setUp(self):
+        self.batch = columnar.Batch(columnar.STATUS_COLUMNS +
+                                    (entities.EntityColumn(),), size=10)
+        for status in (makeStatus(hashtags=['a', 'B']),
+                       makeStatus(),
+                       makeStatus(hashtags=['b'], mentions=[u'\xe9t\xe9'])):
+            self.batch.append(platform.Status.fromDict(status))
+
+
+    def test_arrays(self):
+        """
+        The entities are exported as arrays, with the status index being
+        the row.
+        """
+        arrays = self.batch.arrays()
+        self.assertEqual(array('i', [0, 0, 2, 2]), arrays['entities.status'])
+        self.assertEqual(array('i', [0, 1, 1, 2]), arrays['entities.value'])
+        self.assertEqual(array('i', [0, 1, 2, 7]),
+                         arrays['entities.values.offsets'])
+        self.assertEqual('ab\xc3\xa9t\xc3\xa9',
+                         arrays['entities.values.data'].tostring())
+        self.assertEqual(array('B', [entities.HASHTAG, entities.HASHTAG,
+                                     entities.MENTION]),
+                         arrays['entities.values.kind'])
+        self.assertEqual(array('i', [2, 0, 1]), arrays['hashtags'])
+
+
+    def test_extract(self):
+        """
+        Batches can be passed to L{entities.extract}, status indices continue
+        over batches.
+        """
+        result = entities.extract([makeStatus(hashtags=['b'])])
+        result.extend(self.batch)
+        self.assertEqual(4, result.statuses)
+        self.assertEqual(array('i', [0, 1, 1, 3, 3]), result.status)
+        self.assertEqual([(u'b', 3)], result.top(1))
+        self.assertEqual([(u'\xe9t\xe9', 1)], result.top(1, entities.MENTION))
+
+
+    def test_extractCaseSensitive(self):
+        """
+        Values of batches collected case sensitively are folded when
+        extracting case insensitively.
+        """
+        batch = columnar.Batch((entities.EntityColumn(lowercase=False),))
+        batch.append(platform.Status.fromDict(makeStatus(hashtags=['A'])))
+        self.assertEqual([u'A'], batch.storage('entities').values)
+        self.assertEqual([(u'a', 1)], entities.extract(batch).top(1))
+
+
+    def test_noEntityColumn(self):
+        batch = columnar.Batch(size=1)
+        self.assertRaises(ValueError, entities.extract, batch)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.fakeserver}, end to end with the clients in
+L{twittytwister.twitter}.
+"""
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web import client, error
+
+from twittytwister import fakeserver, metrics, twitter
+
+class FakeTwitterServerTest(unittest.TestCase):
+    """
+    Tests for L{fakeserver.FakeTwitterServer}.
+    """
+
+    def setUp(self):
+        self.server = fakeserver.FakeTwitterServer(rate=1000)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+
+    def test_stream(self):
+        """
+        Statuses are streamed to the feed, with the request arguments.
+        """
+        self.server.stream.disconnectAfter = 10
+        statuses = []
+        feed = self.server.feed()
+        d = feed.filter(statuses.append, {'track': 'twisted'})
+        d.addCallback(lambda protocol: protocol.deferred)
+
+        def cb(_):
+            self.assertEqual(range(1, 11), [status.id for status in statuses])
+            self.assertEqual(u'Status 1 #tag1 @user8', statuses[0].text)
+            self.assertEqual('user2', statuses[0].user.screen_name)
+            path, args, headers = self.server.stream.requests[0]
+            self.assertEqual('statuses/filter.json', path)
+            self.assertEqual(['twisted'], args['track'])
+            self.assertEqual(['length'], args['delimited'])
+            self.assertEqual([], self.server.stream.writers)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_keepAlive(self):
+        """
+        Idle streams get keep-alives, warnings are sent as datagrams.
+        """
+        self.server.stream.rate = 0
+        self.server.stream.keepAliveInterval = 0.05
+        self.server.stream.stallWarningInterval = 0.1
+        feed = self.server.feed()
+        feed.metrics = metrics.MemoryMetrics()
+        statuses = []
+        d = feed.sample(statuses.append)
+        d.addCallback(lambda _: task.deferLater(reactor, 0.3, lambda: None))
+
+        def cb(_):
+            self.assertEqual([], statuses)
+            self.assertTrue(feed.metrics.counters['stream.keepalives'])
+            self.assertTrue(feed.metrics.counters['stream.unsupported'])
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_unauthorizedStream(self):
+        """
+        Streams without OAuth credentials are refused.
+        """
+        d = client.getPage(self.server.streamURL + '/statuses/sample.json')
+        self.assertFailure(d, error.Error)
+        d.addCallback(lambda exc: self.assertEqual('401', exc.status))
+        return d
+
+
+    def test_userTimeline(self):
+        """
+        Timelines are served as XML, honouring C{count} and C{max_id}.
+        """
+        statuses = []
+        api = self.server.api()
+        d = api.user_timeline(statuses.append, 'user1',
+                              {'count': '3', 'max_id': '50'})
+
+        def cb(_):
+            self.assertEqual(['50', '49', '48'],
+                             [status.id for status in statuses])
+            self.assertEqual('user51', statuses[0].user.screen_name)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_rateLimit(self):
+        """
+        Rate limit headers are passed on, exhausted limits give a 429 with
+        the delay until the window is reset.
+        """
+        self.server.rest.rateLimit = 2
+        api = self.server.api()
+        statuses = []
+        d = api.home_timeline(statuses.append, {'count': '1'})
+
+        def cb(_):
+            self.assertEqual(2, api.rate_limit_limit)
+            self.assertEqual(1, api.rate_limit_remaining)
+            d = api.home_timeline(statuses.append, {'count': '1'})
+            d.addCallback(lambda _: api.home_timeline(statuses.append))
+            return self.assertFailure(d, twitter.RateLimitError)
+
+        def eb(exc):
+            self.assertEqual('429', exc.status)
+            self.assertEqual(0, api.rate_limit_remaining)
+            self.assertTrue(0 < exc.retryAfter <= 900)
+
+        d.addCallback(cb)
+        d.addCallback(eb)
+        return d
+
+
+    def test_unauthorized(self):
+        """
+        Requests without OAuth credentials are refused.
+        """
+        d = client.getPage(self.server.baseURL + '/statuses/home_timeline.xml')
+        self.assertFailure(d, error.Error)
+        d.addCallback(lambda exc: self.assertEqual('401', exc.status))
+        return d
+
+
+    def test_cursors(self):
+        """
+        ID lists are paged with cursors, until the next cursor is 0.
+        """
+        self.server.rest.idCount = 250
+        api = self.server.api()
+        ids = []
+        cursors = []
+
+        def page(nextCursor, previousCursor):
+            cursors.append(nextCursor)
+
+        @defer.inlineCallbacks
+        def fetchAll():
+            cursor = '-1'
+            while cursor != '0':
+                yield api.friends_ids(ids.append, 'user1',
+                                      {'cursor': cursor},
+                                      page_delegate=page)
+                cursor = str(cursors[-1])
+
+        def cb(_):
+            self.assertEqual(['101', '201', '0'],
+                             [str(cursor) for cursor in cursors])
+            self.assertEqual([str(i) for i in xrange(1, 251)], ids)
+
+        d = fetchAll()
+        d.addCallback(cb)
+        return d
+
+
+    def test_update(self):
+        """
+        Posted status updates are recorded, the new ID is returned.
+        """
+        api = self.server.api()
+        d = api.update(u'Hello ☃')
+
+        def cb(statusID):
+            self.assertEqual([u'Hello ☃'], self.server.rest.updates)
+            self.assertEqual(u'1001', statusID)
+
+        d.addCallback(cb)
+        return d
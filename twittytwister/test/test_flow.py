@@ -0,0 +1,153 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.flow}.
+"""
+
+from zope.interface import verify
+
+from twisted.internet import defer, task
+from twisted.internet.interfaces import IConsumer
+from twisted.trial import unittest
+
+from twittytwister import flow, metrics
+
+class FakeProducer(object):
+
+    def __init__(self):
+        self.calls = []
+
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+
+    def resumeProducing(self):
+        self.calls.append('resume')
+
+
+    def stopProducing(self):
+        self.calls.append('stop')
+
+
+
+class BackpressureTest(unittest.TestCase):
+    """
+    Tests for L{flow.Backpressure}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = metrics.MemoryMetrics()
+        self.handled = []
+        self.producer = FakeProducer()
+        self.backpressure = flow.Backpressure(self.handler, highWater=3,
+                                              lowWater=1,
+                                              metrics=self.metrics,
+                                              reactor=self.clock)
+        self.backpressure.registerProducer(self.producer, True)
+
+
+    def handler(self, entry):
+        d = defer.Deferred()
+        self.handled.append((entry, d))
+        return d
+
+
+    def test_interface(self):
+        verify.verifyObject(IConsumer, self.backpressure)
+
+
+    def test_pause(self):
+        """
+        The producer is paused when C{highWater} entries are pending.
+        """
+        self.backpressure.write(1)
+        self.backpressure.write(2)
+        self.assertEqual([], self.producer.calls)
+        self.backpressure.write(3)
+        self.assertEqual(['pause'], self.producer.calls)
+        self.assertTrue(self.backpressure.paused)
+        self.assertEqual(3, self.metrics.gauges['flow.pending'])
+        self.assertEqual(1, self.metrics.counters['flow.pauses'])
+
+
+    def test_hysteresis(self):
+        """
+        The producer is resumed only when drained to C{lowWater} entries.
+        """
+        for entry in xrange(3):
+            self.backpressure.write(entry)
+        self.clock.advance(2)
+        self.handled[0][1].callback(None)
+        self.assertEqual(['pause'], self.producer.calls)
+        self.handled[1][1].callback(None)
+        self.assertEqual(['pause', 'resume'], self.producer.calls)
+        self.assertFalse(self.backpressure.paused)
+        self.assertEqual(2, self.metrics.histograms['flow.paused_time'].sum)
+
+        self.backpressure.write(3)
+        self.assertEqual(['pause', 'resume'], self.producer.calls)
+
+
+    def test_synchronous(self):
+        """
+        Handlers that don't return a deferred never cause a pause.
+        """
+        handled = []
+        backpressure = flow.Backpressure(handled.append, highWater=1)
+        backpressure.registerProducer(self.producer, True)
+        backpressure.write(1)
+        backpressure.write(2)
+        self.assertEqual([1, 2], handled)
+        self.assertEqual([], self.producer.calls)
+
+
+    def test_handlerFailure(self):
+        """
+        Failures of the handler are logged and count as handled.
+        """
+        class Error(Exception):
+            pass
+
+        for entry in xrange(3):
+            self.backpressure.write(entry)
+        for entry, d in self.handled[:2]:
+            d.errback(Error())
+        self.assertEqual(2, len(self.flushLoggedErrors(Error)))
+        self.assertEqual(2, self.metrics.counters['flow.errors'])
+        self.assertEqual(['pause', 'resume'], self.producer.calls)
+
+
+    def test_registerProducerPending(self):
+        """
+        A producer registered while entries are pending is paused.
+        """
+        backpressure = flow.Backpressure(self.handler, highWater=1)
+        backpressure.write(1)
+        backpressure.registerProducer(self.producer, True)
+        self.assertEqual(['pause'], self.producer.calls)
+
+
+    def test_registerProducerTwice(self):
+        self.assertRaises(RuntimeError, self.backpressure.registerProducer,
+                          FakeProducer(), True)
+
+
+    def test_registerPullProducer(self):
+        backpressure = flow.Backpressure(self.handler)
+        self.assertRaises(ValueError, backpressure.registerProducer,
+                          self.producer, False)
+
+
+    def test_unregisterProducer(self):
+        """
+        A paused producer is resumed when unregistered.
+        """
+        for entry in xrange(3):
+            self.backpressure.write(entry)
+        self.backpressure.unregisterProducer()
+        self.assertEqual(['pause', 'resume'], self.producer.calls)
+        self.assertIdentical(None, self.backpressure.producer)
+        self.handled[0][1].callback(None)
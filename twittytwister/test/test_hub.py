@@ -0,0 +1,227 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.hub}.
+"""
+
+from twisted.internet import defer, task
+from twisted.python import threadpool
+from twisted.trial import unittest
+
+from twittytwister import hub, metrics
+
+class SubscriptionHubTest(unittest.TestCase):
+    """
+    Tests for L{hub.SubscriptionHub}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = metrics.MemoryMetrics()
+        self.hub = hub.SubscriptionHub(self.metrics, self.clock)
+
+
+    def test_fanOut(self):
+        """
+        Each subscriber receives the same entries.
+        """
+        first, second = [], []
+        self.hub.subscribe(first.append)
+        self.hub.subscribe(second.append)
+        entry = object()
+        self.hub(entry)
+        self.assertEqual([entry], first)
+        self.assertEqual([entry], second)
+        self.assertIdentical(first[0], second[0])
+
+
+    def test_predicate(self):
+        received = []
+        self.hub.subscribe(received.append, predicate=lambda entry: entry > 1)
+        for entry in (1, 2, 3):
+            self.hub(entry)
+        self.assertEqual([2, 3], received)
+
+
+    def test_predicateFailure(self):
+        """
+        Entries for which the predicate fails are skipped and counted.
+        """
+        received = []
+        subscription = self.hub.subscribe(received.append,
+                                          predicate=lambda entry: 1 / entry,
+                                          name='a')
+        self.hub(0)
+        self.hub(1)
+        self.assertEqual([1], received)
+        self.assertEqual(1, subscription.errors)
+        self.assertEqual(1, len(self.flushLoggedErrors(ZeroDivisionError)))
+
+
+    def test_failureIsolated(self):
+        """
+        A failing subscriber does not affect other subscribers.
+        """
+        def fail(entry):
+            raise ValueError(entry)
+
+        received = []
+        self.hub.subscribe(fail, name='failing')
+        self.hub.subscribe(received.append)
+        self.hub(1)
+        self.hub(2)
+        self.assertEqual([1, 2], received)
+        self.assertEqual(2, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(2, self.metrics.counters['hub.failing.errors'])
+
+
+    def test_slowSubscriber(self):
+        """
+        A subscriber that returns a deferred gets one entry at a time,
+        without holding up others.
+        """
+        pending = []
+
+        def slow(entry):
+            d = defer.Deferred()
+            pending.append((entry, d))
+            return d
+
+        received = []
+        subscription = self.hub.subscribe(slow, name='slow')
+        self.hub.subscribe(received.append)
+        for entry in (1, 2, 3):
+            self.hub(entry)
+        self.assertEqual([1, 2, 3], received)
+        self.assertEqual([1], [entry for entry, d in pending])
+        self.assertEqual(2, len(subscription))
+
+        self.clock.advance(5)
+        pending[0][1].callback(None)
+        self.assertEqual([1, 2], [entry for entry, d in pending])
+        self.assertEqual(5, self.metrics.histograms['hub.slow.lag'].sum)
+        self.assertEqual(1, self.metrics.gauges['hub.slow.queued'])
+
+
+    def test_chainedDeferred(self):
+        """
+        A subscriber whose deferred has fired, but waits on another, unfired
+        deferred, does not get the next entry until that has fired.
+        """
+        pending = []
+
+        def chained(entry):
+            inner = defer.Deferred()
+            pending.append((entry, inner))
+            outer = defer.succeed(None)
+            outer.addCallback(lambda _: inner)
+            return outer
+
+        subscription = self.hub.subscribe(chained)
+        for entry in (1, 2):
+            self.hub(entry)
+        self.assertEqual([1], [entry for entry, d in pending])
+        self.assertEqual(1, len(subscription))
+
+        pending[0][1].callback(None)
+        self.assertEqual([1, 2], [entry for entry, d in pending])
+        self.assertEqual(0, len(subscription))
+
+
+    def test_dropOldest(self):
+        """
+        When the queue is full, the oldest queued entry is dropped.
+        """
+        pending = []
+
+        def slow(entry):
+            d = defer.Deferred()
+            pending.append((entry, d))
+            return d
+
+        subscription = self.hub.subscribe(slow, size=2, name='slow')
+        for entry in (1, 2, 3, 4):
+            self.hub(entry)
+        self.assertEqual(1, subscription.dropped)
+        self.assertEqual(1, self.metrics.counters['hub.slow.dropped'])
+
+        pending[-1][1].callback(None)
+        pending[-1][1].callback(None)
+        self.assertEqual([1, 3, 4], [entry for entry, d in pending])
+        self.assertEqual({'slow': {'queued': 0, 'delivered': 3,
+                                   'dropped': 1, 'errors': 0}},
+                         self.hub.stats())
+
+
+    def test_unsubscribe(self):
+        """
+        Unsubscribed subscribers get no further entries.
+        """
+        pending = []
+
+        def slow(entry):
+            d = defer.Deferred()
+            pending.append((entry, d))
+            return d
+
+        subscription = self.hub.subscribe(slow)
+        self.hub(1)
+        self.hub(2)
+        subscription.cancel()
+        self.hub(3)
+        pending[0][1].callback(None)
+        self.assertEqual([1], [entry for entry, d in pending])
+        self.assertEqual([], self.hub.subscriptions)
+
+
+    def test_unsubscribeWhileDelivering(self):
+        """
+        Subscribers may unsubscribe while entries are passed on.
+        """
+        received = []
+        subscriptions = []
+
+        def once(entry):
+            received.append(entry)
+            self.hub.unsubscribe(subscriptions[0])
+
+        subscriptions.append(self.hub.subscribe(once))
+        other = []
+        self.hub.subscribe(other.append)
+        self.hub(1)
+        self.hub(2)
+        self.assertEqual([1], received)
+        self.assertEqual([1, 2], other)
+
+
+    def test_names(self):
+        first = self.hub.subscribe(lambda entry: None)
+        second = self.hub.subscribe(lambda entry: None, name='archive')
+        self.assertEqual('subscriber1', first.name)
+        self.assertEqual('archive', second.name)
+
+
+    def test_threadpool(self):
+        """
+        Handlers can be called in a thread pool.
+        """
+        from twisted.internet import reactor
+        pool = threadpool.ThreadPool(1, 1)
+        pool.start()
+        self.addCleanup(pool.stop)
+
+        hub_ = hub.SubscriptionHub()
+        done = defer.Deferred()
+        received = []
+
+        def handler(entry):
+            received.append(entry)
+            if len(received) == 2:
+                reactor.callFromThread(done.callback, None)
+
+        hub_.subscribe(handler, threadpool=pool)
+        hub_(1)
+        hub_(2)
+        done.addCallback(lambda _: self.assertEqual([1, 2], received))
+        return done
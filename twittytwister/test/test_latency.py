@@ -0,0 +1,177 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.latency}.
+"""
+
+import calendar
+import time
+
+from twisted.trial import unittest
+
+from twittytwister import latency, metrics
+
+class CreatedAtParserTest(unittest.TestCase):
+    """
+    Tests for L{latency.CreatedAtParser}.
+    """
+
+    def setUp(self):
+        self.parser = latency.CreatedAtParser()
+
+
+    def test_parse(self):
+        """
+        Dates are parsed to seconds since the epoch.
+        """
+        value = 'Wed Aug 27 13:08:45 +0000 2008'
+        expected = calendar.timegm(time.strptime(value,
+                                                 '%a %b %d %H:%M:%S +0000 %Y'))
+        self.assertEqual(expected, self.parser.parse(value))
+
+
+    def test_parseOffset(self):
+        """
+        The timezone offset is taken into account.
+        """
+        utc = self.parser.parse('Wed Aug 27 13:08:45 +0000 2008')
+        self.assertEqual(utc,
+                         self.parser.parse('Wed Aug 27 15:38:45 +0230 2008'))
+        self.assertEqual(utc,
+                         self.parser.parse('Wed Aug 27 12:08:45 -0100 2008'))
+
+
+    def test_parseCached(self):
+        """
+        The start of the day is cached for other times on the same day.
+        """
+        first = self.parser.parse('Wed Aug 27 13:08:45 +0000 2008')
+        second = self.parser.parse(u'Wed Aug 27 13:10:00 +0000 2008')
+        self.assertEqual(75, second - first)
+        self.assertEqual(1, len(self.parser._days))
+
+
+    def test_parseCacheSize(self):
+        """
+        The cache is cleared when it reaches its maximum size.
+        """
+        self.parser.maxSize = 2
+        for day in (1, 2, 3):
+            self.parser.parse('Wed Aug %02d 13:08:45 +0000 2008' % day)
+        self.assertEqual(1, len(self.parser._days))
+
+
+    def test_parseInvalid(self):
+        self.assertIdentical(None, self.parser.parse('yesterday'))
+        self.assertIdentical(None,
+                             self.parser.parse('Wed Foo 27 13:08:45 +0000 2008'))
+
+
+
+class MessageTimeTest(unittest.TestCase):
+    """
+    Tests for L{latency.messageTime}.
+    """
+
+    def test_timestampMS(self):
+        """
+        The timestamp in milliseconds is preferred.
+        """
+        obj = {'timestamp_ms': '1219842525500',
+               'created_at': 'Wed Aug 27 13:08:45 +0000 2008'}
+        self.assertEqual(1219842525.5, latency.messageTime(obj))
+
+
+    def test_createdAt(self):
+        obj = {'created_at': 'Wed Aug 27 13:08:45 +0000 2008'}
+        self.assertEqual(1219842525, latency.messageTime(obj))
+
+
+    def test_unknown(self):
+        self.assertIdentical(None, latency.messageTime({}))
+
+
+    def test_invalidTypes(self):
+        """
+        Timestamps of unexpected types are unknown.
+        """
+        self.assertIdentical(None, latency.messageTime({'timestamp_ms': {}}))
+        self.assertIdentical(None, latency.messageTime({'created_at': 12}))
+        obj = {'timestamp_ms': [],
+               'created_at': 'Wed Aug 27 13:08:45 +0000 2008'}
+        self.assertEqual(1219842525, latency.messageTime(obj))
+
+
+
+class RollingWindowTest(unittest.TestCase):
+    """
+    Tests for L{latency.RollingWindow}.
+    """
+
+    def test_percentiles(self):
+        window = latency.RollingWindow()
+        for value in xrange(1, 101):
+            window.add(value)
+        self.assertEqual({50: 50, 90: 90, 99: 99, 100: 100},
+                         window.percentiles((50, 90, 99, 100)))
+
+
+    def test_rolling(self):
+        """
+        Only the most recent samples are kept.
+        """
+        window = latency.RollingWindow(size=2)
+        for value in (10, 1, 2):
+            window.add(value)
+        self.assertEqual(2, len(window))
+        self.assertEqual({100: 2}, window.percentiles((100,)))
+
+
+    def test_empty(self):
+        self.assertEqual({}, latency.RollingWindow().percentiles())
+
+
+
+class LatencyTrackerTest(unittest.TestCase):
+    """
+    Tests for L{latency.LatencyTracker}.
+    """
+
+    def test_record(self):
+        """
+        The timestamps of a message are split into stages.
+        """
+        sink = metrics.MemoryMetrics()
+        tracker = latency.LatencyTracker(metrics=sink)
+        tracker.record(100, 102, 102.5, 103, 103, 107)
+        result = tracker.percentiles((50,))
+        self.assertEqual({'network': {50: 2},
+                          'framing': {50: 0.5},
+                          'decoding': {50: 0.5},
+                          'consumer': {50: 4},
+                          'total': {50: 7}},
+                         result)
+        self.assertEqual(1, sink.histograms['latency.consumer'].count)
+
+
+    def test_recordUnknownCreated(self):
+        """
+        Without creation time, the network and total stages are skipped.
+        """
+        tracker = latency.LatencyTracker()
+        tracker.record(None, 102, 102.5, 103, 103, 107)
+        result = tracker.percentiles((50,))
+        self.assertEqual({}, result['network'])
+        self.assertEqual({}, result['total'])
+        self.assertEqual({50: 4}, result['consumer'])
+
+
+    def test_bottleneck(self):
+        """
+        The stage with the largest latency is the bottleneck.
+        """
+        tracker = latency.LatencyTracker()
+        self.assertIdentical(None, tracker.bottleneck())
+        tracker.record(100, 101, 101.5, 104, 104, 104.5)
+        self.assertEqual('decoding', tracker.bottleneck())
@@ -0,0 +1,198 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.media}.
+"""
+
+import StringIO
+
+import simplejson as json
+from oauth import oauth
+
+from twisted.internet import reactor
+from twisted.trial import unittest
+from twisted.web import error as http_error
+from twisted.web import resource, server
+
+from twittytwister import media, twitter
+
+class FileSegmentTest(unittest.TestCase):
+    """
+    Tests for L{media.FileSegment}.
+    """
+
+    def test_read(self):
+        """
+        Only the data of the segment is read.
+        """
+        f = StringIO.StringIO('0123456789')
+        segment = media.FileSegment(f, 2, 5)
+        self.assertEqual('23', segment.read(2))
+        f.seek(0)
+        self.assertEqual('456', segment.read())
+        self.assertEqual('', segment.read())
+
+
+    def test_seek(self):
+        segment = media.FileSegment(StringIO.StringIO('0123456789'), 2, 5)
+        segment.seek(0, 2)
+        self.assertEqual(5, segment.tell())
+        segment.seek(-2, 1)
+        self.assertEqual('56', segment.read(10))
+
+
+
+class FakeUploadResource(resource.Resource):
+    """
+    Fake media upload endpoint.
+
+    @ivar failures: Number of times to fail C{APPEND} requests per segment
+        index, with a 503 response.
+    @type failures: C{dict}
+
+    @ivar processing: Number of C{STATUS} requests that report processing
+        to be in progress, before succeeding.
+    @type processing: C{int}
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.segments = {}
+        self.commands = []
+        self.failures = {}
+        self.processing = 0
+        self.processingState = 'succeeded'
+
+
+    def render_POST(self, request):
+        command = request.args['command'][0]
+        self.commands.append(command)
+        request.setHeader('content-type', 'application/json')
+
+        if command == 'INIT':
+            self.totalBytes = int(request.args['total_bytes'][0])
+            self.mediaType = request.args['media_type'][0]
+            return json.dumps({'media_id_string': '710511363345354753'})
+        elif command == 'APPEND':
+            index = int(request.args['segment_index'][0])
+            if self.failures.get(index):
+                self.failures[index] -= 1
+                request.setResponseCode(503)
+                return ''
+            self.segments[index] = request.args['media'][0]
+            request.setResponseCode(204)
+            return ''
+        elif command == 'FINALIZE':
+            return json.dumps(self.processingInfo())
+
+
+    def render_GET(self, request):
+        self.commands.append(request.args['command'][0])
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(self.processingInfo())
+
+
+    def processingInfo(self):
+        result = {'media_id_string': '710511363345354753'}
+        if self.processing:
+            self.processing -= 1
+            result['processing_info'] = {'state': 'in_progress',
+                                         'check_after_secs': 0}
+        elif self.processingState != 'succeeded':
+            result['processing_info'] = {'state': self.processingState,
+                                         'error': {'message': 'Bad video'}}
+        return result
+
+
+
+class ChunkedUploadTest(unittest.TestCase):
+    """
+    Tests for L{media.ChunkedUpload} against a local fake upload server.
+    """
+
+    def setUp(self):
+        self.resource = FakeUploadResource()
+        self.port = reactor.listenTCP(0, server.Site(self.resource),
+                                      interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        url = 'http://127.0.0.1:%d/upload.json' % self.port.getHost().port
+        self.api = twitter.Twitter(consumer=oauth.OAuthConsumer('a', 'b'),
+                                   token=oauth.OAuthToken('c', 'd'),
+                                   upload_url=url)
+        self.patch(media.ChunkedUpload, 'retryDelay', 0.01)
+
+
+    def test_upload(self):
+        """
+        The file is uploaded in segments, the media ID is returned.
+        """
+        data = ''.join(chr(i % 256) for i in xrange(1000))
+
+        def cb(mediaID):
+            self.assertEqual('710511363345354753', mediaID)
+            self.assertEqual(['INIT', 'APPEND', 'APPEND', 'APPEND',
+                              'APPEND', 'FINALIZE'], self.resource.commands)
+            self.assertEqual(1000, self.resource.totalBytes)
+            self.assertEqual('video/mp4', self.resource.mediaType)
+            self.assertEqual(data, ''.join(self.resource.segments[i]
+                                           for i in xrange(4)))
+
+        d = self.api.upload_media(data, 'video/mp4', segment_size=300)
+        d.addCallback(cb)
+        return d
+
+
+    def test_retrySegment(self):
+        """
+        Failed segments are retried on their own.
+        """
+        self.resource.failures = {1: 2}
+        data = '0123456789'
+
+        def cb(mediaID):
+            self.assertEqual(['INIT', 'APPEND', 'APPEND', 'APPEND', 'APPEND',
+                              'FINALIZE'],
+                             [command for command in self.resource.commands])
+            self.assertEqual({0: '01234', 1: '56789'}, self.resource.segments)
+
+        d = self.api.upload_media(StringIO.StringIO(data), 'image/png',
+                                  segment_size=5)
+        d.addCallback(cb)
+        return d
+
+
+    def test_segmentFailed(self):
+        """
+        If a segment keeps failing, the upload fails.
+        """
+        self.resource.failures = {0: 10}
+        d = self.api.upload_media('0123456789', 'image/png')
+        self.assertFailure(d, http_error.Error)
+        d.addCallback(lambda exc: self.assertEqual('503', exc.status))
+        return d
+
+
+    def test_processing(self):
+        """
+        Processing status is polled until it has finished.
+        """
+        self.resource.processing = 2
+
+        def cb(mediaID):
+            self.assertEqual(['INIT', 'APPEND', 'FINALIZE', 'STATUS',
+                              'STATUS'], self.resource.commands)
+
+        d = self.api.upload_media('0123456789', 'video/mp4',
+                                  media_category='tweet_video')
+        d.addCallback(cb)
+        return d
+
+
+    def test_processingFailed(self):
+        self.resource.processingState = 'failed'
+        d = self.api.upload_media('0123456789', 'video/mp4')
+        self.assertFailure(d, media.MediaUploadError)
+        return d
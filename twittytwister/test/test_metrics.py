@@ -0,0 +1,178 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.metrics}.
+"""
+
+import socket
+
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from twittytwister import metrics
+
+class HistogramTest(unittest.TestCase):
+    """
+    Tests for L{metrics.Histogram}.
+    """
+
+    def test_observe(self):
+        """
+        Observations are counted in the bucket of their upper bound.
+        """
+        histogram = metrics.Histogram([1, 5])
+        histogram.observe(0.5)
+        histogram.observe(1)
+        histogram.observe(3)
+        histogram.observe(10)
+        self.assertEqual([2, 1, 1], histogram.counts)
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(14.5, histogram.sum)
+        self.assertEqual([(1, 2), (5, 3), (float('inf'), 4)],
+                         histogram.cumulative())
+
+
+
+class MemoryMetricsTest(unittest.TestCase):
+    """
+    Tests for L{metrics.MemoryMetrics}.
+    """
+
+    def setUp(self):
+        self.metrics = metrics.MemoryMetrics(buckets=[1])
+
+
+    def test_snapshot(self):
+        """
+        A snapshot holds all counters, gauges and histograms.
+        """
+        self.metrics.increment('stream.bytes', 10)
+        self.metrics.increment('stream.bytes', 5)
+        self.metrics.gauge('monitor.connected', 1)
+        self.metrics.timing('stream.delegate_latency', 0.5)
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual({'stream.bytes': 15}, snapshot['counters'])
+        self.assertEqual({'monitor.connected': 1}, snapshot['gauges'])
+        self.assertEqual({'stream.delegate_latency': {
+                              'count': 1,
+                              'sum': 0.5,
+                              'buckets': [(1, 1), (float('inf'), 1)]}},
+                         snapshot['histograms'])
+
+
+    def test_snapshotCopy(self):
+        """
+        Snapshots don't change with later updates.
+        """
+        self.metrics.increment('stream.bytes')
+        snapshot = self.metrics.snapshot()
+        self.metrics.increment('stream.bytes')
+        self.assertEqual(1, snapshot['counters']['stream.bytes'])
+
+
+
+class StatsDMetricsTest(unittest.TestCase):
+    """
+    Tests for L{metrics.StatsDMetrics}.
+    """
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        host, port = self.server.getsockname()
+        self.metrics = metrics.StatsDMetrics(host, port, prefix='tt.')
+
+
+    def tearDown(self):
+        self.metrics.close()
+        self.server.close()
+
+
+    def test_increment(self):
+        self.metrics.increment('stream.bytes', 10)
+        self.assertEqual('tt.stream.bytes:10|c', self.server.recv(512))
+
+
+    def test_gauge(self):
+        self.metrics.gauge('monitor.connected', 1)
+        self.assertEqual('tt.monitor.connected:1|g', self.server.recv(512))
+
+
+    def test_timing(self):
+        """
+        Timings are sent in milliseconds.
+        """
+        self.metrics.timing('stream.delegate_latency', 0.25)
+        self.assertEqual('tt.stream.delegate_latency:250.000|ms',
+                         self.server.recv(512))
+
+
+
+class MultiMetricsTest(unittest.TestCase):
+    """
+    Tests for L{metrics.MultiMetrics}.
+    """
+
+    def test_all(self):
+        """
+        All metrics are passed on to all sinks.
+        """
+        sink1 = metrics.MemoryMetrics()
+        sink2 = metrics.MemoryMetrics()
+        multi = metrics.MultiMetrics(sink1, sink2)
+        multi.increment('a')
+        multi.gauge('b', 2)
+        multi.timing('c', 0.1)
+        for sink in (sink1, sink2):
+            self.assertEqual({'a': 1}, sink.counters)
+            self.assertEqual({'b': 2}, sink.gauges)
+            self.assertEqual(1, sink.histograms['c'].count)
+
+
+
+class PrometheusResourceTest(unittest.TestCase):
+    """
+    Tests for L{metrics.PrometheusResource}.
+    """
+
+    def test_render(self):
+        """
+        Metrics are rendered in the text exposition format.
+        """
+        memory = metrics.MemoryMetrics(buckets=[0.1])
+        memory.increment('stream.bytes', 10)
+        memory.gauge('monitor.connected', 1)
+        memory.timing('stream.delegate_latency', 0.05)
+        resource = metrics.PrometheusResource(memory)
+
+        request = DummyRequest([''])
+        result = resource.render_GET(request)
+        self.assertEqual(['text/plain; version=0.0.4'],
+                         request.responseHeaders.getRawHeaders('content-type'))
+        self.assertEqual("""\
+# TYPE stream_bytes counter
+stream_bytes 10
+# TYPE monitor_connected gauge
+monitor_connected 1
+# TYPE stream_delegate_latency histogram
+stream_delegate_latency_bucket{le="0.1"} 1
+stream_delegate_latency_bucket{le="+Inf"} 1
+stream_delegate_latency_sum 0.05
+stream_delegate_latency_count 1
+""", result)
+
+
+    def test_names(self):
+        """
+        Characters not allowed in metric names are replaced.
+        """
+        memory = metrics.MemoryMetrics()
+        memory.increment('shard.0.bytes/s', 1)
+        memory.increment('relay:clients-http', 1)
+        result = metrics.PrometheusResource(memory).render_GET(
+            DummyRequest(['']))
+        self.assertIn('\nshard_0_bytes_s 1\n', result)
+        self.assertIn('\nrelay:clients_http 1\n', result)
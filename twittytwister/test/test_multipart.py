@@ -0,0 +1,152 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.multipart}.
+"""
+
+import StringIO
+import tempfile
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from twisted.web.iweb import IBodyProducer
+
+from twittytwister import media, multipart
+
+EXPECTED = (
+    '--b\r\n'
+    'Content-Disposition: form-data; name="status"\r\n'
+    '\r\n'
+    'Hello\r\n'
+    '--b\r\n'
+    'Content-Disposition: form-data; name="image"; filename="me.png"\r\n'
+    'Content-Type: image/png\r\n'
+    '\r\n'
+    '0123456789\r\n'
+    '--b--\r\n')
+
+class MultipartProducerTest(unittest.TestCase):
+    """
+    Tests for L{multipart.MultipartProducer}.
+    """
+
+    def setUp(self):
+        self.scheduled = []
+        self.cooperator = task.Cooperator(
+                terminationPredicateFactory=lambda: lambda: True,
+                scheduler=self.scheduled.append)
+        self.consumer = proto_helpers.StringTransport()
+
+
+    def produce(self, fileData):
+        return multipart.MultipartProducer([('status', 'Hello')],
+                                           [('image', 'me.png', fileData)],
+                                           boundary='b', chunkSize=4,
+                                           cooperator=self.cooperator)
+
+
+    def runScheduled(self):
+        while self.scheduled:
+            self.scheduled.pop(0)()
+
+
+    def test_interface(self):
+        self.assertTrue(IBodyProducer.providedBy(self.produce('')))
+
+
+    def test_string(self):
+        """
+        File contents given as a string are written as is.
+        """
+        producer = self.produce('0123456789')
+        self.assertEqual(len(EXPECTED), producer.length)
+        self.assertEqual('multipart/form-data; boundary=b',
+                         producer.contentType)
+
+        d = producer.startProducing(self.consumer)
+        self.runScheduled()
+        self.assertEqual(EXPECTED, self.consumer.value())
+        return d
+
+
+    def test_file(self):
+        """
+        File contents are read from the current position.
+        """
+        f = tempfile.TemporaryFile()
+        f.write('xx0123456789')
+        f.seek(2)
+        producer = self.produce(f)
+        self.assertEqual(len(EXPECTED), producer.length)
+
+        d = producer.startProducing(self.consumer)
+        self.runScheduled()
+        self.assertEqual(EXPECTED, self.consumer.value())
+        return d
+
+
+    def test_fileChunks(self):
+        """
+        Files are read in chunks of C{chunkSize}, also when restarted.
+        """
+        writes = []
+        self.consumer.write = writes.append
+        producer = self.produce(StringIO.StringIO('0123456789'))
+        for i in xrange(2):
+            del writes[:]
+            producer.startProducing(self.consumer)
+            self.runScheduled()
+            self.assertEqual(['0123', '4567', '89'],
+                             [data for data in writes if data.isdigit()])
+
+
+    def test_fileSegment(self):
+        """
+        File-like objects that only provide C{read}, C{seek} and C{tell},
+        like L{media.FileSegment}, are read too.
+        """
+        segment = media.FileSegment(StringIO.StringIO('xx0123456789yy'), 2,
+                                    10)
+        producer = self.produce(segment)
+        d = producer.startProducing(self.consumer)
+        self.runScheduled()
+        self.assertEqual(EXPECTED, self.consumer.value())
+        return d
+
+
+    def test_fileTruncated(self):
+        """
+        If a file is shorter than it was, producing fails.
+        """
+        f = StringIO.StringIO('0123456789')
+        producer = self.produce(f)
+        f.truncate(5)
+        d = producer.startProducing(self.consumer)
+        self.runScheduled()
+        return self.assertFailure(d, IOError)
+
+
+    def test_stop(self):
+        """
+        Nothing is written after stopping.
+        """
+        producer = self.produce(StringIO.StringIO('0123456789'))
+        d = producer.startProducing(self.consumer)
+        producer.stopProducing()
+        self.runScheduled()
+        self.assertEqual('', self.consumer.value())
+        self.assertNoResult(d)
+
+
+    def test_pauseResume(self):
+        producer = self.produce(StringIO.StringIO('0123456789'))
+        d = producer.startProducing(self.consumer)
+        producer.pauseProducing()
+        self.runScheduled()
+        self.assertEqual('', self.consumer.value())
+        producer.resumeProducing()
+        self.runScheduled()
+        self.assertEqual(EXPECTED, self.consumer.value())
+        return d
@@ -1,3 +1,5 @@
+import simplejson as json
+
 from twisted.trial import unittest
 
 from twittytwister import platform
@@ -300,3 +302,320 @@ class TwitterObjectTest(unittest.TestCase):
         self.assertEqual(expected, result)
 
 
+
+
+    def test_fromDictInterned(self):
+        """
+        With an intern pool, equal strings of interned properties are shared.
+        """
+        self.patch(platform.TwitterObject, 'internPool',
+                   platform.InternPool())
+        first = platform.Status.fromDict(
+            {'text': u'a', 'source': ''.join(['w', 'eb']),
+             'user': {'screen_name': ''.join(['ik', 'display'])}})
+        second = platform.Status.fromDict(
+            {'text': u'b', 'source': ''.join(['w', 'eb']),
+             'user': {'screen_name': ''.join(['ik', 'display'])}})
+        self.assertIdentical(first.source, second.source)
+        self.assertIdentical(first.user.screen_name, second.user.screen_name)
+        self.assertIdentical(first.raw['source'], second.raw['source'])
+        self.assertIdentical(first.user.raw['screen_name'],
+                             second.user.raw['screen_name'])
+
+
+    def test_fromDictNotInterned(self):
+        """
+        Without an intern pool, strings are kept as they are.
+        """
+        first = platform.Status.fromDict({'source': ''.join(['w', 'eb'])})
+        second = platform.Status.fromDict({'source': ''.join(['w', 'eb'])})
+        self.assertNotIdentical(first.source, second.source)
+
+
+    def test_fromDictInternedOnlyStrings(self):
+        self.patch(platform.User, 'internPool', platform.InternPool())
+        user = platform.User.fromDict({'screen_name': None, 'id': 1})
+        self.assertIdentical(None, user.screen_name)
+        self.assertEqual(0, len(platform.User.internPool))
+
+
+
+class InternPoolTest(unittest.TestCase):
+    """
+    Tests for L{platform.InternPool}.
+    """
+
+    def test_intern(self):
+        pool = platform.InternPool()
+        first = ''.join(['a', 'b'])
+        second = ''.join(['a', 'b'])
+        self.assertIdentical(first, pool.intern(first))
+        self.assertIdentical(first, pool.intern(second))
+        self.assertEqual(1, pool.hits)
+
+
+    def test_evictLeastRecentlyUsed(self):
+        """
+        When full, the least recently used string is evicted.
+        """
+        pool = platform.InternPool(maxSize=2)
+        a, b, c = u'a' * 10, u'b' * 10, u'c' * 10
+        pool.intern(a)
+        pool.intern(b)
+        pool.intern(a)
+        pool.intern(c)
+        self.assertEqual(2, len(pool))
+        self.assertIdentical(a, pool.intern(u''.join([u'a'] * 10)))
+        self.assertNotIdentical(b, pool.intern(u''.join([u'b'] * 10)))
+
+
+
+class UserCacheTest(unittest.TestCase):
+    """
+    Tests for L{platform.UserCache}.
+    """
+
+    def setUp(self):
+        self.cache = platform.UserCache(maxSize=2)
+        self.patch(platform.User, 'userCache', self.cache)
+
+
+    def makeStatus(self, userID=1, statusesCount=10, name=u'Ralph',
+                   createdAt='Mon Aug 31 13:36:20 +0000 2009'):
+        return platform.Status.fromDict({
+            'text': u'Hello',
+            'user': {'id': userID, 'name': name,
+                     'statuses_count': statusesCount,
+                     'created_at': createdAt}})
+
+
+    def test_shared(self):
+        """
+        Statuses by the same user share the user instance.
+        """
+        first = self.makeStatus()
+        second = self.makeStatus()
+        self.assertIdentical(first.user, second.user)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+
+    def test_updateNewer(self):
+        """
+        A newer version of the user updates the cached instance in place.
+        """
+        first = self.makeStatus(name=u'Ralph')
+        second = self.makeStatus(statusesCount=11, name=u'Ralph Meijer')
+        self.assertIdentical(first.user, second.user)
+        self.assertEqual(u'Ralph Meijer', first.user.name)
+        self.assertEqual(11, first.user.raw['statuses_count'])
+        self.assertEqual(1, self.cache.updates)
+
+
+    def test_updateRemovesProperties(self):
+        """
+        Properties missing from the newer version are removed.
+        """
+        first = self.makeStatus()
+        platform.User.fromDict({'id': 1, 'statuses_count': 11,
+                                'created_at': first.user.created_at})
+        self.assertIdentical(None, getattr(first.user, 'name', None))
+
+
+    def test_rawAsReceived(self):
+        """
+        The raw data of a status keeps the user data as received.
+        """
+        first = self.makeStatus(statusesCount=11, name=u'Ralph Meijer')
+        second = self.makeStatus(statusesCount=10, name=u'Ralph')
+        self.assertEqual(u'Ralph Meijer', first.raw['user']['name'])
+        self.assertEqual(u'Ralph', second.raw['user']['name'])
+        self.assertEqual(u'Ralph Meijer', second.user.name)
+
+
+    def test_toDict(self):
+        """
+        The data of a status keeps the user data as received, also when
+        the shared user was updated since.
+        """
+        first = self.makeStatus(name=u'Old')
+        self.makeStatus(statusesCount=11, name=u'New')
+        self.assertIdentical(first.raw, first.toDict())
+        self.assertEqual(u'Old', json.loads(first.toJSON())['user']['name'])
+
+
+    def test_toDictOtherUser(self):
+        """
+        Setting another shared user is a change.
+        """
+        first = self.makeStatus(userID=1)
+        second = self.makeStatus(userID=2, name=u'Other')
+        first.user = second.user
+        self.assertEqual(2, first.toDict()['user']['id'])
+
+
+    def test_updateAtomic(self):
+        """
+        An update sets the new properties without first removing the old
+        ones.
+        """
+        first = self.makeStatus()
+        user = first.user
+        seen = []
+
+        class Dict(dict):
+            def clear(self):
+                seen.append(dict(self))
+                dict.clear(self)
+
+        user.__dict__ = Dict(user.__dict__)
+        self.makeStatus(statusesCount=11, name=u'Ralph Meijer')
+        self.assertEqual([], seen)
+        self.assertEqual(u'Ralph Meijer', user.name)
+        self.assertEqual(11, user.statuses_count)
+
+
+    def test_ignoreOlder(self):
+        """
+        An older version of the user does not update the cached instance.
+        """
+        first = self.makeStatus(statusesCount=11, name=u'Ralph Meijer')
+        second = self.makeStatus(statusesCount=10, name=u'Ralph')
+        self.assertIdentical(first.user, second.user)
+        self.assertEqual(u'Ralph Meijer', second.user.name)
+
+
+    def test_otherAccount(self):
+        """
+        A user with a different creation time replaces the cached one.
+        """
+        first = self.makeStatus()
+        second = self.makeStatus(createdAt='Tue Sep 01 13:36:20 +0000 2009')
+        self.assertNotIdentical(first.user, second.user)
+        self.assertIdentical(second.user, self.cache.get(1))
+
+
+    def test_get(self):
+        self.assertIdentical(None, self.cache.get(1))
+        status = self.makeStatus()
+        self.assertIdentical(status.user, self.cache.get(1))
+        self.assertIn(1, self.cache)
+
+
+    def test_evict(self):
+        """
+        The least recently seen user is evicted when the cache is full.
+        """
+        self.makeStatus(userID=1)
+        self.makeStatus(userID=2)
+        self.makeStatus(userID=1)
+        self.makeStatus(userID=3)
+        self.assertEqual(2, len(self.cache))
+        self.assertIn(1, self.cache)
+        self.assertNotIn(2, self.cache)
+
+
+    def test_noID(self):
+        """
+        Users without an ID are not cached.
+        """
+        first = platform.User.fromDict({'screen_name': u'ralphm'})
+        second = platform.User.fromDict({'screen_name': u'ralphm'})
+        self.assertNotIdentical(first, second)
+        self.assertEqual(0, len(self.cache))
+
+
+
+class SerializationTest(unittest.TestCase):
+    """
+    Tests for L{platform.TwitterObject.toDict} and
+    L{platform.TwitterObject.toJSON}.
+    """
+
+    def setUp(self):
+        self.data = {
+            'id': 1,
+            'id_str': '1',
+            'text': u'Hello #twisted',
+            'entities': {'hashtags': [{'text': u'twisted',
+                                       'indices': [6, 14]}],
+                         'urls': []},
+            'user': {'id': 2, 'screen_name': u'ralphm'},
+            }
+        self.status = platform.Status.fromDict(self.data)
+
+
+    def test_toDictUnmodified(self):
+        """
+        Unmodified objects return their raw data.
+        """
+        self.assertIdentical(self.data, self.status.toDict())
+
+
+    def test_toDictSimple(self):
+        """
+        Changed properties end up in a copy, with unknown keys preserved.
+        """
+        self.status.text = u'Bye'
+        result = self.status.toDict()
+        self.assertNotIdentical(self.data, result)
+        self.assertEqual(u'Bye', result['text'])
+        self.assertEqual('1', result['id_str'])
+        self.assertIdentical(self.data['user'], result['user'])
+        self.assertEqual(u'Hello #twisted', self.data['text'])
+
+
+    def test_toDictNested(self):
+        self.status.user.screen_name = u'ralph'
+        self.status.entities.hashtags[0].indices.start = 7
+        result = self.status.toDict()
+        self.assertEqual(u'ralph', result['user']['screen_name'])
+        self.assertEqual([7, 14],
+                         result['entities']['hashtags'][0]['indices'])
+        self.assertIdentical(self.data['entities']['urls'],
+                             result['entities']['urls'])
+
+
+    def test_toDictList(self):
+        self.status.entities.hashtags.append(
+            platform.HashTag.fromDict({'text': u'python'}))
+        result = self.status.toDict()
+        self.assertEqual([u'twisted', u'python'],
+                         [tag['text']
+                          for tag in result['entities']['hashtags']])
+
+
+    def test_toDictRemoved(self):
+        del self.status.text
+        self.assertNotIn('text', self.status.toDict())
+
+
+    def test_toDictNew(self):
+        """
+        Objects created without data have only their set properties.
+        """
+        status = platform.Status()
+        self.assertEqual({}, status.toDict())
+        status.text = u'Hello'
+        self.assertEqual({'text': u'Hello'}, status.toDict())
+
+
+    def test_toJSON(self):
+        self.assertEqual(self.data, json.loads(self.status.toJSON()))
+
+
+    def test_reprRetweet(self):
+        status = platform.Status.fromDict({
+            'text': 'RT',
+            'retweeted_status': {'text': 'Hi\nthere',
+                                 'user': {'id': 1}}})
+        expected = """Status(
+    retweeted_status=Status(
+        text='Hi\\nthere',
+        user=User(
+            id=1
+        )
+    ),
+    text='RT'
+)"""
+        self.assertEqual(expected, repr(status))
@@ -0,0 +1,363 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.polling}.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from twittytwister import fakeserver, polling
+
+class FakeItem(object):
+    def __init__(self, id):
+        self.id = unicode(id)
+
+
+
+class FakeTwitterAPI(object):
+    """
+    Fake Twitter API with a timeline method that records its calls.
+    """
+
+    rate_limit_remaining = None
+    rate_limit_reset = None
+
+    def __init__(self):
+        self.calls = []
+
+
+    def home_timeline(self, delegate, params={}, extra_args=None):
+        d = defer.Deferred()
+        self.calls.append((delegate, params, extra_args, d))
+        return d
+
+
+    def respond(self, ids):
+        """
+        Pass items with the given IDs to the last delegate and fire.
+        """
+        delegate, params, extra_args, d = self.calls[-1]
+        for id in ids:
+            delegate(FakeItem(id), extra_args)
+        d.callback(None)
+
+
+
+class FakeCheckpoint(object):
+
+    def __init__(self, state=None):
+        self.state = state or {}
+        self.saved = []
+
+
+    def load(self):
+        return dict(self.state)
+
+
+    def save(self, state):
+        self.saved.append(dict(state))
+
+
+
+class TimelinePollerTest(unittest.TestCase):
+    """
+    Tests for L{polling.TimelinePoller}.
+    """
+
+    def setUp(self):
+        self.items = []
+        self.clock = task.Clock()
+        self.api = FakeTwitterAPI()
+        self.checkpoint = FakeCheckpoint()
+        self.poller = polling.TimelinePoller(self.api, self.onItem,
+                                             checkpoint=self.checkpoint,
+                                             reactor=self.clock)
+        self.poller.addTimeline('home', self.api.home_timeline)
+
+
+    def tearDown(self):
+        self.poller.stopService()
+        self.assertEquals(0, len(self.clock.getDelayedCalls()))
+
+
+    def onItem(self, item, name):
+        self.items.append((int(item.id), name))
+
+
+    def test_startService(self):
+        """
+        Starting the service polls all timelines right away.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.api.calls))
+        delegate, params, extra_args, d = self.api.calls[-1]
+        self.assertNotIn('since_id', params)
+        self.assertEqual('home', extra_args)
+        self.api.respond([])
+
+
+    def test_deliverChronological(self):
+        """
+        New items are passed to the delegate, oldest first.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([3, 2, 1])
+        self.assertEqual([(1, 'home'), (2, 'home'), (3, 'home')], self.items)
+
+
+    def test_sinceID(self):
+        """
+        The highest seen item ID is passed as since_id on the next poll.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([3, 2, 1])
+
+        self.clock.advance(self.poller.minInterval)
+        self.assertEqual(2, len(self.api.calls))
+        delegate, params, extra_args, d = self.api.calls[-1]
+        self.assertEqual('3', params['since_id'])
+        self.api.respond([])
+
+
+    def test_ignoreOld(self):
+        """
+        Items at or below the since_id are not delivered again.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([3])
+        self.clock.advance(self.poller.minInterval)
+        self.api.respond([4, 3])
+        self.assertEqual([(3, 'home'), (4, 'home')], self.items)
+
+
+    def test_pageBack(self):
+        """
+        When a full page of new items came in, older pages are fetched
+        until reaching the since_id.
+        """
+        self.poller.count = 3
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([3])
+
+        self.clock.advance(self.poller.minInterval)
+        self.api.respond([10, 9, 8])
+        self.assertEqual(3, len(self.api.calls))
+        delegate, params, extra_args, d = self.api.calls[-1]
+        self.assertEqual('7', params['max_id'])
+        self.assertEqual('3', params['since_id'])
+        self.api.respond([7, 6, 5])
+        self.api.respond([4])
+        delegate, params, extra_args, d = self.api.calls[-1]
+        self.assertEqual('3', params['max_id'])
+        self.api.respond([])
+
+        self.assertEqual(range(3, 11), [itemID for itemID, name in self.items])
+        self.assertEqual(5, len(self.api.calls))
+        self.assertEqual(10, self.poller.timelines['home'].sinceID)
+
+
+    def test_pageBackReachedSinceID(self):
+        """
+        No more pages are fetched when a page reaches the since_id.
+        """
+        self.poller.count = 2
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([3])
+
+        self.clock.advance(self.poller.minInterval)
+        self.api.respond([5, 4])
+        self.api.respond([3])
+        self.assertEqual(3, len(self.api.calls))
+        self.assertEqual([3, 4, 5], [itemID for itemID, name in self.items])
+
+
+    def test_noPageBackFirstPoll(self):
+        """
+        Without a since_id, only the newest page is fetched.
+        """
+        self.poller.count = 2
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([5, 4])
+        self.assertEqual(1, len(self.api.calls))
+
+
+    def test_maxPages(self):
+        self.poller.count = 1
+        self.poller.maxPages = 2
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([1])
+
+        self.clock.advance(self.poller.minInterval)
+        self.api.respond([10])
+        self.api.respond([9])
+        self.assertEqual(3, len(self.api.calls))
+        self.assertEqual([1, 9, 10], [itemID for itemID, name in self.items])
+
+
+    def test_intervalBackOff(self):
+        """
+        Without new items, the poll interval increases up to the maximum.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([1])
+        timeline = self.poller.timelines['home']
+        self.assertEqual(self.poller.minInterval, timeline.interval)
+
+        self.clock.advance(timeline.interval)
+        self.api.respond([])
+        self.assertEqual(self.poller.minInterval * self.poller.backOffFactor,
+                         timeline.interval)
+
+        for i in xrange(20):
+            self.clock.advance(timeline.interval)
+            self.api.respond([])
+        self.assertEqual(self.poller.maxInterval, timeline.interval)
+
+
+    def test_intervalActive(self):
+        """
+        New items cause the poll interval to shrink.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([])
+        timeline = self.poller.timelines['home']
+        timeline.interval = 400
+
+        self.clock.advance(self.poller.minInterval)
+        self.api.respond([1])
+        self.assertEqual(200, timeline.interval)
+
+
+    def test_intervalRateLimit(self):
+        """
+        The interval is stretched to not exhaust the remaining rate limit.
+        """
+        self.api.rate_limit_remaining = 2
+        self.api.rate_limit_reset = 900
+        self.poller.addTimeline('mentions', self.api.home_timeline)
+        self.poller.startService()
+        self.clock.advance(0)
+        for delegate, params, extra_args, d in self.api.calls:
+            d.callback(None)
+
+        # 900 seconds left, two timelines, two requests left.
+        timeline = self.poller.timelines['mentions']
+        self.assertEqual(900, timeline.interval)
+
+
+    def test_error(self):
+        """
+        Errors are logged and the timeline is polled again later.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        delegate, params, extra_args, d = self.api.calls[-1]
+        d.errback(ValueError())
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+        self.clock.advance(self.poller.minInterval)
+        self.assertEqual(2, len(self.api.calls))
+        self.api.respond([])
+
+
+    def test_checkpointSaved(self):
+        """
+        The highest seen IDs are saved to the checkpoint.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([5, 4])
+        self.assertEqual([{'home': 5}], self.checkpoint.saved)
+
+
+    def test_checkpointLoaded(self):
+        """
+        Polls resume from the IDs in the checkpoint.
+        """
+        self.checkpoint.state = {'home': 42}
+        self.poller.startService()
+        self.clock.advance(0)
+        delegate, params, extra_args, d = self.api.calls[-1]
+        self.assertEqual('42', params['since_id'])
+        self.api.respond([])
+
+
+    def test_removeTimeline(self):
+        """
+        Removed timelines are no longer polled.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([])
+        self.poller.removeTimeline('home')
+        self.clock.advance(self.poller.maxInterval)
+        self.assertEqual(1, len(self.api.calls))
+
+
+    def test_pollWhileScheduled(self):
+        """
+        Polling while a poll is scheduled replaces the scheduled poll.
+        """
+        self.poller.startService()
+        self.clock.advance(0)
+        self.api.respond([1])
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+        self.poller.poll('home')
+        self.assertEqual(0, len(self.clock.getDelayedCalls()))
+        self.api.respond([2])
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+        self.clock.advance(self.poller.minInterval)
+        self.assertEqual(3, len(self.api.calls))
+        self.api.respond([3])
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+
+
+class TimelinePollerIntegrationTest(unittest.TestCase):
+    """
+    Tests for L{polling.TimelinePoller} with the REST methods of
+    L{twitter.Twitter} against L{fakeserver}.
+    """
+
+    def setUp(self):
+        self.server = fakeserver.FakeTwitterServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+
+    @defer.inlineCallbacks
+    def test_pageBack(self):
+        """
+        All statuses since the last poll are delivered, across pages.
+        """
+        api = self.server.api()
+        items = []
+        poller = polling.TimelinePoller(api,
+                                        lambda item, name: items.append(item))
+        poller.count = 10
+        poller.addTimeline('home', api.home_timeline)
+
+        self.server.rest.statusCount = 5
+        count = yield poller.poll('home')
+        self.assertEqual(5, count)
+
+        self.server.rest.statusCount = 30
+        count = yield poller.poll('home')
+        self.assertEqual(25, count)
+        self.assertEqual(range(1, 31), [int(item.id) for item in items])
+        self.assertEqual(30, poller.timelines['home'].sinceID)
+        poller.removeTimeline('home')
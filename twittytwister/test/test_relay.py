@@ -0,0 +1,317 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.relay}.
+"""
+
+import simplejson as json
+
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from twisted.web import server
+
+from twittytwister import fakeserver, metrics, platform, relay, streaming
+
+def makeDatagram(statusID, text=None):
+    data = {'id': statusID, 'text': text or u'Status %d' % statusID,
+            'user': {'id': statusID % 10, 'screen_name': 'user'}}
+    return json.dumps(data)
+
+
+
+class MakePredicateTest(unittest.TestCase):
+    """
+    Tests for L{relay.makePredicate}.
+    """
+
+    def status(self, text, userID=1):
+        return platform.Status.fromDict({'text': text,
+                                         'user': {'id': userID}})
+
+
+    def test_none(self):
+        self.assertIdentical(None, relay.makePredicate({}))
+        self.assertIdentical(None, relay.makePredicate({'track': ['']}))
+
+
+    def test_track(self):
+        """
+        Statuses match if they contain any term, case insensitively.
+        """
+        predicate = relay.makePredicate({'track': ['twisted,Python']})
+        self.assertTrue(predicate(self.status(u'I like Twisted')))
+        self.assertTrue(predicate(self.status(u'python!')))
+        self.assertFalse(predicate(self.status(u'Ruby')))
+
+
+    def test_follow(self):
+        predicate = relay.makePredicate({'follow': ['1,2'],
+                                         'track': ['twisted']})
+        self.assertTrue(predicate(self.status(u'Hello', 2)))
+        self.assertTrue(predicate(self.status(u'twisted', 3)))
+        self.assertFalse(predicate(self.status(u'Hello', 3)))
+
+
+    def test_followInvalid(self):
+        self.assertRaises(ValueError, relay.makePredicate,
+                          {'follow': ['abc']})
+
+
+
+class RelayTest(unittest.TestCase):
+    """
+    Tests for L{relay.Relay}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = metrics.MemoryMetrics()
+        self.relay = relay.Relay(maxQueued=2, metrics=self.metrics,
+                                 reactor=self.clock)
+
+
+    def tearDown(self):
+        for client in self.relay.clients:
+            self.relay.removeClient(client)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def addClient(self, predicate=None):
+        transport = proto_helpers.StringTransport()
+        client = relay.RelayClient(self.relay, transport, predicate)
+        transport.registerProducer(client, True)
+        self.relay.addClient(client)
+        return client
+
+
+    def test_fanOut(self):
+        """
+        Datagrams are framed once and written to all clients.
+        """
+        first = self.addClient()
+        second = self.addClient()
+        data = makeDatagram(1)
+        self.relay(data)
+        expected = '%d\r\n%s' % (len(data), data)
+        self.assertEqual(expected, first.consumer.value())
+        self.assertEqual(expected, second.consumer.value())
+        self.assertEqual(1, self.metrics.counters['relay.datagrams'])
+        self.assertEqual(2, self.metrics.gauges['relay.clients'])
+
+
+    def test_framesDecoded(self):
+        """
+        Clients can decode the frames with L{streaming.TwitterStream}.
+        """
+        client = self.addClient()
+        self.relay(makeDatagram(1))
+        self.relay(makeDatagram(2))
+        statuses = []
+        protocol = streaming.TwitterStream(statuses.append)
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocol.dataReceived(client.consumer.value())
+        protocol.setTimeout(None)
+        self.assertEqual([1, 2], [status.id for status in statuses])
+
+
+    def test_predicate(self):
+        """
+        Clients with a predicate only get the statuses that match.
+        """
+        everything = self.addClient()
+        matching = self.addClient(lambda status: status.id % 2)
+        for statusID in (1, 2, 3):
+            self.relay(makeDatagram(statusID))
+        self.relay('{"delete": {}}')
+        self.relay('invalid')
+
+        self.assertEqual(5, everything.consumer.value().count('\r\n'))
+        value = matching.consumer.value()
+        self.assertEqual(2, value.count('\r\n'))
+        self.assertIn('Status 1', value)
+        self.assertIn('Status 3', value)
+        self.assertEqual(1, self.metrics.counters['relay.filtered'])
+
+
+    def test_predicateFailure(self):
+        client = self.addClient(lambda status: 1 / 0)
+        self.relay(makeDatagram(1))
+        self.assertEqual('', client.consumer.value())
+        self.assertEqual(1, len(self.flushLoggedErrors(ZeroDivisionError)))
+
+
+    def test_paused(self):
+        """
+        Datagrams are queued while a client is paused.
+        """
+        client = self.addClient()
+        other = self.addClient()
+        client.pauseProducing()
+        self.relay(makeDatagram(1))
+        self.relay(makeDatagram(2))
+        self.assertEqual('', client.consumer.value())
+        self.assertEqual(2, len(client.queue))
+        self.assertIn('Status 2', other.consumer.value())
+
+        client.resumeProducing()
+        self.assertEqual(other.consumer.value(), client.consumer.value())
+        self.assertEqual(0, len(client.queue))
+
+
+    def test_evict(self):
+        """
+        Clients with more than C{maxQueued} queued datagrams are dropped.
+        """
+        disconnected = []
+        client = self.addClient()
+        client.disconnect = lambda: disconnected.append(client)
+        client.pauseProducing()
+        for statusID in (1, 2, 3):
+            self.relay(makeDatagram(statusID))
+        self.assertEqual([client], disconnected)
+        self.assertEqual([], self.relay.clients)
+        self.assertEqual(0, len(client.queue))
+        self.assertEqual(1, self.metrics.counters['relay.evictions'])
+        self.assertEqual(0, self.metrics.gauges['relay.clients'])
+
+
+    def test_stopProducing(self):
+        client = self.addClient()
+        client.stopProducing()
+        self.assertEqual([], self.relay.clients)
+
+
+    def test_keepAlive(self):
+        """
+        Clients that are not paused get keep-alives.
+        """
+        client = self.addClient()
+        paused = self.addClient()
+        paused.pauseProducing()
+        self.clock.advance(30)
+        self.assertEqual('\r\n', client.consumer.value())
+        self.assertEqual('', paused.consumer.value())
+
+        self.relay.removeClient(client)
+        self.relay.removeClient(paused)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_protocol(self):
+        """
+        TCP clients are added while connected.
+        """
+        factory = relay.RelayFactory(self.relay)
+        protocol = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        self.assertIdentical(protocol.client, transport.producer)
+        self.relay(makeDatagram(1))
+        self.assertIn('Status 1', transport.value())
+
+        protocol.connectionLost(failure.Failure(Exception()))
+        self.assertEqual([], self.relay.clients)
+
+
+
+class RelayIntegrationTest(unittest.TestCase):
+    """
+    End to end tests of a relay of a stream of L{fakeserver}.
+    """
+
+    timeout = 10
+
+    def setUp(self):
+        self.server = fakeserver.FakeTwitterServer(rate=1000)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.relay = relay.Relay(keepAliveInterval=None)
+        site = server.Site(relay.RelayResource(self.relay))
+        site.noisy = False
+        self.port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.streams = []
+        self.addCleanup(self.closeStreams)
+
+
+    def closeStreams(self):
+        deferreds = []
+        for protocol in self.streams:
+            protocol.deferred.addErrback(lambda _: None)
+            protocol.transport.stopProducing()
+            deferreds.append(protocol.deferred)
+        return defer.gatherResults(deferreds)
+
+
+    def connect(self, args=None):
+        """
+        Open a stream from the relay.
+        """
+        address = self.port.getHost()
+        feed = self.server.feed()
+        feed.stream_url = 'http://%s:%d' % (address.host, address.port)
+        statuses = []
+        d = feed.filter(statuses.append, args)
+        d.addCallback(self.streams.append)
+        d.addCallback(lambda _: statuses)
+        return d
+
+
+    def waitFor(self, condition, timeout=5):
+        """
+        Wait until a condition is true.
+        """
+        d = defer.Deferred()
+        start = reactor.seconds()
+
+        def check():
+            if condition() or reactor.seconds() - start > timeout:
+                call.stop()
+                d.callback(None)
+
+        call = task.LoopingCall(check)
+        call.start(0.01)
+        return d
+
+
+    @defer.inlineCallbacks
+    def test_relay(self):
+        """
+        Clients get the upstream statuses, filtered by their arguments.
+        """
+        everything = yield self.connect()
+        tagged = yield self.connect({'track': 'tag3'})
+        self.assertEqual(2, len(self.relay.clients))
+
+        self.server.stream.disconnectAfter = 40
+        upstream = self.server.feed()
+        upstream.protocol = streaming.RawTwitterStream
+        protocol = yield upstream.filter(self.relay, {'track': 'status'})
+        yield protocol.deferred
+        yield self.waitFor(lambda: len(everything) == 40 and
+                                   len(tagged) == 3)
+
+        self.assertEqual(range(1, 41), [status.id for status in everything])
+        self.assertEqual([3, 20, 37], [status.id for status in tagged])
+
+
+    @defer.inlineCallbacks
+    def test_service(self):
+        """
+        The relay service relays the stream of its monitor while running.
+        """
+        feed = self.server.feed()
+        service = relay.RelayService(feed, {'track': 'status'}, httpPort=0)
+        self.assertIdentical(streaming.RawTwitterStream, feed.protocol)
+        self.assertIdentical(service.relay, service.monitor.delegate)
+        service.startService()
+        self.assertEqual(1, len(service.ports))
+        self.assertTrue(service.monitor.running)
+        yield self.waitFor(lambda: service.monitor.protocol is not None)
+        yield service.stopService()
+        self.assertEqual([], service.ports)
+        self.assertFalse(service.monitor.running)
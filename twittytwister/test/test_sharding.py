@@ -0,0 +1,373 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.sharding}.
+"""
+
+import os
+from StringIO import StringIO
+
+import simplejson as json
+
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from twittytwister import metrics, platform, sharding
+
+def makeDatagram(statusID, userID, hashtag=None):
+    data = {'id': statusID, 'text': u'Status %d' % statusID,
+            'user': {'id': userID}}
+    if hashtag is not None:
+        data['entities'] = {'hashtags': [{'text': hashtag}]}
+    return json.dumps(data)
+
+
+
+def recordStatus(status):
+    """
+    Handler for the workers spawned in tests.
+    """
+    path = os.environ['SHARDING_TEST_OUTPUT']
+    f = open(path, 'a')
+    try:
+        f.write('%s %d\n' % (os.environ['TWITTYTWISTER_SHARD'], status.id))
+    finally:
+        f.close()
+
+
+
+def exitFirstWorker(status):
+    """
+    Handler that ends the worker of the first shard, and records the
+    statuses of the others.
+    """
+    if os.environ['TWITTYTWISTER_SHARD'] == '0':
+        os._exit(3)
+    recordStatus(status)
+
+
+
+class FakeProducer(object):
+
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+
+class KeyTest(unittest.TestCase):
+    """
+    Tests for the key functions and L{sharding.shardFor}.
+    """
+
+    def test_userKey(self):
+        self.assertEqual(1, sharding.userKey({'user': {'id': 1}}))
+        self.assertIdentical(None, sharding.userKey({'delete': {}}))
+
+
+    def test_hashtagKey(self):
+        data = {'entities': {'hashtags': [{'text': u'Twisted'},
+                                          {'text': u'python'}]}}
+        self.assertEqual(u'twisted', sharding.hashtagKey(data))
+        self.assertIdentical(None, sharding.hashtagKey({'entities': {}}))
+
+
+    def test_shardFor(self):
+        """
+        Shards are chosen by the CRC-32 of the key.
+        """
+        self.assertEqual(0x884863d2 % 4, sharding.shardFor(123, 4))
+        self.assertEqual(sharding.shardFor('123', 4),
+                         sharding.shardFor(123, 4))
+        self.assertEqual(sharding.shardFor('twisted', 7),
+                         sharding.shardFor(u'twisted', 7))
+        sharding.shardFor(u'\xe9t\xe9', 7)
+
+
+    def test_shardForNone(self):
+        self.assertEqual(0, sharding.shardFor(None, 4))
+
+
+
+class ShardedDispatcherTest(unittest.TestCase):
+    """
+    Tests for L{sharding.ShardedDispatcher}.
+    """
+
+    def setUp(self):
+        self.metrics = metrics.MemoryMetrics()
+        self.dispatcher = sharding.ShardedDispatcher(metrics=self.metrics)
+        self.transports = []
+        for i in xrange(3):
+            transport = proto_helpers.StringTransport()
+            self.dispatcher.addShard(transport)
+            self.transports.append(transport)
+
+
+    def test_dispatch(self):
+        """
+        Datagrams are sent, as received, to the shard of their key.
+        """
+        data = makeDatagram(1, 123)
+        self.dispatcher(data)
+        index = sharding.shardFor(123, 3)
+        self.assertEqual('%d\r\n%s' % (len(data), data),
+                         self.transports[index].value())
+        for i, transport in enumerate(self.transports):
+            if i != index:
+                self.assertEqual('', transport.value())
+        self.assertEqual(1, self.metrics.counters['shard.%d.datagrams' %
+                                                  index])
+        self.assertEqual(len(data), self.metrics.counters['shard.%d.bytes' %
+                                                          index])
+
+
+    def test_perKeyOrder(self):
+        """
+        All entries of a key go to the same shard, in order.
+        """
+        for statusID in xrange(10):
+            self.dispatcher(makeDatagram(statusID, statusID % 4))
+        for userID in xrange(4):
+            transport = self.transports[sharding.shardFor(userID, 3)]
+            received = [statusID for statusID in xrange(10)
+                        if statusID % 4 == userID]
+            positions = [transport.value().index('"id": %d,' % statusID)
+                         for statusID in received]
+            self.assertEqual(sorted(positions), positions)
+
+
+    def test_customKey(self):
+        self.dispatcher.key = sharding.hashtagKey
+        self.dispatcher(makeDatagram(1, 1, u'Twisted'))
+        self.dispatcher(makeDatagram(2, 2, u'twisted'))
+        transport = self.transports[sharding.shardFor(u'twisted', 3)]
+        self.assertEqual(2, transport.value().count('Status'))
+
+
+    def test_noKey(self):
+        """
+        Entries without a key go to the first shard.
+        """
+        self.dispatcher('{"delete": {}}')
+        self.assertEqual('14\r\n{"delete": {}}', self.transports[0].value())
+
+
+    def test_keyFailure(self):
+        self.dispatcher.key = lambda data: 1 / 0
+        self.dispatcher(makeDatagram(1, 1))
+        self.assertEqual(1, len(self.flushLoggedErrors(ZeroDivisionError)))
+        self.assertIn('Status 1', self.transports[0].value())
+
+
+    def test_invalid(self):
+        self.dispatcher('invalid')
+        self.assertEqual(1, self.metrics.counters['shard.decode_errors'])
+        self.assertEqual([0, 0, 0], [shard.datagrams
+                                     for shard in self.dispatcher.shards])
+
+
+    def test_status(self):
+        """
+        Platform objects are encoded again.
+        """
+        status = platform.Status.fromDict(json.loads(makeDatagram(1, 123)))
+        self.dispatcher(status)
+        value = self.transports[sharding.shardFor(123, 3)].value()
+        length, data = value.split('\r\n', 1)
+        self.assertEqual(status.raw, json.loads(data))
+        self.assertEqual(int(length), len(data))
+
+
+    def test_imbalance(self):
+        self.assertEqual(1.0, self.dispatcher.imbalance())
+        self.dispatcher.reportInterval = 2
+        self.dispatcher(makeDatagram(1, 123))
+        self.dispatcher(makeDatagram(2, 123))
+        self.assertEqual(3.0, self.metrics.gauges['shard.imbalance'])
+        stats = self.dispatcher.stats()
+        self.assertEqual(2, stats[sharding.shardFor(123, 3)]['datagrams'])
+        self.assertEqual(2, sum(shard['datagrams'] for shard in stats))
+
+
+    def test_backpressure(self):
+        """
+        The producer is paused while any shard is.
+        """
+        producer = FakeProducer()
+        self.dispatcher.registerProducer(producer, True)
+        first, second = self.dispatcher.shards[:2]
+        first.pauseProducing()
+        second.pauseProducing()
+        self.assertTrue(producer.paused)
+        first.resumeProducing()
+        self.assertTrue(producer.paused)
+        second.resumeProducing()
+        self.assertFalse(producer.paused)
+
+
+    def test_registerProducerPaused(self):
+        self.dispatcher.shards[0].pauseProducing()
+        producer = FakeProducer()
+        self.dispatcher.registerProducer(producer, True)
+        self.assertTrue(producer.paused)
+        self.dispatcher.unregisterProducer()
+        self.assertFalse(producer.paused)
+
+
+    def test_shardEnded(self):
+        """
+        The entries of an ended shard are dropped, the other shards keep
+        getting theirs.
+        """
+        producer = FakeProducer()
+        self.dispatcher.registerProducer(producer, True)
+        shard = self.dispatcher.shards[sharding.shardFor(123, 3)]
+        shard.pauseProducing()
+        self.dispatcher.shardEnded(shard)
+        self.assertFalse(producer.paused)
+        self.assertEqual(1, self.metrics.gauges['shard.ended'])
+
+        self.dispatcher(makeDatagram(1, 123))
+        self.assertEqual('', shard.transport.value())
+        self.assertEqual(1, self.metrics.counters['shard.dropped'])
+
+        other = self.dispatcher.shards[sharding.shardFor(124, 3)]
+        self.assertNotIdentical(shard, other)
+        self.dispatcher(makeDatagram(2, 124))
+        self.assertIn('Status 2', other.transport.value())
+
+        shard.pauseProducing()
+        self.assertFalse(producer.paused)
+
+
+    def test_noShards(self):
+        """
+        Without shards, entries are dropped.
+        """
+        dispatcher = sharding.ShardedDispatcher(metrics=self.metrics)
+        dispatcher(makeDatagram(1, 123))
+        self.assertEqual(1, self.metrics.counters['shard.dropped'])
+
+
+
+class WorkerTest(unittest.TestCase):
+    """
+    Tests for the worker side.
+    """
+
+    def test_runWorker(self):
+        """
+        Statuses are decoded and passed to the handler, other entries are
+        skipped.
+        """
+        frames = ''.join('%d\r\n%s\r\n' % (len(data), data)
+                         for data in (makeDatagram(1, 1), '{"delete": {}}',
+                                      makeDatagram(2, 1)))
+        statuses = []
+        count = sharding.runWorker(statuses.append, StringIO(frames))
+        self.assertEqual(2, count)
+        self.assertEqual([1, 2], [status.id for status in statuses])
+        self.assertIsInstance(statuses[0], platform.Status)
+
+
+    def test_runWorkerInvalid(self):
+        """
+        Datagrams that are not JSON objects are skipped.
+        """
+        frames = ''.join('%d\r\n%s\r\n' % (len(data), data)
+                         for data in ('1', 'invalid', '[]',
+                                      makeDatagram(1, 1)))
+        statuses = []
+        count = sharding.runWorker(statuses.append, StringIO(frames))
+        self.assertEqual(1, count)
+        self.assertEqual([1], [status.id for status in statuses])
+
+
+    def test_runWorkerHandlerFailure(self):
+        """
+        Failures of the handler are logged, and the worker goes on with the
+        next status.
+        """
+        def handler(status):
+            statuses.append(status)
+            if status.id == 1:
+                raise ValueError(status.id)
+
+        frames = ''.join('%d\r\n%s\r\n' % (len(data), data)
+                         for data in (makeDatagram(1, 1),
+                                      makeDatagram(2, 1)))
+        statuses = []
+        count = sharding.runWorker(handler, StringIO(frames))
+        self.assertEqual(1, count)
+        self.assertEqual([1, 2], [status.id for status in statuses])
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+
+    @defer.inlineCallbacks
+    def test_spawnWorkers(self):
+        """
+        Worker processes get the statuses of their shard.
+        """
+        path = os.path.abspath(self.mktemp())
+        dispatcher = sharding.ShardedDispatcher()
+        workers = sharding.spawnWorkers(
+            dispatcher, 'twittytwister.test.test_sharding.recordStatus', 2,
+            env={'SHARDING_TEST_OUTPUT': path})
+        self.assertEqual(2, len(dispatcher.shards))
+
+        for statusID in xrange(20):
+            dispatcher(makeDatagram(statusID, statusID % 5))
+        yield defer.gatherResults([worker.stop() for worker in workers])
+
+        f = open(path)
+        try:
+            lines = [line.split() for line in f]
+        finally:
+            f.close()
+        self.assertEqual(range(20), sorted(int(statusID)
+                                           for shard, statusID in lines))
+        for shard, statusID in lines:
+            self.assertEqual(sharding.shardFor(int(statusID) % 5, 2),
+                             int(shard))
+        self.assertTrue(all(shard.ended for shard in dispatcher.shards))
+
+
+    @defer.inlineCallbacks
+    def test_workerExits(self):
+        """
+        When a worker exits, its shard is ended, and the other workers
+        keep getting the statuses of their shards.
+        """
+        path = os.path.abspath(self.mktemp())
+        dispatcher = sharding.ShardedDispatcher()
+        producer = FakeProducer()
+        dispatcher.registerProducer(producer, True)
+        workers = sharding.spawnWorkers(
+            dispatcher, 'twittytwister.test.test_sharding.exitFirstWorker',
+            2, env={'SHARDING_TEST_OUTPUT': path})
+        first = [userID for userID in xrange(10)
+                 if sharding.shardFor(userID, 2) == 0]
+        second = [userID for userID in xrange(10)
+                  if sharding.shardFor(userID, 2) == 1]
+        dispatcher(makeDatagram(1, first[0]))
+        yield workers[0].ended
+        self.assertTrue(dispatcher.shards[0].ended)
+        self.assertFalse(producer.paused)
+
+        dispatcher(makeDatagram(2, first[0]))
+        dispatcher(makeDatagram(3, second[0]))
+        yield workers[1].stop()
+
+        f = open(path)
+        try:
+            self.assertEqual([['1', '3']], [line.split() for line in f])
+        finally:
+            f.close()
@@ -5,14 +5,14 @@
 Tests for L{twittytwister.streaming}.
 """
 
-from twisted.internet import task
-from twisted.python import failure
+from twisted.internet import defer, task
+from twisted.python import failure, log
 from twisted.test import proto_helpers
 from twisted.trial import unittest
 from twisted.web.client import ResponseDone
 from twisted.web.http import PotentialDataLoss
 
-from twittytwister import platform, streaming
+from twittytwister import latency, metrics, platform, streaming
 
 class StreamTester(streaming.LengthDelimitedStream):
     """
@@ -126,6 +126,20 @@ class TwitterStreamTest(unittest.TestCase):
         self.assertEquals(0, len(self.objects))
 
 
+    def test_unknownObjectLogged(self):
+        """
+        Unknown objects are logged, formatted only when the event is.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        self.protocol.datagramReceived('{"something": "Some Value"}')
+        self.assertEquals({'something': 'Some Value'}, events[-1]['obj'])
+        self.assertEquals(
+            "Unsupported object {'something': 'Some Value'}",
+            log.textFromEventDict(events[-1]))
+
+
     def test_badJSON(self):
         """
         Datagrams with invalid JSON are logged and ignored.
@@ -137,6 +151,73 @@ class TwitterStreamTest(unittest.TestCase):
         self.assertEquals(1, len(loggedErrors))
 
 
+    def test_metrics(self):
+        """
+        Received bytes, datagrams, statuses and errors are counted.
+        """
+        sink = metrics.MemoryMetrics()
+        protocol = streaming.TwitterStream(self.objects.append,
+                                           timeoutPeriod=None, metrics=sink)
+        protocol.makeConnection(self.transport)
+        data = ''.join('%d\r\n%s' % (len(datagram), datagram)
+                       for datagram in ('{"text": "Test status"}\r\n',
+                                        'blah\r\n',
+                                        '{"friends": []}\r\n'))
+        protocol.dataReceived('\r\n' + data)
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual({'stream.bytes': len(data) + 2,
+                          'stream.keepalives': 1,
+                          'stream.datagrams': 3,
+                          'stream.statuses': 1,
+                          'stream.decode_errors': 1,
+                          'stream.unsupported': 1},
+                         sink.counters)
+        self.assertEqual(1, sink.histograms['stream.delegate_latency'].count)
+
+
+    def test_nullMetricsNotTimed(self):
+        """
+        The delegate is not timed when metrics are discarded.
+        """
+        timings = []
+
+        class Sink(metrics.NullMetrics):
+            def timing(self, name, value):
+                timings.append(name)
+
+        protocol = streaming.TwitterStream(self.objects.append,
+                                           timeoutPeriod=None, metrics=Sink())
+        protocol.makeConnection(self.transport)
+        protocol.dataReceived('25\r\n{"text": "Test status"}\r\n')
+        self.assertEqual(1, len(self.objects))
+        self.assertEqual([], timings)
+
+
+    def test_latency(self):
+        """
+        Timestamps of each status are passed to the latency tracker.
+        """
+        tracker = latency.LatencyTracker()
+        times = iter([10, 11, 12, 13, 14])
+        tracker.clock = lambda: times.next()
+        protocol = streaming.TwitterStream(self.objects.append,
+                                           timeoutPeriod=None,
+                                           latency=tracker)
+        protocol.makeConnection(self.transport)
+
+        datagram = '{"text": "Test status", "timestamp_ms": "8000"}\r\n'
+        protocol.dataReceived('%d\r\n%s' % (len(datagram), datagram[:10]))
+        protocol.dataReceived(datagram[10:])
+
+        self.assertEqual(1, len(self.objects))
+        self.assertEqual({'network': {50: 2},
+                          'framing': {50: 2},
+                          'decoding': {50: 1},
+                          'consumer': {50: 1},
+                          'total': {50: 6}},
+                         tracker.percentiles((50,)))
+
+
     def test_closedResponseDone(self):
         """
         When the connection is done, the deferred is fired.
@@ -198,3 +279,330 @@ class TwitterStreamTest(unittest.TestCase):
                           "Unexpected timeout")
         self.clock.advance(20)
         self.assertEquals('stopped', self.transport.producerState)
+
+
+    def test_pause(self):
+        """
+        Pausing pauses the transport and suspends the timeout.
+        """
+        self.clock.advance(20)
+        self.protocol.pauseProducing()
+        self.assertEquals('paused', self.transport.producerState)
+        self.clock.advance(120)
+        self.assertEquals('paused', self.transport.producerState)
+
+        self.protocol.resumeProducing()
+        self.assertEquals('producing', self.transport.producerState)
+        self.clock.advance(59)
+        self.assertEquals('producing', self.transport.producerState)
+        self.clock.advance(1)
+        self.assertEquals('stopped', self.transport.producerState)
+
+
+    def test_pauseBuffered(self):
+        """
+        Buffered datagrams are not processed while paused.
+        """
+        data = '{"text": "Test status"}'
+        self.protocol.pauseProducing()
+        self.protocol.dataReceived('%d\r\n%s' % (len(data), data))
+        self.assertEquals([], self.objects)
+        self.protocol.resumeProducing()
+        self.assertEquals(1, len(self.objects))
+
+
+    def test_resumeClosed(self):
+        """
+        Resuming after the connection was closed does not start the timeout.
+        """
+        self.protocol.pauseProducing()
+        self.protocol.connectionLost(failure.Failure(ResponseDone()))
+        self.protocol.resumeProducing()
+        self.assertEquals(None, self.protocol.timeOut)
+        return self.protocol.deferred
+
+
+
+class RawTwitterStreamTest(unittest.TestCase):
+    """
+    Tests for L{streaming.RawTwitterStream}.
+    """
+
+    def setUp(self):
+        self.objects = []
+        self.protocol = streaming.RawTwitterStream(self.objects.append)
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+
+
+    def tearDown(self):
+        self.protocol.setTimeout(None)
+
+
+    def test_datagrams(self):
+        """
+        Datagrams are passed on as received, also if not statuses.
+        """
+        self.protocol.dataReceived('17\r\n{"text": "Hello"}\r\n'
+                                   '14\r\n{"delete": {}}')
+        self.assertEqual(['{"text": "Hello"}', '{"delete": {}}'],
+                         self.objects)
+
+
+
+class WatchdogTest(unittest.TestCase):
+    """
+    Tests for L{streaming.Watchdog}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.watchdog = streaming.Watchdog(interval=1, reactor=self.clock)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = streaming.TwitterStream(lambda entry: None,
+                                                timeoutPeriod=10,
+                                                watchdog=self.watchdog)
+        self.protocol.makeConnection(self.transport)
+
+
+    def tearDown(self):
+        self.protocol.setTimeout(None)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_noTimer(self):
+        """
+        Streams don't have their own timer, data only flags activity.
+        """
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.protocol.dataReceived('\r\n')
+        self.assertTrue(self.protocol.active)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+
+    def test_timeout(self):
+        """
+        Idle streams time out at the first sweep after the timeout period.
+        """
+        self.clock.advance(9)
+        self.assertEqual('producing', self.transport.producerState)
+        self.clock.advance(1)
+        self.assertEqual('stopped', self.transport.producerState)
+        self.assertEqual(0, len(self.watchdog))
+
+
+    def test_timeoutPostponedOnData(self):
+        """
+        Activity noticed at a sweep postpones the timeout.
+        """
+        self.clock.pump([1] * 5)
+        self.protocol.dataReceived('\r\n')
+        self.clock.pump([1] * 10)
+        self.assertEqual('producing', self.transport.producerState)
+        self.clock.advance(1)
+        self.assertEqual('stopped', self.transport.producerState)
+
+
+    def test_closed(self):
+        """
+        Closed streams are no longer watched, the sweep stops.
+        """
+        self.protocol.connectionLost(failure.Failure(ResponseDone()))
+        self.assertEqual(0, len(self.watchdog))
+        self.assertEqual([], self.clock.getDelayedCalls())
+        return self.protocol.deferred
+
+
+    def test_shared(self):
+        """
+        One sweep covers all streams, each with its own timeout.
+        """
+        transport = proto_helpers.StringTransport()
+        protocol = streaming.TwitterStream(lambda entry: None,
+                                           timeoutPeriod=20,
+                                           watchdog=self.watchdog)
+        protocol.makeConnection(transport)
+        self.assertEqual(2, len(self.watchdog))
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+        self.clock.advance(10)
+        self.assertEqual('stopped', self.transport.producerState)
+        self.assertEqual('producing', transport.producerState)
+        self.clock.advance(10)
+        self.assertEqual('stopped', transport.producerState)
+
+
+    def test_timeoutFailure(self):
+        """
+        A connection that fails to time out does not stop the sweep for
+        the others.
+        """
+        class Failing(object):
+            timeOut = 10
+
+            def timeoutConnection(self):
+                raise ValueError()
+
+        self.watchdog.add(Failing())
+        self.clock.advance(10)
+        self.assertEqual('stopped', self.transport.producerState)
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+        transport = proto_helpers.StringTransport()
+        protocol = streaming.TwitterStream(lambda entry: None,
+                                           timeoutPeriod=10,
+                                           watchdog=self.watchdog)
+        protocol.makeConnection(transport)
+        self.clock.advance(10)
+        self.assertEqual('stopped', transport.producerState)
+
+
+    def test_restart(self):
+        """
+        Adding a connection restarts a sweep that was stopped.
+        """
+        class Idle(object):
+            timeOut = 60
+
+        self.watchdog._call.stop()
+        self.clock.advance(10)
+        self.assertEqual('producing', self.transport.producerState)
+        idle = Idle()
+        self.watchdog.add(idle)
+        self.clock.advance(10)
+        self.assertEqual('stopped', self.transport.producerState)
+        self.watchdog.remove(idle)
+
+
+
+class StreamQueueTest(unittest.TestCase):
+    """
+    Tests for L{streaming.StreamQueue}.
+    """
+
+    def setUp(self):
+        self.queue = streaming.StreamQueue(size=2, lowWater=1)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = streaming.TwitterStream(self.queue.put,
+                                                timeoutPeriod=None)
+        self.protocol.makeConnection(self.transport)
+        self.queue.setProtocol(self.protocol)
+
+
+    def test_getQueued(self):
+        """
+        Entries received before get is called are queued.
+        """
+        self.queue.put(1)
+        results = []
+        self.queue.get().addCallback(results.append)
+        self.assertEqual([1], results)
+
+
+    def test_getWaiting(self):
+        """
+        Consumers waiting in get receive the next entry.
+        """
+        results = []
+        self.queue.get().addCallback(results.append)
+        self.assertEqual([], results)
+        self.protocol.datagramReceived('{"text": "Test status"}')
+        self.assertEqual(1, len(results))
+        self.assertIsInstance(results[-1], platform.Status)
+
+
+    def test_pause(self):
+        """
+        The transport is paused when the queue is full.
+        """
+        self.queue.put(1)
+        self.assertEqual('producing', self.transport.producerState)
+        self.queue.put(2)
+        self.assertEqual('paused', self.transport.producerState)
+        self.assertTrue(self.queue.paused)
+
+
+    def test_pauseFullOnSetProtocol(self):
+        """
+        A protocol set when the queue is already full is paused.
+        """
+        queue = streaming.StreamQueue(size=2, lowWater=1)
+        queue.put(1)
+        queue.put(2)
+        transport = proto_helpers.StringTransport()
+        protocol = streaming.TwitterStream(queue.put, timeoutPeriod=None)
+        protocol.makeConnection(transport)
+        queue.setProtocol(protocol)
+        self.assertEqual('paused', transport.producerState)
+        self.assertTrue(queue.paused)
+
+        queue.get()
+        self.assertEqual('producing', transport.producerState)
+
+
+    def test_resume(self):
+        """
+        The transport is resumed when the queue is drained to the low water.
+        """
+        self.queue.put(1)
+        self.queue.put(2)
+        self.queue.get()
+        self.assertEqual('producing', self.transport.producerState)
+        self.assertFalse(self.queue.paused)
+
+
+    def test_closed(self):
+        """
+        When the stream is done, waiting and new consumers get None.
+        """
+        results = []
+        self.queue.get().addCallback(results.append)
+        self.protocol.connectionLost(failure.Failure(ResponseDone()))
+        self.queue.get().addCallback(results.append)
+        self.assertEqual([None, None], results)
+
+
+    def test_closedQueued(self):
+        """
+        Queued entries can still be retrieved after the stream is done.
+        """
+        self.queue.put(1)
+        self.protocol.connectionLost(failure.Failure(ResponseDone()))
+        results = []
+        self.queue.get().addCallback(results.append)
+        self.queue.get().addCallback(results.append)
+        self.assertEqual([1, None], results)
+
+
+    def test_failed(self):
+        """
+        When the stream fails, consumers get the failure.
+        """
+        d = self.queue.get()
+        self.protocol.connectionLost(failure.Failure(ValueError()))
+        self.assertFailure(d, ValueError)
+        self.assertFailure(self.queue.get(), ValueError)
+        return d
+
+
+    def test_cancel(self):
+        """
+        Cancelling stops the transport and ends the queue cleanly.
+        """
+        results = []
+        self.queue.get().addCallback(results.append)
+        self.queue.cancel()
+        self.assertEqual('stopped', self.transport.producerState)
+        self.protocol.connectionLost(failure.Failure(ValueError()))
+        self.assertEqual([None], results)
+
+
+    def test_cancelGet(self):
+        """
+        Cancelling the deferred from get removes the waiting consumer.
+        """
+        d = self.queue.get()
+        d.cancel()
+        self.assertFailure(d, defer.CancelledError)
+        self.queue.put(1)
+        self.assertEqual(1, len(self.queue.pending))
+        return d
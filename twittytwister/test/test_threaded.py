@@ -0,0 +1,230 @@
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Tests for L{twittytwister.threaded}.
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from twittytwister import metrics, platform, threaded
+
+class FakeReactor(task.Clock):
+    """
+    Clock that runs calls from threads right away.
+    """
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+
+class FakeThreadPool(object):
+    """
+    Thread pool that runs calls when told to.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.calls.append((onResult, f, args, kwargs))
+
+
+    def run(self, index=0):
+        """
+        Run a queued call.
+        """
+        onResult, f, args, kwargs = self.calls.pop(index)
+        onResult(True, f(*args, **kwargs))
+
+
+
+def makeStatus(statusID, userID):
+    return platform.Status.fromDict({'id': statusID, 'text': u'Hello',
+                                     'user': {'id': userID}})
+
+
+
+class FakeProducer(object):
+
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+
+class ThreadedDelegateTest(unittest.TestCase):
+    """
+    Tests for L{threaded.ThreadedDelegate}.
+    """
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.pool = FakeThreadPool()
+        self.metrics = metrics.MemoryMetrics()
+        self.handled = []
+
+
+    def makeDelegate(self, **kwargs):
+        return threaded.ThreadedDelegate(self.handled.append,
+                                         threadpool=self.pool,
+                                         metrics=self.metrics,
+                                         reactor=self.reactor, **kwargs)
+
+
+    def test_strict(self):
+        """
+        With strict ordering, one entry is handled at a time.
+        """
+        delegate = self.makeDelegate()
+        delegate(makeStatus(1, 1))
+        delegate(makeStatus(2, 2))
+        self.assertEqual(1, len(self.pool.calls))
+        self.assertEqual(2, delegate.pending)
+
+        self.pool.run()
+        self.assertEqual(1, len(self.pool.calls))
+        self.pool.run()
+        self.assertEqual([1, 2], [status.id for status in self.handled])
+        self.assertEqual(0, delegate.pending)
+        self.assertEqual({}, delegate._queues)
+
+
+    def test_perUser(self):
+        """
+        With per user ordering, entries of different users are handled
+        concurrently, those of one user in order.
+        """
+        delegate = self.makeDelegate(ordering=threaded.PER_USER)
+        delegate(makeStatus(1, 1))
+        delegate(makeStatus(2, 1))
+        delegate(makeStatus(3, 2))
+        self.assertEqual(2, len(self.pool.calls))
+
+        self.pool.run(1)
+        self.pool.run(0)
+        self.pool.run(0)
+        self.assertEqual([3, 1, 2], [status.id for status in self.handled])
+
+
+    def test_unordered(self):
+        delegate = self.makeDelegate(ordering=threaded.UNORDERED)
+        for statusID in (1, 2, 3):
+            delegate(makeStatus(statusID, 1))
+        self.assertEqual(3, len(self.pool.calls))
+        self.pool.run(2)
+        self.assertEqual([3], [status.id for status in self.handled])
+        self.assertEqual(2, delegate.pending)
+
+
+    def test_unknownOrdering(self):
+        self.assertRaises(ValueError, self.makeDelegate, ordering='random')
+
+
+    def test_metrics(self):
+        """
+        The time waiting and the time spent in the handler are recorded.
+        """
+        def handler(entry):
+            self.reactor.advance(2)
+
+        delegate = threaded.ThreadedDelegate(handler, threadpool=self.pool,
+                                             metrics=self.metrics,
+                                             reactor=self.reactor)
+        delegate.timer = self.reactor.seconds
+        delegate(makeStatus(1, 1))
+        self.assertEqual(1, self.metrics.gauges['threads.pending'])
+        self.reactor.advance(3)
+        self.pool.run()
+        self.assertEqual(3, self.metrics.histograms['threads.queue_wait'].sum)
+        self.assertEqual(2, self.metrics.histograms['threads.execution'].sum)
+        self.assertEqual(0, self.metrics.gauges['threads.pending'])
+
+
+    def test_failure(self):
+        """
+        Failures of the handler are logged and counted, and the next entry
+        is handled.
+        """
+        def handler(entry):
+            raise ValueError(entry.id)
+
+        delegate = threaded.ThreadedDelegate(handler, threadpool=self.pool,
+                                             metrics=self.metrics,
+                                             reactor=self.reactor)
+        delegate(makeStatus(1, 1))
+        delegate(makeStatus(2, 1))
+        self.pool.run()
+        self.pool.run()
+        self.assertEqual(2, self.metrics.counters['threads.errors'])
+        self.assertEqual(2, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(0, delegate.pending)
+
+
+    def test_drop(self):
+        """
+        Without a producer, entries beyond C{maxPending} are dropped.
+        """
+        delegate = self.makeDelegate(maxPending=2)
+        for statusID in (1, 2, 3):
+            delegate(makeStatus(statusID, 1))
+        self.assertEqual(2, delegate.pending)
+        self.assertEqual(1, delegate.dropped)
+        self.assertEqual(1, self.metrics.counters['threads.dropped'])
+
+
+    def test_producer(self):
+        """
+        The producer is paused at C{maxPending} entries, and resumed at
+        C{lowWater}.
+        """
+        producer = FakeProducer()
+        delegate = self.makeDelegate(maxPending=3, lowWater=1)
+        delegate.registerProducer(producer, True)
+        for statusID in (1, 2, 3, 4):
+            delegate(makeStatus(statusID, 1))
+        self.assertTrue(producer.paused)
+        self.assertEqual(4, delegate.pending)
+        self.assertEqual(1, self.metrics.counters['threads.pauses'])
+
+        self.pool.run()
+        self.pool.run()
+        self.assertTrue(producer.paused)
+        self.pool.run()
+        self.assertFalse(producer.paused)
+
+
+    def test_registerProducerTwice(self):
+        delegate = self.makeDelegate()
+        delegate.registerProducer(FakeProducer(), True)
+        self.assertRaises(RuntimeError, delegate.registerProducer,
+                          FakeProducer(), True)
+
+
+    def test_unregisterProducer(self):
+        producer = FakeProducer()
+        delegate = self.makeDelegate(maxPending=1)
+        delegate.registerProducer(producer, True)
+        delegate(makeStatus(1, 1))
+        self.assertTrue(producer.paused)
+        delegate.unregisterProducer()
+        self.assertFalse(producer.paused)
+        self.assertIdentical(None, delegate.producer)
+
+
+    def test_drain(self):
+        delegate = self.makeDelegate()
+        self.successResultOf(delegate.drain())
+        delegate(makeStatus(1, 1))
+        d = delegate.drain()
+        self.assertNoResult(d)
+        self.pool.run()
+        self.successResultOf(d)
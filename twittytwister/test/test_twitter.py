@@ -5,18 +5,42 @@
 Tests for L{twittytwister.twitter}.
 """
 
+import logging
+import os
+import random
+import subprocess
+import sys
+
+from oauth import oauth
+
+from zope.interface import verify
+
 from twisted.internet import defer, task
 from twisted.internet.error import ConnectError
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import failure
 from twisted.trial import unittest
 from twisted.web import error as http_error
+from twisted.web import client, http_headers
 from twisted.web.client import ResponseDone
 from twisted.web.http import PotentialDataLoss
 
-from twittytwister import twitter, platform
+import twittytwister
+from twittytwister import backfill, backoff, latency, metrics, twitter
+from twittytwister import platform, threaded
+from twittytwister import streaming
 
 DELAY_INITIAL = twitter.TwitterMonitor.backOffs[None]['initial']
 
+# Trial changes the working directory, so determine the path up front.
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(
+    twittytwister.__file__)))
+
+# Subsystems that are imported when used.
+OPTIONAL_MODULES = ('twittytwister.backfill', 'twittytwister.bulk',
+                    'twittytwister.hub', 'twittytwister.multipart',
+                    'twittytwister.threaded')
+
 class TwitterFeedTest(unittest.TestCase):
     """
     Tests for L{twitter.TwitterFeed):
@@ -67,6 +91,164 @@ class TwitterFeedTest(unittest.TestCase):
         self.assertEqual({'follow': '6253282'}, args)
 
 
+    def test_agentCompressed(self):
+        """
+        Streams are requested with gzip compression.
+        """
+        self.assertIsInstance(self.feed.agent, client.ContentDecoderAgent)
+        self.assertIn('gzip', self.feed.agent._supported)
+
+
+    def test_filterStream(self):
+        """
+        C{filter_stream} opens a filter stream with a queue as delegate.
+        """
+        protocol = FakeTwitterProtocol()
+
+        def _rtfeed(url, delegate, args):
+            self._rtfeed(url, delegate, args)
+            return defer.succeed(protocol)
+
+        self.patch(self.feed, '_rtfeed', _rtfeed)
+        d = self.feed.filter_stream({'track': 'twisted'}, size=10)
+        url, delegate, args = self.calls[-1]
+        self.assertEqual('https://stream.twitter.com/1.1/statuses/filter.json',
+                         url)
+        self.assertEqual({'track': 'twisted'}, args)
+
+        def cb(queue):
+            self.assertIsInstance(queue, streaming.StreamQueue)
+            self.assertEqual(10, queue.size)
+            self.assertIdentical(protocol, queue.protocol)
+            self.assertEqual(queue.put, delegate)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_rateLimited(self):
+        """
+        Rate limited stream requests fail with the Retry-After delay.
+        """
+        self.feed = twitter.TwitterFeed(consumer=oauth.OAuthConsumer('a', 'b'),
+                                        token=oauth.OAuthToken('c', 'd'))
+        self.feed.agent = FakeAgent()
+        d = self.feed.filter(None, {'track': 'twisted'})
+        self.feed.agent.requests[-1][-1].callback(
+                FakeResponse(420, '', {'Retry-After': ['120']}))
+        self.assertFailure(d, twitter.RateLimitError)
+        d.addCallback(lambda exc: self.assertEqual(120, exc.retryAfter))
+        return d
+
+
+    def test_watchdog(self):
+        """
+        The watchdog is passed on to the stream protocol.
+        """
+        self.feed = twitter.TwitterFeed(consumer=oauth.OAuthConsumer('a', 'b'),
+                                        token=oauth.OAuthToken('c', 'd'))
+        self.feed.agent = FakeAgent()
+        self.feed.watchdog = streaming.Watchdog(reactor=task.Clock())
+        d = self.feed.filter(None, {'track': 'twisted'})
+        self.feed.agent.requests[-1][-1].callback(FakeResponse(200, ''))
+        d.addCallback(lambda protocol: self.assertIdentical(
+            self.feed.watchdog, protocol.watchdog))
+        return d
+
+
+    def test_rateLimitedNoRetryAfter(self):
+        self.feed = twitter.TwitterFeed(consumer=oauth.OAuthConsumer('a', 'b'),
+                                        token=oauth.OAuthToken('c', 'd'))
+        self.feed.agent = FakeAgent()
+        d = self.feed.filter(None, {'track': 'twisted'})
+        self.feed.agent.requests[-1][-1].callback(FakeResponse(429, ''))
+        self.assertFailure(d, twitter.RateLimitError)
+        d.addCallback(lambda exc: self.assertIdentical(None, exc.retryAfter))
+        return d
+
+
+
+class FakeResponse(object):
+    """
+    Fake response that delivers its body right away.
+    """
+
+    def __init__(self, code, body, headers=None):
+        self.code = code
+        self.phrase = 'Phrase'
+        self.headers = http_headers.Headers(headers or {})
+        self.body = body
+
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(ResponseDone()))
+
+
+
+class FakeAgent(object):
+    """
+    Fake agent that records requests and returns deferreds fired at will.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        d = defer.Deferred()
+        self.requests.append((method, uri, headers, bodyProducer, d))
+        return d
+
+
+
+class TwitterUploadTest(unittest.TestCase):
+    """
+    Tests for streaming uploads with L{twitter.Twitter}.
+    """
+
+    def setUp(self):
+        self.agent = FakeAgent()
+        self.twitter = twitter.Twitter(consumer=oauth.OAuthConsumer('a', 'b'),
+                                       token=oauth.OAuthToken('c', 'd'))
+        self.twitter.uploadAgent = self.agent
+
+
+    def test_updateProfileImage(self):
+        """
+        The image is sent as a streaming multipart body.
+        """
+        d = self.twitter.update_profile_image('me.png', '0123456789')
+        method, uri, headers, producer, requestDeferred = self.agent.requests[-1]
+        self.assertEqual('POST', method)
+        self.assertEqual(twitter.BASE_URL + '/account/update_profile_image.xml',
+                         uri)
+        self.assertEqual([producer.contentType],
+                         headers.getRawHeaders('content-type'))
+        self.assertTrue(headers.getRawHeaders('authorization')[0].startswith(
+                'OAuth'))
+        self.assertIn('0123456789', ''.join(
+                data for data, _, _ in producer._segments))
+
+        requestDeferred.callback(FakeResponse(200, '<user/>',
+                                              {'X-RateLimit-Remaining': ['7']}))
+        d.addCallback(self.assertEqual, '<user/>')
+        d.addCallback(lambda _: self.assertEqual(
+                7, self.twitter.rate_limit_remaining))
+        return d
+
+
+    def test_updateProfileImageError(self):
+        """
+        Error responses result in a L{http_error.Error}.
+        """
+        d = self.twitter.update_profile_image('me.png', '0123456789')
+        self.agent.requests[-1][-1].callback(FakeResponse(403, 'Forbidden'))
+        self.assertFailure(d, http_error.Error)
+        d.addCallback(lambda exc: self.assertEqual('403', exc.status))
+        return d
+
+
 
 class FakeTwitterProtocol(object):
     """
@@ -77,6 +259,7 @@ class FakeTwitterProtocol(object):
         self.deferred = defer.Deferred()
         self.transport = self
         self.stopCalled = False
+        self.paused = False
 
 
     def stopProducing(self):
@@ -86,6 +269,14 @@ class FakeTwitterProtocol(object):
         self.stopCalled = True
 
 
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+
     def connectionLost(self, reason):
         """
         Lose the connection with reason.
@@ -602,6 +793,93 @@ class TwitterMonitorTest(unittest.TestCase):
             self.assertEqual(callCount, len(self.api.filterCalls))
 
 
+    def test_connectRateLimited(self):
+        """
+        Rate limited connects are retried after the Retry-After delay.
+        """
+        self.setUpState('connecting')
+
+        self.api.connectFail(twitter.RateLimitError(420, 'Enhance Your Calm',
+                                                    retryAfter=90))
+        self.clock.advance(0)
+        self.assertEquals(1, len(self.flushLoggedErrors(http_error.Error)))
+
+        self.clock.advance(89)
+        self.assertEqual(1, len(self.api.filterCalls))
+        self.clock.advance(1)
+        self.assertEqual(2, len(self.api.filterCalls))
+        self.api.connected()
+
+
+    def test_connectRateLimitedNoRetryAfter(self):
+        """
+        Without Retry-After, rate limited connects back off from a minute.
+        """
+        self.setUpState('connecting')
+        self.patch(self.monitor, 'backOffs', dict(self.monitor.backOffs))
+        self.monitor.backOffs['ratelimit'] = dict(
+                self.monitor.backOffs['ratelimit'],
+                strategy=backoff.RetryAfter(
+                    backoff.DecorrelatedJitter(lambda: 1)))
+
+        callCount = 1
+        for delay in (60, 180, 540, 960, 960):
+            self.api.connectFail(twitter.RateLimitError(420,
+                                                        'Enhance Your Calm'))
+            self.clock.advance(0)
+            self.assertEquals(1, len(self.flushLoggedErrors(
+                twitter.RateLimitError)))
+
+            self.clock.advance(delay - 0.01)
+            self.assertEqual(callCount, len(self.api.filterCalls))
+            self.clock.advance(0.01)
+            callCount += 1
+            self.assertEqual(callCount, len(self.api.filterCalls))
+        self.api.connected()
+
+
+    def test_connectStrategy(self):
+        """
+        The back-off strategy of the error state computes the delays.
+        """
+        self.setUpState('connecting')
+        self.patch(self.monitor, 'backOffs', dict(self.monitor.backOffs))
+        self.monitor.backOffs['network'] = dict(
+                self.monitor.backOffs['network'],
+                strategy=backoff.FullJitter(lambda: 0.5))
+
+        callCount = 1
+        for delay in (0.125, 0.25, 0.5, 1, 2, 4, 8, 8):
+            self.api.connectFail(ConnectError())
+            self.clock.advance(0)
+            self.assertEquals(1, len(self.flushLoggedErrors(ConnectError)))
+
+            self.clock.advance(delay)
+            callCount += 1
+            self.assertEqual(callCount, len(self.api.filterCalls))
+        self.api.connected()
+
+
+    def test_reconnectBudget(self):
+        """
+        The reconnect budget postpones reconnects beyond the back-off delay.
+        """
+        self.monitor.reconnectBudget = backoff.ReconnectBudget(rate=0.1,
+                                                               burst=1)
+        self.monitor.reconnectBudget.reserve(self.clock.seconds(), 0)
+        self.setUpState('connecting')
+
+        self.api.connectFail(ConnectError())
+        self.clock.advance(0)
+        self.flushLoggedErrors(ConnectError)
+
+        self.clock.advance(9.9)
+        self.assertEqual(1, len(self.api.filterCalls))
+        self.clock.advance(0.1)
+        self.assertEqual(2, len(self.api.filterCalls))
+        self.api.connected()
+
+
     def test_connectionLostDone(self):
         """
         When the connection is closed while connected, attempt reconnect.
@@ -722,3 +1000,526 @@ class TwitterMonitorTest(unittest.TestCase):
         self.api.delegate(status)
 
         self.assertEqual(1, len(self.flushLoggedErrors(Error)))
+
+
+    def test_metrics(self):
+        """
+        State transitions, time in state, errors and entries are recorded.
+        """
+        sink = metrics.MemoryMetrics()
+        self.monitor.metrics = sink
+        self.setUpState('connecting')
+        self.clock.advance(5)
+        self.api.connected()
+
+        status = platform.Status.fromDict({'text': u'Hello!'})
+        self.api.delegate(status)
+
+        self.api.protocol.connectionLost(failure.Failure(ConnectError()))
+        self.flushLoggedErrors(ConnectError)
+        self.clock.advance(self.monitor.backOffs['network']['initial'])
+
+        self.assertEqual(1, sink.counters['monitor.entries'])
+        self.assertEqual(1, sink.counters['monitor.errors.network'])
+        self.assertEqual(1, sink.counters['monitor.reconnects'])
+        self.assertEqual(2, sink.counters['monitor.transitions.connecting'])
+        self.assertEqual(0, sink.gauges['monitor.connected'])
+        self.assertEqual(5, sink.histograms['monitor.state_time.connecting'].sum)
+
+
+    def test_latency(self):
+        """
+        The latency tracker is passed on to the protocol.
+        """
+        tracker = latency.LatencyTracker()
+        self.monitor.latency = tracker
+        self.assertEqual({}, self.monitor.latencyPercentiles()['total'])
+
+        self.setUpState('connected')
+        self.assertIdentical(tracker, self.api.protocol.latency)
+
+        tracker.record(1, 2, 3, 4, 4, 5)
+        self.assertEqual({50: 4}, self.monitor.latencyPercentiles((50,))['total'])
+
+
+    def test_latencyNone(self):
+        """
+        Without latency tracker, there are no percentiles.
+        """
+        self.assertEqual({}, self.monitor.latencyPercentiles())
+
+
+    def test_subscribe(self):
+        """
+        Subscribing makes the hub the delegate and connects.
+        """
+        received = []
+        self.setUpState('idle')
+        subscription = self.monitor.subscribe(received.append, name='a')
+        self.assertIdentical(self.monitor.hub, self.monitor.delegate)
+        self.assertEqual('a', subscription.name)
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.api.filterCalls))
+
+        other = []
+        self.monitor.subscribe(other.append)
+        self.api.connected()
+        status = platform.Status.fromDict({'text': u'Hello!'})
+        self.api.delegate(status)
+        self.assertEqual([status], received)
+        self.assertEqual([status], other)
+
+        self.monitor.unsubscribe(subscription)
+        self.api.delegate(status)
+        self.assertEqual([status], received)
+        self.assertEqual([status, status], other)
+
+
+    def test_subscribeDelegate(self):
+        """
+        Subscribing to a monitor with its own delegate fails.
+        """
+        self.monitor.delegate = self.onEntry
+        self.assertRaises(twitter.Error, self.monitor.subscribe,
+                          self.onEntry)
+
+
+    def test_offload(self):
+        """
+        Offloading the delegate pauses the stream while too many entries
+        are pending.
+        """
+        self.setUpState('connected')
+        delegate = self.monitor.offload(threadpool=object(), maxPending=2)
+        self.assertIdentical(delegate, self.monitor.delegate)
+        self.assertEqual(self.onEntry, delegate.handler)
+        self.assertIdentical(self.monitor, delegate.producer)
+        self.assertIdentical(self.clock, delegate.reactor)
+
+        calls = []
+        self.patch(threaded.threads, 'deferToThreadPool',
+                   lambda *args: calls.append(args) or defer.Deferred())
+        self.api.delegate(makeStatus(1))
+        self.assertFalse(self.api.protocol.paused)
+        self.api.delegate(makeStatus(2))
+        self.assertTrue(self.monitor.paused)
+        self.assertTrue(self.api.protocol.paused)
+        self.assertEqual(1, len(calls))
+
+
+    def test_interface(self):
+        verify.verifyObject(IPushProducer, self.monitor)
+
+
+    def test_pauseProducing(self):
+        """
+        Pausing the monitor pauses the current stream.
+        """
+        self.setUpState('connected')
+        self.monitor.pauseProducing()
+        self.assertTrue(self.monitor.paused)
+        self.assertTrue(self.api.protocol.paused)
+        self.monitor.resumeProducing()
+        self.assertFalse(self.monitor.paused)
+        self.assertFalse(self.api.protocol.paused)
+
+
+    def test_pauseProducingReconnect(self):
+        """
+        New connections of a paused monitor start paused.
+        """
+        self.setUpState('connecting')
+        self.monitor.pauseProducing()
+        self.api.connected()
+        self.assertTrue(self.api.protocol.paused)
+
+
+    def test_pauseProducingMetrics(self):
+        """
+        Pauses and the time spent paused are recorded.
+        """
+        sink = metrics.MemoryMetrics()
+        self.monitor.metrics = sink
+        self.setUpState('connected')
+        self.monitor.pauseProducing()
+        self.monitor.pauseProducing()
+        self.assertEqual(1, sink.gauges['monitor.paused'])
+        self.clock.advance(3)
+        self.monitor.resumeProducing()
+        self.monitor.resumeProducing()
+
+        self.assertEqual(1, sink.counters['monitor.pauses'])
+        self.assertEqual(0, sink.gauges['monitor.paused'])
+        self.assertEqual(3, sink.histograms['monitor.paused_time'].sum)
+
+
+    def test_stopProducing(self):
+        """
+        When the consumer goes away, the service is stopped.
+        """
+        self.setUpState('connected')
+        self.monitor.stopProducing()
+        self.assertFalse(self.monitor.running)
+        self.assertTrue(self.api.protocol.stopCalled)
+
+
+
+def makeStatus(statusID):
+    return platform.Status.fromDict({'id': statusID, 'text': u'Hello'})
+
+
+
+class FakeCheckpoint(object):
+
+    def __init__(self, state=None):
+        self.state = state or {}
+        self.saved = []
+
+
+    def load(self):
+        return dict(self.state)
+
+
+    def save(self, state):
+        self.saved.append(dict(state))
+
+
+
+class TwitterMonitorBackfillTest(unittest.TestCase):
+    """
+    Tests for checkpoints and backfill of L{twitter.TwitterMonitor}.
+    """
+
+    def setUp(self):
+        self.entries = []
+        self.clock = task.Clock()
+        self.api = FakeTwitterAPI()
+        self.checkpoint = FakeCheckpoint()
+        self.timelineCalls = []
+        self.timeline = []
+        self.monitor = twitter.TwitterMonitor(
+                self.api.filter, delegate=self.entries.append,
+                reactor=self.clock, checkpoint=self.checkpoint,
+                backfill=backfill.TimelineBackfill(self.fetchTimeline))
+
+
+    def tearDown(self):
+        self.monitor.stopService()
+
+
+    def fetchTimeline(self, delegate, params):
+        self.timelineCalls.append(params)
+        for statusID in reversed(self.timeline):
+            if statusID > int(params['since_id']):
+                delegate(makeStatus(statusID))
+        return defer.succeed(None)
+
+
+    def connect(self):
+        self.clock.advance(0)
+        self.api.connected()
+
+
+    def reconnect(self):
+        self.api.protocol.connectionLost(failure.Failure(ResponseDone()))
+        self.clock.advance(self.monitor.backOffs[None]['initial'])
+        self.api.connected()
+
+
+    def receive(self, *statusIDs):
+        for statusID in statusIDs:
+            self.api.delegate(makeStatus(statusID))
+
+
+    def test_checkpoint(self):
+        """
+        The last delivered status is saved, at most every interval.
+        """
+        self.monitor.startService()
+        self.connect()
+        self.receive(1, 2)
+        self.assertEqual([{'stream': {'id': 1, 'timestamp': None}}],
+                         self.checkpoint.saved)
+
+        self.clock.advance(self.monitor.checkpointInterval)
+        self.receive(3)
+        self.assertEqual({'id': 3, 'timestamp': None},
+                         self.checkpoint.saved[-1]['stream'])
+
+
+    def test_checkpointOnDisconnect(self):
+        """
+        The checkpoint is saved when the connection is lost.
+        """
+        self.monitor.startService()
+        self.connect()
+        self.receive(1, 2)
+        self.api.protocol.connectionLost(failure.Failure(ResponseDone()))
+        self.assertEqual(2, self.checkpoint.saved[-1]['stream']['id'])
+        self.assertEqual(2, len(self.checkpoint.saved))
+
+
+    def test_checkpointTimestamp(self):
+        self.monitor.startService()
+        self.connect()
+        self.api.delegate(platform.Status.fromDict({
+            'id': 1, 'text': u'Hello', 'timestamp_ms': '1445412480000'}))
+        self.assertEqual(1445412480, self.checkpoint.saved[-1]['stream'][
+            'timestamp'])
+
+
+    def test_backfillAfterReconnect(self):
+        """
+        Missed statuses are backfilled after reconnecting, without
+        duplicates.
+        """
+        self.monitor.metrics = metrics.MemoryMetrics()
+        self.monitor.startService()
+        self.connect()
+        self.receive(1, 2)
+        self.assertEqual([], self.timelineCalls)
+
+        self.timeline = [1, 2, 3, 4, 5]
+        self.reconnect()
+        self.receive(5, 6)
+
+        self.assertEqual('2', self.timelineCalls[-1]['since_id'])
+        self.assertEqual([1, 2, 3, 4, 5, 6],
+                         [entry.id for entry in self.entries])
+        self.assertEqual(3, self.monitor.metrics.counters['monitor.backfilled'])
+        self.assertEqual(1, self.monitor.metrics.counters['monitor.duplicates'])
+
+
+    def test_backfillFromCheckpoint(self):
+        """
+        On start, statuses since the stored checkpoint are backfilled.
+        """
+        self.checkpoint.state = {'stream': {'id': 3}}
+        self.timeline = [1, 2, 3, 4]
+        self.monitor.startService()
+        self.connect()
+        self.assertEqual([4], [entry.id for entry in self.entries])
+
+
+    def test_backfillFailed(self):
+        """
+        Failing backfills are logged, the stream goes on.
+        """
+        class Error(Exception):
+            pass
+
+        self.monitor.backfill = backfill.TimelineBackfill(
+                lambda delegate, params: defer.fail(Error()))
+        self.checkpoint.state = {'stream': {'id': 3}}
+        self.monitor.startService()
+        self.connect()
+        self.assertEqual(1, len(self.flushLoggedErrors(Error)))
+        self.receive(4)
+        self.assertEqual([4], [entry.id for entry in self.entries])
+
+
+    def test_checkpointDuringBackfill(self):
+        """
+        The checkpoint doesn't move past statuses that are still being
+        backfilled.
+        """
+        pending = []
+
+        def fetchTimeline(delegate, params):
+            d = defer.Deferred()
+            pending.append((delegate, d))
+            return d
+
+        self.monitor.backfill = backfill.TimelineBackfill(fetchTimeline)
+        self.checkpoint.state = {'stream': {'id': 3}}
+        self.monitor.startService()
+        self.connect()
+        self.receive(6, 7)
+        self.clock.advance(self.monitor.checkpointInterval)
+        self.receive(8)
+        self.assertEqual([], self.checkpoint.saved)
+
+        self.api.protocol.connectionLost(failure.Failure(ResponseDone()))
+        self.assertEqual([], self.checkpoint.saved)
+
+        delegate, d = pending[-1]
+        delegate(makeStatus(5))
+        delegate(makeStatus(4))
+        d.callback(None)
+        self.assertEqual([6, 7, 8, 4, 5], [entry.id for entry in self.entries])
+        self.assertEqual(8, self.checkpoint.saved[-1]['stream']['id'])
+
+
+    def test_checkpointBackfillFailed(self):
+        """
+        After a failed backfill, the checkpoint stays before the missed
+        statuses, which are backfilled again on the next reconnect.
+        """
+        class Error(Exception):
+            pass
+
+        self.monitor.backfill = backfill.TimelineBackfill(
+                lambda delegate, params: defer.fail(Error()))
+        self.checkpoint.state = {'stream': {'id': 3}}
+        self.monitor.startService()
+        self.connect()
+        self.assertEqual(1, len(self.flushLoggedErrors(Error)))
+        self.receive(6)
+
+        self.monitor.backfill = backfill.TimelineBackfill(self.fetchTimeline)
+        self.timeline = [4, 5, 6, 7]
+        self.reconnect()
+        self.assertEqual('3', self.timelineCalls[-1]['since_id'])
+        self.assertEqual([6, 4, 5, 7], [entry.id for entry in self.entries])
+        self.assertEqual(7, self.checkpoint.saved[-1]['stream']['id'])
+
+
+    def test_countBackfill(self):
+        """
+        The count parameter replays statuses, older ones are dropped.
+        """
+        self.monitor.backfill = backfill.CountBackfill(100)
+        self.monitor.args = {'track': 'twisted'}
+        self.monitor.startService()
+        self.connect()
+        self.assertEqual({'track': 'twisted'}, self.api.filterCalls[-1])
+        self.receive(1, 2)
+
+        self.reconnect()
+        self.assertEqual({'track': 'twisted', 'count': '100'},
+                         self.api.filterCalls[-1])
+        self.receive(1, 2, 3)
+        self.assertEqual([1, 2, 3], [entry.id for entry in self.entries])
+        self.assertEqual({'track': 'twisted'}, self.monitor.args)
+
+
+
+class FakeStormAPI(object):
+    """
+    Fake stream endpoint shared by many monitors, for simulating outages.
+
+    Until C{outageUntil}, all connects fail with a network error. After
+    that, at most C{capacity} connects per second succeed, the rest is
+    refused with a L{twitter.RateLimitError}.
+    """
+
+    def __init__(self, clock, outageUntil, capacity):
+        self.clock = clock
+        self.outageUntil = outageUntil
+        self.capacity = capacity
+        self.second = None
+        self.accepted = 0
+        self.rateLimited = 0
+
+
+    def filter(self, delegate, args=None):
+        d = defer.Deferred()
+        now = self.clock.seconds()
+        if now < self.outageUntil:
+            self.clock.callLater(0.1, d.errback, ConnectError())
+            return d
+
+        if int(now) != self.second:
+            self.second = int(now)
+            self.accepted = 0
+        if self.accepted < self.capacity:
+            self.accepted += 1
+            self.clock.callLater(0.1, d.callback, FakeTwitterProtocol())
+        else:
+            self.rateLimited += 1
+            self.clock.callLater(0.1, d.errback,
+                                 twitter.RateLimitError(420,
+                                                        'Enhance Your Calm'))
+        return d
+
+
+
+class TwitterMonitorStormTest(unittest.TestCase):
+    """
+    Simulations of many monitors recovering from an outage together.
+    """
+
+    monitorCount = 50
+    outage = 60
+    capacity = 5
+
+    def simulate(self, backOffs, budget=None):
+        """
+        Run monitors through an outage until they are all connected, for at
+        most two hours.
+
+        @return: The time to recovery after the outage, in seconds, and the
+            number of rate limited connects.
+        """
+        clock = task.Clock()
+        api = FakeStormAPI(clock, self.outage, self.capacity)
+        monitors = []
+        for i in xrange(self.monitorCount):
+            monitor = twitter.TwitterMonitor(api.filter, lambda entry: None,
+                                             reactor=clock)
+            monitor.backOffs = backOffs
+            monitor.reconnectBudget = budget
+            monitor.startService()
+            monitors.append(monitor)
+
+        while (clock.seconds() < 7200 and
+               any(monitor._state != 'connected' for monitor in monitors)):
+            clock.advance(0.25)
+
+        for monitor in monitors:
+            self.assertEqual('connected', monitor._state)
+            monitor.stopService()
+        self.flushLoggedErrors(ConnectError, twitter.RateLimitError)
+        return clock.seconds() - self.outage, api.rateLimited
+
+
+    def test_lockstep(self):
+        """
+        Without jitter, monitors reconnect in lockstep and keep getting
+        rate limited, while jitter and a reconnect budget recover quickly.
+        """
+        rng = random.Random(0).random
+        deterministic = dict(twitter.TwitterMonitor.backOffs)
+        deterministic['ratelimit'] = dict(deterministic['ratelimit'],
+                                          strategy=backoff.Exponential())
+        jittered = dict(twitter.TwitterMonitor.backOffs)
+        jittered['network'] = dict(jittered['network'],
+                                   strategy=backoff.FullJitter(rng))
+        jittered['ratelimit'] = dict(
+                jittered['ratelimit'],
+                strategy=backoff.RetryAfter(backoff.DecorrelatedJitter(rng)))
+        # Stay below the capacity of the server, without bursts.
+        budget = backoff.ReconnectBudget(rate=self.capacity - 1, burst=1)
+
+        lockstepRecovery, lockstepLimited = self.simulate(deterministic)
+        jitterRecovery, jitterLimited = self.simulate(jittered, budget)
+
+        self.assertTrue(lockstepRecovery > 1800, lockstepRecovery)
+        self.assertTrue(jitterRecovery < 30, jitterRecovery)
+        self.assertTrue(lockstepLimited > 100, lockstepLimited)
+        self.assertEqual(0, jitterLimited)
+
+
+
+class ImportTest(unittest.TestCase):
+    """
+    Tests for the side effects of importing L{twittytwister.twitter}.
+    """
+
+    def test_noSideEffects(self):
+        """
+        Importing doesn't configure logging or import optional modules.
+        """
+        script = ("import logging, sys\n"
+                  "import twittytwister.twitter\n"
+                  "print len(logging.getLogger().handlers)\n"
+                  "print logging.getLogger().level\n"
+                  "print 'treq' in sys.modules\n"
+                  "print [name for name in sys.modules\n"
+                  "       if name in %r]\n" % (OPTIONAL_MODULES,))
+        env = dict(os.environ,
+                   PYTHONPATH=os.pathsep.join([PACKAGE_PATH] + sys.path))
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env=env)
+        self.assertEqual(['0', str(logging.WARNING), 'False', '[]'],
+                         output.split())
@@ -0,0 +1,249 @@
+# -*- test-case-name: twittytwister.test.test_threaded -*-
+#
+# Copyright (c) 2010-2013 Ralph Meijer <ralphm@ik.nu>
+# See LICENSE.txt for details
+
+"""
+Delegates that handle entries in a thread pool.
+
+Delegates are called in the reactor thread. A delegate that blocks, like
+one writing to a database with a blocking driver, holds up the reactor,
+including reading the stream, and can make the stream time out.
+L{ThreadedDelegate} calls a blocking handler in a thread pool instead::
+
+    monitor = TwitterMonitor(feed.filter, store, args)
+    monitor.offload(threadpool=pool, ordering=PER_USER)
+
+The order in which entries are handled is one of:
+
+ - L{STRICT}: one entry at a time, in the order received.
+ - L{PER_USER}: one entry at a time per user, in the order received, with
+   entries of different users handled concurrently.
+ - L{UNORDERED}: all entries concurrently, up to the size of the pool.
+
+This reports the number of pending entries (C{threads.pending}), the time
+from receiving an entry to calling the handler (C{threads.queue_wait}), the
+time spent in the handler (C{threads.execution}), failed entries
+(C{threads.errors}), dropped entries (C{threads.dropped}) and pauses of the
+producer (C{threads.pauses}).
+"""
+
+import time
+from collections import deque
+
+from zope.interface import implementer
+
+from twisted.internet import defer, threads
+from twisted.internet.interfaces import IConsumer
+from twisted.python import failure, log
+
+from twittytwister import metrics
+
+STRICT, PER_USER, UNORDERED = 'strict', 'per-user', 'unordered'
+
+def userKey(entry):
+    """
+    Return the ID of the user of an entry, or C{None}.
+    """
+    user = getattr(entry, 'user', None)
+    if user is not None:
+        return getattr(user, 'id', None)
+    return getattr(entry, 'user_id', None)
+
+
+
+@implementer(IConsumer)
+class ThreadedDelegate(object):
+    """
+    Delegate that calls a handler in a thread pool.
+
+    At most C{maxPending} entries are pending, queued or being handled. With
+    a registered producer, like L{twittytwister.twitter.TwitterMonitor}, the
+    producer is paused when that number is reached, and resumed when the
+    number of pending entries has dropped to C{lowWater}. Without a
+    producer, entries received while C{maxPending} entries are pending are
+    dropped.
+
+    Failures of the handler are logged and counted.
+
+    @ivar handler: Called with each entry, in a thread of C{threadpool}.
+
+    @ivar threadpool: The thread pool. Defaults to the reactor's thread
+        pool.
+    @type threadpool: L{twisted.python.threadpool.ThreadPool}
+
+    @ivar ordering: One of L{STRICT}, L{PER_USER} and L{UNORDERED}.
+
+    @ivar key: With L{PER_USER} ordering, called with an entry to get the
+        key of entries that are handled in order. Defaults to L{userKey}.
+
+    @ivar maxPending: Maximum number of pending entries.
+    @type maxPending: C{int}
+
+    @ivar lowWater: Number of pending entries to resume the producer at.
+    @type lowWater: C{int}
+
+    @ivar pending: Number of pending entries.
+    @type pending: C{int}
+
+    @ivar dropped: Number of dropped entries.
+    @type dropped: C{int}
+
+    @cvar timer: Returns the current time for the metrics. This is called
+        from the threads of the pool too, so it is not the reactor's clock.
+    """
+
+    metrics = metrics.NullMetrics()
+    timer = staticmethod(time.time)
+    producer = None
+    paused = False
+
+    def __init__(self, handler, threadpool=None, ordering=STRICT,
+                 maxPending=1000, lowWater=None, key=userKey, metrics=None,
+                 reactor=None):
+        if ordering not in (STRICT, PER_USER, UNORDERED):
+            raise ValueError("Unknown ordering %r" % (ordering,))
+        self.handler = handler
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.threadpool = threadpool
+        self.ordering = ordering
+        self.key = key
+        self.maxPending = maxPending
+        if lowWater is None:
+            lowWater = maxPending // 2
+        self.lowWater = lowWater
+        if metrics is not None:
+            self.metrics = metrics
+        self.pending = 0
+        self.dropped = 0
+        self._queues = {}
+        self._idle = []
+
+
+    def registerProducer(self, producer, streaming):
+        """
+        Register a push producer.
+
+        @raises RuntimeError: When a producer is already registered.
+        @raises ValueError: For pull producers, which are not supported.
+        """
+        if self.producer is not None:
+            raise RuntimeError("Producer %r already registered" %
+                               (self.producer,))
+        if not streaming:
+            raise ValueError("Only push producers are supported")
+        self.producer = producer
+
+
+    def unregisterProducer(self):
+        """
+        Unregister the producer.
+        """
+        if self.paused:
+            self.paused = False
+            self.producer.resumeProducing()
+        self.producer = None
+
+
+    def __call__(self, entry):
+        """
+        Queue an entry to be handled.
+        """
+        if self.pending >= self.maxPending and self.producer is None:
+            self.dropped += 1
+            self.metrics.increment('threads.dropped')
+            return
+
+        self.pending += 1
+        self.metrics.gauge('threads.pending', self.pending)
+        item = (entry, self.timer())
+
+        if self.ordering == UNORDERED:
+            self._dispatch(None, item)
+        else:
+            if self.ordering == STRICT:
+                key = None
+            else:
+                key = self.key(entry)
+            queue = self._queues.get(key)
+            if queue is None:
+                # Nothing pending for this key, handle it right away.
+                self._queues[key] = deque()
+                self._dispatch(key, item)
+            else:
+                queue.append(item)
+
+        if (self.producer is not None and not self.paused and
+            self.pending >= self.maxPending):
+            self.paused = True
+            self.metrics.increment('threads.pauses')
+            self.producer.pauseProducing()
+
+
+    def _dispatch(self, key, item):
+        if self.threadpool is None:
+            self.threadpool = self.reactor.getThreadPool()
+        d = threads.deferToThreadPool(self.reactor, self.threadpool,
+                                      self._call, *item)
+        d.addCallback(self._done, key)
+        d.addErrback(log.err, "Error in threaded delegate")
+
+
+    def _call(self, entry, queued):
+        """
+        Call the handler. This runs in a thread of the pool.
+
+        @return: The time the entry waited, the time spent in the handler,
+            and the failure of the handler, if any.
+        """
+        started = self.timer()
+        try:
+            self.handler(entry)
+        except:
+            reason = failure.Failure()
+        else:
+            reason = None
+        return started - queued, self.timer() - started, reason
+
+
+    def _done(self, result, key):
+        wait, execution, reason = result
+        self.metrics.timing('threads.queue_wait', wait)
+        self.metrics.timing('threads.execution', execution)
+        if reason is not None:
+            self.metrics.increment('threads.errors')
+            log.err(reason, "Error in threaded delegate")
+
+        self.pending -= 1
+        self.metrics.gauge('threads.pending', self.pending)
+
+        if self.ordering != UNORDERED:
+            queue = self._queues[key]
+            if queue:
+                self._dispatch(key, queue.popleft())
+            else:
+                del self._queues[key]
+
+        if self.paused and self.pending <= self.lowWater:
+            self.paused = False
+            self.producer.resumeProducing()
+
+        if not self.pending:
+            idle, self._idle = self._idle, []
+            for d in idle:
+                d.callback(None)
+
+
+    def drain(self):
+        """
+        Wait for all pending entries to be handled.
+
+        @rtype: L{defer.Deferred}
+        """
+        if not self.pending:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._idle.append(d)
+        return d
@@ -11,30 +11,31 @@ Twisted Twitter interface.
 
 import base64
 import logging
-import mimetypes
-import mimetools
 import urllib
 import warnings
 
 from oauth import oauth
+from zope.interface import implementer
 
 from twisted.application import service
 from twisted.internet import defer, reactor, endpoints
 from twisted.internet import error as ierror
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import failure, log
 from twisted.web import client, error, http_headers
 
-import treq
-
-from twittytwister import platform, streaming, txml
+from twittytwister import backoff, compression, latency, metrics, platform
+from twittytwister import streaming, txml
 
 SIGNATURE_METHOD = oauth.OAuthSignatureMethod_HMAC_SHA1()
 
 BASE_URL="https://api.twitter.com/1.1"
 SEARCH_URL="http://search.twitter.com/search.atom"
+UPLOAD_URL="https://upload.twitter.com/1.1/media/upload.json"
+STREAM_URL="https://stream.twitter.com/1.1"
+USERSTREAM_URL="https://userstream.twitter.com/1.1"
+SITESTREAM_URL="https://sitestream.twitter.com/1.1"
 
-logging.basicConfig()
-logging.getLogger().setLevel(logging.DEBUG)
 logger = logging.getLogger('twittytwister.twitter')
 
 
@@ -98,12 +99,14 @@ def __downloadPage(factory, *args, **kwargs):
                            downloader)
     return downloader
 
-def downloadPage(url, file, timeout=0, **kwargs):
-    c = __downloadPage(client.HTTPDownloader, url, file, **kwargs)
+def downloadPage(url, file, timeout=0, compressionStats=None, **kwargs):
+    c = __downloadPage(compression.DecompressingDownloader, url, file,
+                       **kwargs)
     # HTTPDownloader doesn't have the 'timeout' keyword parameter on
     # Twisted 8.2.0, so set it directly:
     if timeout:
         c.timeout = timeout
+    c.compressionStats = compressionStats
     return c
 
 def getPage(url, *args, **kwargs):
@@ -112,12 +115,13 @@ def getPage(url, *args, **kwargs):
 class Twitter(object):
 
     agent="twitty twister"
+    uploadAgent = None
 
     def __init__(self, user=None, passwd=None,
                  base_url=BASE_URL, search_url=SEARCH_URL,
                  consumer=None, token=None,
                  signature_method=SIGNATURE_METHOD,
-                 client_info = None, timeout=0):
+                 client_info = None, timeout=0, upload_url=UPLOAD_URL):
         """
         @param consumer: The OAuth consumer.
         @type consumer: L{oauth.ouath.OAuthConsumer}
@@ -128,9 +132,11 @@ class Twitter(object):
 
         self.base_url = base_url
         self.search_url = search_url
+        self.upload_url = upload_url
 
         self.client_info = None
         self.timeout = timeout
+        self.compressionStats = compression.CompressionStats()
 
         # rate-limit info:
         self.rate_limit_limit = None
@@ -155,7 +161,9 @@ class Twitter(object):
             self.client_info = client_info
 
 
-    def _makeAuthHeader(self, method, url, parameters={}, headers={}):
+    def _makeAuthHeader(self, method, url, parameters=None, headers=None):
+        if headers is None:
+            headers = {}
         oauth_request = oauth.OAuthRequest.from_consumer_and_token(self.consumer,
             token=self.token, http_method=method, http_url=url, parameters=parameters)
         oauth_request.sign_request(self.signature_method, self.consumer, self.token)
@@ -172,33 +180,6 @@ class Twitter(object):
                 urllib.quote(v.encode("utf-8"))))
         return '&'.join(rv)
 
-    def __encodeMultipart(self, fields, files):
-        """
-        fields is a sequence of (name, value) elements for regular form fields.
-        files is a sequence of (name, filename, value) elements for data to be uploaded as files
-        Return (content_type, body) ready for httplib.HTTP instance
-        """
-        boundary = mimetools.choose_boundary()
-        crlf = '\r\n'
-
-        l = []
-        for k, v in fields:
-            l.append('--' + boundary)
-            l.append('Content-Disposition: form-data; name="%s"' % k)
-            l.append('')
-            l.append(v)
-        for (k, f, v) in files:
-            l.append('--' + boundary)
-            l.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (k, f))
-            l.append('Content-Type: %s' % self.__getContentType(f))
-            l.append('')
-            l.append(v)
-        l.append('--' + boundary + '--')
-        l.append('')
-        body = crlf.join(l)
-
-        return boundary, body
-
     def gotHeaders(self, headers):
         logger.debug("hdrs: %r", headers)
         if headers is None:
@@ -221,35 +202,88 @@ class Twitter(object):
         logger.debug('hdrs end')
 
 
-    def __getContentType(self, filename):
-        return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-
     def __clientDefer(self, c):
         """Return a deferred for a HTTP client, after handling incoming headers"""
         def handle_headers(r):
             self.gotHeaders(c.response_headers)
             return r
 
-        return c.deferred.addBoth(handle_headers)
+        def handle_error(f):
+            f.trap(error.Error)
+            if f.value.status in ('420', '429'):
+                retryAfter = (c.response_headers or {}).get('retry-after')
+                raise RateLimitError(f.value.status, f.value.message,
+                                     f.value.response,
+                                     _retryAfter(retryAfter))
+            return f
+
+        return c.deferred.addBoth(handle_headers).addErrback(handle_error)
+
+    def __decompress(self, body, c):
+        """Decompress a response body received in full, if needed"""
+        return compression.decompressBody(body, c.response_headers,
+                                          self.compressionStats)
+
+    def _getUploadAgent(self):
+        """Return the agent for streaming uploads, creating it on first use"""
+        if self.uploadAgent is None:
+            self.uploadAgent = compression.decodingAgent(
+                client.Agent(reactor, connectTimeout=self.timeout or None),
+                self.compressionStats)
+        return self.uploadAgent
+
+    def _requestBody(self, method, url, producer, headers=None, params=None):
+        """Send a request with a streaming body, return a deferred body.
+
+        The params are signed and added to the URL as query arguments.
+        The response headers are passed to L{gotHeaders}. Error responses
+        result in a L{twisted.web.error.Error}, like with L{getPage}, or a
+        L{RateLimitError} when rate limited.
+        """
+        headers = dict(headers or {})
+        headers.update(self._makeAuthHeader(method, url, params or {}))
+        if params:
+            url += '?' + self._urlencode(params)
+        headers['User-Agent'] = Twitter.agent
+        if self.client_info != None:
+            headers.update(self.client_info.get_headers())
+        rawHeaders = http_headers.Headers(dict([(name, [value])
+                                                for name, value
+                                                in headers.iteritems()]))
+
+        def cb(response):
+            self.gotHeaders(dict([(name.lower(), values)
+                                  for name, values
+                                  in response.headers.getAllRawHeaders()]))
+            d = client.readBody(response)
+            if response.code in (420, 429):
+                retryAfter = response.headers.getRawHeaders('Retry-After')
+                def fail(body):
+                    raise RateLimitError(str(response.code), response.phrase,
+                                         body, _retryAfter(retryAfter))
+                d.addCallback(fail)
+            elif response.code >= 400:
+                def fail(body):
+                    raise error.Error(str(response.code), response.phrase,
+                                      body)
+                d.addCallback(fail)
+            return d
+
+        d = self._getUploadAgent().request(method, url, rawHeaders, producer)
+        d.addCallback(cb)
+        return d
 
     def __postMultipart(self, path, fields=(), files=()):
+        from twittytwister import multipart
         url = self.base_url + path
-
-        (boundary, body) = self.__encodeMultipart(fields, files)
-        headers = {'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
-            'Content-Length': str(len(body))
-            }
-
-        self._makeAuthHeader('POST', url, headers=headers)
-
-        c = getPage(url, method='POST',
-            agent=self.agent,
-            postdata=body, headers=headers, timeout=self.timeout)
-        return self.__clientDefer(c)
+        producer = multipart.MultipartProducer(fields, files)
+        return self._requestBody('POST', url, producer,
+                                 {'Content-Type': producer.contentType})
 
     #TODO: deprecate __post()?
     def __post(self, path, args={}):
-        headers = {'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8'}
+        headers = {'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8',
+                   'Accept-Encoding': 'gzip'}
 
         url = self.base_url + path
 
@@ -262,18 +296,19 @@ class Twitter(object):
         c = getPage(url, method='POST',
             agent=self.agent,
             postdata=self._urlencode(args), headers=headers, timeout=self.timeout)
-        return self.__clientDefer(c)
+        return self.__clientDefer(c).addCallback(self.__decompress, c)
 
     def __doDownloadPage(self, *args, **kwargs):
         """Works like client.downloadPage(), but handle incoming headers
         """
         logger.debug("download page: %r, %r", args, kwargs)
 
+        kwargs['compressionStats'] = self.compressionStats
         return self.__clientDefer(downloadPage(*args, **kwargs))
 
     def __postPage(self, path, parser, args={}):
         url = self.base_url + path
-        headers = self.makeAuthHeader('POST', url, args)
+        headers = self._makeAuthHeader('POST', url, args)
 
         if self.client_info != None:
             headers.update(self.client_info.get_headers())
@@ -286,7 +321,7 @@ class Twitter(object):
     def __downloadPage(self, path, parser, params=None):
         url = self.base_url + path
 
-        headers = self.makeAuthHeader('GET', url, params)
+        headers = self._makeAuthHeader('GET', url, params)
         if params:
             url += '?' + self._urlencode(params)
 
@@ -499,7 +534,9 @@ class Twitter(object):
         if screen_name is not None:
             args['screen_name'] = screen_name
 
-        url = BASE_URL + '/users/show.json'
+        import treq
+
+        url = self.base_url + '/users/show.json'
 
         authHeaders = self._makeAuthHeader("GET", url, args)
         rawHeaders = dict([(name, [value])
@@ -542,13 +579,63 @@ class Twitter(object):
 
     def update_profile_image(self, filename, image):
         """Update the profile image of an authenticated user.
-        The image parameter must be raw data.
+        The image parameter must be raw data or a file object, which is
+        streamed in chunks.
 
         Returns no useful data."""
 
         return self.__postMultipart('/account/update_profile_image.xml',
                                     files=(('image', filename, image),))
 
+    def upload_media(self, media, media_type, media_category=None,
+                     segment_size=None, concurrency=None):
+        """Upload media in segments, using the chunked upload API.
+
+        The media can be raw data or a file object, which is read in
+        segments that are uploaded in parallel. Returns a deferred that
+        fires with the media ID, to be passed to L{update} in the
+        C{media_ids} parameter. See L{media.ChunkedUpload}."""
+        from twittytwister import media as _media
+
+        if isinstance(media, basestring):
+            import StringIO
+            media = StringIO.StringIO(media)
+
+        upload = _media.ChunkedUpload(self, media, media_type, media_category,
+                                      segment_size, concurrency)
+        return upload.run()
+
+    def bulk(self, operations, concurrency=4, resultDelegate=None,
+             failureDelegate=None, progressDelegate=None):
+        """
+        Run many operations with bounded concurrency.
+
+        Operations are retried on transient errors, and wait for the rate
+        limit window to be reset when it is exhausted. For example, to
+        follow a list of users::
+
+            operations = ((api.follow_user, (user, None))
+                          for user in users)
+            d = api.bulk(operations, concurrency=8)
+
+        See L{twittytwister.bulk.BulkExecutor} for details.
+
+        @param operations: Iterable of operations. Each operation is a
+            tuple of C{(method, args, kwargs)}, with C{kwargs} being
+            optional, or a callable returning a deferred.
+
+        @return: Deferred that fires with the
+            L{twittytwister.bulk.BulkExecutor}, holding the final progress
+            metrics, when all operations have finished.
+        """
+        from twittytwister import bulk
+        executor = bulk.BulkExecutor(self, concurrency,
+                                     resultDelegate=resultDelegate,
+                                     failureDelegate=failureDelegate,
+                                     progressDelegate=progressDelegate)
+        return executor.run(operations)
+
+
 
 
 class TwitterFeed(Twitter):
@@ -568,12 +655,30 @@ class TwitterFeed(Twitter):
 
     @cvar protocol: The protocol class to instantiate and deliver the response
         body to. Defaults to L{streaming.TwitterStream}.
+
+    @ivar metrics: Metrics sink passed on to the stream protocols, if set.
+        See L{twittytwister.metrics}.
+
+    @ivar watchdog: Watchdog passed on to the stream protocols, if set, to
+        handle their timeouts. See L{streaming.Watchdog}.
+
+    @ivar stream_url: Base URL of the public streams, taken from the
+        C{stream_url} keyword argument. Defaults to L{STREAM_URL}.
+    @ivar userstream_url: Base URL of the user stream, taken from the
+        C{userstream_url} keyword argument. Defaults to L{USERSTREAM_URL}.
+    @ivar sitestream_url: Base URL of site streams, taken from the
+        C{sitestream_url} keyword argument. Defaults to L{SITESTREAM_URL}.
     """
 
     protocol = streaming.TwitterStream
+    metrics = None
+    watchdog = None
 
     def __init__(self, *args, **kwargs):
         self.proxy_username = None
+        self.stream_url = kwargs.pop('stream_url', STREAM_URL)
+        self.userstream_url = kwargs.pop('userstream_url', USERSTREAM_URL)
+        self.sitestream_url = kwargs.pop('sitestream_url', SITESTREAM_URL)
         if "proxy_host" in kwargs:
             port = 80
             if "proxy_port" in kwargs:
@@ -587,20 +692,32 @@ class TwitterFeed(Twitter):
                 del kwargs["proxy_password"]
 
             endpoint = endpoints.TCP4ClientEndpoint(reactor, kwargs["proxy_host"], port)
-            self.agent = client.ProxyAgent(endpoint)
+            agent = client.ProxyAgent(endpoint)
             del kwargs["proxy_host"]
         else:
-            self.agent = client.Agent(reactor)
+            agent = client.Agent(reactor)
 
         Twitter.__init__(self, *args, **kwargs)
 
+        # Request gzip compressed streams, decompressed as data arrives.
+        self.agent = compression.decodingAgent(agent, self.compressionStats)
+
 
     def _rtfeed(self, url, delegate, args):
         def cb(response):
             if response.code == 200:
-                protocol = self.protocol(delegate)
+                if self.watchdog is not None:
+                    protocol = self.protocol(delegate, watchdog=self.watchdog)
+                else:
+                    protocol = self.protocol(delegate)
+                if self.metrics is not None:
+                    protocol.metrics = self.metrics
                 response.deliverBody(protocol)
                 return protocol
+            elif response.code in (420, 429):
+                retryAfter = response.headers.getRawHeaders('Retry-After')
+                raise RateLimitError(response.code, response.phrase,
+                                     retryAfter=_retryAfter(retryAfter))
             else:
                 raise error.Error(response.code, response.phrase)
 
@@ -612,7 +729,7 @@ class TwitterFeed(Twitter):
                            for name, value
                            in authHeaders.iteritems()])
         headers = http_headers.Headers(rawHeaders)
-        print 'Fetching', url
+        logger.debug("fetching stream: %s", url)
         d = self.agent.request('GET', url, headers, None)
         d.addCallback(cb)
         return d
@@ -633,7 +750,7 @@ class TwitterFeed(Twitter):
         The actual access level determines the portion of the firehose.
         """
         return self._rtfeed(
-            'https://stream.twitter.com/1.1/statuses/sample.json',
+            self.stream_url + '/statuses/sample.json',
             delegate,
             args)
 
@@ -663,7 +780,7 @@ class TwitterFeed(Twitter):
         Returns all public statuses.
         """
         return self._rtfeed(
-            'https://stream.twitter.com/1.1/statuses/firehose.json',
+            self.stream_url + '/statuses/firehose.json',
             delegate,
             args)
 
@@ -673,11 +790,62 @@ class TwitterFeed(Twitter):
         Returns public statuses that match one or more filter predicates.
         """
         return self._rtfeed(
-            'https://stream.twitter.com/1.1/statuses/filter.json',
+            self.stream_url + '/statuses/filter.json',
             delegate,
             args)
 
 
+    def _rtqueue(self, method, args, size):
+        """
+        Open a stream with a L{streaming.StreamQueue} as delegate.
+        """
+        queue = streaming.StreamQueue(size)
+        d = method(queue.put, args)
+        d.addCallback(queue.setProtocol)
+        return d
+
+
+    def sample_stream(self, args=None, size=1000):
+        """
+        Returns a queue with a random sample of all public statuses.
+
+        This is the pull based equivalent of L{sample}.
+
+        @param size: Maximum number of queued statuses before pausing the
+            stream.
+        @type size: C{int}
+
+        @return: Deferred that fires with a L{streaming.StreamQueue} when
+            the response has been received.
+        """
+        return self._rtqueue(self.sample, args, size)
+
+
+    def filter_stream(self, args=None, size=1000):
+        """
+        Returns a queue with public statuses that match filter predicates.
+
+        This is the pull based equivalent of L{filter}::
+
+            @defer.inlineCallbacks
+            def track(feed):
+                queue = yield feed.filter_stream({'track': 'twisted'})
+                while True:
+                    status = yield queue.get()
+                    if status is None:
+                        break
+                    print status.text
+
+        @param size: Maximum number of queued statuses before pausing the
+            stream.
+        @type size: C{int}
+
+        @return: Deferred that fires with a L{streaming.StreamQueue} when
+            the response has been received.
+        """
+        return self._rtqueue(self.filter, args, size)
+
+
     def follow(self, delegate, follow):
         """
         Returns public statuses from or in reply to a set of users.
@@ -736,7 +904,7 @@ class TwitterFeed(Twitter):
         location.
         """
         return self._rtfeed(
-            'https://userstream.twitter.com/1.1/user.json',
+            self.userstream_url + '/user.json',
             delegate,
             args)
 
@@ -755,7 +923,7 @@ class TwitterFeed(Twitter):
         follow.
         """
         return self._rtfeed(
-            'https://sitestream.twitter.com/1.1/site.json',
+            self.sitestream_url + '/site.json',
             delegate,
             args)
 
@@ -782,6 +950,32 @@ class NoConsumerError(Error):
 
 
 
+class RateLimitError(error.Error):
+    """
+    A request was refused because of rate limiting (HTTP 420 or 429).
+
+    @ivar retryAfter: Seconds to wait before retrying, from the
+        C{Retry-After} header, or C{None} if there was none.
+    @type retryAfter: C{float}
+    """
+
+    def __init__(self, code, message=None, response=None, retryAfter=None):
+        error.Error.__init__(self, code, message, response)
+        self.retryAfter = retryAfter
+
+
+
+def _retryAfter(values):
+    """
+    Return the delay of the raw values of a C{Retry-After} header, if any.
+    """
+    if values:
+        return backoff.parseRetryAfter(values[0])
+    return None
+
+
+
+@implementer(IPushProducer)
 class TwitterMonitor(service.Service):
     """
     Reconnecting Twitter monitor service.
@@ -791,6 +985,19 @@ class TwitterMonitor(service.Service):
     the API parameters provided in L{args} have all required parameters before
     starting the service.
 
+    The monitor is a push producer of entries, so that a consumer can apply
+    backpressure. While paused, the stream is paused, also across
+    reconnects, which pushes back on Twitter through TCP flow control. To
+    write entries to a transport, register the monitor as its producer::
+
+        monitor = TwitterMonitor(feed.filter,
+                                 lambda entry: transport.write(encode(entry)),
+                                 args)
+        transport.registerProducer(monitor, True)
+
+    For consumers that return a deferred per entry, like message queue
+    clients, see L{twittytwister.flow.Backpressure}.
+
     @cvar noisy: Whether or not to log informational messages about
         reconnects.
     type noisy: C{bool}
@@ -802,13 +1009,46 @@ class TwitterMonitor(service.Service):
 
     @ivar delegate: The consumer of incoming Twitter entries.
 
+    @ivar hub: The hub passing entries to the subscribers added with
+        L{subscribe}, if any. It is also the L{delegate}.
+    @type hub: L{twittytwister.hub.SubscriptionHub}
+
     @ivar protocol: Current protocol instance parsing incoming Twitter
         entries.
     @type protocol: L{TwitterStream}
 
-    @ivar _delay: Current delay, in seconds.
+    @ivar paused: Whether producing entries is paused by the consumer.
+    @type paused: C{bool}
+
+    @ivar metrics: Metrics sink for state transitions, time spent in each
+        state, reconnects, errors and received entries. See
+        L{twittytwister.metrics}.
+
+    @ivar latency: Latency tracker that is passed on to the stream protocol
+        of each connection, optional.
+    @type latency: L{twittytwister.latency.LatencyTracker}
+
+    @ivar checkpoint: Checkpoint to persist the ID and creation time of the
+        last delivered status, optional. It is saved at most every
+        L{checkpointInterval} seconds, under L{checkpointKey}, and when the
+        connection is lost or the service stops. See
+        L{twittytwister.checkpoint.JSONFileCheckpoint}.
+
+    @ivar backfill: Strategy to fetch the statuses missed since the last
+        delivered status, when (re)connecting, optional. Backfilled statuses
+        are merged with the live ones, dropping duplicates. See
+        L{twittytwister.backfill}.
+
+    @ivar reconnectBudget: Bound on the rate of reconnects, optional. Set
+        this on the class to share it between all monitors in a process.
+    @type reconnectBudget: L{twittytwister.backoff.ReconnectBudget}
+
+    @ivar _delay: Current back-off delay, in seconds.
     @type _delay: C{float}
 
+    @ivar _attempt: Number of the current attempt in the error state.
+    @type _attempt: C{int}
+
     @ivar _state: Current state.
 
     @ivar _errorState: Current error state. One of C{None}, C{'http'},
@@ -822,16 +1062,45 @@ class TwitterMonitor(service.Service):
         keys C{'initial'}, C{'max'} and {'factor'} to represent the initial
         and maximum backoff delay (both in seconds), and the multiplication
         factor on each attempt, respectively. The key C{'errorTypes'} key
-        holds a set of exceptions to match failures against.
+        holds a set of exceptions to match failures against, where the
+        most specific match wins. The optional key C{'strategy'} holds the
+        strategy that computes the delays from these settings, see
+        L{twittytwister.backoff}. It defaults to exponential back-off.
     @type backOffs: C{dict}
 
     """
     noisy = False
 
     protocol = None
+    hub = None
+    paused = False
+    _pausedSince = None
+
+    metrics = metrics.NullMetrics()
+    latency = None
+
+    reconnectBudget = None
+
+    checkpoint = None
+    checkpointKey = 'stream'
+    checkpointInterval = 5
+    backfill = None
+    dedupSize = 10000
+
+    _lastID = None
+    _lastEntry = None
+    _checkpointState = None
+    _checkpointSaved = None
+    _checkpointDirty = False
+    _recentIDs = None
+    _backfillWindow = None
+    _pendingID = None
+    _pendingEntry = None
 
     _delay = None
+    _attempt = 0
     _state = None
+    _stateSince = None
     _errorState = None
     _reconnectDelayedCall = None
 
@@ -842,6 +1111,14 @@ class TwitterMonitor(service.Service):
                 'max': float('inf'), # No limit,
                 'factor': 1, # No increase
                 },
+            # Back-off settings for rate limiting, honouring Retry-After.
+            'ratelimit': {
+                'errorTypes': (RateLimitError,),
+                'initial': 60,
+                'max': 960,
+                'factor': 2,
+                'strategy': backoff.RetryAfter(backoff.DecorrelatedJitter()),
+                },
             # Back-off settings for HTTP errors
             'http': {
                 'errorTypes': (error.Error,),
@@ -868,7 +1145,8 @@ class TwitterMonitor(service.Service):
                 },
             }
 
-    def __init__(self, api, delegate, args=None, reactor=None):
+    def __init__(self, api, delegate, args=None, reactor=None, metrics=None,
+                 latency=None, checkpoint=None, backfill=None):
         """
         Initialize the monitor.
 
@@ -883,6 +1161,15 @@ class TwitterMonitor(service.Service):
 
         @param args: Initial arguments to the API.
         @type args: C{dict}
+
+        @param metrics: Metrics sink, optional.
+
+        @param latency: Latency tracker, optional.
+        @type latency: L{twittytwister.latency.LatencyTracker}
+
+        @param checkpoint: Checkpoint of the last delivered status, optional.
+
+        @param backfill: Strategy to backfill missed statuses, optional.
         """
         self.api = api
         self.delegate = delegate
@@ -890,7 +1177,16 @@ class TwitterMonitor(service.Service):
         if reactor is None:
             from twisted.internet import reactor
         self.reactor = reactor
+        if metrics is not None:
+            self.metrics = metrics
+        if latency is not None:
+            self.latency = latency
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+        if backfill is not None:
+            self.backfill = backfill
         self._state = 'stopped'
+        self._stateSince = self.reactor.seconds()
 
 
     def startService(self):
@@ -901,6 +1197,13 @@ class TwitterMonitor(service.Service):
         L{connect} to attempt an initial conection.
         """
         service.Service.startService(self)
+
+        if self.checkpoint is not None and self._checkpointState is None:
+            self._checkpointState = self.checkpoint.load()
+            state = self._checkpointState.get(self.checkpointKey) or {}
+            if self._lastID is None and state.get('id') is not None:
+                self._lastID = int(state['id'])
+
         self._toState('idle')
 
         try:
@@ -982,6 +1285,47 @@ class TwitterMonitor(service.Service):
             self.protocol.transport.stopProducing()
 
 
+    def pauseProducing(self):
+        """
+        Pause producing entries, because the consumer is overloaded.
+
+        The current stream is paused, and new connections start paused
+        until L{resumeProducing} is called.
+        """
+        if self.paused:
+            return
+        self.paused = True
+        self._pausedSince = self.reactor.seconds()
+        self.metrics.increment('monitor.pauses')
+        self.metrics.gauge('monitor.paused', 1)
+        if self.protocol is not None:
+            self.protocol.pauseProducing()
+
+
+    def resumeProducing(self):
+        """
+        Resume producing entries.
+        """
+        if not self.paused:
+            return
+        self.paused = False
+        self.metrics.timing('monitor.paused_time',
+                            self.reactor.seconds() - self._pausedSince)
+        self.metrics.gauge('monitor.paused', 0)
+        if self.protocol is not None:
+            self.protocol.resumeProducing()
+
+
+    def stopProducing(self):
+        """
+        Stop producing entries, because the consumer went away.
+
+        This stops the service.
+        """
+        if self.running:
+            self.stopService()
+
+
     def makeConnection(self, protocol):
         """
         Called when the connection has been established.
@@ -1012,17 +1356,213 @@ class TwitterMonitor(service.Service):
                 self._toState('disconnected', reason)
 
         self.protocol = protocol
+        if self.latency is not None:
+            protocol.latency = self.latency
+        if self.paused:
+            protocol.pauseProducing()
         d = protocol.deferred
         d.addBoth(cb)
 
 
-    def _reconnect(self, errorState):
+    def subscribe(self, handler, **kwargs):
+        """
+        Add a subscriber to the entries of this monitor.
+
+        Subscribers have their own queue, and don't hold up each other. On
+        the first subscription, a L{twittytwister.hub.SubscriptionHub}
+        becomes the delegate, and a connection is started if the service
+        is running.
+
+        @param handler: Called with each entry.
+
+        @param kwargs: Further arguments to
+            L{twittytwister.hub.SubscriptionHub.subscribe}.
+
+        @raises Error: When a delegate other than the hub is set.
+
+        @rtype: L{twittytwister.hub.Subscription}
+        """
+        if self.hub is None:
+            if self.delegate is not None:
+                raise Error("This monitor already has a delegate.")
+            from twittytwister import hub
+            self.hub = hub.SubscriptionHub(self.metrics, self.reactor)
+        elif self.delegate is not self.hub:
+            raise Error("This monitor already has a delegate.")
+
+        subscription = self.hub.subscribe(handler, **kwargs)
+        if self.delegate is None:
+            self.delegate = self.hub
+            if self._state == 'idle':
+                self.connect()
+        return subscription
+
+
+    def unsubscribe(self, subscription):
+        """
+        Remove a subscriber added with L{subscribe}.
+        """
+        self.hub.unsubscribe(subscription)
+
+
+    def offload(self, **kwargs):
+        """
+        Call the delegate in a thread pool, for delegates that block.
+
+        The delegate is wrapped in a L{twittytwister.threaded.ThreadedDelegate}
+        that has this monitor as its producer, so that the stream is paused
+        while too many entries are pending. Entries count as delivered, for
+        the L{checkpoint}, when they have been queued.
+
+        @param kwargs: Further arguments to
+            L{twittytwister.threaded.ThreadedDelegate}, like C{threadpool},
+            C{ordering} and C{maxPending}.
+
+        @rtype: L{twittytwister.threaded.ThreadedDelegate}
+        """
+        from twittytwister import threaded
+        delegate = threaded.ThreadedDelegate(self.delegate,
+                                             metrics=self.metrics,
+                                             reactor=self.reactor, **kwargs)
+        delegate.registerProducer(self, True)
+        self.delegate = delegate
+        return delegate
+
+
+    def latencyPercentiles(self, percentiles=(50, 90, 99)):
+        """
+        Return rolling percentiles of the latency of received entries.
+
+        @return: Dictionary of stage to a dictionary of percentile to seconds,
+            see L{twittytwister.latency.LatencyTracker.percentiles}. Empty if
+            there is no latency tracker.
+        @rtype: C{dict}
+        """
+        if self.latency is None:
+            return {}
+        return self.latency.percentiles(percentiles)
+
+
+    def _deliver(self, entry, itemID):
+        """
+        Pass an entry to the delegate, unless it is a duplicate.
+
+        @param itemID: The ID of the entry, or C{None}.
+        """
+        if itemID is not None and self._recentIDs is not None:
+            if not self._recentIDs.add(itemID):
+                self.metrics.increment('monitor.duplicates')
+                return
+
+        if self.delegate:
+            try:
+                self.delegate(entry)
+            except:
+                log.err()
+
+        if itemID is not None and (self._lastID is None or
+                                   itemID > self._lastID):
+            if self._backfillWindow is not None:
+                # Statuses older than this one may still be backfilled, so
+                # don't move the checkpoint past them until it is done.
+                if self._pendingID is None or itemID > self._pendingID:
+                    self._pendingID = itemID
+                    self._pendingEntry = entry
+            else:
+                self._advance(itemID, entry)
+
+
+    def _advance(self, itemID, entry):
+        """
+        Record the last delivered status, for the checkpoint.
+        """
+        self._lastID = itemID
+        self._lastEntry = entry
+        self._checkpointDirty = True
+        self._saveCheckpoint()
+
+
+    def _saveCheckpoint(self, force=False):
+        """
+        Save the checkpoint, if changed and not saved too recently.
+        """
+        if self.checkpoint is None or not self._checkpointDirty:
+            return
+
+        now = self.reactor.seconds()
+        if (not force and self._checkpointSaved is not None and
+            now - self._checkpointSaved < self.checkpointInterval):
+            return
+
+        timestamp = None
+        raw = getattr(self._lastEntry, 'raw', None)
+        if raw is not None:
+            try:
+                timestamp = latency.messageTime(raw)
+            except ValueError:
+                pass
+
+        if self._checkpointState is None:
+            self._checkpointState = {}
+        self._checkpointState[self.checkpointKey] = {'id': self._lastID,
+                                                     'timestamp': timestamp}
+        self._checkpointSaved = now
+        self._checkpointDirty = False
+        try:
+            self.checkpoint.save(self._checkpointState)
+        except:
+            log.err(None, "Saving checkpoint failed")
+
+
+    def _backfill(self, lastID):
+        """
+        Fetch and deliver the statuses missed since C{lastID}.
+
+        Until the backfill has succeeded, the last delivered status, and
+        with it the checkpoint, stays at C{lastID}, so that the missed
+        statuses are fetched again after a restart or reconnect.
+        """
+        from twittytwister import backfill
+
+        window = self._backfillWindow = object()
+
+        def deliver(entry):
+            if self._state == 'stopped':
+                return
+            itemID = backfill.entryID(entry)
+            if itemID is not None and itemID <= lastID:
+                return
+            self.metrics.increment('monitor.backfilled')
+            self._deliver(entry, itemID)
+
+        def done(_):
+            if self._backfillWindow is not window:
+                # Superseded by the backfill of a later reconnect.
+                return
+            self._backfillWindow = None
+            itemID, entry = self._pendingID, self._pendingEntry
+            self._pendingID = self._pendingEntry = None
+            if itemID is not None and (self._lastID is None or
+                                       itemID > self._lastID):
+                self._advance(itemID, entry)
+
+        d = defer.maybeDeferred(self.backfill.fetch, lastID, deliver)
+        d.addCallback(done)
+        d.addErrback(log.err, "Backfill failed")
+        return d
+
+
+    _exponential = backoff.Exponential()
+
+    def _reconnect(self, errorState, reason=None):
         """
         Attempt to reconnect.
 
-        If the current back-off delay is 0, L{connect} is called. Otherwise,
-        it will cause a transition to the C{'waiting'} state, ultimately
-        causing a call to L{connect} when the delay expires.
+        The delay is computed by the back-off strategy of the error state,
+        and postponed further if the L{reconnectBudget} requires so. If the
+        delay is 0, L{connect} is called. Otherwise, it will cause a
+        transition to the C{'waiting'} state, ultimately causing a call to
+        L{connect} when the delay expires.
         """
         def connect():
             if self.noisy:
@@ -1030,17 +1570,30 @@ class TwitterMonitor(service.Service):
             self.connect()
 
         backOff = self.backOffs[errorState]
+        strategy = backOff.get('strategy', self._exponential)
 
         if self._errorState != errorState or self._delay is None:
             self._errorState = errorState
-            self._delay = backOff['initial']
+            self._attempt = 0
+            previous = None
         else:
-            self._delay = min(backOff['max'], self._delay * backOff['factor'])
+            self._attempt += 1
+            previous = self._delay
+        self._delay = strategy.nextDelay(backOff, self._attempt, previous,
+                                         reason)
+
+        delay = self._delay
+        if self.reconnectBudget is not None:
+            delay = self.reconnectBudget.reserve(self.reactor.seconds(),
+                                                 delay)
+
+        self.metrics.increment('monitor.reconnects')
+        self.metrics.gauge('monitor.reconnect_delay', delay)
 
-        if self._delay == 0:
+        if delay == 0:
             connect()
         else:
-            self._reconnectDelayedCall = self.reactor.callLater(self._delay,
+            self._reconnectDelayedCall = self.reactor.callLater(delay,
                                                                 connect)
             self._toState('waiting')
 
@@ -1056,7 +1609,16 @@ class TwitterMonitor(service.Service):
         except AttributeError:
             raise ValueError("No such state %r" % state)
 
-        log.msg("%s: to state %r" % (self.__class__.__name__, state))
+        log.msg(format="%(monitor)s: to state %(state)r",
+                monitor=self.__class__.__name__, state=state)
+
+        now = self.reactor.seconds()
+        self.metrics.timing('monitor.state_time.%s' % self._state,
+                            now - self._stateSince)
+        self.metrics.increment('monitor.transitions.%s' % state)
+        self.metrics.gauge('monitor.connected', int(state == 'connected'))
+        self._stateSince = now
+
         self._state = state
         method(*args, **kwargs)
 
@@ -1073,6 +1635,7 @@ class TwitterMonitor(service.Service):
             self._reconnectDelayedCall.cancel()
             self._reconnectDelayedCall = None
         self.loseConnection()
+        self._saveCheckpoint(force=True)
 
 
     def _state_idle(self):
@@ -1104,7 +1667,21 @@ class TwitterMonitor(service.Service):
         by transitioning to C{'disconnecting'}.
 
         Errors will cause a transition to the C{'error'} state.
+
+        With a L{backfill} strategy and a last delivered status, the
+        statuses missed since then are backfilled once connected.
         """
+        from twittytwister import backfill
+
+        args = self.args
+        lastID = None
+        if self.backfill is not None:
+            if self._recentIDs is None:
+                self._recentIDs = backfill.RecentIDs(self.dedupSize)
+            lastID = self._lastID
+            if lastID is not None:
+                args = dict(args or {})
+                args.update(self.backfill.args(lastID))
 
         def responseReceived(protocol):
             self.makeConnection(protocol)
@@ -1112,20 +1689,25 @@ class TwitterMonitor(service.Service):
                 self._toState('disconnecting')
             else:
                 self._toState('connected')
+                if lastID is not None:
+                    self._backfill(lastID)
 
         def trapError(failure):
             self._toState('error', failure)
 
         def onEntry(entry):
-            if self.delegate:
-                try:
-                    self.delegate(entry)
-                except:
-                    log.err()
-            else:
-                pass
-
-        d = self.api(onEntry, self.args)
+            self.metrics.increment('monitor.entries')
+            itemID = None
+            if self.checkpoint is not None or self.backfill is not None:
+                itemID = backfill.entryID(entry)
+                if (lastID is not None and itemID is not None and
+                    itemID <= lastID):
+                    # Replayed by the stream, already delivered before.
+                    self.metrics.increment('monitor.duplicates')
+                    return
+            self._deliver(entry, itemID)
+
+        d = self.api(onEntry, args)
         d.addCallback(responseReceived)
         d.addErrback(trapError)
 
@@ -1154,6 +1736,7 @@ class TwitterMonitor(service.Service):
 
         If there was a failure, A reconnect will be attempted.
         """
+        self._saveCheckpoint(force=True)
         if reason:
             self._toState('error', reason)
         else:
@@ -1178,7 +1761,8 @@ class TwitterMonitor(service.Service):
         Wait for L{delay} seconds until attempting a new connect.
         """
         if self.noisy:
-            log.msg("Reconnecting in %0.2f seconds" % (self._delay,))
+            delay = self._reconnectDelayedCall.getTime() - self.reactor.seconds()
+            log.msg("Reconnecting in %0.2f seconds" % (delay,))
 
 
     def _state_error(self, reason):
@@ -1190,15 +1774,20 @@ class TwitterMonitor(service.Service):
         log.err(reason)
 
         def matchException(failure):
+            match = 'other'
+            depth = 0
             for errorState, backOff in self.backOffs.iteritems():
                 if 'errorTypes' not in backOff:
                     continue
-                if failure.check(*backOff['errorTypes']):
-                    return errorState
+                errorType = failure.check(*backOff['errorTypes'])
+                if errorType and len(errorType.__mro__) > depth:
+                    match = errorState
+                    depth = len(errorType.__mro__)
 
-            return 'other'
+            return match
 
         errorState = matchException(reason)
-        self._reconnect(errorState)
+        self.metrics.increment('monitor.errors.%s' % errorState)
+        self._reconnect(errorState, reason)
 
 # vim: set expandtab:
@@ -260,7 +260,9 @@ class Parser(sux.XMLParser):
     def write(self, b):
         self.dataReceived(b)
     def close(self):
-        self.connectionLost(error.ConnectionDone())
+        # Nothing was written for error responses.
+        if self.state is not None:
+            self.connectionLost(error.ConnectionDone())
     def open(self):
         pass
     def read(self):
@@ -284,7 +286,7 @@ class Parser(sux.XMLParser):
         elif data[0] == '#':
             self.data.append('&' + data + ';')
         else:
-            logger.error("Unhandled entity reference: %s\n" % (data))
+            logger.error("Unhandled entity reference: %s", data)
 
 
 def listParser(list_type, delegate, extra_args=None):